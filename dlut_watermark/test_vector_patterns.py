@@ -0,0 +1,47 @@
+"""
+矢量底纹测试：同尺寸页面共用一个 Form XObject，文件增量与页数基本无关，文字层保留
+"""
+
+import fitz
+
+import vector_patterns
+
+
+def make_text_pdf(pages):
+    """生成带文字层的测试 PDF（最后一页为横向，另一页旋转 90 度后与其同尺寸）"""
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Exam page {i}\n" + "Line of text.\n" * 20, fontsize=11)
+    doc.new_page(width=842, height=595).insert_text((72, 72), "Landscape page", fontsize=11)
+    doc[0].set_rotation(90)
+    return doc.tobytes()
+
+
+def test_vector_patterns():
+    added = {}
+    for pages in (2, 20):
+        source = make_text_pdf(pages)
+        doc = fitz.open(stream=source, filetype='pdf')
+        kinds = vector_patterns.add_vector_patterns(doc, sine_wave=True)
+        output = doc.tobytes(garbage=3, deflate=True)
+        added[pages] = len(output) - len(source)
+
+        # 纵向页面一种底纹；旋转后的第一页与横向页面可见尺寸相同，共用另一种
+        assert kinds == 2
+
+        result = fitz.open(stream=output, filetype='pdf')
+        shared = {xref for page in result for xref, name, *_ in page.get_xobjects()
+                  if name == 'fullpage'}
+        assert len(shared) == kinds
+        assert f"Exam page {pages - 1}" in result[pages - 1].get_text()
+        assert "Landscape page" in result[pages].get_text()
+
+    print(f"2 页增加 {added[2] / 1024:.1f} KB，20 页增加 {added[20] / 1024:.1f} KB")
+    # 每多一页只增加一个引用（约几百字节），底纹本身不随页数重复
+    assert added[20] - added[2] < 18 * 1024
+
+
+if __name__ == "__main__":
+    test_vector_patterns()
+    print("Success: vector patterns shared across pages")
@@ -0,0 +1,339 @@
+"""
+矢量底纹生成器
+把 Guilloche 底纹和正弦波防复印底纹输出为 PDF 矢量路径，
+每种页面尺寸只在文档中定义一次（Form XObject），各页通过 show_pdf_page 引用。
+矢量底纹与分辨率无关，无需栅格化，每份文档只增加几 KB。
+
+曲线公式与 watermark_helper/image_processor.py 中的
+generate_guilloche_pattern、add_anti_copy_pattern('sine_wave') 一致，
+原算法以像素为单位，这里按 REFERENCE_DPI 换算为 pt。
+所有曲线都是周期的，每条只写一个周期，由 PDF 平铺图案（Tiling Pattern）重复。
+"""
+
+import math
+
+import fitz  # pymupdf
+
+
+# 原算法的参数按此分辨率下的像素定义（200 DPI 下与栅格版本外观一致）
+REFERENCE_DPI = 200
+
+# 每个正弦周期用几段三次贝塞尔曲线近似（6 段时误差小于振幅的 0.1%）
+SEGMENTS_PER_PERIOD = 6
+
+# 只需要单份（不重复）的方向上使用的平铺步长（pt），大于任何页面尺寸
+SINGLE_COPY_STEP = 14400
+
+
+def _fmt(value):
+    """格式化坐标（两位小数，去掉多余的 0）"""
+    text = f"{value:.2f}".rstrip('0').rstrip('.')
+    return text if text not in ('', '-0') else '0'
+
+
+def _bezier_path(point, derivative, t_start, t_end, segments, transform):
+    """
+    用三次贝塞尔曲线近似参数曲线，生成描边操作符
+
+    每段按两端的点和切线构造控制点（Hermite 插值）
+
+    参数:
+        point: t → (x, y)
+        derivative: t → (dx/dt, dy/dt)
+        t_start, t_end: 参数范围
+        segments: 分段数
+        transform: (x, y) → (x', y')，把曲线坐标映射到 PDF 坐标（必须是线性的）
+
+    返回:
+        (操作符字符串, 包围盒 (x0, y0, x1, y1))
+    """
+    step = (t_end - t_start) / segments
+    origin = transform(0, 0)
+
+    def mapped(t):
+        x, y = point(t)
+        dx, dy = derivative(t)
+        tx, ty = transform(dx, dy)
+        return transform(x, y), (tx - origin[0], ty - origin[1])
+
+    (x, y), (dx, dy) = mapped(t_start)
+    ops = [f"{_fmt(x)} {_fmt(y)} m"]
+    # 贝塞尔曲线落在控制点的凸包内，控制点的包围盒即曲线的包围盒
+    xs, ys = [x], [y]
+    for index in range(1, segments + 1):
+        (nx, ny), (ndx, ndy) = mapped(t_start + index * step)
+        controls = [(x + dx * step / 3, y + dy * step / 3),
+                    (nx - ndx * step / 3, ny - ndy * step / 3),
+                    (nx, ny)]
+        ops.append(" ".join(f"{_fmt(cx)} {_fmt(cy)}" for cx, cy in controls) + " c")
+        xs.extend(cx for cx, _ in controls)
+        ys.extend(cy for _, cy in controls)
+        x, y, dx, dy = nx, ny, ndx, ndy
+    ops.append("S")
+    return "\n".join(ops), (min(xs), min(ys), max(xs), max(ys))
+
+
+def _sine_curve(base, amplitude, frequency, phase, horizontal):
+    """沿 x（或 y）方向的正弦曲线，返回 (point, derivative)"""
+    omega = 2 * math.pi * frequency
+
+    def point(t):
+        offset = base + amplitude * math.sin(omega * t + phase)
+        return (t, offset) if horizontal else (offset, t)
+
+    def derivative(t):
+        slope = amplitude * omega * math.cos(omega * t + phase)
+        return (1, slope) if horizontal else (slope, 1)
+
+    return point, derivative
+
+
+def guilloche_curves(width, height, density=20):
+    """
+    计算 Guilloche 底纹的曲线（像素坐标，原点在左上角）
+
+    参数:
+        width: 页面宽度（像素）
+        height: 页面高度（像素）
+        density: 底纹密度（曲线数量）
+
+    返回:
+        曲线列表，每条为 (方向, point, derivative, 周期, 振幅)，
+        方向为 'horizontal' / 'vertical' / 'diagonal'
+    """
+    curves = []
+
+    # 水平方向的正弦曲线
+    num_h_curves = max(5, int(density * 0.5))
+    for curve_idx in range(num_h_curves):
+        base_y = (curve_idx + 1) * height / (num_h_curves + 1)
+        frequency = 0.01 + (curve_idx % 3) * 0.005
+        amplitude = 10 + (curve_idx % 5) * 5
+        phase = curve_idx * 0.5
+        curves.append(('horizontal',)
+                      + _sine_curve(base_y, amplitude, frequency, phase, True)
+                      + (1 / frequency, amplitude))
+
+    # 垂直方向的正弦曲线
+    num_v_curves = max(5, int(density * 0.5))
+    for curve_idx in range(num_v_curves):
+        base_x = (curve_idx + 1) * width / (num_v_curves + 1)
+        frequency = 0.01 + (curve_idx % 3) * 0.005
+        amplitude = 10 + (curve_idx % 5) * 5
+        phase = curve_idx * 0.7
+        curves.append(('vertical',)
+                      + _sine_curve(base_x, amplitude, frequency, phase, False)
+                      + (1 / frequency, amplitude))
+
+    # 对角线方向的正弦曲线（每个周期沿对角线平移 (T, T)）
+    num_d_curves = max(3, int(density * 0.3))
+    for curve_idx in range(num_d_curves):
+        frequency = 0.02 + (curve_idx % 2) * 0.01
+        amplitude = 15 + (curve_idx % 4) * 8
+        phase = curve_idx * 1.2
+        omega = 2 * math.pi * frequency
+
+        def point(t, amplitude=amplitude, omega=omega, phase=phase):
+            return (t + amplitude * math.sin(omega * t + phase),
+                    t + amplitude * math.cos(omega * t + phase + 0.5))
+
+        def derivative(t, amplitude=amplitude, omega=omega, phase=phase):
+            return (1 + amplitude * omega * math.cos(omega * t + phase),
+                    1 - amplitude * omega * math.sin(omega * t + phase + 0.5))
+
+        curves.append(('diagonal', point, derivative, 1 / frequency, amplitude))
+
+    return curves
+
+
+def guilloche_tiles(width_pt, height_pt, density=20, reference_dpi=REFERENCE_DPI):
+    """
+    把 Guilloche 底纹的每条曲线转换为一个平铺单元
+
+    单元在重复方向上正好一个周期宽，相邻单元首尾相接拼出整条曲线
+
+    参数:
+        width_pt: 页面宽度（pt）
+        height_pt: 页面高度（pt）
+        density: 底纹密度
+        reference_dpi: 原算法像素参数对应的分辨率
+
+    返回:
+        [(内容流, 包围盒, (x_step, y_step), 图案矩阵), ...]（单位 pt）
+    """
+    scale = 72.0 / reference_dpi
+    tiles = []
+
+    for direction, point, derivative, period, amplitude in guilloche_curves(
+            width_pt / scale, height_pt / scale, density):
+        step = period * scale
+        periods = 0
+        matrix = None
+
+        if direction == 'diagonal':
+            # 错切矩阵 [1 -1 0 1] 把图案空间的 x 方向映射为 PDF 中的 (1, -1)，
+            # 平铺步长 (T, 0) 即沿对角线的一个周期
+            matrix = (1, -1, 0, 1, 0, 0)
+            steps = (step, SINGLE_COPY_STEP)
+            # 曲线在 x 方向来回摆动，单元内要多画几个周期，裁剪后才不缺段
+            periods = math.ceil(amplitude / period)
+
+            def transform(x, y):
+                return x * scale, height_pt - y * scale + x * scale
+        else:
+            # 像素坐标（左上原点）→ PDF 坐标（左下原点）
+            steps = (step, SINGLE_COPY_STEP) if direction == 'horizontal' \
+                else (SINGLE_COPY_STEP, step)
+
+            def transform(x, y):
+                return x * scale, height_pt - y * scale
+
+        content, (x0, y0, x1, y1) = _bezier_path(
+            point, derivative, -periods * period, (periods + 1) * period,
+            (2 * periods + 1) * SEGMENTS_PER_PERIOD, transform
+        )
+        # 重复方向上裁剪为一个周期，另一方向留出线宽
+        if direction == 'vertical':
+            bbox = (x0 - scale, height_pt - step, x1 + scale, height_pt)
+        else:
+            bbox = (0, y0 - scale, step, y1 + scale)
+        tiles.append((content, bbox, steps, matrix))
+
+    return tiles
+
+
+def sine_wave_tiles(density=50, reference_dpi=REFERENCE_DPI):
+    """
+    生成正弦波防复印底纹的两个平铺单元（水平波 + 垂直波）
+
+    栅格版本每 2 像素一条正弦线，直接输出路径会有上万条；
+    这里每个方向只定义一个周期、一个行距的单元，由 PDF 平铺图案重复
+
+    参数:
+        density: 底纹密度（波浪频率 = density / 1000 每像素）
+        reference_dpi: 原算法像素参数对应的分辨率
+
+    返回:
+        [(内容流, 包围盒, (x_step, y_step), 图案矩阵), ...]（单位 pt）
+    """
+    scale = 72.0 / reference_dpi
+    wavelength = scale * 1000.0 / max(density, 1)
+    spacing = 2 * scale
+    amplitude = 3 * scale
+
+    # 振幅大于行距，单元内需要画出相邻几行落在本单元中的部分
+    reach = math.ceil(amplitude / spacing) + 1
+    horizontal = []
+    vertical = []
+    for k in range(-reach, reach + 1):
+        point, derivative = _sine_curve(k * spacing, amplitude, 1 / wavelength, 0, True)
+        horizontal.append(_bezier_path(point, derivative, 0, wavelength, SEGMENTS_PER_PERIOD,
+                                       lambda x, y: (x, y))[0])
+        vertical.append(_bezier_path(point, derivative, 0, wavelength, SEGMENTS_PER_PERIOD,
+                                     lambda x, y: (y, x))[0])
+
+    return [("\n".join(horizontal), (0, 0, wavelength, spacing), (wavelength, spacing), None),
+            ("\n".join(vertical), (0, 0, spacing, wavelength), (spacing, wavelength), None)]
+
+
+def _new_stream(doc, dictionary, content):
+    """在文档中创建一个带数据流的间接对象，返回 xref"""
+    xref = doc.get_new_xref()
+    doc.update_object(xref, dictionary)
+    doc.update_stream(xref, content.encode('latin-1'))
+    return xref
+
+
+def _tiling_pattern(doc, tile, setup, resources):
+    """把平铺单元写成 Tiling Pattern 对象，返回 xref"""
+    content, bbox, (x_step, y_step), matrix = tile
+    dictionary = (
+        "<< /Type /Pattern /PatternType 1 /PaintType 1 /TilingType 1 "
+        f"/BBox [{' '.join(_fmt(v) for v in bbox)}] "
+        f"/XStep {_fmt(x_step)} /YStep {_fmt(y_step)} "
+        f"/Resources {resources} "
+    )
+    if matrix:
+        dictionary += f"/Matrix [{' '.join(_fmt(v) for v in matrix)}] "
+    dictionary += ">>"
+    return _new_stream(doc, dictionary, f"{setup}\n{content}")
+
+
+def _pattern_page(doc, width_pt, height_pt, guilloche=True, density=20, color_depth=0.3,
+                  sine_wave=False, sine_density=50, sine_color=(255, 200, 200), sine_alpha=30):
+    """在底纹文档中添加一页矢量底纹（资源和内容流直接写入）"""
+    page = doc.new_page(width=width_pt, height=height_pt)
+    line_width = _fmt(72.0 / REFERENCE_DPI)
+    fill_page = f"0 0 {_fmt(width_pt)} {_fmt(height_pt)} re f"
+
+    layers = []
+    # 防复印底纹在下，Guilloche 在上（与 process_page 的图层顺序一致）
+    if sine_wave:
+        alpha = _fmt(sine_alpha / 255)
+        rgb = " ".join(_fmt(c / 255) for c in sine_color)
+        layers.append((sine_wave_tiles(sine_density),
+                       f"/GS0 gs {rgb} RG {line_width} w",
+                       f"<< /ExtGState << /GS0 << /CA {alpha} /ca {alpha} >> >> >>"))
+
+    if guilloche and density > 0 and color_depth > 0:
+        alpha = _fmt(min(color_depth * 1.2, 1.0))
+        gray = _fmt(1 - color_depth * 0.5)
+        layers.append((guilloche_tiles(width_pt, height_pt, density),
+                       f"/GS0 gs {gray} G {line_width} w 1 J 1 j",
+                       f"<< /ExtGState << /GS0 << /CA {alpha} /ca {alpha} >> >> >>"))
+
+    patterns = []
+    ops = ["/Pattern cs"]
+    for tiles, setup, resources in layers:
+        for tile in tiles:
+            name = f"P{len(patterns)}"
+            patterns.append(f"/{name} {_tiling_pattern(doc, tile, setup, resources)} 0 R")
+            ops.append(f"/{name} scn {fill_page}")
+
+    doc.xref_set_key(page.xref, "Resources", f"<< /Pattern << {' '.join(patterns)} >> >>")
+    contents = _new_stream(doc, "<< >>", "\n".join(ops))
+    doc.xref_set_key(page.xref, "Contents", f"{contents} 0 R")
+    return page.number
+
+
+def add_vector_patterns(doc, guilloche=True, density=20, color_depth=0.3,
+                        sine_wave=False, sine_density=50, overlay=True):
+    """
+    为文档的每一页叠加矢量底纹
+
+    每种页面尺寸的底纹只生成一次（Form XObject），同尺寸页面共用
+
+    参数:
+        doc: fitz.Document 对象（原地修改）
+        guilloche: 是否添加 Guilloche 底纹
+        density: Guilloche 底纹密度
+        color_depth: Guilloche 颜色深度（0-1）
+        sine_wave: 是否添加正弦波防复印底纹（浅红色）
+        sine_density: 正弦波密度
+        overlay: True 画在页面内容上方，False 画在下方
+
+    返回:
+        生成的底纹种类数（不同页面尺寸的数量）
+    """
+    pattern_doc = fitz.open()
+    pages_by_size = {}
+
+    def size_of(page):
+        """页面可见尺寸（page.rect 已含旋转，show_pdf_page 会把底纹正立放到旋转后的页面上）"""
+        return round(page.rect.width, 1), round(page.rect.height, 1)
+
+    # 先生成全部底纹页：show_pdf_page 会缓存源文档的对象映射，之后不能再往源文档添加页面
+    for page in doc:
+        size = size_of(page)
+        if size not in pages_by_size:
+            pages_by_size[size] = _pattern_page(
+                pattern_doc, page.rect.width, page.rect.height, guilloche, density,
+                color_depth, sine_wave, sine_density
+            )
+
+    for page in doc:
+        page.show_pdf_page(page.rect, pattern_doc, pages_by_size[size_of(page)],
+                           overlay=overlay)
+
+    pattern_doc.close()
+    return len(pages_by_size)
@@ -12,13 +12,38 @@ except ImportError as e:
     print("Please install: pip install pymupdf")
     sys.exit(1)
 
-def add_watermark_and_id_to_pdf(input_pdf_path, output_pdf_path, student_id, watermark_text, watermark_size, id_frequency, opacity=0.1, repeats=3):
+import vector_patterns
+
+# --pattern 选项 → (Guilloche 底纹, 正弦波防复印底纹)
+PATTERN_CHOICES = {
+    "none": (False, False),
+    "guilloche": (True, False),
+    "sine_wave": (False, True),
+    "both": (True, True),
+}
+
+def add_watermark_and_id_to_pdf(input_pdf_path, output_pdf_path, student_id, watermark_text, watermark_size, id_frequency, opacity=0.1, repeats=3,
+                                pattern="none", pattern_density=20, pattern_depth=0.3):
     """
     为 PDF 的每一页添加水印和学生 ID。
     opacity: 0.0 到 1.0（透明度）。
     repeats: 水印在垂直方向上重复的次数。
+    pattern: 矢量底纹，"none" / "guilloche" / "sine_wave" / "both"（见 PATTERN_CHOICES）。
+    pattern_density: Guilloche 底纹密度。
+    pattern_depth: Guilloche 颜色深度（0.0 - 1.0）。
     """
     doc = fitz.open(input_pdf_path)
+
+    # 0. 矢量底纹（每种页面尺寸只生成一次，各页共用，画在水印下方）
+    guilloche, sine_wave = PATTERN_CHOICES[pattern]
+    if guilloche or sine_wave:
+        vector_patterns.add_vector_patterns(
+            doc,
+            guilloche=guilloche,
+            density=pattern_density,
+            color_depth=pattern_depth,
+            sine_wave=sine_wave
+        )
     
     # 加载中文字体
     font_path = "/System/Library/Fonts/STHeiti Medium.ttc"
@@ -161,6 +186,10 @@ def main():
     parser.add_argument("--frequency", type=int, default=1, help="每页插入 ID 的次数")
     parser.add_argument("--opacity", type=float, default=0.1, help="水印透明度（0.0 - 1.0）")
     parser.add_argument("--repeats", type=int, default=3, help="每页水印重复次数")
+    parser.add_argument("--pattern", choices=list(PATTERN_CHOICES), default="none",
+                        help="矢量底纹（Guilloche / 正弦波防复印 / 两者）")
+    parser.add_argument("--pattern_density", type=int, default=20, help="Guilloche 底纹密度")
+    parser.add_argument("--pattern_depth", type=float, default=0.3, help="Guilloche 颜色深度（0.0 - 1.0）")
     
     args = parser.parse_args()
     
@@ -178,6 +207,8 @@ def main():
     print(f"正在处理 PDF：{args.file}")
     print(f"水印：'{args.watermark_text}'（大小：{args.fontsize}，透明度：{args.opacity}）")
     print(f"ID 插入：'{args.student_id}'（每页 {args.frequency} 次）")
+    if args.pattern != "none":
+        print(f"矢量底纹：{args.pattern}（密度：{args.pattern_density}，深度：{args.pattern_depth}）")
     
     add_watermark_and_id_to_pdf(
         args.file, 
@@ -187,7 +218,10 @@ def main():
         args.fontsize,
         args.frequency,
         args.opacity,
-        args.repeats
+        args.repeats,
+        args.pattern,
+        args.pattern_density,
+        args.pattern_depth
     )
     
     print(f"完成。已保存至 {output_pdf}")
@@ -8,6 +8,42 @@ import pandas as pd
 import io
 import zipfile
 import image_processor
+from page_cache import PageCache
+from memory_budget import MemoryBudgetExceeded
+from issuance_ledger import IssuanceLedger
+import cost_estimator
+import hybrid_pdf
+import trace_engine
+import buyer_index
+import glyph_classifier
+import page_registration
+
+
+@st.cache_resource
+def get_page_cache():
+    """进程级页面缓存：同一 worker 上的所有会话共享栅格化结果"""
+    return PageCache(max_bytes=1024 * 1024 * 1024)
+
+
+@st.cache_resource
+def get_ledger():
+    """进程级发行台账连接（所有会话共享）"""
+    return IssuanceLedger()
+
+
+# 单份 PDF 超过此体积时提示打印机可能无法处理
+PRINTER_SIZE_WARNING_MB = 30
+
+
+@st.cache_data(show_spinner="正在预估处理成本（处理一页样本）...", max_entries=32)
+def estimate_cost(pdf_bytes, dpi, quality, output_mode, watermark_text,
+                  interference_text, page_options):
+    """按参数缓存单份副本的成本预估（参数不变时不重复处理样本页）"""
+    return cost_estimator.estimate_job(
+        pdf_bytes, copies=1, dpi=dpi, quality=quality, output_mode=output_mode,
+        watermark_text=watermark_text, interference_text=interference_text,
+        **dict(page_options)
+    )
 
 
 def main():
@@ -132,7 +168,7 @@ def main():
         st.markdown("**空间溯源系统**")
         st.info("""
         **字符-坐标映射溯源：**
-        - 基于买家 ID 生成 4 位特征码
+        - 基于买家 ID 生成 4~8 位特征码（买家越多位数越长）
         - 可见：装订线竖排小字（像批次号）
         - 隐形：特定坐标的微型黑点（2x2像素）
         - 查盗版：对照解密卡拼出特征码
@@ -148,7 +184,7 @@ def main():
             enable_visible_code = st.checkbox(
                 "启用装订线可见码",
                 value=True,
-                help="在左侧装订线区域竖排打印 4 位特征码"
+                help="在左侧装订线区域竖排打印特征码"
             )
 
             enable_invisible_dots = st.checkbox(
@@ -163,6 +199,15 @@ def main():
                 help="在左侧绘制装订线图案（点和线），实则是二进制编码买家信息"
             )
 
+            code_length = st.selectbox(
+                "特征码位数",
+                options=(['auto'] if work_mode == 'batch' else []) +
+                        list(image_processor.SUPPORTED_CODE_LENGTHS),
+                format_func=lambda value: "自动（按买家数量）" if value == 'auto' else f"{value} 位",
+                help="位数越多撞码概率越低：4 位适合几千位买家以内，"
+                     "自动模式按买家数量选择撞码概率低于 1% 的位数。溯源时自动识别位数"
+            )
+
             # 生成解密卡按钮
             st.markdown("**解密工具**")
             if st.button("生成解密对照卡", key="sidebar_generate_map", use_container_width=True):
@@ -217,6 +262,19 @@ def main():
 
         st.divider()
 
+        # 混合模式：保留原 PDF 文字层，只叠加共享的防护图层
+        keep_text_layer = False
+        if work_mode == 'single':
+            keep_text_layer = st.checkbox(
+                "保留文字层（混合模式）",
+                value=False,
+                disabled=hybrid_pdf.fitz is None,
+                help="不栅格化原 PDF，只把底纹和水印渲染一次叠加到每一页，"
+                     "文件小、速度快且与页数无关；但文字仍可复制，"
+                     "水波纹、噪点、干扰线和溯源标记不生效（填写买家并启用空间溯源时"
+                     "自动改为栅格化）。需要安装 PyMuPDF"
+            )
+
         # 高级算法参数
         st.subheader("高级算法（核心）")
 
@@ -364,14 +422,31 @@ def main():
         st.subheader("压缩与优化")
         st.markdown("**控制输出文件体积**")
 
+        output_mode_labels = {
+            'grayscale': "灰度（推荐，减少 2/3 体积）",
+            'color': "彩色",
+            'bilevel': "黑白二值（CCITT G4，文本页体积最小）",
+            'mrc': "分层压缩（MRC，清晰文字 + 低分辨率底纹）",
+        }
         output_mode = st.selectbox(
             "输出模式",
-            options=['grayscale', 'color'],
+            options=['grayscale', 'color', 'bilevel', 'mrc'],
             index=0,  # 默认选择灰度
-            format_func=lambda x: "灰度（推荐，减少 2/3 体积）" if x == 'grayscale' else "彩色",
-            help="灰度模式可大幅减小文件体积，适合黑白文档打印"
+            format_func=output_mode_labels.get,
+            help="灰度模式可大幅减小文件体积，适合黑白文档打印；"
+                 "黑白二值模式适合纯文本试卷，浅色底纹会被去除，溯源标记和水印仍会保留；"
+                 "分层压缩模式文字保持全分辨率，底纹和水印以低分辨率背景保留"
         )
 
+        threshold_method = 'otsu'
+        if output_mode in ('bilevel', 'mrc'):
+            threshold_method = st.selectbox(
+                "二值化方法",
+                options=['otsu', 'adaptive'],
+                format_func=lambda x: "全局阈值（Otsu）" if x == 'otsu' else "局部自适应阈值",
+                help="底纹深浅不均、全局阈值丢字时改用局部自适应阈值"
+            )
+
         dpi = st.selectbox(
             "输出 DPI（分辨率）",
             options=[150, 200, 300],
@@ -389,16 +464,66 @@ def main():
             help="质量越高文件越大。75 是质量与体积的平衡点"
         )
 
+        target_size_mb = st.number_input(
+            "目标体积（MB，单份）",
+            min_value=0.0,
+            max_value=500.0,
+            value=0.0,
+            step=1.0,
+            help="设置后自动抽样选择压缩质量，使单份 PDF 不超过该体积（忽略上面的质量滑块）。"
+                 "0 表示按上面的质量压缩"
+        )
+
+        allow_dpi_reduction = False
+        if target_size_mb:
+            allow_dpi_reduction = st.checkbox(
+                "必要时降低 DPI",
+                value=False,
+                help="最低质量仍超出目标体积时，逐级降低输出分辨率"
+            )
+
+        max_part_mb = st.number_input(
+            "分卷体积上限（MB）",
+            min_value=0.0,
+            max_value=500.0,
+            value=0.0,
+            step=5.0,
+            help="打印机内存有限时，把输出拆分为多个不超过该体积的 PDF，"
+                 "按文件名顺序打印即可。0 表示不拆分"
+        )
+
+        max_pages_per_part = st.number_input(
+            "分卷页数上限",
+            min_value=0,
+            max_value=5000,
+            value=0,
+            step=10,
+            help="每个分卷最多包含的页数。0 表示不限制"
+        )
+
+        max_rss_mb = st.number_input(
+            "内存上限（MB）",
+            min_value=0,
+            max_value=65536,
+            value=2048,
+            step=256,
+            help="按页面尺寸和 DPI 估算内存开销，自动调整每次栅格化的页数和并发数；"
+                 "放不下时在栅格化之前直接报错。0 表示不限制"
+        )
+
         # 显示预估说明
         st.info(f"""
         **当前设置预估：**
-        - 模式：{'灰度（省空间）' if output_mode == 'grayscale' else '彩色（体积大）'}
+        - 模式：{output_mode_labels[output_mode]}
         - 分辨率：{dpi} DPI
         - 质量：{quality}%
 
         推荐组合：灰度 + 200 DPI + 75% 质量
         """)
 
+        # 上传文件后在此显示成本预估（随参数变化实时更新）
+        estimate_placeholder = st.empty()
+
     # ========================================================================
     # 主界面 - 根据模式显示不同内容
     # ========================================================================
@@ -440,6 +565,7 @@ def main():
         # ====================================================================
         # 批量发行模式
         # ====================================================================
+        num_copies = 1
         left_col, right_col = st.columns([1, 1])
 
         with left_col:
@@ -470,6 +596,7 @@ def main():
                         st.error("名单文件必须包含 'name' 和 'phone' 两列！")
                     else:
                         st.success(f"已加载 {len(df)} 位买家信息")
+                        num_copies = len(df)
                         st.dataframe(df.head(5))
 
                         if len(df) > 5:
@@ -490,6 +617,15 @@ def main():
                 help="用空格分隔多个干扰词"
             )
 
+            shared_pages = st.checkbox(
+                "共享页面快速发行",
+                value=False,
+                disabled=output_mode not in ('grayscale', 'color'),
+                help="底纹、扭曲、噪点等与买家无关的图层只处理一次，所有副本共用同一组页面图像，"
+                     "每位买家只叠加水印、干扰字符和溯源标记。买家越多提速越明显；"
+                     "噪点和干扰线在各副本中相同。仅支持灰度 / 彩色输出"
+            )
+
         with right_col:
             st.subheader("批量处理说明")
             st.info("""
@@ -634,12 +770,70 @@ def main():
             st.markdown("如果自动识别失败，可以手动输入特征码：")
 
             manual_code = st.text_input(
-                "手动输入4位特征码",
+                "手动输入特征码（4~8 位）",
                 placeholder="例如：W3MK",
                 help="查看 PDF 左侧装订线的竖排小字",
                 key="manual_trace_code"
             )
 
+    # ========================================================================
+    # 侧边栏 - 处理成本预估
+    # ========================================================================
+    if work_mode != 'trace' and uploaded_file:
+        if work_mode == 'single':
+            copies = 1
+            if buyer_name and buyer_phone:
+                sample_watermark = f"{buyer_name} {buyer_phone}"
+                sample_buyer_id = f"{buyer_name}_{buyer_phone}"
+            else:
+                sample_watermark = watermark_text
+                sample_buyer_id = None
+            density_options = (('watermark_density', 'normal'),
+                               ('watermark_color', (128, 128, 128)),
+                               ('watermark_alpha', 80))
+        else:
+            copies = num_copies
+            sample_watermark = watermark_template.format(name='张三', phone='13800138000')
+            sample_buyer_id = "张三_13800138000"
+            density_options = (('watermark_density', 'very_dense'),
+                               ('watermark_color', (200, 200, 200)),
+                               ('watermark_alpha', 60))
+
+        page_options = (
+            ('ripple_amplitude', ripple_amplitude),
+            ('ripple_frequency', ripple_frequency),
+            ('guilloche_density', guilloche_density),
+            ('guilloche_color_depth', guilloche_color_depth),
+            ('noise_level', noise_level),
+            ('num_lines', num_lines),
+            ('num_interference', num_interference),
+            ('watermark_font_size', watermark_font_size),
+            ('enable_anti_copy', enable_anti_copy),
+            ('anti_copy_pattern', anti_copy_pattern if enable_anti_copy else 'dot_matrix'),
+            ('anti_copy_density', anti_copy_density if enable_anti_copy else 50),
+            ('buyer_id', sample_buyer_id),
+            ('enable_spatial_tracking', enable_spatial_tracking),
+            ('enable_binding_line', enable_spatial_tracking and enable_binding_line),
+        ) + density_options
+
+        with estimate_placeholder.container():
+            try:
+                estimate = estimate_cost(
+                    uploaded_file.getvalue(), dpi, quality, output_mode,
+                    sample_watermark if enable_watermark else "",
+                    interference_text if enable_interference_text else "",
+                    page_options
+                ).with_copies(copies)
+
+                estimate_lines = "\n".join(f"- {line}" for line in estimate.describe().split("\n"))
+                st.info(f"**处理成本预估：**\n\n{estimate_lines}")
+
+                if estimate.copy_bytes > PRINTER_SIZE_WARNING_MB * 1024 * 1024:
+                    st.warning(f"单份 PDF 预计超过 {PRINTER_SIZE_WARNING_MB} MB，"
+                               f"打印机可能无法处理，建议降低 DPI 或质量")
+            except Exception as e:
+                st.caption(f"成本预估不可用：{str(e)}")
+
     st.divider()
 
     # ========================================================================
@@ -699,36 +893,68 @@ def main():
 
                 actual_interference_text = interference_text if enable_interference_text else ""
 
+                # 混合模式不写入溯源标记和发行台账，买家副本启用空间溯源时改为栅格化
+                tracked = bool(buyer_id) and 'enable_spatial_tracking' in locals() and enable_spatial_tracking
+                if keep_text_layer and tracked:
+                    st.warning("混合模式无法写入溯源标记和发行台账，已改为栅格化处理")
+                    keep_text_layer = False
+
                 # 显示处理进度
                 with st.spinner("正在处理 PDF，请稍候..."):
-                    # 调用 image_processor 模块处理 PDF
-                    output_pdf, preview_images = image_processor.process_pdf(
-                        pdf_bytes,
-                        actual_watermark_text,
-                        actual_interference_text,
-                        ripple_amplitude=ripple_amplitude,
-                        ripple_frequency=ripple_frequency,
-                        guilloche_density=guilloche_density,
-                        guilloche_color_depth=guilloche_color_depth,
-                        noise_level=noise_level,
-                        num_lines=num_lines,
-                        num_interference=num_interference,
-                        watermark_font_size=watermark_font_size if enable_watermark else 60,
-                        output_mode=output_mode,
-                        dpi=dpi,
-                        quality=quality,
-                        # 防复印底纹参数
-                        enable_anti_copy=enable_anti_copy if 'enable_anti_copy' in locals() else False,
-                        anti_copy_pattern=anti_copy_pattern if 'anti_copy_pattern' in locals() else 'dot_matrix',
-                        anti_copy_density=anti_copy_density if 'anti_copy_density' in locals() else 50,
-                        # 空间溯源参数
-                        buyer_id=buyer_id,
-                        enable_spatial_tracking=enable_spatial_tracking if 'enable_spatial_tracking' in locals() else False,
-                        enable_visible_code=enable_visible_code if 'enable_visible_code' in locals() else True,
-                        enable_invisible_dots=enable_invisible_dots if 'enable_invisible_dots' in locals() else True,
-                        enable_binding_line=enable_binding_line if 'enable_binding_line' in locals() else False,
-                        progress_callback=show_progress
-                    )
+                    if keep_text_layer:
+                        # 混合模式：底纹和水印作为共享图像 XObject 叠加在原页面上
+                        output_pdf = hybrid_pdf.apply_hybrid_protection(
+                            pdf_bytes,
+                            guilloche_density=guilloche_density,
+                            guilloche_color_depth=guilloche_color_depth,
+                            enable_anti_copy=enable_anti_copy if 'enable_anti_copy' in locals() else False,
+                            anti_copy_pattern=anti_copy_pattern if 'anti_copy_pattern' in locals() else 'dot_matrix',
+                            anti_copy_density=anti_copy_density if 'anti_copy_density' in locals() else 50,
+                            watermark_text=actual_watermark_text,
+                            watermark_font_size=watermark_font_size if enable_watermark else 60,
+                            progress_callback=show_progress
+                        )
+                        preview_images = {'original': None, 'processed': None}
+                    else:
+                        # 调用 image_processor 模块处理 PDF
+                        output_pdf, preview_images = image_processor.process_pdf(
+                            pdf_bytes,
+                            actual_watermark_text,
+                            actual_interference_text,
+                            ripple_amplitude=ripple_amplitude,
+                            ripple_frequency=ripple_frequency,
+                            guilloche_density=guilloche_density,
+                            guilloche_color_depth=guilloche_color_depth,
+                            noise_level=noise_level,
+                            num_lines=num_lines,
+                            num_interference=num_interference,
+                            watermark_font_size=watermark_font_size if enable_watermark else 60,
+                            output_mode=output_mode,
+                            dpi=dpi,
+                            quality=quality,
+                            # 防复印底纹参数
+                            enable_anti_copy=enable_anti_copy if 'enable_anti_copy' in locals() else False,
+                            anti_copy_pattern=anti_copy_pattern if 'anti_copy_pattern' in locals() else 'dot_matrix',
+                            anti_copy_density=anti_copy_density if 'anti_copy_density' in locals() else 50,
+                            # 空间溯源参数
+                            buyer_id=buyer_id,
+                            enable_spatial_tracking=enable_spatial_tracking if 'enable_spatial_tracking' in locals() else False,
+                            enable_visible_code=enable_visible_code if 'enable_visible_code' in locals() else True,
+                            enable_invisible_dots=enable_invisible_dots if 'enable_invisible_dots' in locals() else True,
+                            enable_binding_line=enable_binding_line if 'enable_binding_line' in locals() else False,
+                            code_length=code_length if 'code_length' in locals() else image_processor.DEFAULT_CODE_LENGTH,
+                            page_cache=get_page_cache(),
+                            max_rss_mb=max_rss_mb or None,
+                            target_size_mb=target_size_mb or None,
+                            allow_dpi_reduction=allow_dpi_reduction,
+                            max_part_mb=max_part_mb or None,
+                            max_pages_per_part=max_pages_per_part or None,
+                            threshold_method=threshold_method,
+                            part_stem=f"protected_{uploaded_file.name.rsplit('.', 1)[0]}",
+                            # 填写了买家信息的副本记入发行台账
+                            ledger=get_ledger() if buyer_id else None,
+                            progress_callback=show_progress
+                        )
 
                 progress_text.empty()
                 st.success("PDF 处理完成！")
@@ -752,21 +978,42 @@ def main():
                             processed_preview.thumbnail((400, 600))
                             st.image(processed_preview, use_container_width=True)
 
-                # 计算文件大小
-                output_size_mb = len(output_pdf.getvalue()) / (1024 * 1024)
+                if isinstance(output_pdf, list):
+                    # 分卷输出：打包为 ZIP 一次下载
+                    part_sizes = [len(part.getvalue()) / (1024 * 1024) for _, part in output_pdf]
+                    zip_buffer = image_processor.package_parts(output_pdf)
+                    output_size_mb = len(zip_buffer.getvalue()) / (1024 * 1024)
+
+                    st.download_button(
+                        label=f"下载全部 {len(output_pdf)} 个分卷（ZIP 压缩包，{output_size_mb:.2f} MB）",
+                        data=zip_buffer,
+                        file_name=f"protected_{uploaded_file.name.rsplit('.', 1)[0]}_parts.zip",
+                        mime="application/zip",
+                        type="primary",
+                        use_container_width=True
+                    )
+                    st.caption("分卷：" + "，".join(
+                        f"{name}（{size:.2f} MB）" for (name, _), size in zip(output_pdf, part_sizes)
+                    ))
+                else:
+                    # 计算文件大小
+                    output_size_mb = len(output_pdf.getvalue()) / (1024 * 1024)
 
-                # 提供下载
-                st.download_button(
-                    label=f"下载处理后的 PDF ({output_size_mb:.2f} MB)",
-                    data=output_pdf,
-                    file_name=f"protected_{uploaded_file.name}",
-                    mime="application/pdf",
-                    type="primary",
-                    use_container_width=True
-                )
+                    # 提供下载
+                    st.download_button(
+                        label=f"下载处理后的 PDF ({output_size_mb:.2f} MB)",
+                        data=output_pdf,
+                        file_name=f"protected_{uploaded_file.name}",
+                        mime="application/pdf",
+                        type="primary",
+                        use_container_width=True
+                    )
 
                 # 构建防护措施列表
-                protection_layers = ["矢量转栅格化（{} DPI）- 防止直接复制文字".format(dpi)]
+                if keep_text_layer:
+                    protection_layers = ["混合模式 - 保留原文字层，底纹与水印作为共享图层叠加"]
+                else:
+                    protection_layers = ["矢量转栅格化（{} DPI）- 防止直接复制文字".format(dpi)]
 
                 if enable_guilloche and guilloche_density > 0:
                     protection_layers.append("Guilloche 高频底纹 - 类钞票级防伪背景")
@@ -808,7 +1055,7 @@ def main():
                 """
                     if 'enable_spatial_tracking' in locals() and enable_spatial_tracking:
                         from image_processor import generate_feature_code
-                        feature_code = generate_feature_code(buyer_id)
+                        feature_code = generate_feature_code(buyer_id, code_length)
                         tracing_info += f"- 特征码：{feature_code}\n"
 
                 st.success(f"""
@@ -819,9 +1066,9 @@ def main():
                 **防护等级：企业级**
                 {tracing_info}
                 **压缩信息：**
-                - 输出模式：{'灰度' if output_mode == 'grayscale' else '彩色'}
+                - 输出模式：{output_mode_labels[output_mode]}
                 - 分辨率：{dpi} DPI
-                - JPEG 质量：{quality}%
+                - JPEG 质量：{f'自动（目标 {target_size_mb:g} MB）' if target_size_mb else f'{quality}%'}
                 - 文件大小：{output_size_mb:.2f} MB
                 """)
 
@@ -860,6 +1107,7 @@ def main():
                         enable_visible_code=enable_visible_code if 'enable_visible_code' in locals() else True,
                         enable_invisible_dots=enable_invisible_dots if 'enable_invisible_dots' in locals() else True,
                         enable_binding_line=enable_binding_line if 'enable_binding_line' in locals() else False,
+                        code_length=code_length if 'code_length' in locals() else image_processor.DEFAULT_CODE_LENGTH,
                         ripple_amplitude=ripple_amplitude,
                         ripple_frequency=ripple_frequency,
                         guilloche_density=guilloche_density,
@@ -871,6 +1119,15 @@ def main():
                         output_mode=output_mode,
                         dpi=dpi,
                         quality=quality,
+                        page_cache=get_page_cache(),
+                        max_rss_mb=max_rss_mb or None,
+                        target_size_mb=target_size_mb or None,
+                        allow_dpi_reduction=allow_dpi_reduction,
+                        max_part_mb=max_part_mb or None,
+                        max_pages_per_part=max_pages_per_part or None,
+                        threshold_method=threshold_method,
+                        shared_pages=shared_pages and output_mode in ('grayscale', 'color'),
+                        ledger=get_ledger(),
                         progress_callback=show_progress
                     )
 
@@ -881,6 +1138,11 @@ def main():
                 zip_buffer = io.BytesIO()
                 with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
                     for customer_id, (pdf_bytesio, customer_info) in results.items():
+                        if isinstance(pdf_bytesio, list):
+                            # 分卷：0001_张三/0001_张三_01of03.pdf
+                            for part_name, part in pdf_bytesio:
+                                zip_file.writestr(f"{customer_id}/{part_name}", part.getvalue())
+                            continue
                         # 文件名：0001_张三.pdf
                         file_name = f"{customer_id}.pdf"
                         zip_file.writestr(file_name, pdf_bytesio.getvalue())
@@ -903,7 +1165,7 @@ def main():
                 if 'enable_spatial_tracking' in locals() and enable_spatial_tracking:
                     spatial_tracking_info = f"""
                 **空间溯源系统（已启用）：**
-                - 每份 PDF 包含基于买家 ID 的 4 位特征码
+                - 每份 PDF 包含基于买家 ID 的特征码
                 - {'已启用' if enable_visible_code else '未启用'}装订线可见码（竖排小字）
                 - {'已启用' if enable_invisible_dots else '未启用'}隐形位置点（2x2 像素黑点）
                 - 通过解密卡可识别盗版来源
@@ -922,7 +1184,7 @@ def main():
                 - 每份 PDF 包含买家专属溯源水印
                 - 姓名 + 手机号高密度平铺
                 - {'已启用' if enable_anti_copy else '未启用'}防复印底纹
-                - 采用灰度压缩（{dpi} DPI，质量 {quality}%）
+                - 采用灰度压缩（{dpi} DPI，{f'目标 {target_size_mb:g} MB/份' if target_size_mb else f'质量 {quality}%'}）
                 {spatial_tracking_info}
                 **心理威慑原理：**
                 如果买家拍照倒卖，其个人隐私（姓名+手机号）会在盗版件中完全暴露，
@@ -932,9 +1194,10 @@ def main():
                 # 显示部分买家清单
                 with st.expander("查看生成的文件列表"):
                     file_list = []
-                    for customer_id, (_, customer_info) in results.items():
+                    for customer_id, (pdf_bytesio, customer_info) in results.items():
                         file_list.append({
-                            '文件名': f"{customer_id}.pdf",
+                            '文件名': f"{customer_id}/（{len(pdf_bytesio)} 个分卷）"
+                                      if isinstance(pdf_bytesio, list) else f"{customer_id}.pdf",
                             '姓名': customer_info['name'],
                             '手机号': customer_info['phone']
                         })
@@ -949,17 +1212,6 @@ def main():
                 # 读取PDF
                 pdf_bytes = pirated_pdf.read()
 
-                # 转换为图像
-                from pdf2image import convert_from_bytes
-                images = convert_from_bytes(pdf_bytes, dpi=200)
-
-                if not images:
-                    st.error("PDF 没有页面")
-                    return
-
-                first_page = images[0]
-                st.success(f"PDF 页数: {len(images)}，图像尺寸: {first_page.size}")
-
                 # 尝试识别特征码
                 feature_code = None
 
@@ -970,60 +1222,130 @@ def main():
                 else:
                     st.info("开始自动识别特征码...")
 
-                    # 方法：检测隐形位置点（简化版，不依赖OCR）
-                    width, height = first_page.size
-                    pixels = first_page.load()
-
-                    # 计算缩放比例
-                    scale_x = width / 2480
-                    scale_y = height / 3508
-
-                    detected_chars = []
-
-                    # 遍历所有字符的坐标位置
-                    for char, (std_x, std_y) in sorted(image_processor.CHAR_POSITION_MAP.items()):
-                        # 缩放到实际图像尺寸
-                        actual_x = int(std_x * scale_x)
-                        actual_y = int(std_y * scale_y)
-
-                        # 确保坐标在范围内
-                        if actual_x < 0 or actual_x >= width - 2 or actual_y < 0 or actual_y >= height - 2:
-                            continue
-
-                        # 检测该位置附近是否有黑点
-                        has_black_dot = False
-                        for dx in range(-1, 2):
-                            for dy in range(-1, 2):
-                                check_x = actual_x + dx
-                                check_y = actual_y + dy
-
-                                if 0 <= check_x < width and 0 <= check_y < height:
-                                    pixel = pixels[check_x, check_y]
-
-                                    # 检查是否为黑色或深色
-                                    if isinstance(pixel, tuple):
-                                        if len(pixel) >= 3 and sum(pixel[:3]) < 50 * 3:
-                                            has_black_dot = True
-                                            break
-                                    elif pixel < 50:  # 灰度图
-                                        has_black_dot = True
-                                        break
-
-                                if has_black_dot:
-                                    break
-
-                        if has_black_dot:
-                            detected_chars.append(char)
-
-                    if len(detected_chars) == 4:
-                        feature_code = ''.join(detected_chars)
+                    # 逐页检测装订线编码和隐形位置点（只渲染页边区域），某个特征码明显领先即停止
+                    # 读不出有序特征码时按扫描件 / 翻拍件配准页面后重试
+                    trace = trace_engine.trace_pdf(pdf_bytes, dpi=200,
+                                                   page_cache=get_page_cache(),
+                                                   progress_callback=show_progress,
+                                                   register='auto')
+
+                    if not trace['page_count']:
+                        st.error("PDF 没有页面")
+                        return
+
+                    structure_note = ''
+                    if trace['source'] == 'structure':
+                        structure_note = ('（PDF 结构标记，已由页面标记证实）' if trace['structure']['confirmed']
+                                          else '（PDF 结构标记，未渲染页面）')
+                    st.success(f"PDF 页数: {trace['page_count']}，已检查 {trace['pages_scanned']} 页"
+                               f"{'（提前结束）' if trace['early_exit'] else ''}"
+                               f"{'（已配准）' if trace['registered'] else ''}"
+                               f"{structure_note}")
+                    if trace['structure'] and not trace['structure']['consistent']:
+                        st.warning("PDF 结构标记各通道不一致，文件可能被篡改，已改用图像溯源")
+                    elif trace['structure'] and trace['structure']['confirmed'] is False:
+                        st.warning(f"PDF 结构标记（{trace['structure']['code']}）未被页面标记证实，"
+                                   f"可能是伪造的令牌，不采信")
+
+                    if trace['source'] in trace_engine.ORDERED_SOURCES:
+                        feature_code = trace['code']
                         st.success(f"自动识别到特征码: {feature_code}")
-                    elif len(detected_chars) > 4:
-                        feature_code = ''.join(detected_chars[:4])
-                        st.warning(f"检测到 {len(detected_chars)} 个可能的字符，使用前4个: {feature_code}")
+                    elif trace['source'] == 'dots':
+                        st.warning(f"只检测到位置点字符（无顺序）: {trace['code']}，请核对装订线后手动输入特征码")
+                        if customer_file:
+                            if customer_file.name.endswith('.csv'):
+                                df = pd.read_csv(customer_file)
+                            else:
+                                df = pd.read_excel(customer_file)
+                            customer_file.seek(0)
+
+                            # 位置点只给出字符集合，按集合差异列出最接近的买家
+                            candidates = buyer_index.find_buyers_by_chars(
+                                trace['code'], df.to_dict('records'))
+                            st.markdown("**字符集合最接近的买家**")
+                            st.dataframe(pd.DataFrame([{
+                                '特征码': candidate['feature_code'],
+                                '姓名': candidate['customer'].get('name', ''),
+                                '手机号': candidate['customer'].get('phone', ''),
+                                '漏检字符': candidate['missing'],
+                                '多出字符': candidate['extra'],
+                            } for candidate in candidates]))
                     else:
                         st.warning("自动识别失败，请手动输入特征码")
 
+                    # 装订线读数有误码：在已发行的特征码中按汉明距离容错查找
+                    if not feature_code and trace['bits']:
+                        nearest = get_ledger().nearest(trace['bits'], trace['bit_confidence'])
+                        if customer_file:
+                            if customer_file.name.endswith('.csv'):
+                                df = pd.read_csv(customer_file)
+                            else:
+                                df = pd.read_excel(customer_file)
+                            customer_file.seek(0)
+                            nearest += buyer_index.find_buyers_by_bits(
+                                trace['bits'], df.to_dict('records'), trace['bit_confidence'])
+
+                        if nearest:
+                            st.markdown("**装订线读数最接近的特征码**")
+                            st.dataframe(pd.DataFrame(list({match['feature_code']: {
+                                '特征码': match['feature_code'],
+                                '误码位数': match['distance'],
+                                '代价': round(match['cost'], 2),
+                            } for match in sorted(nearest, key=lambda m: m['cost'])}.values())))
+                        feature_code = buyer_index.unambiguous_code(nearest)
+                        if feature_code:
+                            st.success(f"容错匹配到特征码: {feature_code}")
+
+                    # 装订线明码：对第一页的竖排小字做模板匹配
+                    if not feature_code:
+                        if trace['registered']:
+                            first_page, _ = page_registration.register_margins(
+                                image_processor.render_pages(pdf_bytes, [0], dpi=200,
+                                                             page_cache=get_page_cache())[0])
+                        else:
+                            first_page = image_processor.render_trace_pages(
+                                pdf_bytes, [0], dpi=200, page_cache=get_page_cache())[0]
+                        visible = glyph_classifier.read_visible_code(first_page)
+                        if visible:
+                            feature_code = visible['code']
+                            st.success(f"识别到装订线明码: {feature_code}（请与装订线核对）")
+
+                # 按页面感知哈希反查来源母版（台账中记录了母版页面指纹时）
+                source_document = None
+                try:
+                    sources = trace_engine.find_source_document(pdf_bytes, get_ledger())
+                except Exception as e:
+                    st.warning(f"反查来源母版失败: {str(e)}")
+                    sources = []
+                if sources:
+                    source_document = sources[0]['document_sha256']
+                    st.markdown("### 来源母版")
+                    st.dataframe(pd.DataFrame([{
+                        '母版': source['document_sha256'][:12],
+                        '匹配页': '、'.join(f"{suspect + 1}→{page + 1}"
+                                          for suspect, page, _ in source['matches']),
+                        '平均距离': f"{source['distance']:.0f}/128",
+                        '发行次数': source.get('releases', 0),
+                        '最近发行': source.get('created_at', ''),
+                    } for source in sources]))
+
+                # 发行台账：列出该特征码在所有历史发行中的副本（不需要买家名单）
+                if feature_code:
+                    issued = get_ledger().lookup(feature_code)
+                    # 确定了来源母版时只列该母版的发行（没有记录时不过滤）
+                    issued = [row for row in issued if row['document_sha256'] == source_document] or issued
+                    if issued:
+                        st.markdown(f"### 发行台账记录（{len(issued)} 份副本）")
+                        st.dataframe(pd.DataFrame([{
+                            '姓名': row['buyer_name'] or row['buyer_id'],
+                            '手机号': row['buyer_phone'],
+                            '发行时间': row['issued_at'],
+                            '母版': row['document_sha256'][:12],
+                            '模式': row['mode'],
+                        } for row in issued]))
+                    elif not customer_file:
+                        st.warning("发行台账中没有该特征码的记录，请上传买家名单进一步匹配")
+
                 # 如果有特征码，查找买家
                 if feature_code and customer_file:
                     st.info("正在匹配买家信息...")
@@ -1036,25 +1358,19 @@ def main():
 
                     customer_list = df.to_dict('records')
 
-                    # 查找匹配的买家
-                    result = None
-                    for customer in customer_list:
-                        name = customer.get('name', '')
-                        phone = customer.get('phone', '')
-                        buyer_id = f"{name}_{phone}"
-                        code = image_processor.generate_feature_code(buyer_id)
-
-                        if code == feature_code:
-                            result = customer
-                            break
+                    # 查找匹配的买家（撞码时列出全部）
+                    matches = buyer_index.find_buyers_by_code(feature_code, customer_list)
 
-                    if result:
+                    if matches:
                         st.success("找到盗版来源！")
                         st.markdown("---")
                         st.markdown("### 溯源结果")
                         st.markdown(f"**特征码**: `{feature_code}`")
-                        st.markdown(f"**买家姓名**: {result['name']}")
-                        st.markdown(f"**买家手机号**: {result['phone']}")
+                        if len(matches) > 1:
+                            st.warning(f"{len(matches)} 位买家的特征码相同，请结合可见水印进一步核对")
+                        for result in matches:
+                            st.markdown(f"**买家姓名**: {result['name']}")
+                            st.markdown(f"**买家手机号**: {result['phone']}")
                         st.markdown("---")
 
                         st.warning("""
@@ -1074,6 +1390,8 @@ def main():
                         - PDF 不是通过本系统生成的
                         """)
 
+        except MemoryBudgetExceeded as e:
+            st.error(str(e))
         except Exception as e:
             st.error(f"处理失败：{str(e)}")
             st.error("请检查文件是否损坏，或尝试调整参数后重试。")
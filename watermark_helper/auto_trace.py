@@ -5,55 +5,24 @@
 上传 PDF 文件，自动识别空间溯源标记，找出盗版来源
 """
 
+import os
 import sys
-from pdf2image import convert_from_bytes
-from PIL import Image, ImageEnhance
+from PIL import Image
 import image_processor
+import glyph_classifier
+import page_registration
+import trace_engine
+import buyer_index
+from issuance_ledger import IssuanceLedger
 
 
-def extract_visible_code_ocr(image):
-    """
-    从图像中提取装订线可见码（使用 OCR）
+# 以这些扩展名结尾的“名单”按发行台账处理
+LEDGER_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
 
-    参数:
-        image: PIL Image 对象
 
-    返回:
-        识别到的特征码字符串，如果失败返回 None
+def extract_visible_code(image):
     """
-    try:
-        import pytesseract
-
-        # 裁剪装订线区域（左侧 30 像素宽，上方 100-200 像素高）
-        width, height = image.size
-        binding_region = image.crop((0, 100, 30, 200))
-
-        # 增强对比度
-        enhancer = ImageEnhance.Contrast(binding_region)
-        binding_region = enhancer.enhance(2.0)
-
-        # OCR 识别
-        text = pytesseract.image_to_string(binding_region, config='--psm 6')
-
-        # 提取4位字符
-        import re
-        chars = re.findall(r'[A-Z0-9]', text.upper())
-
-        if len(chars) >= 4:
-            return ''.join(chars[:4])
-
-    except ImportError:
-        print("⚠️  pytesseract 未安装，无法使用 OCR 识别")
-        print("   安装: pip3 install pytesseract")
-    except Exception as e:
-        print(f"⚠️  OCR 识别失败: {str(e)}")
-
-    return None
-
-
-def extract_code_from_positions(image):
-    """
-    从图像中检测隐形位置点，拼出特征码
+    从图像中识别装订线明码（模板匹配，不需要 OCR 引擎）
 
     参数:
         image: PIL Image 对象
@@ -61,60 +30,12 @@ def extract_code_from_positions(image):
     返回:
         识别到的特征码字符串，如果失败返回 None
     """
-    width, height = image.size
-    pixels = image.load()
-
-    # 计算缩放比例
-    scale_x = width / 2480
-    scale_y = height / 3508
-
-    detected_chars = []
-
-    # 遍历所有字符的坐标位置
-    for char, (std_x, std_y) in sorted(image_processor.CHAR_POSITION_MAP.items()):
-        # 缩放到实际图像尺寸
-        actual_x = int(std_x * scale_x)
-        actual_y = int(std_y * scale_y)
-
-        # 确保坐标在范围内
-        if actual_x < 0 or actual_x >= width - 2 or actual_y < 0 or actual_y >= height - 2:
-            continue
-
-        # 检测该位置附近是否有黑点（检查 3x3 区域）
-        has_black_dot = False
-        for dx in range(-1, 2):
-            for dy in range(-1, 2):
-                check_x = actual_x + dx
-                check_y = actual_y + dy
-
-                if 0 <= check_x < width and 0 <= check_y < height:
-                    pixel = pixels[check_x, check_y]
-
-                    # 检查是否为黑色或深色（RGB 值都小于 50）
-                    if isinstance(pixel, tuple):
-                        if len(pixel) >= 3 and sum(pixel[:3]) < 50 * 3:
-                            has_black_dot = True
-                            break
-                    elif pixel < 50:  # 灰度图
-                        has_black_dot = True
-                        break
-
-            if has_black_dot:
-                break
-
-        if has_black_dot:
-            detected_chars.append(char)
-
-    # 如果检测到恰好 4 个字符，可能就是特征码
-    if len(detected_chars) == 4:
-        return ''.join(detected_chars)
-    elif len(detected_chars) > 4:
-        # 如果检测到多个字符，尝试组合（可能需要更智能的算法）
-        print(f"⚠️  检测到 {len(detected_chars)} 个可能的字符: {detected_chars}")
-        # 返回前4个
-        return ''.join(detected_chars[:4])
-
-    return None
+    result = glyph_classifier.read_visible_code(image)
+    if result is None:
+        return None
+
+    print(f"   明码字符相关系数: {' '.join(f'{score:.2f}' for score in result['scores'])}")
+    return result['code']
 
 
 def manual_input_code():
@@ -122,50 +43,48 @@ def manual_input_code():
     手动输入特征码（备用方案）
 
     返回:
-        用户输入的4位特征码
+        用户输入的特征码
     """
     print()
     print("=" * 60)
     print("自动识别失败，请手动输入特征码")
     print("=" * 60)
     print()
-    print("请查看 PDF 左侧装订线区域，找到竖排的 4 位字符")
+    print("请查看 PDF 左侧装订线区域，找到竖排的 4~8 位字符")
     print("（例如：W 3 M K 从上到下排列）")
     print()
 
     while True:
-        code = input("请输入4位特征码（如 W3MK）: ").strip().upper()
+        code = input("请输入特征码（如 W3MK）: ").strip().upper()
 
-        if len(code) == 4 and all(c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789' for c in code):
+        if (len(code) in image_processor.SUPPORTED_CODE_LENGTHS and
+                all(c in image_processor.FEATURE_CODE_CHARS for c in code)):
             return code
         else:
-            print("❌ 特征码必须是4位字符（A-Z, 0-9），请重新输入")
+            print("❌ 特征码必须是4~8位字符（A-Z, 0-9），请重新输入")
 
 
-def find_buyer_by_code(feature_code, customer_list):
+def load_customer_list(customer_list_path):
     """
-    根据特征码查找买家
+    读取买家名单（CSV 或 Excel）
 
     参数:
-        feature_code: 4位特征码
-        customer_list: 买家列表
+        customer_list_path: 买家名单文件路径，必须包含 name 和 phone 两列
 
     返回:
-        匹配的买家信息，如果没找到返回 None
+        买家字典列表
     """
-    feature_code = feature_code.upper().strip()
-
-    for customer in customer_list:
-        name = customer.get('name', '')
-        phone = customer.get('phone', '')
-        buyer_id = f"{name}_{phone}"
+    import pandas as pd
 
-        code = image_processor.generate_feature_code(buyer_id)
+    if customer_list_path.endswith('.csv'):
+        df = pd.read_csv(customer_list_path)
+    else:
+        df = pd.read_excel(customer_list_path)
 
-        if code == feature_code:
-            return customer
+    if 'name' not in df.columns or 'phone' not in df.columns:
+        raise ValueError("名单文件必须包含 'name' 和 'phone' 两列")
 
-    return None
+    return df.to_dict('records')
 
 
 def auto_trace_pdf(pdf_path, customer_list_path):
@@ -174,30 +93,26 @@ def auto_trace_pdf(pdf_path, customer_list_path):
 
     参数:
         pdf_path: PDF 文件路径
-        customer_list_path: 买家名单文件路径
+        customer_list_path: 买家名单文件路径，或发行台账文件（.db，按历史发行记录匹配）
     """
     print("=" * 60)
     print("自动溯源工具")
     print("=" * 60)
     print()
 
-    # 读取买家名单
+    # 读取买家名单（或发行台账）
     print("1. 读取买家名单")
     print("-" * 60)
+    ledger = None
     try:
-        import pandas as pd
-
-        if customer_list_path.endswith('.csv'):
-            df = pd.read_csv(customer_list_path)
+        if customer_list_path.lower().endswith(LEDGER_EXTENSIONS):
+            if not os.path.exists(customer_list_path):
+                raise FileNotFoundError(f"发行台账不存在: {customer_list_path}")
+            ledger = IssuanceLedger(customer_list_path)
+            print(f"✅ 已打开发行台账，共 {len(ledger)} 份发行记录")
         else:
-            df = pd.read_excel(customer_list_path)
-
-        if 'name' not in df.columns or 'phone' not in df.columns:
-            print("❌ 名单文件必须包含 'name' 和 'phone' 两列")
-            return
-
-        customer_list = df.to_dict('records')
-        print(f"✅ 已加载 {len(customer_list)} 位买家信息")
+            customer_list = load_customer_list(customer_list_path)
+            print(f"✅ 已加载 {len(customer_list)} 位买家信息")
 
     except Exception as e:
         print(f"❌ 读取买家名单失败: {str(e)}")
@@ -220,52 +135,98 @@ def auto_trace_pdf(pdf_path, customer_list_path):
 
     print()
 
-    # 转换为图像
-    print("3. 转换 PDF 为图像")
-    print("-" * 60)
-    try:
-        images = convert_from_bytes(pdf_bytes, dpi=200)
-        print(f"✅ PDF 页数: {len(images)}")
+    # 按页面感知哈希反查来源母版，买家只在该母版的发行记录中匹配
+    source_document = None
+    if ledger is not None:
+        try:
+            sources = trace_engine.find_source_document(pdf_bytes, ledger)
+        except Exception as e:
+            print(f"⚠️  反查来源母版失败: {str(e)}")
+            sources = []
+        if sources:
+            source_document = sources[0]['document_sha256']
+            pages = '、'.join(f"第 {page + 1} 页" for _, page, _ in sources[0]['matches'])
+            print(f"✅ 来源母版: {source_document[:12]}（匹配母版{pages}，平均距离 "
+                  f"{sources[0]['distance']:.0f}/128，共发行 {sources[0].get('releases', 0)} 次）")
+        else:
+            print("⚠️  台账中没有相似的母版页面，将在所有历史发行中匹配")
+        print()
 
-        if not images:
-            print("❌ PDF 没有页面")
-            return
+    # 逐页投票识别特征码（只渲染页边区域，某个特征码明显领先即停止）
+    print("3. 识别空间溯源标记")
+    print("-" * 60)
 
-        # 使用第一页进行识别
-        first_page = images[0]
-        width, height = first_page.size
-        print(f"✅ 第一页尺寸: {width}x{height}")
+    feature_code = None
 
+    # 方法 1：逐页检测装订线编码和隐形位置点，累积投票
+    print("尝试方法 1: 逐页检测装订线编码和隐形位置点...")
+    try:
+        trace = trace_engine.trace_pdf(pdf_bytes, dpi=200, register='auto',
+                                       progress_callback=lambda message: print(f"   {message}"))
     except Exception as e:
         print(f"❌ PDF 转图像失败: {str(e)}")
         return
 
-    print()
-
-    # 尝试自动识别特征码
-    print("4. 识别空间溯源标记")
-    print("-" * 60)
-
-    feature_code = None
-
-    # 方法 1：OCR 识别装订线可见码
-    print("尝试方法 1: OCR 识别装订线可见码...")
-    ocr_code = extract_visible_code_ocr(first_page)
-    if ocr_code:
-        print(f"✅ OCR 识别到特征码: {ocr_code}")
-        feature_code = ocr_code
+    structure_note = ''
+    if trace['source'] == 'structure':
+        structure_note = ('（PDF 结构标记，已由页面标记证实）' if trace['structure']['confirmed']
+                          else '（PDF 结构标记，未渲染页面）')
+    print(f"   已检查 {trace['pages_scanned']}/{trace['page_count']} 页"
+          f"{'（提前结束）' if trace['early_exit'] else ''}"
+          f"{'（已配准）' if trace['registered'] else ''}"
+          f"{structure_note}")
+    if trace['structure'] and not trace['structure']['consistent']:
+        print("⚠️  PDF 结构标记各通道不一致，文件可能被篡改，已改用图像溯源")
+    elif trace['structure'] and trace['structure']['confirmed'] is False:
+        print(f"⚠️  PDF 结构标记（{trace['structure']['code']}）未被页面标记证实，可能是伪造的令牌，不采信")
+
+    if trace['source'] in trace_engine.ORDERED_SOURCES:
+        print(f"✅ 识别到特征码: {trace['code']}")
+        feature_code = trace['code']
+    elif trace['source'] == 'dots':
+        # 位置点没有顺序，只能作为核对参考：按字符集合列出最接近的买家
+        print(f"⚠️  只检测到位置点字符（无顺序）: {trace['code']}")
+        if ledger is None:
+            print("   字符集合最接近的买家（漏检/多出字符数）：")
+            for candidate in buyer_index.find_buyers_by_chars(trace['code'], customer_list):
+                customer = candidate['customer']
+                print(f"   {candidate['feature_code']}  {customer.get('name', '')} "
+                      f"{customer.get('phone', '')}（{candidate['missing']}/{candidate['extra']}）")
     else:
-        print("⚠️  OCR 识别失败")
+        print("⚠️  未检测到溯源标记")
 
-    # 方法 2：检测隐形位置点
-    if not feature_code:
-        print("尝试方法 2: 检测隐形位置点...")
-        position_code = extract_code_from_positions(first_page)
-        if position_code:
-            print(f"✅ 位置点检测到特征码: {position_code}")
-            feature_code = position_code
+    # 装订线读数有误码：在已发行的特征码中按汉明距离容错查找（低置信度的位优先视为误码）
+    if not feature_code and trace['bits']:
+        if ledger is not None:
+            nearest = ledger.nearest(trace['bits'], trace['bit_confidence'])
+        else:
+            nearest = buyer_index.find_buyers_by_bits(trace['bits'], customer_list,
+                                                      trace['bit_confidence'])
+        shown = {}
+        for match in nearest:
+            shown.setdefault(match['feature_code'], match)
+        if shown:
+            print("   装订线读数有误码，最接近的特征码（误码位数，代价）：")
+            for code, match in shown.items():
+                print(f"   {code}（{match['distance']} 位，{match['cost']:.2f}）")
+        feature_code = buyer_index.unambiguous_code(nearest)
+        if feature_code:
+            print(f"✅ 容错匹配到特征码: {feature_code}")
+
+    # 方法 2：模板匹配识别第一页装订线明码
+    if not feature_code and trace['page_count']:
+        print("尝试方法 2: 模板匹配识别装订线明码...")
+        if trace['registered']:
+            first_page, _ = page_registration.register_margins(
+                image_processor.render_pages(pdf_bytes, [0], dpi=200)[0])
         else:
-            print("⚠️  位置点检测失败")
+            first_page = image_processor.render_trace_pages(pdf_bytes, [0], dpi=200)[0]
+        visible_code = extract_visible_code(first_page)
+        if visible_code:
+            print(f"✅ 识别到装订线明码: {visible_code}")
+            feature_code = visible_code
+        else:
+            print("⚠️  未识别到装订线明码")
 
     # 方法 3：手动输入
     if not feature_code:
@@ -277,22 +238,35 @@ def auto_trace_pdf(pdf_path, customer_list_path):
     print()
 
     # 查找买家
-    print("5. 查找盗版来源")
+    print("4. 查找盗版来源")
     print("-" * 60)
     print("正在匹配买家信息...")
 
-    result = find_buyer_by_code(feature_code, customer_list)
+    if ledger is not None:
+        # 一次索引查询覆盖所有历史发行；确定了来源母版时只保留该母版的发行（没有记录时不过滤）
+        issued = ledger.lookup(feature_code)
+        issued = [row for row in issued if row['document_sha256'] == source_document] or issued
+        matches = [{'name': row['buyer_name'] or row['buyer_id'], 'phone': row['buyer_phone'],
+                    'issued_at': row['issued_at']}
+                   for row in issued]
+    else:
+        matches = buyer_index.find_buyers_by_code(feature_code, customer_list)
 
     print()
 
-    if result:
+    if matches:
         print("=" * 60)
         print("✅ 找到盗版来源！")
         print("=" * 60)
         print()
         print(f"特征码: {feature_code}")
-        print(f"买家姓名: {result['name']}")
-        print(f"买家手机号: {result['phone']}")
+        if len(matches) > 1:
+            print(f"⚠️  {len(matches)} 位买家的特征码相同，请结合可见水印进一步核对：")
+        for result in matches:
+            print(f"买家姓名: {result['name']}")
+            print(f"买家手机号: {result['phone']}")
+            if 'issued_at' in result:
+                print(f"发行时间: {result['issued_at']}")
         print()
         print("建议采取的行动：")
         print("1. 联系该买家，确认是否本人传播")
@@ -334,7 +308,7 @@ def main():
         print()
 
         pdf_path = input("请输入盗版 PDF 文件路径: ").strip()
-        customer_list_path = input("请输入买家名单文件路径 (CSV/Excel): ").strip()
+        customer_list_path = input("请输入买家名单文件路径 (CSV/Excel) 或发行台账 (.db): ").strip()
 
         print()
 
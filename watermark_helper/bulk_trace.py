@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+批量溯源工具
+
+非交互地扫描目录或文件列表中的可疑 PDF / 图片，用进程池并行溯源，
+按文件内容哈希缓存结果（重复上传的文件不再渲染），输出 CSV / JSON 报告
+
+用法:
+    python3 bulk_trace.py 可疑文件目录/ other.pdf -c customers.csv -o report.csv
+    python3 bulk_trace.py 可疑文件目录/ -l issuance_ledger.db -o report.json
+"""
+
+import argparse
+import hashlib
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PIL import Image, ImageSequence
+
+import buyer_index
+import trace_engine
+from auto_trace import load_customer_list
+from issuance_ledger import IssuanceLedger
+
+
+# 支持的文件类型
+PDF_EXTENSIONS = ('.pdf',)
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.tif')
+
+# 报告列（顺序即 CSV 列顺序）
+REPORT_FIELDS = ['file', 'sha256', 'code', 'source', 'confidence', 'match_count', 'buyer_name',
+                 'buyer_phone', 'pages_scanned', 'page_count', 'seconds', 'cached', 'error']
+
+# 溯源结果字段（与买家名单无关，换名单后仍然有效）
+TRACE_FIELDS = ['code', 'source', 'confidence', 'pages_scanned', 'page_count', 'seconds']
+
+# 缓存的字段（耗时只属于首次溯源的那次运行，不缓存）
+CACHED_FIELDS = [field for field in TRACE_FIELDS if field != 'seconds']
+
+DEFAULT_CACHE_PATH = 'trace_cache.json'
+
+# 缓存格式和解码算法的版本，溯源结果可能变化时递增，旧缓存自动失效
+CACHE_VERSION = 2
+
+
+def collect_files(paths):
+    """
+    展开输入路径（目录递归查找 PDF 和图片）
+
+    参数:
+        paths: 文件或目录路径列表
+
+    返回:
+        去重后的文件路径列表（目录内按文件名排序）
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in sorted(os.walk(path)):
+                files.extend(os.path.join(root, name) for name in sorted(names)
+                             if name.lower().endswith(PDF_EXTENSIONS + IMAGE_EXTENSIONS))
+        else:
+            files.append(path)
+    return list(dict.fromkeys(files))
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """计算文件内容的 SHA-256（分块读取）"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def trace_bytes(data, is_pdf, dpi=200, max_pages=None):
+    """
+    溯源内存中的 PDF 或图片
+
+    PDF 逐页只渲染页边区域；图片（含多帧 TIFF）先配准再逐帧检测
+
+    参数:
+        data: 文件的字节内容
+        is_pdf: 是否为 PDF
+        dpi: PDF 渲染分辨率
+        max_pages: 最多检查的页数（None 表示不限）
+
+    返回:
+        trace_engine.trace_pdf / trace_images 的结果字典（'page_count' 为总页数或帧数）
+    """
+    if is_pdf:
+        return trace_engine.trace_pdf(data, dpi=dpi, max_pages=max_pages, register='auto')
+
+    with Image.open(io.BytesIO(data)) as image:
+        frame_count = getattr(image, 'n_frames', 1)
+        frames = (frame.convert('RGB') for frame in ImageSequence.Iterator(image))
+        # 图片多为扫描件或翻拍件，先配准到标准页面网格
+        result = trace_engine.trace_images(itertools.islice(frames, max_pages),
+                                           page_count=frame_count, register=True)
+    result['page_count'] = frame_count
+    result['registered'] = True
+    result['structure'] = None
+    return result
+
+
+def trace_file(path, dpi=200, max_pages=None):
+    """
+    溯源单个文件（进程池工作函数）
+
+    参数:
+        path: PDF 或图片文件路径
+        dpi: PDF 渲染分辨率
+        max_pages: 最多检查的页数（None 表示不限）
+
+    返回:
+        字典，包含 TRACE_FIELDS 和 'error'（失败时为错误信息）
+    """
+    start = time.perf_counter()
+    record = {'code': None, 'source': None, 'confidence': 0.0,
+              'pages_scanned': 0, 'page_count': 0, 'error': ''}
+
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        result = trace_bytes(data, path.lower().endswith(PDF_EXTENSIONS), dpi, max_pages)
+        record.update({field: result[field] for field in
+                       ('code', 'source', 'confidence', 'pages_scanned', 'page_count')})
+    except Exception as e:
+        record['error'] = str(e)
+
+    record['seconds'] = round(time.perf_counter() - start, 3)
+    return record
+
+
+class TraceResultCache:
+    """
+    按文件哈希持久化的溯源结果缓存（JSON 文件）
+
+    键包含缓存版本、文件哈希、渲染 DPI 和检查页数上限；只缓存识别出特征码的结果，
+    未识别或失败的文件下次重新溯源（解码改进后可能识别），买家匹配在读取后重新进行
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(sha256, dpi, max_pages=None):
+        """缓存键"""
+        return f"v{CACHE_VERSION}:{sha256}:{dpi}:{max_pages or 'all'}"
+
+    def get(self, key):
+        """获取缓存的溯源结果，未命中返回 None"""
+        return self.entries.get(key)
+
+    def put(self, key, record):
+        """保存溯源结果（失败或未识别的结果不缓存）"""
+        if not record.get('error') and record.get('source') is not None:
+            self.entries[key] = {field: record[field] for field in CACHED_FIELDS}
+
+    def save(self):
+        """写回缓存文件（先写临时文件再替换，中断时不会损坏缓存）"""
+        if not self.path:
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def trace_files(paths, customer_list=None, workers=None, cache=None, dpi=200,
+                max_pages=None, ledger=None, progress_callback=None):
+    """
+    批量溯源
+
+    参数:
+        paths: 文件路径列表
+        customer_list: 买家字典列表（可选，用于匹配买家）
+        workers: 进程数（None 为 CPU 核数）
+        cache: TraceResultCache 对象（可选）
+        dpi: PDF 渲染分辨率
+        max_pages: 每个文件最多检查的页数
+        ledger: issuance_ledger.IssuanceLedger 对象（可选），按历史发行记录匹配买家
+        progress_callback: 进度回调函数，接受一个字符串参数
+
+    返回:
+        报告行字典列表（与 paths 顺序一致，字段见 REPORT_FIELDS）
+    """
+    def update_progress(message):
+        """内部辅助函数：更新进度"""
+        if progress_callback:
+            progress_callback(message)
+
+    customer_list = customer_list or []
+    rows = []
+
+    # 哈希 → 缓存键；内容相同的文件只溯源一次
+    pending = {}
+    for path in paths:
+        row = dict.fromkeys(REPORT_FIELDS, '')
+        row['file'] = path
+        try:
+            row['sha256'] = file_sha256(path)
+        except OSError as e:
+            row['error'] = str(e)
+            rows.append(row)
+            continue
+
+        key = TraceResultCache.key(row['sha256'], dpi, max_pages)
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            row.update(cached)
+            row['seconds'] = 0.0
+            row['cached'] = True
+        else:
+            pending.setdefault(key, path)
+            row['cached'] = False
+        rows.append(row)
+
+    update_progress(f"共 {len(rows)} 个文件，缓存命中 {sum(row['cached'] is True for row in rows)} 个，"
+                    f"待溯源 {len(pending)} 个")
+
+    traced = {}
+    if pending:
+        workers = min(workers or os.cpu_count() or 1, len(pending))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(trace_file, path, dpi, max_pages): key
+                       for key, path in pending.items()}
+            for done, future in enumerate(as_completed(futures), 1):
+                key = futures[future]
+                traced[key] = future.result()
+                if cache is not None:
+                    cache.put(key, traced[key])
+                update_progress(f"[{done}/{len(futures)}] {pending[key]}: "
+                                f"{traced[key]['code'] or traced[key]['error'] or '未识别'}")
+
+    for row in rows:
+        if row['cached'] is False:
+            row.update(traced[TraceResultCache.key(row['sha256'], dpi, max_pages)])
+
+        # 撞码时列出全部买家（以分号分隔），名单和台账中的同一买家只列一次
+        buyers = []
+        if row['source'] in trace_engine.ORDERED_SOURCES:
+            buyers = buyer_index.find_buyers_by_code(row['code'], customer_list)
+            if ledger is not None:
+                buyers = buyers + [{'name': issue['buyer_name'] or issue['buyer_id'],
+                                    'phone': issue['buyer_phone'] or ''}
+                                   for issue in ledger.lookup(row['code'])]
+            buyers = list({(str(buyer.get('name', '')), str(buyer.get('phone', ''))): buyer
+                           for buyer in buyers}.values())
+        row['match_count'] = len(buyers)
+        row['buyer_name'] = ';'.join(str(buyer.get('name', '')) for buyer in buyers)
+        row['buyer_phone'] = ';'.join(str(buyer.get('phone', '')) for buyer in buyers)
+
+    return rows
+
+
+def write_report(rows, output_path):
+    """
+    写出溯源报告（扩展名为 .json 时输出 JSON，否则输出 Excel 可直接打开的 CSV）
+
+    参数:
+        rows: trace_files 返回的报告行
+        output_path: 报告文件路径
+    """
+    if output_path.lower().endswith('.json'):
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2, default=str)
+    else:
+        import pandas as pd
+        pd.DataFrame(rows, columns=REPORT_FIELDS).to_csv(output_path, index=False,
+                                                         encoding='utf-8-sig')
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='批量溯源可疑 PDF / 图片文件')
+    parser.add_argument('paths', nargs='+', help='可疑文件或目录（目录递归查找 PDF 和图片）')
+    parser.add_argument('-c', '--customers', help='买家名单文件（CSV/Excel，包含 name 和 phone 两列）')
+    parser.add_argument('-l', '--ledger', help='发行台账文件（issuance_ledger.db），按历史发行记录匹配买家')
+    parser.add_argument('-o', '--output', default='trace_report.csv',
+                        help='报告文件（.csv 或 .json，默认 trace_report.csv）')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='并行进程数（默认 CPU 核数）')
+    parser.add_argument('--cache', default=DEFAULT_CACHE_PATH,
+                        help=f'结果缓存文件（默认 {DEFAULT_CACHE_PATH}，传空字符串禁用）')
+    parser.add_argument('--dpi', type=int, default=200, help='PDF 渲染分辨率（默认 200）')
+    parser.add_argument('--max_pages', type=int, default=None, help='每个文件最多检查的页数')
+    args = parser.parse_args()
+
+    files = collect_files(args.paths)
+    if not files:
+        print("❌ 没有找到 PDF 或图片文件")
+        sys.exit(1)
+
+    customer_list = load_customer_list(args.customers) if args.customers else None
+    cache = TraceResultCache(args.cache) if args.cache else None
+    if args.ledger and not os.path.exists(args.ledger):
+        print(f"❌ 发行台账不存在: {args.ledger}")
+        sys.exit(1)
+    ledger = IssuanceLedger(args.ledger) if args.ledger else None
+
+    start = time.perf_counter()
+    rows = trace_files(files, customer_list, args.workers, cache, args.dpi, args.max_pages,
+                       ledger, progress_callback=print)
+    if cache is not None:
+        cache.save()
+    write_report(rows, args.output)
+
+    matched = sum(bool(row['buyer_name']) for row in rows)
+    failed = sum(bool(row['error']) for row in rows)
+    print()
+    print(f"✅ 已处理 {len(rows)} 个文件（{time.perf_counter() - start:.1f} 秒），"
+          f"识别到买家 {matched} 个，失败 {failed} 个")
+    print(f"报告已保存: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
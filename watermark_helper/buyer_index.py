@@ -0,0 +1,540 @@
+"""
+特征码索引模块
+
+一次性为整份买家名单批量计算特征码，建立 特征码 → 买家 的索引，
+按名单内容和特征码位数哈希持久化到磁盘，之后同一份名单的查找为 O(1)
+特征码位数有限，不同买家可能撞码，查找时返回全部匹配的买家
+隐形位置点只记录特征码包含哪些字符，另以 36 位字符集合掩码为每位买家建索引，
+检测不完整（漏点或多出污点）时按掩码差异给出最接近的买家
+装订线读数有误码时，以多索引哈希在全部特征码中查找汉明距离不超过 k 的候选
+不依赖 Streamlit，可独立使用
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+
+# 索引格式版本（特征码算法或文件格式变化时递增，旧索引自动失效）
+INDEX_VERSION = 2
+
+# 特征码字符集（6 位二进制可表示 0-63，足够 36 个字符），image_processor 等模块均引用这里的定义
+CODE_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
+# 特征码位数：默认 4 位（约 168 万种），买家较多时可加长到 8 位（SHA-256 的 8 个 32 位分段）
+DEFAULT_CODE_LENGTH = 4
+SUPPORTED_CODE_LENGTHS = tuple(range(4, 9))
+
+DEFAULT_INDEX_DIR = os.path.join(tempfile.gettempdir(), 'watermark_helper_buyer_index')
+
+# 进程内保留最近使用的索引数（同一进程反复查找时不再读盘；按字符集合查找会用到全部位数）
+MEMORY_INDEXES = 2 * len(SUPPORTED_CODE_LENGTHS)
+
+# 按字符集合查找时默认返回的候选买家数
+DEFAULT_TOP_K = 5
+
+# 装订线每个字符的位数；容错查找默认允许的误码位数
+BITS_PER_CHAR = 6
+DEFAULT_MAX_DISTANCE = 2
+
+# 多索引哈希的每个分段中最多枚举的缺失位数（超过时退化为全表扫描）
+MAX_ENUMERATED_BITS = 4
+
+_memory_indexes = OrderedDict()
+
+# 字符 → 掩码位（ASCII 查表），字节 → 置 1 的位数
+_CHAR_BITS = np.full(256, -1, dtype=np.int64)
+_CHAR_BITS[np.frombuffer(CODE_CHARS.encode('ascii'), dtype=np.uint8)] = np.arange(len(CODE_CHARS))
+_BYTE_POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+def buyer_id(customer):
+    """买家标识（与发行时写入溯源标记的 ID 一致）"""
+    return f"{customer.get('name', '')}_{customer.get('phone', '')}"
+
+
+def feature_codes(buyer_ids, code_length=DEFAULT_CODE_LENGTH):
+    """
+    批量计算特征码（结果与逐个调用 generate_feature_code 相同）
+
+    每个摘要的前 code_length 个 32 位大端整数对 36 取模，用 NumPy 一次完成
+
+    参数:
+        buyer_ids: 买家标识列表
+        code_length: 特征码位数（4~8）
+
+    返回:
+        特征码字符串列表
+    """
+    if not buyer_ids:
+        return []
+
+    digests = b''.join(hashlib.sha256(str(item).encode('utf-8')).digest() for item in buyer_ids)
+    words = np.frombuffer(digests, dtype='>u4').reshape(-1, 8)[:, :code_length]
+    chars = np.frombuffer(CODE_CHARS.encode('ascii'), dtype='S1')[words % len(CODE_CHARS)]
+    return [row.tobytes().decode('ascii') for row in chars]
+
+
+def char_mask(chars):
+    """
+    字符集合掩码（CODE_CHARS 中第 i 个字符对应第 i 位，重复和顺序不影响结果）
+
+    参数:
+        chars: 字符串或字符列表（大小写不敏感，不在字符表中的字符忽略）
+
+    返回:
+        整数掩码
+    """
+    mask = 0
+    for char in ''.join(chars).upper():
+        position = CODE_CHARS.find(char)
+        if position >= 0:
+            mask |= 1 << position
+    return mask
+
+
+def char_masks(codes):
+    """
+    批量计算特征码的字符集合掩码（结果与逐个调用 char_mask 相同）
+
+    参数:
+        codes: 等长特征码列表
+
+    返回:
+        uint64 数组
+    """
+    if not codes:
+        return np.zeros(0, dtype=np.uint64)
+
+    chars = np.frombuffer(''.join(codes).encode('ascii'), dtype=np.uint8).reshape(len(codes), -1)
+    bits = np.left_shift(np.uint64(1), _CHAR_BITS[chars].astype(np.uint64))
+    return np.bitwise_or.reduce(bits, axis=1)
+
+
+def popcount(values):
+    """uint64 数组每个元素中置 1 的位数（NumPy 2 用 bitwise_count，否则按字节查表）"""
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values).astype(np.int64)
+    return _BYTE_POPCOUNT[values.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+
+def code_values(codes):
+    """
+    批量把特征码转换为装订线二进制编码的整数值（与 encode_to_binary 的位串一致）
+
+    参数:
+        codes: 等长特征码列表
+
+    返回:
+        uint64 数组
+    """
+    if not codes:
+        return np.zeros(0, dtype=np.uint64)
+
+    chars = np.frombuffer(''.join(codes).encode('ascii'), dtype=np.uint8).reshape(len(codes), -1)
+    shifts = BITS_PER_CHAR * np.arange(chars.shape[1] - 1, -1, -1, dtype=np.uint64)
+    return np.bitwise_or.reduce(_CHAR_BITS[chars].astype(np.uint64) << shifts, axis=1)
+
+
+class BindingCodeIndex:
+    """
+    装订线编码容错索引（多索引哈希）
+
+    把位数 × 6 位的编码切成 max_distance + 1 段，每段按值排序；
+    误码不超过 max_distance 位时至少有一段完全一致，
+    只需在各段的同值桶中取候选再逐一计算距离，不必扫描全部特征码
+    """
+
+    def __init__(self, codes, max_distance=DEFAULT_MAX_DISTANCE):
+        self.codes = sorted(set(codes))
+        lengths = {len(code) for code in self.codes}
+        if len(lengths) > 1:
+            raise ValueError(f"特征码位数不一致: {sorted(lengths)}")
+
+        self.code_length = lengths.pop() if lengths else DEFAULT_CODE_LENGTH
+        self.bit_count = self.code_length * BITS_PER_CHAR
+        self.max_distance = max_distance
+        self.values = code_values(self.codes)
+        self._bit_shifts = np.arange(self.bit_count - 1, -1, -1, dtype=np.uint64)
+
+        # 每段：(右移位数, 段掩码, 排序后的段值, 排序下标)
+        self.segments = []
+        for bits in np.array_split(np.arange(self.bit_count), max_distance + 1):
+            shift = self.bit_count - 1 - int(bits[-1])
+            mask = (1 << len(bits)) - 1
+            keys = (self.values >> np.uint64(shift)) & np.uint64(mask)
+            order = np.argsort(keys, kind='stable')
+            self.segments.append((shift, mask, keys[order], order))
+
+    def _candidates(self, value, erased):
+        """各段同值桶的并集（缺失位在段内枚举），缺失位过多时返回 None"""
+        found = []
+        for shift, mask, keys, order in self.segments:
+            erased_bits = (erased >> shift) & mask
+            if bin(erased_bits).count('1') > MAX_ENUMERATED_BITS:
+                return None
+            base = (value >> shift) & mask & ~erased_bits
+
+            # 枚举缺失位的全部取值（erased_bits 的全部子集）
+            subset = erased_bits
+            while True:
+                key = np.uint64(base | subset)
+                low, high = np.searchsorted(keys, key, 'left'), np.searchsorted(keys, key, 'right')
+                found.append(order[low:high])
+                if subset == 0:
+                    break
+                subset = (subset - 1) & erased_bits
+        return np.unique(np.concatenate(found))
+
+    def query(self, bits, confidence=None, max_distance=None, top_k=None):
+        """
+        查找与装订线读数汉明距离不超过 max_distance 的特征码
+
+        置信度为 0 的位（未检测到的符号）视为缺失，不计入距离；
+        其余误码位的置信度之和作为代价，代价越小越可信
+
+        参数:
+            bits: 装订线读出的二进制字符串（位数 × 6）
+            confidence: 每一位的置信度数组（None 表示全部为 1）
+            max_distance: 允许的误码位数（None 为建索引时的值，更大时全表扫描）
+            top_k: 最多返回的候选数（None 表示不限）
+
+        返回:
+            字典列表 {'feature_code', 'distance', 'cost'}，按代价、距离排序；位数不符时为空列表
+        """
+        if len(bits) != self.bit_count or not self.codes:
+            return []
+
+        confidence = (np.ones(self.bit_count) if confidence is None
+                      else np.asarray(confidence, dtype=np.float64))
+        max_distance = self.max_distance if max_distance is None else max_distance
+        value = int(bits, 2)
+        erased = int(''.join('1' if c <= 0 else '0' for c in confidence), 2)
+
+        candidates = None
+        if max_distance <= self.max_distance:
+            candidates = self._candidates(value, erased)
+        if candidates is None:
+            candidates = np.arange(len(self.values))
+
+        diff = (self.values[candidates] ^ np.uint64(value)) & np.uint64(~erased & ((1 << self.bit_count) - 1))
+        distance = popcount(diff)
+        keep = distance <= max_distance
+        candidates, diff, distance = candidates[keep], diff[keep], distance[keep]
+
+        flipped = ((diff[:, None] >> self._bit_shifts) & np.uint64(1)).astype(np.float64)
+        cost = flipped @ confidence
+        order = np.lexsort((distance, cost))[:top_k]
+
+        return [{'feature_code': self.codes[i], 'distance': int(distance[j]),
+                 'cost': float(cost[j])} for i, j in zip(candidates[order], order)]
+
+
+def list_hash(customer_list, code_length=DEFAULT_CODE_LENGTH):
+    """名单内容哈希（只取决于按顺序排列的买家标识和特征码位数）"""
+    digest = hashlib.sha256(f"v{INDEX_VERSION}:{code_length}".encode('utf-8'))
+    for customer in customer_list:
+        digest.update(buyer_id(customer).encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+class FeatureCodeIndex:
+    """
+    特征码 → 买家 索引
+
+    - positions: 特征码 → 名单中的下标列表（持久化的内容）
+    - codes: 每位买家的特征码（与名单顺序一致）
+    - masks: 每位买家特征码的字符集合掩码（首次按字符查找时计算）
+    - code_length: 特征码位数
+    """
+
+    def __init__(self, customer_list, positions=None, code_length=DEFAULT_CODE_LENGTH):
+        self.customer_list = list(customer_list)
+        self.code_length = code_length
+        self._derived = {}  # 由 positions 派生的数组（同一名单的索引对象之间共享）
+
+        if positions is None:
+            positions = {}
+            codes = feature_codes([buyer_id(customer) for customer in self.customer_list],
+                                  code_length)
+            for position, code in enumerate(codes):
+                positions.setdefault(code, []).append(position)
+        self.positions = positions
+
+    @property
+    def codes(self):
+        """每位买家的特征码（与名单顺序一致）"""
+        if 'codes' not in self._derived:
+            codes = [None] * len(self.customer_list)
+            for code, positions in self.positions.items():
+                for position in positions:
+                    codes[position] = code
+            self._derived['codes'] = codes
+        return list(self._derived['codes'])
+
+    @property
+    def masks(self):
+        """每位买家特征码的字符集合掩码（uint64 数组，与名单顺序一致）"""
+        if 'masks' not in self._derived:
+            self._derived['masks'] = char_masks(self.codes)
+        return self._derived['masks']
+
+    def lookup(self, feature_code):
+        """
+        查找特征码对应的全部买家
+
+        参数:
+            feature_code: 特征码（大小写、首尾空白不敏感）
+
+        返回:
+            买家信息字典列表（名单顺序），没找到时为空列表
+        """
+        feature_code = str(feature_code).upper().strip()
+        return [self.customer_list[i] for i in self.positions.get(feature_code, [])]
+
+    def rank_by_chars(self, chars, top_k=DEFAULT_TOP_K):
+        """
+        按位置点检测到的字符集合查找买家
+
+        以掩码异或的位数（漏检字符 + 多出字符）为距离排序，
+        字符集合完全一致的买家全部返回，其余补足到 top_k 位
+
+        参数:
+            chars: 检测到的字符（无顺序）
+            top_k: 最少返回的候选数
+
+        返回:
+            字典列表 {'customer', 'feature_code', 'missing', 'extra'}，按距离、名单顺序排列
+        """
+        masks = self.masks
+        if not len(masks):
+            return []
+
+        query = np.uint64(char_mask(chars))
+        missing = popcount(masks & ~query)
+        extra = popcount(~masks & query)
+        distance = missing + extra
+
+        count = max(top_k, int(np.count_nonzero(distance == 0)))
+        if count < len(distance):
+            candidates = np.argpartition(distance, count - 1)[:count]
+        else:
+            candidates = np.arange(len(distance))
+        candidates = candidates[np.lexsort((candidates, distance[candidates]))]
+
+        codes = self._derived['codes']
+        return [{'customer': self.customer_list[i], 'feature_code': codes[i],
+                 'missing': int(missing[i]), 'extra': int(extra[i])} for i in candidates]
+
+    def nearest(self, bits, confidence=None, max_distance=DEFAULT_MAX_DISTANCE, top_k=None):
+        """
+        按有误码的装订线读数查找买家（容错索引在首次查找时建立）
+
+        参数:
+            bits, confidence, max_distance, top_k: 同 BindingCodeIndex.query
+
+        返回:
+            字典列表 {'customer', 'feature_code', 'distance', 'cost'}，
+            撞码的买家依次列出，按代价、距离排序
+        """
+        if 'binding' not in self._derived:
+            self._derived['binding'] = BindingCodeIndex(list(self.positions))
+        return [{'customer': self.customer_list[i], **match}
+                for match in self._derived['binding'].query(bits, confidence, max_distance, top_k)
+                for i in self.positions[match['feature_code']]]
+
+    def collisions(self):
+        """撞码的特征码 → 买家列表"""
+        return {code: [self.customer_list[i] for i in positions]
+                for code, positions in self.positions.items() if len(positions) > 1}
+
+    def save(self, path):
+        """保存索引（先写临时文件再替换）"""
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'count': len(self.customer_list),
+                       'code_length': self.code_length, 'positions': self.positions}, f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, customer_list):
+        """
+        读取已保存的索引
+
+        参数:
+            path: 索引文件路径
+            customer_list: 建立索引时使用的买家名单
+
+        返回:
+            FeatureCodeIndex 对象，文件版本或买家数量不符时返回 None
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        if data.get('version') != INDEX_VERSION or data.get('count') != len(customer_list):
+            return None
+        return cls(customer_list, data['positions'], data['code_length'])
+
+    def __len__(self):
+        return len(self.customer_list)
+
+
+def load_index(customer_list, index_dir=DEFAULT_INDEX_DIR, code_length=DEFAULT_CODE_LENGTH):
+    """
+    获取名单的特征码索引（磁盘上有同一名单、同一位数的索引时直接读取，否则建立并保存）
+
+    参数:
+        customer_list: 买家字典列表
+        index_dir: 索引目录（None 表示不持久化）
+        code_length: 特征码位数
+
+    返回:
+        FeatureCodeIndex 对象
+    """
+    if not index_dir:
+        return FeatureCodeIndex(customer_list, code_length=code_length)
+
+    key = list_hash(customer_list, code_length)
+    if key in _memory_indexes:
+        _memory_indexes.move_to_end(key)
+        cached = _memory_indexes[key]
+        index = FeatureCodeIndex(customer_list, cached.positions, code_length)
+        index._derived = cached._derived
+        return index
+
+    index = None
+    path = os.path.join(index_dir, f"{key}.json")
+    if os.path.exists(path):
+        try:
+            index = FeatureCodeIndex.load(path, customer_list)
+        except (OSError, ValueError, KeyError):
+            index = None  # 损坏的索引文件，重新建立
+
+    if index is None:
+        index = FeatureCodeIndex(customer_list, code_length=code_length)
+        try:
+            os.makedirs(index_dir, exist_ok=True)
+            index.save(path)
+        except OSError:
+            pass  # 无法写入时只在内存中使用
+
+    _memory_indexes[key] = index
+    while len(_memory_indexes) > MEMORY_INDEXES:
+        _memory_indexes.popitem(last=False)
+    return index
+
+
+def find_buyers_by_code(feature_code, customer_list, index_dir=DEFAULT_INDEX_DIR):
+    """
+    根据特征码查找全部匹配的买家（按特征码长度使用对应位数的索引）
+
+    参数:
+        feature_code: 特征码（4~8 位）
+        customer_list: 买家字典列表
+        index_dir: 索引目录
+
+    返回:
+        匹配的买家信息字典列表（撞码时包含多位买家），没找到时为空列表
+    """
+    feature_code = str(feature_code).upper().strip()
+    return load_index(customer_list, index_dir, len(feature_code)).lookup(feature_code)
+
+
+def rank_buyers_by_chars(index_for_length, chars, top_k=DEFAULT_TOP_K, code_length=None):
+    """
+    按位置点字符集合在各位数的索引中查找买家并合并排序
+
+    检测到的字符数不能说明特征码位数（漏点、污点都会改变字符数），
+    位数未知时在全部支持的位数中查找，按差异合并
+
+    参数:
+        index_for_length: 按位数返回 FeatureCodeIndex 的函数
+        chars: 检测到的字符
+        top_k: 最少返回的候选数
+        code_length: 特征码位数（已知时只查该位数，如发行参数或台账中的位数）
+
+    返回:
+        字典列表 {'customer', 'feature_code', 'code_length', 'missing', 'extra'}，
+        每位买家只出现一次（取距离最小的位数，同距离时取短码），
+        按距离排列（同距离时短码在前），字符集合完全一致的买家全部返回
+    """
+    lengths = [code_length] if code_length else SUPPORTED_CODE_LENGTHS
+    best = {}
+    for length in lengths:
+        for match in index_for_length(length).rank_by_chars(chars, top_k):
+            key = buyer_id(match['customer'])
+            distance = match['missing'] + match['extra']
+            if key not in best or distance < best[key]['missing'] + best[key]['extra']:
+                best[key] = dict(match, code_length=length)
+    ranked = sorted(best.values(),
+                    key=lambda match: (match['missing'] + match['extra'], match['code_length']))
+
+    exact = sum(1 for match in ranked if match['missing'] + match['extra'] == 0)
+    return ranked[:max(top_k, exact)]
+
+
+def find_buyers_by_chars(chars, customer_list, top_k=DEFAULT_TOP_K, index_dir=DEFAULT_INDEX_DIR,
+                         code_length=None):
+    """
+    根据位置点字符集合（无顺序）查找最接近的买家
+
+    参数:
+        chars: 检测到的字符
+        customer_list: 买家字典列表
+        top_k: 最少返回的候选数
+        index_dir: 索引目录
+        code_length: 特征码位数（None 时在全部支持的位数中查找）
+
+    返回:
+        rank_buyers_by_chars 的候选列表
+    """
+    return rank_buyers_by_chars(lambda length: load_index(customer_list, index_dir, length),
+                                chars, top_k, code_length)
+
+
+def find_buyers_by_bits(bits, customer_list, confidence=None, max_distance=DEFAULT_MAX_DISTANCE,
+                        top_k=None, index_dir=DEFAULT_INDEX_DIR):
+    """
+    根据有误码的装订线读数查找买家（特征码位数由位串长度决定）
+
+    参数:
+        bits: 装订线读出的二进制字符串
+        customer_list: 买家字典列表
+        confidence: 每一位的置信度数组（可选）
+        max_distance: 允许的误码位数
+        top_k: 最多返回的特征码数
+        index_dir: 索引目录
+
+    返回:
+        FeatureCodeIndex.nearest 的候选列表
+    """
+    code_length = len(bits) // BITS_PER_CHAR
+    if code_length not in SUPPORTED_CODE_LENGTHS:
+        return []
+    return load_index(customer_list, index_dir, code_length).nearest(bits, confidence,
+                                                                     max_distance, top_k)
+
+
+def unambiguous_code(matches):
+    """
+    容错查找结果中代价唯一最小的特征码
+
+    参数:
+        matches: nearest / find_buyers_by_bits / IssuanceLedger.nearest 的结果
+
+    返回:
+        特征码，没有候选或最小代价并列时返回 None
+    """
+    costs = {}
+    for match in matches:
+        costs.setdefault(match['feature_code'], match['cost'])
+    ranked = sorted(costs.items(), key=lambda item: item[1])
+    if not ranked or (len(ranked) > 1 and ranked[1][1] <= ranked[0][1]):
+        return None
+    return ranked[0][0]
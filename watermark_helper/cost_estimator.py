@@ -0,0 +1,194 @@
+"""
+处理成本预估模块
+不渲染整份文档：用 pdfinfo 读取页数和页面尺寸，只按目标 DPI 和质量
+完整处理一页样本，再按页面面积外推耗时、内存峰值和输出体积
+不依赖 Streamlit，可独立使用
+"""
+
+import time
+from pdf2image import convert_from_bytes
+
+import image_processor
+import memory_budget
+import pdf_writer
+
+
+class CostEstimate:
+    """
+    处理成本预估结果
+
+    属性:
+        pages: 页数
+        copies: 生成份数
+        sample_page: 样本页页码（从 1 开始）
+        raster_seconds: 栅格化整份文档的预计耗时（秒，批量模式只需一次）
+        copy_seconds: 处理并编码一份副本的预计耗时（秒）
+        total_seconds: 全部副本的预计总耗时（秒）
+        peak_memory_bytes: 预计内存峰值（字节，含进程当前占用）
+        copy_bytes: 单份输出 PDF 的预计体积（字节）
+        total_bytes: 全部副本的预计总体积（字节）
+    """
+
+    def __init__(self, pages, copies, sample_page, raster_seconds, copy_seconds,
+                 peak_memory_bytes, copy_bytes):
+        self.pages = pages
+        self.copies = copies
+        self.sample_page = sample_page
+        self.raster_seconds = raster_seconds
+        self.copy_seconds = copy_seconds
+        self.total_seconds = raster_seconds + copy_seconds * copies
+        self.peak_memory_bytes = peak_memory_bytes
+        self.copy_bytes = copy_bytes
+        self.total_bytes = copy_bytes * copies
+
+    def with_copies(self, copies):
+        """
+        换算为另一份数的预估（样本结果不变，无需重新处理样本页）
+
+        参数:
+            copies: 生成份数
+
+        返回:
+            新的 CostEstimate 对象
+        """
+        return CostEstimate(self.pages, copies, self.sample_page, self.raster_seconds,
+                            self.copy_seconds, self.peak_memory_bytes, self.copy_bytes)
+
+    def describe(self):
+        """生成中文摘要（多行）"""
+        mb = 1024 * 1024
+        return "\n".join([
+            f"页数：{self.pages} 页 × {self.copies} 份（样本：第 {self.sample_page} 页）",
+            f"预计耗时：{format_duration(self.total_seconds)}"
+            f"（每份约 {format_duration(self.copy_seconds)}）",
+            f"预计内存峰值：{self.peak_memory_bytes / mb:.0f} MB",
+            f"预计单份体积：{self.copy_bytes / mb:.2f} MB",
+            f"预计总体积：{self.total_bytes / mb:.1f} MB",
+        ])
+
+
+def format_duration(seconds):
+    """
+    把秒数格式化为易读的中文时长
+
+    参数:
+        seconds: 秒数
+
+    返回:
+        如 '45 秒'、'3 分 20 秒'、'2 小时 5 分'
+    """
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds} 秒"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes} 分 {seconds} 秒"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} 小时 {minutes} 分"
+
+
+def estimate_from_sample(sample_image, page_sizes, sample_index, dpi=200, quality=75,
+                         output_mode='grayscale', copies=1, raster_seconds_per_page=0.0,
+                         watermark_text="", interference_text="", **page_options):
+    """
+    用一页已栅格化的样本外推整份任务的成本
+
+    参数:
+        sample_image: 样本页 PIL Image 对象（目标 DPI）
+        page_sizes: 每页尺寸列表 [(width_pt, height_pt), ...]
+        sample_index: 样本页下标（从 0 开始）
+        dpi: 目标分辨率
+        quality: JPEG 压缩质量
+        output_mode: 输出模式
+        copies: 生成份数
+        raster_seconds_per_page: 样本页的栅格化耗时（秒）
+        watermark_text: 可见水印文字（批量模式传入一份代表性文字）
+        interference_text: 干扰文字内容
+        **page_options: 传给 image_processor.process_page 的其他参数
+
+    返回:
+        CostEstimate 对象
+    """
+    sample_w, sample_h = page_sizes[sample_index]
+    sample_area = sample_w * sample_h
+    area_factor = sum(w * h for w, h in page_sizes) / sample_area
+
+    start = time.perf_counter()
+    processed = image_processor.process_page(sample_image.copy(), watermark_text,
+                                             interference_text, **page_options)
+    encoded = image_processor.encode_output_page(processed, output_mode, dpi, quality)
+    page_seconds = time.perf_counter() - start
+
+    copy_bytes = int(encoded.nbytes * area_factor) + pdf_writer.PAGE_OVERHEAD_BYTES * len(page_sizes)
+
+    largest = max(page_sizes, key=lambda size: size[0] * size[1])
+    cost = memory_budget.estimate_page_cost(
+        largest[0], largest[1], dpi, output_mode,
+        enable_anti_copy=page_options.get('enable_anti_copy', False),
+        guilloche=page_options.get('guilloche_density', 20) > 0
+        and page_options.get('guilloche_color_depth', 0.3) > 0,
+        ripple=page_options.get('ripple_amplitude', 2) > 0,
+        watermark=bool(watermark_text),
+        noise=page_options.get('noise_level', 10) > 0
+    )
+    peak = memory_budget.current_rss_bytes() + cost['peak'] + copy_bytes
+
+    return CostEstimate(
+        pages=len(page_sizes),
+        copies=copies,
+        sample_page=sample_index + 1,
+        raster_seconds=raster_seconds_per_page * area_factor,
+        copy_seconds=page_seconds * area_factor,
+        peak_memory_bytes=peak,
+        copy_bytes=copy_bytes,
+    )
+
+
+def estimate_job(pdf_bytes, copies=1, dpi=200, quality=75, output_mode='grayscale',
+                 sample_page=None, watermark_text="", interference_text="",
+                 **page_options):
+    """
+    预估处理任务的耗时、内存峰值和输出体积（不渲染整份文档）
+
+    流程：
+    1. pdfinfo 读取页数和每页尺寸
+    2. 只栅格化一页样本（默认取中间页，避开封面）
+    3. 按目标参数完整处理并编码样本页，计时
+    4. 按页面面积外推到整份文档和全部副本
+
+    参数:
+        pdf_bytes: PDF 文件的字节内容
+        copies: 生成份数（批量模式为买家数量）
+        dpi: 目标分辨率
+        quality: JPEG 压缩质量
+        output_mode: 输出模式
+        sample_page: 样本页页码（从 1 开始，可选）
+        watermark_text: 可见水印文字
+        interference_text: 干扰文字内容
+        **page_options: 传给 image_processor.process_page 的其他参数
+
+    返回:
+        CostEstimate 对象
+    """
+    info = image_processor.probe_pdf(pdf_bytes)
+    page_sizes = info['page_sizes']
+    if not page_sizes:
+        raise ValueError("PDF 没有页面，无法预估")
+
+    if sample_page is None:
+        sample_page = (len(page_sizes) + 1) // 2
+    sample_page = max(1, min(sample_page, len(page_sizes)))
+
+    start = time.perf_counter()
+    sample_image = convert_from_bytes(pdf_bytes, dpi=dpi, first_page=sample_page,
+                                      last_page=sample_page,
+                                      poppler_path=image_processor.POPPLER_PATH)[0]
+    raster_seconds = time.perf_counter() - start
+
+    return estimate_from_sample(
+        sample_image, page_sizes, sample_page - 1,
+        dpi=dpi, quality=quality, output_mode=output_mode, copies=copies,
+        raster_seconds_per_page=raster_seconds,
+        watermark_text=watermark_text, interference_text=interference_text,
+        **page_options
+    )
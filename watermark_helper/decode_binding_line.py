@@ -6,109 +6,275 @@
 """
 
 import sys
-from pdf2image import convert_from_bytes
+import cv2
+import numpy as np
 from PIL import Image
+import buyer_index
 import image_processor
 
 
-def detect_binding_line_code(image):
+# 装订线参数（与 image_processor.add_binding_line_encoding 保持一致，单位为绘制时的像素）
+BINDING_X = image_processor.BINDING_LINE_X
+START_Y = image_processor.BINDING_LINE_START_Y
+SPACING = image_processor.BINDING_LINE_SPACING
+DOT_RADIUS = 4
+LINE_LENGTH = 12
+LINE_WIDTH = 2
+
+# 每个特征码字符 6 个符号；默认 4 位特征码为 24 个符号
+BITS_PER_CHAR = buyer_index.BITS_PER_CHAR
+BINDING_BITS = image_processor.DEFAULT_CODE_LENGTH * BITS_PER_CHAR
+
+# 至少识别出这个比例的符号才认为解码成功（24 个符号时为 20 个）
+MIN_SYMBOL_RATIO = 5 / 6
+
+# 模板匹配的尺度金字塔：溯源分辨率 / 绘制分辨率在 0.5 - 2 倍之间（如 300 DPI 发行、200 DPI 溯源）
+# 相邻尺度相差 19%，归一化相关对这个量级的尺寸偏差不敏感
+BINDING_SCALES = tuple(2 ** (k / 4) for k in range(-4, 5))
+
+# 装订线水平方向允许的偏移（相对标称位置的比例，另加 8 像素）
+BINDING_X_TOLERANCE = 1.5
+
+# 归一化相关系数高于该值才算检测到符号
+SYMBOL_THRESHOLD = 0.5
+
+# 装订线标记的灰度范围（绘制为 160 灰；上限留出 JPEG 压缩、扫描和配准重采样后
+# 细线变浅的余量）。更深的正文、黑色污点不算装订线标记
+MARK_GRAY_RANGE = (130, 215)
+
+# 这些输出模式把溯源标记强制为纯黑（二值化页面 / MRC 文字蒙版），装订线按深色像素读取
+BLACK_MARK_MODES = ('bilevel', 'mrc')
+
+
+def _binding_templates(scale):
     """
-    从图像中检测装订线编码（点线二进制）
+    生成指定尺度下的圆点和短线模板（同尺寸，便于比较相关系数）
+
+    返回:
+        (dot, dash) 两个 float32 数组，值为黑度（1 为标记，0 为背景）
+    """
+    radius = max(1, round(DOT_RADIUS * scale))
+    half_length = max(radius + 1, round(LINE_LENGTH * scale / 2))
+    thickness = max(1, round(LINE_WIDTH * scale))
+    height = 2 * (radius + 1) + 1
+    width = 2 * (half_length + 1) + 1
+    center = (width // 2, height // 2)
+
+    dot = np.zeros((height, width), np.float32)
+    cv2.circle(dot, center, radius, 1.0, -1)
+
+    dash = np.zeros((height, width), np.float32)
+    cv2.line(dash, (center[0] - half_length, center[1]), (center[0] + half_length, center[1]),
+             1.0, thickness)
+
+    return dot, dash
+
+
+def _match(darkness, template):
+    """归一化相关匹配，返回以模板中心对齐的响应图（与 darkness 同尺寸）"""
+    response = cv2.matchTemplate(darkness, template, cv2.TM_CCOEFF_NORMED)
+    response = np.nan_to_num(response, nan=0.0, posinf=0.0, neginf=0.0)
+    height, width = template.shape
+    top, left = height // 2, width // 2
+    return cv2.copyMakeBorder(response, top, height - 1 - top, left, width - 1 - left,
+                              cv2.BORDER_CONSTANT, value=0)
+
+
+def mark_darkness(gray, output_mode=None):
+    """
+    只保留装订线标记颜色的像素
+
+    参数:
+        gray: float32 灰度数组
+        output_mode: 发行时的输出模式（bilevel / mrc 的标记为纯黑，其余为浅灰）
+
+    返回:
+        黑度数组（255 - 灰度，标记颜色以外为 0）
+    """
+    low = 0 if output_mode in BLACK_MARK_MODES else MARK_GRAY_RANGE[0]
+    ink = (gray >= low) & (gray <= MARK_GRAY_RANGE[1])
+    return np.where(ink, 255 - gray, 0).astype(np.float32)
+
+
+def min_symbols(bit_count):
+    """解码成功至少需要识别出的符号个数"""
+    return int(np.ceil(bit_count * MIN_SYMBOL_RATIO))
+
+
+def _detect_code_length(symbol_count):
+    """
+    由网格上连续符号的跨度推断特征码位数
+
+    允许末端缺失 1 个符号；跨度超过最长编码时（如网格上混入页面内容）取最长位数
+    """
+    lengths = [length for length in image_processor.SUPPORTED_CODE_LENGTHS
+               if length * BITS_PER_CHAR <= symbol_count + 1]
+    return lengths[-1] if lengths else image_processor.SUPPORTED_CODE_LENGTHS[0]
+
+
+def read_binding_line(image, scales=BINDING_SCALES, code_length=None, output_mode=None):
+    """
+    用模板匹配读取装订线编码（容忍缩放和偏移，自动识别特征码位数）
+
+    在左侧窄条上按尺度金字塔匹配圆点 / 短线模板，选出响应最强的尺度和列，
+    由检测到的符号峰值拟合间距和起点，按符号跨度确定位数后一次性读出全部符号
 
     参数:
         image: PIL Image 对象
+        scales: 尝试的尺度列表（绘制像素 → 图像像素）
+        code_length: 特征码位数（None 表示自动识别）
+        output_mode: 发行时的输出模式（见 mark_darkness）。None 表示未知：
+                     先只读浅灰标记，读不出装订线时再按纯黑标记读取
 
     返回:
-        二进制字符串，如果失败返回 None
+        字典，未找到装订线时返回 None
+        - bits: 二进制字符串（位数 × 6，未检测到的符号记为 0）
+        - code_length: 特征码位数
+        - confidence: 每个符号的置信度数组（圆点与短线响应之差，0 - 2）
+        - present: 每个符号是否检测到的布尔数组
+        - scale: 匹配的尺度
+        - pitch: 符号间距（像素）
+        - origin: 第一个符号的中心坐标 (x, y)
     """
-    width, height = image.size
-    pixels = image.load()
-
-    # 装订线参数（与 add_binding_line_encoding 保持一致）
-    binding_x = 25
-    start_y = 200
-    spacing = 40
-    dot_radius = 4
-    line_length = 12
-
-    binary_str = ''
-    detected_count = 0
-
-    # 尝试检测24个符号（24位二进制）
-    for i in range(24):
-        y_pos = start_y + i * spacing
-
-        # 确保不超出页面
-        if y_pos >= height - 100:
-            break
-
-        # 检测该位置的符号类型
-        # 策略：检查一个小区域内的像素
-        dot_score = 0  # 圆点的特征分数
-        line_score = 0  # 线条的特征分数
-
-        # 检测圆点（检查中心附近的圆形区域）
-        for dx in range(-dot_radius, dot_radius + 1):
-            for dy in range(-dot_radius, dot_radius + 1):
-                check_x = binding_x + dx
-                check_y = y_pos + dy
-
-                if 0 <= check_x < width and 0 <= check_y < height:
-                    pixel = pixels[check_x, check_y]
-
-                    # 检查是否为灰色（装订线颜色 160, 160, 160）
-                    if isinstance(pixel, tuple):
-                        # RGB 或 RGBA
-                        r, g, b = pixel[:3]
-                        # 允许一定误差
-                        if 130 <= r <= 190 and 130 <= g <= 190 and 130 <= b <= 190:
-                            # 如果在圆形范围内，增加圆点分数
-                            if dx * dx + dy * dy <= dot_radius * dot_radius:
-                                dot_score += 1
-                    else:
-                        # 灰度图
-                        if 130 <= pixel <= 190:
-                            if dx * dx + dy * dy <= dot_radius * dot_radius:
-                                dot_score += 1
-
-        # 检测线条（水平线）
-        for dx in range(-line_length // 2, line_length // 2 + 1):
-            check_x = binding_x + dx
-            check_y = y_pos
-
-            if 0 <= check_x < width and 0 <= check_y < height:
-                pixel = pixels[check_x, check_y]
-
-                if isinstance(pixel, tuple):
-                    r, g, b = pixel[:3]
-                    if 130 <= r <= 190 and 130 <= g <= 190 and 130 <= b <= 190:
-                        line_score += 1
-                else:
-                    if 130 <= pixel <= 190:
-                        line_score += 1
-
-        # 判断是点还是线
-        if dot_score > line_score and dot_score > 3:
-            binary_str += '0'
-            detected_count += 1
-        elif line_score > dot_score and line_score > 3:
-            binary_str += '1'
-            detected_count += 1
-        else:
-            # 无法确定，可能没有符号或识别失败
-            pass
+    if output_mode is None:
+        result = _read_binding_line(image, scales, code_length, 'grayscale')
+        if result is not None and result['present'].sum() >= min_symbols(len(result['bits'])):
+            return result
+        black = _read_binding_line(image, scales, code_length, 'bilevel')
+        if black is not None and (result is None or black['present'].sum() > result['present'].sum()):
+            return black
+        return result
+    return _read_binding_line(image, scales, code_length, output_mode)
+
+
+def _read_binding_line(image, scales, code_length, output_mode):
+    """read_binding_line 的实现（标记颜色由 output_mode 确定）"""
+    def strip_width_for(scale):
+        """该尺度下装订线可能出现的左侧窄条宽度"""
+        return min(image.width,
+                   int(np.ceil((BINDING_X + LINE_LENGTH) * scale * BINDING_X_TOLERANCE)) + 8)
+
+    strip = np.asarray(image.crop((0, 0, strip_width_for(max(scales)), image.height)).convert('L'),
+                       dtype=np.float32)
+    darkness = mark_darkness(strip, output_mode)
+
+    # 只在有深色像素的行范围内匹配（页边大部分是空白）
+    dark_rows = np.flatnonzero(darkness.max(axis=1) > 32)
+    if len(dark_rows) == 0:
+        return None
+    row_offset = max(int(dark_rows[0]) - 2 * SPACING, 0)
+    darkness = darkness[row_offset:int(dark_rows[-1]) + 2 * SPACING]
+    height = darkness.shape[0]
+
+    # 1. 尺度和列：每列取最强的 24 个响应求和，得分最高者即装订线所在
+    best = None
+    for scale in scales:
+        dot, dash = _binding_templates(scale)
+        strip_width = strip_width_for(scale)
+        if dot.shape[0] > height or dot.shape[1] > strip_width or height < BINDING_BITS:
+            continue
+
+        dot_response = _match(darkness[:, :strip_width], dot)
+        dash_response = _match(darkness[:, :strip_width], dash)
+        response = np.maximum(dot_response, dash_response)
+
+        top = np.partition(response, height - BINDING_BITS, axis=0)[height - BINDING_BITS:]
+        column_scores = top.sum(axis=0)
+        column = int(np.argmax(column_scores))
+
+        if best is None or column_scores[column] > best[0]:
+            best = (column_scores[column], scale, column, dot_response, dash_response)
+
+    if best is None:
+        return None
+
+    _, scale, column, dot_response, dash_response = best
+
+    # 允许符号中心左右偏离 1 像素
+    columns = slice(max(column - 1, 0), column + 2)
+    dot_profile = dot_response[:, columns].max(axis=1)
+    dash_profile = dash_response[:, columns].max(axis=1)
+    profile = np.maximum(dot_profile, dash_profile)
 
-    # 如果检测到的符号数量不是24，可能识别失败
-    if detected_count < 20:
+    # 2. 符号峰值：半个间距内的局部最大值
+    nominal_pitch = SPACING * scale
+    window = max(3, int(nominal_pitch / 2) | 1)
+    local_max = cv2.dilate(profile.reshape(-1, 1), np.ones((window, 1), np.uint8)).ravel()
+    peaks = np.flatnonzero((profile >= local_max) & (profile > SYMBOL_THRESHOLD))
+    if len(peaks) < 2:
         return None
 
-    # 如果不足24位，尝试填充（假设缺失的是0）
-    if len(binary_str) < 24:
-        binary_str += '0' * (24 - len(binary_str))
-    elif len(binary_str) > 24:
-        binary_str = binary_str[:24]
+    # 3. 间距：相邻峰值之差中接近标称间距的中位数
+    #    （特征码较长时绘制端会压缩间距，最小为标称的 0.6 倍）
+    gaps = np.diff(peaks)
+    minimum_pitch = image_processor.BINDING_LINE_MIN_SPACING * scale * 0.9
+    gaps = gaps[(gaps > minimum_pitch) & (gaps < nominal_pitch * 1.25)]
+    if len(gaps) == 0:
+        return None
+    pitch = float(np.median(gaps))
+
+    # 4. 以落在同一等间距网格上的峰值最多的峰为基准编号，
+    #    去掉网格外的峰值（如竖排明码、装订线标题），最小二乘拟合起点和间距
+    distance = (peaks[None, :] - peaks[:, None]) / pitch
+    on_grids = np.abs(distance - np.round(distance)) < 0.25
+    reference = peaks[np.argmax(on_grids.sum(axis=1))]
+    indices = np.round((peaks - reference) / pitch)
+    on_grid = np.abs(peaks - reference - indices * pitch) < pitch * 0.25
+    peaks, indices = peaks[on_grid], indices[on_grid]
+    if len(peaks) >= 2 and np.ptp(indices) > 0:
+        pitch, offset = np.polyfit(indices, peaks, 1)
+    else:
+        offset = float(peaks[0])
+
+    # 网格上符号的跨度决定特征码位数；跨度更长时取响应总和最大的连续窗口
+    first, last = int(indices.min()), int(indices.max())
+    if code_length is None:
+        code_length = _detect_code_length(last - first + 1)
+    bit_count = code_length * BITS_PER_CHAR
+    starts = np.arange(first, max(first, last - bit_count + 1) + 1)
+    grid = offset + (starts[:, None] + np.arange(bit_count)) * pitch
+    grid_rows = np.clip(np.round(grid).astype(np.int64), 0, height - 1)
+    start = starts[np.argmax(profile[grid_rows].sum(axis=1))]
+
+    # 5. 一次性读出全部符号（上下各容忍 1 像素）
+    rows = offset + (start + np.arange(bit_count)) * pitch
+    rows = np.clip(np.round(rows).astype(np.int64)[:, None] + np.arange(-1, 2), 0, height - 1)
+    dot_scores = dot_profile[rows].max(axis=1)
+    dash_scores = dash_profile[rows].max(axis=1)
+
+    present = np.maximum(dot_scores, dash_scores) > SYMBOL_THRESHOLD
+    is_line = dash_scores > dot_scores
+    bits = ''.join('1' if line and found else '0' for line, found in zip(is_line, present))
+
+    return {
+        'bits': bits,
+        'code_length': code_length,
+        'confidence': np.where(present, np.abs(dash_scores - dot_scores), 0.0),
+        'present': present,
+        'scale': scale,
+        'pitch': float(pitch),
+        'origin': (column, float(row_offset + offset + start * pitch)),
+    }
+
+
+def detect_binding_line_code(image, output_mode=None):
+    """
+    从图像中检测装订线编码（点线二进制）
+
+    参数:
+        image: PIL Image 对象
+        output_mode: 发行时的输出模式（None 表示未知，见 read_binding_line）
+
+    返回:
+        二进制字符串（位数 × 6），如果失败返回 None
+    """
+    result = read_binding_line(image, output_mode=output_mode)
 
-    return binary_str
+    # 检测到的符号太少，可能识别失败
+    if result is None or result['present'].sum() < min_symbols(len(result['bits'])):
+        return None
+
+    return result['bits']
 
 
 def decode_pdf(pdf_path):
@@ -137,31 +303,30 @@ def decode_pdf(pdf_path):
 
     print()
 
-    # 转换为图像
-    print("2. 转换 PDF 为图像")
+    # 逐页检测（只渲染页边区域），封面或被裁剪的页面没有编码时继续检查下一页
+    print("2. 逐页检测装订线编码")
     print("-" * 60)
+    binary_str = None
     try:
-        images = convert_from_bytes(pdf_bytes, dpi=200)
-        print(f"PDF 页数: {len(images)}")
-
-        if not images:
-            print("PDF 没有页面")
-            return
-
-        first_page = images[0]
-        width, height = first_page.size
-        print(f"第一页尺寸: {width}x{height}")
+        page_count = image_processor.count_pdf_pages(pdf_bytes)
+        print(f"PDF 页数: {page_count}")
+
+        pages = image_processor.iter_trace_pages(pdf_bytes, range(page_count), dpi=200)
+        try:
+            for index, page in enumerate(pages):
+                binary_str = detect_binding_line_code(page)
+                if binary_str:
+                    print(f"第 {index + 1} 页检测到装订线编码")
+                    break
+                print(f"第 {index + 1} 页未检测到装订线编码")
+        finally:
+            pages.close()
     except Exception as e:
         print(f"PDF 转图像失败: {str(e)}")
         return
 
     print()
 
-    # 检测装订线编码
-    print("3. 检测装订线编码")
-    print("-" * 60)
-    binary_str = detect_binding_line_code(first_page)
-
     if not binary_str:
         print("未检测到装订线编码")
         print()
@@ -176,7 +341,7 @@ def decode_pdf(pdf_path):
     print()
 
     # 解码为特征码
-    print("4. 解码为特征码")
+    print("3. 解码为特征码")
     print("-" * 60)
     feature_code = image_processor.decode_from_binary(binary_str)
     print(f"特征码: {feature_code}")
@@ -3,9 +3,9 @@
 空间溯源系统 - 特征码反查工具
 
 使用方法：
-1. 从盗版 PDF 中找到 4 位特征码（装订线或位置点）
+1. 从盗版 PDF 中找到特征码（4~8 位，装订线或位置点）
 2. 运行此脚本，输入特征码
-3. 脚本会遍历买家名单，找到对应的买家
+3. 脚本通过特征码索引找到对应的买家（撞码时列出全部）
 
 示例：
 python decode_feature_code.py
@@ -13,37 +13,7 @@ python decode_feature_code.py
 
 import sys
 import pandas as pd
-from image_processor import generate_feature_code
-
-
-def find_buyer_by_code(feature_code, customer_list):
-    """
-    根据特征码查找对应的买家
-
-    参数:
-        feature_code: 4位特征码，如 "W3MK"
-        customer_list: 买家列表，格式 [{'name': '张三', 'phone': '138...'}, ...]
-
-    返回:
-        匹配的买家信息字典，如果没找到返回 None
-    """
-    feature_code = feature_code.upper().strip()
-
-    for customer in customer_list:
-        name = customer.get('name', '')
-        phone = customer.get('phone', '')
-
-        # 生成 buyer_id
-        buyer_id = f"{name}_{phone}"
-
-        # 计算特征码
-        code = generate_feature_code(buyer_id)
-
-        # 匹配
-        if code == feature_code:
-            return customer
-
-    return None
+import buyer_index
 
 
 def main():
@@ -76,10 +46,10 @@ def main():
         return
 
     # 输入特征码
-    feature_code = input("请输入从盗版 PDF 中识别的 4 位特征码（如 W3MK）：").strip()
+    feature_code = input("请输入从盗版 PDF 中识别的特征码（如 W3MK）：").strip()
 
-    if len(feature_code) != 4:
-        print("错误：特征码必须是 4 位字符！")
+    if len(feature_code) not in buyer_index.SUPPORTED_CODE_LENGTHS:
+        print("错误：特征码必须是 4~8 位字符！")
         return
 
     print()
@@ -87,14 +57,18 @@ def main():
     print()
 
     # 查找买家
-    result = find_buyer_by_code(feature_code, customer_list)
+    index = buyer_index.load_index(customer_list, code_length=len(feature_code))
+    matches = index.lookup(feature_code)
 
-    if result:
+    if matches:
         print("=" * 60)
         print("找到盗版来源！")
         print("=" * 60)
-        print(f"姓名：{result['name']}")
-        print(f"手机号：{result['phone']}")
+        if len(matches) > 1:
+            print(f"注意：{len(matches)} 位买家的特征码相同，请结合可见水印进一步核对")
+        for result in matches:
+            print(f"姓名：{result['name']}")
+            print(f"手机号：{result['phone']}")
         print()
         print("建议采取的行动：")
         print("1. 联系该买家，确认是否本人传播")
@@ -122,11 +96,9 @@ def main():
         print(f"{'姓名':<10} {'手机号':<15} {'特征码':<10}")
         print("-" * 60)
 
-        for customer in customer_list:
+        for customer, code in zip(customer_list, index.codes):
             name = customer.get('name', '')
             phone = customer.get('phone', '')
-            buyer_id = f"{name}_{phone}"
-            code = generate_feature_code(buyer_id)
             print(f"{name:<10} {phone:<15} {code:<10}")
 
 
@@ -150,9 +122,8 @@ def batch_generate_codes():
             return
 
         # 添加特征码列
-        df['feature_code'] = df.apply(
-            lambda row: generate_feature_code(f"{row['name']}_{row['phone']}"),
-            axis=1
+        df['feature_code'] = buyer_index.feature_codes(
+            [f"{name}_{phone}" for name, phone in zip(df['name'], df['phone'])]
         )
 
         # 保存到新文件
@@ -0,0 +1,216 @@
+"""
+装订线明码识别模块
+
+装订线明码是已知字体、已知字号的 4~8 个字符，不需要通用 OCR 引擎：
+用发行时同一字体渲染 36 个字符作为模板，从左侧窄条切出每个字符，
+归一化后与全部模板一次矩阵乘法求归一化互相关，取最相似者
+不依赖 Streamlit 和 Tesseract，可独立使用
+"""
+
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw
+
+import image_processor
+
+
+# 字符归一化后的边长（先按长边补成正方形，保留字形的宽高比）
+GLYPH_SIZE = 16
+
+# 深度（255 - 灰度）超过该值的像素视为笔画（小字号抗锯齿后笔画很淡，阈值不能高）
+INK_THRESHOLD = 40
+
+# 估计行距时只看明码最左侧的几列（宽字符右侧可能紧贴装订线标题）
+PROBE_COLUMNS = 4
+
+# 溯源分辨率 / 发行分辨率的范围（与装订线解码的尺度金字塔一致）
+MIN_SCALE, MAX_SCALE = 0.5, 2.0
+
+# 明码字符右侧留出的宽度（发行像素），窄条只取到这里
+GLYPH_MAX_WIDTH = 12
+
+# 模板在每个方向上的亚像素相位数（缩放后小字号的笔画落点不同，形状差别明显）
+TEMPLATE_PHASES = 3
+
+
+def _normalize(darkness):
+    """把字符深度图补成正方形、缩放到 GLYPH_SIZE，返回零均值单位向量"""
+    height, width = darkness.shape
+    side = max(height, width)
+    square = np.zeros((side, side), dtype=np.float32)
+    top, left = (side - height) // 2, (side - width) // 2
+    square[top:top + height, left:left + width] = darkness
+
+    vector = cv2.resize(square, (GLYPH_SIZE, GLYPH_SIZE), interpolation=cv2.INTER_AREA).ravel()
+    vector = vector - vector.mean()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def _ink_box(darkness):
+    """笔画像素的外接框 (top, bottom, left, right)，没有笔画时返回 None"""
+    rows = np.flatnonzero((darkness > INK_THRESHOLD).any(axis=1))
+    columns = np.flatnonzero((darkness > INK_THRESHOLD).any(axis=0))
+    if len(rows) == 0:
+        return None
+    return rows[0], rows[-1] + 1, columns[0], columns[-1] + 1
+
+
+@lru_cache(maxsize=8)
+def glyph_templates(scale=1.0):
+    """
+    用明码字体渲染 36 个字符的模板（按溯源尺度缩放，每个字符若干亚像素相位）
+
+    参数:
+        scale: 溯源分辨率 / 发行分辨率（调用方取两位小数，便于缓存）
+
+    返回:
+        (每个模板对应的字符列表, 模板矩阵 N × GLYPH_SIZE²，每行为零均值单位向量)
+    """
+    font = image_processor.visible_code_font()
+    phases = [0.0] if scale == 1.0 else np.arange(TEMPLATE_PHASES) / TEMPLATE_PHASES
+    size = (GLYPH_MAX_WIDTH * 3, image_processor.VISIBLE_CODE_SPACING * 3)
+    # 取样窗口比画布小 1 像素，留出相位偏移的余量
+    window = (size[0] - 1, size[1] - 1)
+    scaled_size = (max(1, round(window[0] * scale)), max(1, round(window[1] * scale)))
+
+    labels, templates = [], []
+    for char in image_processor.FEATURE_CODE_CHARS:
+        canvas = Image.new('L', size, 255)
+        ImageDraw.Draw(canvas).text((GLYPH_MAX_WIDTH, image_processor.VISIBLE_CODE_SPACING), char,
+                                    fill=image_processor.VISIBLE_CODE_COLOR[0], font=font)
+        for dx in phases:
+            for dy in phases:
+                # 按相位偏移取样窗口后一次缩放，模拟字符落在不同亚像素位置上的重采样
+                left, top = dx / scale, dy / scale
+                glyph = canvas if scale == 1.0 else canvas.resize(
+                    scaled_size, Image.LANCZOS,
+                    box=(left, top, left + window[0], top + window[1]))
+                darkness = 255 - np.asarray(glyph, dtype=np.float32)
+                box = _ink_box(darkness)
+                if box is None:
+                    continue
+                top, bottom, left, right = box
+                labels.append(char)
+                templates.append(_normalize(darkness[top:bottom, left:right]))
+    return labels, np.stack(templates)
+
+
+@lru_cache(maxsize=1)
+def glyph_width():
+    """明码字体中最宽字符的笔画宽度（发行像素）"""
+    font = image_processor.visible_code_font()
+    widths = []
+    for char in image_processor.FEATURE_CODE_CHARS:
+        canvas = Image.new('L', (GLYPH_MAX_WIDTH * 3, image_processor.VISIBLE_CODE_SPACING * 3), 255)
+        ImageDraw.Draw(canvas).text((GLYPH_MAX_WIDTH, image_processor.VISIBLE_CODE_SPACING), char,
+                                    fill=image_processor.VISIBLE_CODE_COLOR[0], font=font)
+        _, _, left, right = _ink_box(255 - np.asarray(canvas, dtype=np.float32))
+        widths.append(right - left)
+    return max(widths)
+
+
+def _runs(mask, max_gap=1):
+    """布尔序列中连续 True 的区间 [(start, end), ...]，间隔不超过 max_gap 的区间合并"""
+    runs = []
+    for index in np.flatnonzero(mask):
+        if runs and index - runs[-1][1] <= max_gap:
+            runs[-1][1] = index + 1
+        else:
+            runs.append([index, index + 1])
+    return [tuple(run) for run in runs]
+
+
+def _evenly_spaced(boxes):
+    """取行间距一致（与中位数相差不超过 25%）的最长连续字符序列"""
+    if len(boxes) < 3:
+        return boxes
+    centers = np.array([(top + bottom) / 2 for top, bottom in boxes])
+    gaps = np.diff(centers)
+    pitch = np.median(gaps)
+    regular = np.abs(gaps - pitch) <= pitch * 0.25
+
+    best = (0, 0)
+    for start, end in _runs(regular, max_gap=0):
+        if end - start > best[1] - best[0]:
+            best = (start, end)
+    return boxes[best[0]:best[1] + 1]
+
+
+def read_visible_code(image, scale=None):
+    """
+    识别装订线明码（竖排小字）
+
+    参数:
+        image: PIL Image 对象（整页或 render_trace_pages 的页边画布）
+        scale: 溯源分辨率 / 发行分辨率（可选，如装订线解码给出的尺度；None 时在 0.5~2 倍范围内查找）
+
+    返回:
+        字典，少于 4 个字符时返回 None
+        - code: 识别出的明码
+        - confidence: 每个字符最佳与次佳模板相关系数之差（0 - 2）
+        - scores: 每个字符的最佳相关系数
+        - boxes: 每个字符在图像中的外接框 (left, top, right, bottom)
+    """
+    low, high = (scale, scale) if scale else (MIN_SCALE, MAX_SCALE)
+    max_length = image_processor.SUPPORTED_CODE_LENGTHS[-1]
+    top = int((image_processor.VISIBLE_CODE_START_Y - image_processor.VISIBLE_CODE_SPACING / 2) * low)
+    bottom = int(np.ceil((image_processor.VISIBLE_CODE_START_Y
+                          + max_length * image_processor.VISIBLE_CODE_SPACING) * high))
+    right = int(np.ceil((image_processor.VISIBLE_CODE_X + GLYPH_MAX_WIDTH) * high))
+
+    strip = image.crop((0, max(top, 0), min(right, image.width), min(bottom, image.height)))
+    darkness = 255 - np.asarray(strip.convert('L'), dtype=np.float32)
+    ink = darkness > INK_THRESHOLD
+
+    def row_boxes(right):
+        """左侧列范围内的字符行（取行距一致的最长序列）"""
+        boxes = [box for box in _runs(ink[:, left:right].any(axis=1)) if box[1] - box[0] >= 2]
+        return _evenly_spaced(boxes)[:max_length]
+
+    # 明码是页面最左侧的笔画
+    columns = np.flatnonzero(ink.any(axis=0))
+    if len(columns) == 0:
+        return None
+    left = int(columns[0])
+
+    # 未给出尺度时由最左侧几列的字符行距估计
+    if not scale:
+        boxes = row_boxes(left + PROBE_COLUMNS)
+        if len(boxes) < 2:
+            return None
+        centers = [(box_top + box_bottom) / 2 for box_top, box_bottom in boxes]
+        scale = float(np.median(np.diff(centers))) / image_processor.VISIBLE_CODE_SPACING
+    scale = round(float(np.clip(scale, MIN_SCALE, MAX_SCALE)), 2)
+
+    # 明码列宽不超过最宽字符，避免把右侧紧贴的装订线标题切进来
+    right = left + int(np.ceil(glyph_width() * scale))
+    boxes = row_boxes(right)
+    if len(boxes) < image_processor.SUPPORTED_CODE_LENGTHS[0]:
+        return None
+
+    labels, templates = glyph_templates(scale)
+    glyphs, glyph_boxes = [], []
+    for row_top, row_bottom in boxes:
+        glyph = darkness[row_top:row_bottom, left:right]
+        glyph_top, glyph_bottom, glyph_left, glyph_right = _ink_box(glyph)
+        glyphs.append(_normalize(glyph[glyph_top:glyph_bottom, glyph_left:glyph_right]))
+        glyph_boxes.append((left + glyph_left, max(top, 0) + row_top + glyph_top,
+                            left + glyph_right, max(top, 0) + row_top + glyph_bottom))
+
+    # 全部字符与全部模板的相关系数一次算出，每个字符取各相位中的最大值
+    chars = image_processor.FEATURE_CODE_CHARS
+    label_index = np.array([chars.index(label) for label in labels])
+    correlation = np.full((len(glyphs), len(chars)), -1.0, dtype=np.float32)
+    np.maximum.at(correlation.T, label_index, (np.stack(glyphs) @ templates.T).T)
+    ranked = np.sort(correlation, axis=1)
+    best = np.argmax(correlation, axis=1)
+
+    return {
+        'code': ''.join(chars[i] for i in best),
+        'confidence': ranked[:, -1] - ranked[:, -2],
+        'scores': ranked[:, -1],
+        'boxes': glyph_boxes,
+    }
@@ -0,0 +1,134 @@
+"""
+混合模式模块
+保留原 PDF 的矢量文字层，只把 Guilloche 底纹、防复印底纹和可见水印
+渲染一次为带透明通道的图像 XObject，通过 PyMuPDF 放到每一页上
+同尺寸页面引用同一个 XObject，输出体积和耗时几乎与页数、DPI 无关
+不依赖 Streamlit，可独立使用（需要 PyMuPDF）
+"""
+
+import io
+from PIL import Image
+
+import image_processor
+
+try:
+    import pymupdf as fitz
+except ImportError:
+    try:
+        import fitz  # 旧版 PyMuPDF
+    except ImportError:
+        fitz = None
+
+
+# 防护图层的默认渲染分辨率（底纹为浅色细线，150 DPI 已足够）
+DEFAULT_LAYER_DPI = 150
+
+
+def require_fitz():
+    """检查 PyMuPDF 是否可用"""
+    if fitz is None:
+        raise ImportError("混合模式需要 PyMuPDF，请安装: pip install pymupdf")
+
+
+def render_protection_layer(width_pt, height_pt, dpi=DEFAULT_LAYER_DPI,
+                            guilloche_density=20, guilloche_color_depth=0.3,
+                            enable_anti_copy=False, anti_copy_pattern='dot_matrix',
+                            anti_copy_density=50, watermark_text="", watermark_font_size=60,
+                            watermark_density='normal', watermark_color=(128, 128, 128),
+                            watermark_alpha=80):
+    """
+    渲染一页的防护图层（透明背景）
+
+    图层顺序与 process_page 一致：防复印底纹在下，Guilloche 底纹居中，可见水印在上
+
+    参数:
+        width_pt: 页面宽度（pt）
+        height_pt: 页面高度（pt）
+        dpi: 渲染分辨率
+        ...: 其他参数同 image_processor.process_page
+
+    返回:
+        PIL Image 对象（RGBA 模式）
+    """
+    width = max(1, round(width_pt * dpi / 72))
+    height = max(1, round(height_pt * dpi / 72))
+    layer = Image.new('RGBA', (width, height), (255, 255, 255, 0))
+
+    if enable_anti_copy:
+        layer = Image.alpha_composite(layer, image_processor.generate_anti_copy_pattern(
+            width, height, anti_copy_pattern, anti_copy_density))
+
+    if guilloche_density > 0 and guilloche_color_depth > 0:
+        layer = Image.alpha_composite(layer, image_processor.generate_guilloche_pattern(
+            width, height, guilloche_density, guilloche_color_depth))
+
+    if watermark_text:
+        layer = Image.alpha_composite(layer, image_processor.generate_watermark_layer(
+            width, height, watermark_text, watermark_font_size, watermark_density,
+            watermark_color, watermark_alpha))
+
+    return layer
+
+
+def encode_layer(layer):
+    """
+    把防护图层编码为 PNG（PyMuPDF 插入时自动拆分为图像和 SMask）
+
+    参数:
+        layer: RGBA 模式的 PIL Image 对象
+
+    返回:
+        PNG 字节
+    """
+    buffer = io.BytesIO()
+    layer.save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def apply_hybrid_protection(pdf_bytes, dpi=DEFAULT_LAYER_DPI, overlay=True,
+                            progress_callback=None, **layer_options):
+    """
+    在原 PDF 的每一页上放置共享的防护图层（不栅格化原页面）
+
+    参数:
+        pdf_bytes: PDF 文件的字节内容
+        dpi: 防护图层的渲染分辨率
+        overlay: True 放在页面内容上方，False 放在下方（扫描件请用 True）
+        progress_callback: 进度回调函数，接受一个字符串参数
+        **layer_options: 传给 render_protection_layer 的参数
+
+    返回:
+        BytesIO 对象（处理后的 PDF，文字层保持可选中）
+    """
+    require_fitz()
+
+    def update_progress(message):
+        """内部辅助函数：更新进度"""
+        if progress_callback:
+            progress_callback(message)
+
+    doc = fitz.open(stream=pdf_bytes, filetype='pdf')
+
+    # 页面尺寸 → 已插入的图像 xref（同尺寸页面只渲染、嵌入一次）
+    layer_xrefs = {}
+
+    for index, page in enumerate(doc):
+        rect = page.rect
+        size = (round(rect.width, 1), round(rect.height, 1))
+
+        if size in layer_xrefs:
+            page.insert_image(rect, xref=layer_xrefs[size], overlay=overlay)
+            continue
+
+        update_progress(f"渲染防护图层（{size[0]:g} x {size[1]:g} pt，{dpi} DPI）...")
+        layer = render_protection_layer(rect.width, rect.height, dpi, **layer_options)
+        layer_xrefs[size] = page.insert_image(rect, stream=encode_layer(layer),
+                                              overlay=overlay)
+
+    update_progress(f"已处理 {len(doc)} 页，共嵌入 {len(layer_xrefs)} 个防护图层")
+
+    output = io.BytesIO()
+    doc.save(output, garbage=3, deflate=True)
+    doc.close()
+    output.seek(0)
+    return output
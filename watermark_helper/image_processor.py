@@ -5,12 +5,26 @@
 """
 
 import io
+import os
+import subprocess
+import tempfile
+import zipfile
+import re
 import random
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 import cv2
-from pdf2image import convert_from_bytes
+from pdf2image import convert_from_bytes, pdfinfo_from_bytes
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
+import buyer_index
+import memory_budget
+import pdf_writer
+import issuance_ledger
+import page_fingerprint
+import size_target
+import structure_marks
+from page_cache import PageCache, CachedPages, DEFAULT_CACHE_BYTES, document_key, compress_page
 
 
 # ============================================================================
@@ -63,26 +77,76 @@ CHAR_POSITION_MAP = {
 }
 
 
-def generate_feature_code(buyer_id):
+# 特征码字符集和位数只在 buyer_index 中定义（台账、结构标记等模块共用，它们不能导入本模块）
+FEATURE_CODE_CHARS = buyer_index.CODE_CHARS
+DEFAULT_CODE_LENGTH = buyer_index.DEFAULT_CODE_LENGTH
+SUPPORTED_CODE_LENGTHS = buyer_index.SUPPORTED_CODE_LENGTHS
+
+
+def check_code_length(code_length):
+    """检查特征码位数是否受支持"""
+    if code_length not in SUPPORTED_CODE_LENGTHS:
+        raise ValueError(f"特征码位数必须在 {SUPPORTED_CODE_LENGTHS[0]}-{SUPPORTED_CODE_LENGTHS[-1]} "
+                         f"之间，当前为 {code_length}")
+
+
+def collision_probability(buyer_count, code_length=DEFAULT_CODE_LENGTH):
+    """
+    同一批买家中至少两人特征码相同的概率（生日问题近似）
+
+    参数:
+        buyer_count: 买家数量
+        code_length: 特征码位数
+
+    返回:
+        0-1 之间的概率
+    """
+    space = len(FEATURE_CODE_CHARS) ** code_length
+    return 1 - np.exp(-buyer_count * (buyer_count - 1) / (2 * space))
+
+
+def recommended_code_length(buyer_count, max_collision_probability=0.01):
+    """
+    满足撞码概率上限的最短特征码位数
+
+    参数:
+        buyer_count: 买家数量
+        max_collision_probability: 可接受的撞码概率
+
+    返回:
+        特征码位数（超过 8 位仍不满足时返回 8）
     """
-    从买家ID生成4位特征码
+    for code_length in SUPPORTED_CODE_LENGTHS:
+        if collision_probability(buyer_count, code_length) <= max_collision_probability:
+            return code_length
+    return SUPPORTED_CODE_LENGTHS[-1]
+
+
+def generate_feature_code(buyer_id, code_length=DEFAULT_CODE_LENGTH):
+    """
+    从买家ID生成特征码
+
+    较长的特征码以较短的为前缀（4 位特征码与加长前的结果相同）
 
     参数:
         buyer_id: 买家标识（如手机号、姓名等）
+        code_length: 特征码位数（4-8）
 
     返回:
-        4位特征码字符串（包含A-Z和0-9）
+        特征码字符串（包含A-Z和0-9）
     """
+    check_code_length(code_length)
+
     # 使用 SHA256 哈希
     hash_obj = hashlib.sha256(str(buyer_id).encode('utf-8'))
     hash_hex = hash_obj.hexdigest()
 
     # 转换为大写字母和数字
-    chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    chars = FEATURE_CODE_CHARS
     code = ''
 
-    # 从哈希值中提取4个字符
-    for i in range(4):
+    # 每个字符取哈希值的一个 32 位分段
+    for i in range(code_length):
         # 使用哈希值的不同部分
         index = int(hash_hex[i*8:(i+1)*8], 16) % len(chars)
         code += chars[index]
@@ -92,16 +156,16 @@ def generate_feature_code(buyer_id):
 
 def encode_to_binary(feature_code):
     """
-    将4位特征码转换为二进制字符串
+    将特征码转换为二进制字符串（每个字符 6 位）
 
     参数:
-        feature_code: 4位特征码（如 'W3MK'）
+        feature_code: 特征码（如 'W3MK'）
 
     返回:
-        二进制字符串（如 '100001000011100100100101'，24位）
+        二进制字符串（如 '100001000011100100100101'，4 位特征码为 24 位）
     """
-    # 字符集：A-Z(值10-35), 0-9(值0-9)
-    chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    # 字符集：A-Z(值0-25), 0-9(值26-35)
+    chars = FEATURE_CODE_CHARS
 
     binary_str = ''
     for char in feature_code:
@@ -122,12 +186,12 @@ def decode_from_binary(binary_str):
     将二进制字符串解码为特征码
 
     参数:
-        binary_str: 24位二进制字符串
+        binary_str: 二进制字符串（长度为 6 的倍数）
 
     返回:
-        4位特征码
+        特征码（位数 = 二进制位数 / 6，无效值记为 '?'）
     """
-    chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+    chars = FEATURE_CODE_CHARS
 
     code = ''
     # 每6位解码一个字符
@@ -143,24 +207,52 @@ def decode_from_binary(binary_str):
     return code
 
 
-def add_binding_line_encoding(image, buyer_id):
+# 装订线编码版式（绘制像素）
+BINDING_LINE_X = 25        # 距离左边缘的距离
+BINDING_LINE_START_Y = 200  # 起始Y坐标
+BINDING_LINE_SPACING = 40   # 符号间距
+BINDING_LINE_BOTTOM = 100   # 距离下边缘的最小距离
+# 特征码较长、页面放不下时压缩间距，但不小于该值（仍能分辨相邻符号）
+BINDING_LINE_MIN_SPACING = 24
+
+
+def binding_line_spacing(height, symbol_count):
+    """
+    装订线符号间距：默认 40 像素，放不下全部符号时压缩（不小于 24 像素）
+
+    参数:
+        height: 页面像素高度
+        symbol_count: 符号个数（特征码位数 × 6）
+
+    返回:
+        符号间距（像素）
+    """
+    if symbol_count < 2:
+        return BINDING_LINE_SPACING
+    available = (height - BINDING_LINE_BOTTOM - BINDING_LINE_START_Y) // (symbol_count - 1)
+    return max(BINDING_LINE_MIN_SPACING, min(BINDING_LINE_SPACING, available))
+
+
+def add_binding_line_encoding(image, buyer_id, code_length=DEFAULT_CODE_LENGTH):
     """
     在左侧添加装订线编码（点线编码）
 
     外观：普通的装订线装饰（点和线）
     实质：点=0，线=1，二进制编码买家特征码
+    符号个数即特征码位数 × 6，解码时据此自动识别位数
 
     参数:
         image: PIL Image 对象
         buyer_id: 买家标识
+        code_length: 特征码位数
 
     返回:
         添加装订线编码后的 PIL Image 对象
     """
     # 生成特征码
-    feature_code = generate_feature_code(buyer_id)
+    feature_code = generate_feature_code(buyer_id, code_length)
 
-    # 转换为二进制（24位）
+    # 转换为二进制（每个字符 6 位）
     binary_str = encode_to_binary(feature_code)
 
     # 创建绘图对象
@@ -168,9 +260,9 @@ def add_binding_line_encoding(image, buyer_id):
     width, height = image.size
 
     # 装订线参数
-    binding_x = 25  # 距离左边缘的距离
-    start_y = 200   # 起始Y坐标
-    spacing = 40    # 符号间距
+    binding_x = BINDING_LINE_X
+    start_y = BINDING_LINE_START_Y
+    spacing = binding_line_spacing(height, len(binary_str))
 
     # 点的参数
     dot_radius = 4  # 圆点半径
@@ -187,7 +279,7 @@ def add_binding_line_encoding(image, buyer_id):
         y_pos = start_y + i * spacing
 
         # 确保不超出页面
-        if y_pos > height - 100:
+        if y_pos > height - BINDING_LINE_BOTTOM:
             break
 
         if bit == '0':
@@ -217,7 +309,26 @@ def add_binding_line_encoding(image, buyer_id):
     return image
 
 
-def add_spatial_tracking(image, buyer_id, enable_visible=True, enable_invisible=True):
+# 装订线明码布局（发行分辨率下的像素）
+VISIBLE_CODE_X = 5             # 距离左边缘的距离
+VISIBLE_CODE_START_Y = 100     # 第一个字符的 Y 坐标
+VISIBLE_CODE_SPACING = 15      # 字符间隔
+VISIBLE_CODE_COLOR = (80, 80, 80)
+VISIBLE_CODE_FONT_SIZE = 10
+
+
+def visible_code_font():
+    """
+    装订线明码使用的字体（识别明码时用同一字体渲染模板）
+
+    使用 Pillow 内置的 Aileron 字体（随依赖分发），不查找系统字体，
+    任何操作系统上发行和识别的字形都相同
+    """
+    return ImageFont.load_default(size=VISIBLE_CODE_FONT_SIZE)
+
+
+def add_spatial_tracking(image, buyer_id, enable_visible=True, enable_invisible=True,
+                         code_length=DEFAULT_CODE_LENGTH):
     """
     添加空间溯源标记（字符-坐标映射）
 
@@ -226,6 +337,7 @@ def add_spatial_tracking(image, buyer_id, enable_visible=True, enable_invisible=
         buyer_id: 买家标识
         enable_visible: 是否启用可见的装订线明码
         enable_invisible: 是否启用隐形位置黑点
+        code_length: 特征码位数
 
     返回:
         添加溯源标记后的 PIL Image 对象
@@ -242,28 +354,18 @@ def add_spatial_tracking(image, buyer_id, enable_visible=True, enable_invisible=
 
     draw = ImageDraw.Draw(image)
 
-    # 生成4位特征码
-    feature_code = generate_feature_code(buyer_id)
+    # 生成特征码
+    feature_code = generate_feature_code(buyer_id, code_length)
 
     # 特征1：装订线明码（竖排）
     if enable_visible:
-        try:
-            # 尝试加载小字体
-            font = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 6)
-        except:
-            try:
-                font = ImageFont.truetype("/System/Library/Fonts/Arial.ttf", 6)
-            except:
-                font = ImageFont.load_default()
+        font = visible_code_font()
 
         # 在页面极左侧竖排打印特征码
-        binding_x = 5  # 距离左边缘5像素
-        start_y = 100  # 从上往下100像素开始
-
         for i, char in enumerate(feature_code):
-            y_pos = start_y + i * 15  # 每个字符间隔15像素
+            y_pos = VISIBLE_CODE_START_Y + i * VISIBLE_CODE_SPACING
             # 深灰色，看起来像批次号
-            draw.text((binding_x, y_pos), char, fill=(80, 80, 80), font=font)
+            draw.text((VISIBLE_CODE_X, y_pos), char, fill=VISIBLE_CODE_COLOR, font=font)
 
     # 特征2：隐形位置黑点
     if enable_invisible:
@@ -293,6 +395,121 @@ def add_spatial_tracking(image, buyer_id, enable_visible=True, enable_invisible=
     return image
 
 
+# 位置点检测：字符按 CHAR_POSITION_MAP 的排序固定为得分向量的下标
+POSITION_CHARS = ''.join(sorted(CHAR_POSITION_MAP))
+_POSITION_XY = np.array([CHAR_POSITION_MAP[char] for char in POSITION_CHARS], dtype=np.float64)
+
+# 每个位置点离哪条页边最近（0 左、1 右、2 上、3 下），检测时按页边分组裁剪
+_POSITION_EDGES = np.argmin(np.stack([
+    _POSITION_XY[:, 0], 2480 - _POSITION_XY[:, 0],
+    _POSITION_XY[:, 1], 3508 - _POSITION_XY[:, 1]
+], axis=1), axis=1)
+
+# 3x3 邻域内有像素低于该值（RGB 取三通道均值）即视为黑点
+DOT_DARKNESS_THRESHOLD = 50
+DOT_SCORE_THRESHOLD = (255 - DOT_DARKNESS_THRESHOLD) / 255
+
+
+def dot_scores(image):
+    """
+    检测全部 36 个位置点的黑度得分
+
+    只把四条页边附近包含位置点的窄条转换为数组，
+    再用花式索引一次取出所有位置点的 3x3 邻域
+
+    参数:
+        image: PIL Image 对象（整页，任意尺寸，坐标按 A4 300DPI 缩放）
+
+    返回:
+        numpy 数组（长度 36，按 POSITION_CHARS 排列），
+        每个值为邻域内最暗像素的黑度 (255 - 亮度) / 255；超出页面的位置为 0
+    """
+    width, height = image.size
+    xs = (_POSITION_XY[:, 0] * (width / 2480)).astype(np.int64)
+    ys = (_POSITION_XY[:, 1] * (height / 3508)).astype(np.int64)
+    valid = (xs >= 0) & (xs < width - 2) & (ys >= 0) & (ys < height - 2)
+
+    scores = np.zeros(len(POSITION_CHARS))
+    offsets = np.arange(-1, 2)
+
+    for edge in range(4):
+        members = np.flatnonzero(valid & (_POSITION_EDGES == edge))
+        if len(members) == 0:
+            continue
+
+        # 邻域坐标（超出图像的裁到边界上，不影响取最小值）
+        neighbor_x = np.clip(xs[members, None] + offsets, 0, width - 1)
+        neighbor_y = np.clip(ys[members, None] + offsets, 0, height - 1)
+        left, top = neighbor_x.min(), neighbor_y.min()
+
+        strip = image.crop((left, top, neighbor_x.max() + 1, neighbor_y.max() + 1))
+        if strip.mode not in ('L', 'RGB', 'RGBA'):
+            strip = strip.convert('RGB')
+        region = np.asarray(strip)
+
+        neighborhoods = region[(neighbor_y - top)[:, :, None], (neighbor_x - left)[:, None, :]]
+        if neighborhoods.ndim == 4:
+            neighborhoods = neighborhoods[..., :3].mean(axis=3)
+        scores[members] = (255 - neighborhoods.min(axis=(1, 2))) / 255
+
+    return scores
+
+
+def position_code_from_scores(scores, threshold=DOT_SCORE_THRESHOLD,
+                              code_length=DEFAULT_CODE_LENGTH):
+    """
+    根据位置点得分拼出特征码
+
+    参数:
+        scores: dot_scores 返回的得分向量
+        threshold: 判定为黑点的最低得分
+        code_length: 特征码位数
+
+    返回:
+        (特征码字符串或 None, 检测到的字符列表)
+        检测到的字符恰好 code_length 个时返回特征码，多于 code_length 个时取前 code_length 个
+    """
+    detected_chars = [POSITION_CHARS[i] for i in np.flatnonzero(np.asarray(scores) > threshold)]
+
+    if len(detected_chars) >= code_length:
+        return ''.join(detected_chars[:code_length]), detected_chars
+
+    return None, detected_chars
+
+
+# 快速溯源只渲染页边：装订线编码和竖排明码都在左侧 40 像素以内，
+# 各页边再留出余量，容忍打印扫描带来的轻微偏移和缩放
+TRACE_BINDING_WIDTH = 40
+TRACE_MARGIN_PAD = 24
+
+
+def trace_margin_boxes(width, height, pad=TRACE_MARGIN_PAD):
+    """
+    计算溯源标记所在的四条页边区域
+
+    参数:
+        width: 页面宽度（像素）
+        height: 页面高度（像素）
+        pad: 在标记外侧额外保留的像素数
+
+    返回:
+        [(left, top, right, bottom), ...]，依次为左、右、上、下页边（已裁到页面内）
+    """
+    xs = _POSITION_XY[:, 0] * (width / 2480)
+    ys = _POSITION_XY[:, 1] * (height / 3508)
+
+    left = max(xs[_POSITION_EDGES == 0].max() + 2, TRACE_BINDING_WIDTH) + pad
+    right = xs[_POSITION_EDGES == 1].min() - 1 - pad
+    top = ys[_POSITION_EDGES == 2].max() + 2 + pad
+    bottom = ys[_POSITION_EDGES == 3].min() - 1 - pad
+
+    left, top = min(int(np.ceil(left)), width), min(int(np.ceil(top)), height)
+    right, bottom = max(int(right), 0), max(int(bottom), 0)
+
+    return [(0, 0, left, height), (right, 0, width, height),
+            (0, 0, width, top), (0, bottom, width, height)]
+
+
 def generate_map_reference(output_path='map_reference.png', output_text_path='code_book.txt'):
     """
     生成解密对照卡（图片和文本两种格式）
@@ -600,13 +817,14 @@ def add_interference_lines(image, num_lines=50):
     return image
 
 
-def add_visible_watermark(image, watermark_text, font_size=60, density='normal',
-                         color=(128, 128, 128), alpha=80):
+def generate_watermark_layer(width, height, watermark_text, font_size=60, density='normal',
+                             color=(128, 128, 128), alpha=80):
     """
-    添加可见水印（旋转45度，半透明，铺满整个页面）
+    生成可见水印图层（旋转45度，铺满整个页面）
 
     参数:
-        image: PIL Image 对象
+        width: 图层宽度
+        height: 图层高度
         watermark_text: 水印文字
         font_size: 字体大小
         density: 水印密度 ('sparse', 'normal', 'dense', 'very_dense')
@@ -614,9 +832,8 @@ def add_visible_watermark(image, watermark_text, font_size=60, density='normal',
         alpha: 透明度 (0-255)
 
     返回:
-        添加水印后的 PIL Image 对象
+        PIL Image 对象（RGBA 模式，透明背景）
     """
-    width, height = image.size
     watermark_layer = Image.new('RGBA', (width, height), (0, 0, 0, 0))
     draw = ImageDraw.Draw(watermark_layer)
 
@@ -670,6 +887,29 @@ def add_visible_watermark(image, watermark_text, font_size=60, density='normal',
     top = (temp_size - height) // 2
     watermark_layer = temp_layer.crop((left, top, left + width, top + height))
 
+    return watermark_layer
+
+
+def add_visible_watermark(image, watermark_text, font_size=60, density='normal',
+                         color=(128, 128, 128), alpha=80):
+    """
+    添加可见水印（旋转45度，半透明，铺满整个页面）
+
+    参数:
+        image: PIL Image 对象
+        watermark_text: 水印文字
+        font_size: 字体大小
+        density: 水印密度 ('sparse', 'normal', 'dense', 'very_dense')
+        color: 水印颜色 RGB 元组
+        alpha: 透明度 (0-255)
+
+    返回:
+        添加水印后的 PIL Image 对象
+    """
+    width, height = image.size
+    watermark_layer = generate_watermark_layer(width, height, watermark_text, font_size,
+                                               density, color, alpha)
+
     if image.mode != 'RGBA':
         image = image.convert('RGBA')
 
@@ -677,27 +917,22 @@ def add_visible_watermark(image, watermark_text, font_size=60, density='normal',
     return watermarked.convert('RGB')
 
 
-def add_anti_copy_pattern(image, pattern_type='dot_matrix', density=50,
-                         color=(255, 200, 200), alpha=30):
+def generate_anti_copy_pattern(width, height, pattern_type='dot_matrix', density=50,
+                               color=(255, 200, 200), alpha=30):
     """
-    添加防复印/防拍照底纹（利用摩尔纹效应）
+    生成防复印/防拍照底纹图层
 
     参数:
-        image: PIL Image 对象
+        width: 图层宽度
+        height: 图层高度
         pattern_type: 底纹类型 ('dot_matrix' 点阵, 'sine_wave' 正弦波)
         density: 底纹密度（点阵间距或波浪频率）
-        color: 底纹颜色 RGB 元组（推荐浅红色 255,200,200）
+        color: 底纹颜色 RGB 元组
         alpha: 透明度 (0-255)
 
     返回:
-        添加防复印底纹后的 PIL Image 对象
-
-    原理：
-    - 浅红色在黑白复印机上会变黑遮挡文字
-    - 高频点阵对抗手机摄像头（摩尔纹效应）
-    - 拍照去底色时红色最难处理
+        PIL Image 对象（RGBA 模式，透明背景）
     """
-    width, height = image.size
     pattern_layer = Image.new('RGBA', (width, height), (255, 255, 255, 0))
     draw = ImageDraw.Draw(pattern_layer)
 
@@ -739,6 +974,33 @@ def add_anti_copy_pattern(image, pattern_type='dot_matrix', density=50,
             if len(points) > 1:
                 draw.line(points, fill=pattern_color, width=1)
 
+    return pattern_layer
+
+
+def add_anti_copy_pattern(image, pattern_type='dot_matrix', density=50,
+                         color=(255, 200, 200), alpha=30):
+    """
+    添加防复印/防拍照底纹（利用摩尔纹效应）
+
+    参数:
+        image: PIL Image 对象
+        pattern_type: 底纹类型 ('dot_matrix' 点阵, 'sine_wave' 正弦波)
+        density: 底纹密度（点阵间距或波浪频率）
+        color: 底纹颜色 RGB 元组（推荐浅红色 255,200,200）
+        alpha: 透明度 (0-255)
+
+    返回:
+        添加防复印底纹后的 PIL Image 对象
+
+    原理：
+    - 浅红色在黑白复印机上会变黑遮挡文字
+    - 高频点阵对抗手机摄像头（摩尔纹效应）
+    - 拍照去底色时红色最难处理
+    """
+    width, height = image.size
+    pattern_layer = generate_anti_copy_pattern(width, height, pattern_type, density,
+                                               color, alpha)
+
     # 转换图像为 RGBA
     if image.mode != 'RGBA':
         image = image.convert('RGBA')
@@ -793,62 +1055,683 @@ def add_invisible_interference_text(image, interference_text, num_texts=100):
     return image
 
 
+# ============================================================================
+# 黑白二值输出（CCITT G4）
+# ============================================================================
+
+# 4x4 Bayer 有序抖动阈值矩阵（0-1）
+BAYER_4X4 = np.array([[0, 8, 2, 10],
+                      [12, 4, 14, 6],
+                      [3, 11, 1, 9],
+                      [15, 7, 13, 5]], dtype=np.float32) / 16
+
+# 浅色水印在二值页面上的网点覆盖率
+WATERMARK_SCREEN = 0.25
+
+
+def render_mark_layers(size, watermark_text="", buyer_id=None,
+                       watermark_font_size=60, watermark_density='normal',
+                       watermark_color=(128, 128, 128), watermark_alpha=80,
+                       enable_spatial_tracking=False, enable_visible_code=True,
+                       enable_invisible_dots=True, enable_binding_line=False,
+                       code_length=DEFAULT_CODE_LENGTH):
+    """
+    在白底上单独绘制需要在二值化后保留的图层
+
+    溯源标记（装订线编码、装订线明码、位置黑点）多为浅灰色，
+    直接阈值化会被当作背景丢弃；可见水印同理。这里按与 process_page
+    相同的参数单独绘制，供 binarize_page 强制保留
+
+    参数:
+        size: 页面像素尺寸 (width, height)
+        watermark_text: 可见水印文字
+        buyer_id: 买家标识
+        ...: 其他参数同 process_page
+
+    返回:
+        (marks, watermark) 元组，均为 L 模式图像（白底），对应图层未启用时为 None
+    """
+    marks = None
+    if buyer_id and (enable_spatial_tracking or enable_binding_line):
+        canvas = Image.new('RGB', size, 'white')
+        if enable_spatial_tracking:
+            canvas = add_spatial_tracking(canvas, buyer_id, enable_visible_code,
+                                          enable_invisible_dots, code_length)
+        if enable_binding_line:
+            canvas = add_binding_line_encoding(canvas, buyer_id, code_length)
+        marks = canvas.convert('L')
+
+    watermark = None
+    if watermark_text:
+        canvas = Image.new('RGB', size, 'white')
+        watermark = add_visible_watermark(canvas, watermark_text, watermark_font_size,
+                                          watermark_density, watermark_color,
+                                          watermark_alpha).convert('L')
+
+    return marks, watermark
+
+
+def binarize_page(image, method='otsu', marks=None, watermark=None):
+    """
+    将处理后的页面二值化为 1 位图像
+
+    参数:
+        image: PIL Image 对象
+        method: 阈值方法 ('otsu' 全局阈值，或 'adaptive' 局部自适应阈值，
+                后者对底纹深浅不均的页面更稳)
+        marks: 溯源标记图层（L 模式白底图像，可选），非白色像素强制为黑
+        watermark: 可见水印图层（L 模式白底图像，可选），以有序抖动网点保留
+
+    返回:
+        1 位 PIL Image 对象
+    """
+    gray = np.asarray(image.convert('L'))
+
+    if method == 'adaptive':
+        binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                       cv2.THRESH_BINARY, 31, 15)
+    elif method == 'otsu':
+        _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    else:
+        raise ValueError(f"未知的阈值方法: {method}")
+
+    height, width = gray.shape
+
+    if watermark is not None:
+        screen = np.tile(BAYER_4X4, (height // 4 + 1, width // 4 + 1))[:height, :width]
+        covered = np.asarray(watermark) < 250
+        binary = np.where(covered & (screen < WATERMARK_SCREEN), 0, binary).astype(np.uint8)
+
+    if marks is not None:
+        binary = np.where(np.asarray(marks) < 250, 0, binary).astype(np.uint8)
+
+    return Image.fromarray(binary).convert('1', dither=Image.Dither.NONE)
+
+
+# ============================================================================
+# 混合光栅内容输出（MRC）
+# ============================================================================
+
+# MRC 背景相对前景的缩小倍数（200 DPI 页面的背景约为 67 DPI）
+MRC_BACKGROUND_SCALE = 3
+
+# 通道差值不超过该值的像素视为灰色（JPEG 色度噪点约几个灰阶）
+MRC_COLOR_TOLERANCE = 12
+
+
+def is_color_image(image, tolerance=MRC_COLOR_TOLERANCE):
+    """
+    判断页面是否含有彩色内容（各通道差值超过容差的像素）
+
+    参数:
+        image: PIL Image 对象
+        tolerance: 视为灰色的最大通道差值
+
+    返回:
+        bool
+    """
+    if image.mode in ('1', 'L', 'LA', 'I', 'F'):
+        return False
+
+    pixels = np.asarray(image.convert('RGB'), dtype=np.int16)
+    spread = pixels.max(axis=2) - pixels.min(axis=2)
+    return bool((spread > tolerance).any())
+
+
+def split_mrc_layers(image, method='otsu', marks=None, background_scale=MRC_BACKGROUND_SCALE):
+    """
+    把页面拆分为前景蒙版和低分辨率背景
+
+    前景为阈值化得到的文字和溯源标记（全分辨率 1 位）；背景在缩小时
+    只对非前景像素取平均，文字不会在背景中留下灰色残影，
+    底纹、噪点和浅色水印保留在背景中。彩色页面的背景保留 RGB，
+    灰度页面的背景为 L 模式
+
+    参数:
+        image: PIL Image 对象
+        method: 阈值方法 ('otsu' 或 'adaptive')
+        marks: 溯源标记图层（L 模式白底图像，可选），强制归入前景
+        background_scale: 背景缩小倍数
+
+    返回:
+        (mask, background) 元组
+        - mask: 1 位 PIL Image（黑色为前景）
+        - background: L 或 RGB 模式 PIL Image（尺寸为原图的 1/background_scale）
+    """
+    mask = binarize_page(image, method, marks)
+    if is_color_image(image):
+        pixels = np.asarray(image.convert('RGB'), dtype=np.float32)
+    else:
+        pixels = np.asarray(image.convert('L'), dtype=np.float32)
+
+    # 前景像素外扩 1 像素，去掉抗锯齿边缘
+    foreground = np.asarray(mask, dtype=np.uint8) == 0
+    foreground = cv2.dilate(foreground.astype(np.uint8), np.ones((3, 3), np.uint8)) > 0
+    weight = (~foreground).astype(np.float32)
+
+    height, width = pixels.shape[:2]
+    size = (max(1, width // background_scale), max(1, height // background_scale))
+    count = cv2.resize(weight, size, interpolation=cv2.INTER_AREA)
+    if pixels.ndim == 3:
+        weight, count = weight[:, :, None], count[:, :, None]
+    total = cv2.resize(pixels * weight, size, interpolation=cv2.INTER_AREA)
+
+    background = np.where(count > 1e-3, total / np.maximum(count, 1e-3), 0)
+    background = np.clip(background, 0, 255).astype(np.uint8)
+
+    # 完全被前景覆盖的块用周围背景修补（低分辨率下修补很快）
+    holes = (count.reshape(size[1], size[0]) <= 1e-3).astype(np.uint8)
+    if holes.any():
+        background = cv2.inpaint(background, holes, 3, cv2.INPAINT_TELEA)
+
+    return mask, Image.fromarray(background)
+
+
+def encode_output_page(image, output_mode='grayscale', dpi=200, quality=75,
+                       threshold_method='otsu', marks=None, watermark=None):
+    """
+    按输出模式编码一页已处理的页面
+
+    参数:
+        image: PIL Image 对象（已按输出分辨率缩放）
+        output_mode: 输出模式 ('grayscale'、'color'、'bilevel' 或 'mrc')
+        dpi: 输出分辨率
+        quality: JPEG 压缩质量（mrc 模式用于背景）
+        threshold_method: bilevel / mrc 模式的阈值方法
+        marks: 溯源标记图层（bilevel / mrc 模式，可选）
+        watermark: 可见水印图层（仅 bilevel 模式，mrc 模式下水印保留在背景中）
+
+    返回:
+        pdf_writer.PdfPage 对象
+    """
+    if output_mode == 'bilevel':
+        binary = binarize_page(image, threshold_method, marks, watermark)
+        return pdf_writer.encode_page(binary, 'bilevel', dpi)
+
+    if output_mode == 'mrc':
+        mask, background = split_mrc_layers(image, threshold_method, marks)
+        return pdf_writer.encode_mrc_page(mask, background, dpi, quality)
+
+    return pdf_writer.encode_page(image, output_mode, dpi, quality)
+
+
 # ============================================================================
 # PDF 处理主流程
 # ============================================================================
-def pdf_to_images(pdf_bytes, dpi=200):
+# poppler 安装目录（可选）。未加入 PATH 时（如 Windows 便携版）由部署环境设置
+POPPLER_PATH = os.environ.get('POPPLER_PATH') or None
+
+
+def poppler_command(name, poppler_path=None):
+    """
+    按 pdf2image 的方式解析 poppler 命令路径（Windows 下补 .exe，配置了目录时拼接目录）
+
+    参数:
+        name: 命令名（如 'pdftoppm'）
+        poppler_path: poppler 安装目录，默认使用 POPPLER_PATH
+
+    返回:
+        命令路径字符串
+    """
+    poppler_path = poppler_path or POPPLER_PATH
+    if os.name == 'nt':
+        name += '.exe'
+    return os.path.join(poppler_path, name) if poppler_path else name
+
+
+def count_pdf_pages(pdf_bytes):
+    """用 pdfinfo 读取 PDF 页数（不渲染页面）"""
+    return pdfinfo_from_bytes(pdf_bytes, poppler_path=POPPLER_PATH)['Pages']
+
+
+def probe_pdf(pdf_bytes):
+    """
+    不渲染页面，用 pdfinfo 读取页数和每页尺寸
+
+    参数:
+        pdf_bytes: PDF 文件的字节内容
+
+    返回:
+        字典 {'pages': 页数, 'page_sizes': [(width_pt, height_pt), ...]}
+    """
+    page_count = count_pdf_pages(pdf_bytes)
+    info = pdfinfo_from_bytes(pdf_bytes, first_page=1, last_page=page_count,
+                              poppler_path=POPPLER_PATH)
+
+    page_sizes = [_page_size(info, page) for page in range(1, page_count + 1)]
+
+    return {'pages': page_count, 'page_sizes': page_sizes}
+
+
+def _page_size(info, page):
+    """从 pdfinfo 输出中读取某一页（从 1 开始）旋转后的尺寸（pt）"""
+    size_text = info.get(f"Page {page:4d} size", info.get('Page size', ''))
+    match = re.match(r'\s*([\d.]+)\s*x\s*([\d.]+)', size_text)
+    if match:
+        width_pt, height_pt = float(match.group(1)), float(match.group(2))
+    else:
+        # 读取失败时按 A4 估算
+        width_pt, height_pt = 595.276, 841.89
+
+    rotation = info.get(f"Page {page:4d} rot", '0').strip()
+    if rotation in ('90', '270'):
+        width_pt, height_pt = height_pt, width_pt
+
+    return width_pt, height_pt
+
+
+def pdf_to_images(pdf_bytes, dpi=200, page_cache=None):
     """
     将 PDF 转换为图像列表
 
     参数:
         pdf_bytes: PDF 文件的字节内容
         dpi: 转换分辨率
+        page_cache: PageCache 对象（可选），命中时跳过栅格化
 
     返回:
-        PIL Image 对象列表
+        PIL Image 对象列表；传入 page_cache 时返回按需解码的 CachedPages
     """
-    return convert_from_bytes(pdf_bytes, dpi=dpi)
+    if page_cache is None:
+        return convert_from_bytes(pdf_bytes, dpi=dpi, poppler_path=POPPLER_PATH)
+
+    key = document_key(pdf_bytes, dpi)
+    pages = page_cache.get(key)
+    if pages is None:
+        images = convert_from_bytes(pdf_bytes, dpi=dpi, poppler_path=POPPLER_PATH)
+        pages = page_cache.put(key, images)
+    return pages
+
+
+def iter_page_windows(pdf_bytes, dpi=200, window=None, page_cache=None, page_count=None):
+    """
+    按窗口分批栅格化 PDF，避免一次性把整份文档展开到内存
+
+    参数:
+        pdf_bytes: PDF 文件的字节内容
+        dpi: 转换分辨率
+        window: 每批栅格化的页数，None 表示整份文档一次完成
+        page_cache: PageCache 对象（可选），命中时直接按需解码缓存页面
+        page_count: 页数（可选，未提供时用 pdfinfo 读取）
+
+    返回:
+        生成器，每次产出一批页面（PIL Image 列表或 CachedPages）
+    """
+    if window is None:
+        yield pdf_to_images(pdf_bytes, dpi=dpi, page_cache=page_cache)
+        return
+
+    key = document_key(pdf_bytes, dpi)
+    cached = page_cache.get(key) if page_cache is not None else None
+    if cached is not None:
+        for start in range(0, len(cached), window):
+            yield [cached[i] for i in range(start, min(start + window, len(cached)))]
+        return
+
+    if page_count is None:
+        page_count = probe_pdf(pdf_bytes)['pages']
+
+    blobs = []
+    for first_page in range(1, page_count + 1, window):
+        last_page = min(first_page + window - 1, page_count)
+        images = convert_from_bytes(pdf_bytes, dpi=dpi, first_page=first_page,
+                                    last_page=last_page, poppler_path=POPPLER_PATH)
+        if page_cache is not None:
+            blobs.extend(compress_page(img, page_cache.compress_level) for img in images)
+        yield images
+
+    if page_cache is not None:
+        page_cache.store(key, CachedPages(blobs))
+
+
+def render_pages(pdf_bytes, page_indices, dpi=200, page_cache=None):
+    """
+    只栅格化指定的几页（用于抽样）
+
+    参数:
+        pdf_bytes: PDF 文件的字节内容
+        page_indices: 页面下标列表（从 0 开始）
+        dpi: 转换分辨率
+        page_cache: PageCache 对象（可选），命中时直接解码缓存页面
+
+    返回:
+        PIL Image 对象列表（与 page_indices 顺序一致）
+    """
+    cached = page_cache.get(document_key(pdf_bytes, dpi)) if page_cache is not None else None
+    if cached is not None:
+        return [cached[i] for i in page_indices]
+
+    return [convert_from_bytes(pdf_bytes, dpi=dpi, first_page=i + 1, last_page=i + 1,
+                               poppler_path=POPPLER_PATH)[0]
+            for i in page_indices]
 
 
-def images_to_pdf(images, output_mode='grayscale', dpi=200, quality=75):
+def iter_trace_pages(pdf_bytes, page_indices=(0,), dpi=200, page_cache=None):
+    """
+    快速溯源：逐页只栅格化页边区域（溯源标记所在的四条窄带）
+
+    每条页边用 pdftoppm 的 -f/-l 选页、-x/-y/-W/-H 裁剪单独渲染（并行），
+    再贴回与整页渲染同尺寸的白色画布，检测函数无需改动即可使用。
+    栅格化面积约为整页的 1/7，且与文档总页数无关
+
+    参数:
+        pdf_bytes: PDF 文件的字节内容
+        page_indices: 页面下标列表（从 0 开始）
+        dpi: 转换分辨率（与整页渲染一致）
+        page_cache: PageCache 对象（可选），命中时直接解码缓存的整页
+
+    返回:
+        生成器，按 page_indices 顺序逐页产出 PIL Image 对象
+        （RGB，整页尺寸，页边以外为白色）
+    """
+    page_indices = list(page_indices)
+    if not page_indices:
+        return
+
+    cached = page_cache.get(document_key(pdf_bytes, dpi)) if page_cache is not None else None
+    if cached is not None:
+        for index in page_indices:
+            yield cached[index]
+        return
+
+    info = pdfinfo_from_bytes(pdf_bytes, first_page=min(page_indices) + 1,
+                              last_page=max(page_indices) + 1, poppler_path=POPPLER_PATH)
+
+    # 与 pdf2image 相同：配置了 poppler 目录时从该目录运行并加载其动态库
+    pdftoppm = poppler_command('pdftoppm')
+    env = os.environ.copy()
+    if POPPLER_PATH:
+        env['LD_LIBRARY_PATH'] = POPPLER_PATH + ':' + env.get('LD_LIBRARY_PATH', '')
+
+    handle, pdf_path = tempfile.mkstemp(suffix='.pdf')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(pdf_bytes)
+
+        def render_box(page, box):
+            """用 pdftoppm 渲染一页中的一个矩形区域"""
+            left, top, right, bottom = box
+            result = subprocess.run(
+                [pdftoppm, '-r', str(dpi), '-f', str(page), '-l', str(page),
+                 '-x', str(left), '-y', str(top),
+                 '-W', str(right - left), '-H', str(bottom - top), pdf_path],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, check=True
+            )
+            return Image.open(io.BytesIO(result.stdout)).convert('RGB')
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for index in page_indices:
+                page = index + 1
+                width_pt, height_pt = _page_size(info, page)
+                # 与 pdftoppm 整页渲染的尺寸计算方式一致（向上取整）
+                size = (int(np.ceil(width_pt * dpi / 72)), int(np.ceil(height_pt * dpi / 72)))
+                boxes = [box for box in trace_margin_boxes(*size)
+                         if box[2] > box[0] and box[3] > box[1]]
+                strips = [executor.submit(render_box, page, box) for box in boxes]
+
+                canvas = Image.new('RGB', size, 'white')
+                for box, strip in zip(boxes, strips):
+                    canvas.paste(strip.result(), box[:2])
+                yield canvas
+    finally:
+        os.remove(pdf_path)
+
+
+def render_trace_pages(pdf_bytes, page_indices=(0,), dpi=200, page_cache=None):
+    """
+    快速溯源：只栅格化指定页面的页边区域（见 iter_trace_pages）
+
+    返回:
+        PIL Image 对象列表（与 page_indices 顺序一致）
+    """
+    return list(iter_trace_pages(pdf_bytes, page_indices, dpi, page_cache))
+
+
+def images_to_pdf(images, output_mode='grayscale', dpi=200, quality=75,
+                  target_size_mb=None, allow_dpi_reduction=False,
+                  max_part_mb=None, max_pages_per_part=None, part_stem='part',
+                  threshold_method='otsu'):
     """
     将图像列表保存为 PDF（带压缩优化）
 
     参数:
         images: PIL Image 对象列表
-        output_mode: 输出模式 ('grayscale' 或 'color')
+        output_mode: 输出模式 ('grayscale'、'color'、'bilevel' 或 'mrc'，
+                     bilevel 为二值化 + CCITT G4 无损压缩，适合黑白文本页；
+                     mrc 为全分辨率 1 位文字蒙版 + 低分辨率 JPEG 背景)
         dpi: 输出分辨率
         quality: JPEG 压缩质量 (10-100)
+        target_size_mb: 目标体积（MB，可选）。设置后忽略 quality，
+                        在抽样页上搜索满足目标的最高质量，再对全文编码一次
+        allow_dpi_reduction: 目标体积模式下是否允许降低输出 DPI
+        max_part_mb: 每个分卷的体积上限（MB，可选）
+        max_pages_per_part: 每个分卷的页数上限（可选）
+        part_stem: 分卷文件名前缀
+        threshold_method: bilevel / mrc 模式的阈值方法 ('otsu' 或 'adaptive')
 
     返回:
-        BytesIO 对象（PDF 内容）
+        BytesIO 对象（PDF 内容）；设置了分卷上限时为 [(文件名, BytesIO), ...] 列表
     """
-    processed_images = []
-
-    # 灰度化处理（可选）
-    if output_mode == 'grayscale':
-        for img in images:
-            gray_img = img.convert('L')
-            processed_images.append(gray_img)
-    else:
-        processed_images = images
-
-    # 使用 JPEG 压缩保存 PDF
-    output_pdf = io.BytesIO()
-
-    if processed_images:
-        processed_images[0].save(
-            output_pdf,
-            format='PDF',
-            save_all=True,
-            append_images=processed_images[1:],
-            resolution=float(dpi),
-            quality=quality,
-            optimize=True
+    output_dpi = dpi
+    if target_size_mb and images:
+        samples = [images[i] for i in size_target.sample_indices(len(images))]
+        choice = size_target.choose_encoding(
+            samples, len(images), int(target_size_mb * 1024 * 1024),
+            output_mode=output_mode, dpi=dpi, allow_dpi_reduction=allow_dpi_reduction,
+            encode_page=encode_output_page
         )
+        quality, output_dpi = choice['quality'], choice['dpi']
+
+    # 逐页编码（JPEG / 二值化 + G4 / MRC），编码后的数据流直接写入 PDF 或当前分卷
+    pages = (encode_output_page(size_target.resize_for_dpi(img, dpi, output_dpi),
+                                output_mode, output_dpi, quality, threshold_method)
+             for img in images)
+    return write_output(pages, max_part_mb, max_pages_per_part, part_stem)
+
+
+def write_output(pages, max_part_mb=None, max_pages_per_part=None, part_stem='part',
+                 feature_code=None, trace_key=None):
+    """
+    把已编码的页面写成一份 PDF，或按打印机限制拆分为多个分卷
+
+    参数:
+        pages: pdf_writer.PdfPage 对象的可迭代序列（可以是生成器，逐页写出）
+        max_part_mb: 每个分卷的体积上限（MB，可选）
+        max_pages_per_part: 每个分卷的页数上限（可选）
+        part_stem: 分卷文件名前缀
+        feature_code: 特征码（可选），设置后在每个文件的结构中写入溯源令牌（见 structure_marks）
+        trace_key: 结构标记的令牌密钥（默认读取环境变量，未配置时抛出 ValueError）
 
-    output_pdf.seek(0)
-    return output_pdf
+    返回:
+        未设置分卷上限时为 BytesIO 对象，否则为 [(文件名, BytesIO), ...] 列表
+    """
+    structure = structure_marks.writer_options(feature_code, trace_key) if feature_code else {}
+    if not max_part_mb and not max_pages_per_part:
+        return pdf_writer.write_pdf(pages, **structure)
+
+    max_part_bytes = int(max_part_mb * 1024 * 1024) if max_part_mb else None
+    return pdf_writer.write_parts(pages, part_stem, max_part_bytes, max_pages_per_part, **structure)
+
+
+def package_parts(parts, folder=None):
+    """
+    把分卷打包为 ZIP（解压后按文件名排序即为阅读顺序）
+
+    参数:
+        parts: [(文件名, BytesIO), ...] 列表
+        folder: ZIP 内的目录名（可选）
+
+    返回:
+        BytesIO 对象（ZIP 内容）
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for file_name, part in parts:
+            arcname = f"{folder}/{file_name}" if folder else file_name
+            zip_file.writestr(arcname, part.getvalue())
+    buffer.seek(0)
+    return buffer
+
+
+def choose_target_encoding(pdf_bytes, watermark_text, interference_text, target_size_mb,
+                           output_mode='grayscale', dpi=200, allow_dpi_reduction=False,
+                           page_cache=None, **page_options):
+    """
+    按目标体积选择 JPEG 质量和输出 DPI（只处理抽样页）
+
+    参数:
+        pdf_bytes: PDF 文件的字节内容
+        watermark_text: 可见水印文字
+        interference_text: 干扰文字内容
+        target_size_mb: 目标体积（MB）
+        output_mode: 输出模式
+        dpi: 栅格化分辨率
+        allow_dpi_reduction: 是否允许降低输出 DPI
+        page_cache: PageCache 对象（可选）
+        **page_options: 传给 process_page 的其他参数
+
+    返回:
+        字典 {'quality', 'dpi', 'estimated_bytes', 'fits'}（见 size_target.choose_encoding）
+    """
+    cached = page_cache.get(document_key(pdf_bytes, dpi)) if page_cache is not None else None
+    page_count = len(cached) if cached is not None else probe_pdf(pdf_bytes)['pages']
+
+    indices = size_target.sample_indices(page_count)
+    samples = [process_page(img, watermark_text, interference_text, **page_options)
+               for img in render_pages(pdf_bytes, indices, dpi, page_cache)]
+
+    return size_target.choose_encoding(
+        samples, page_count, int(target_size_mb * 1024 * 1024),
+        output_mode=output_mode, dpi=dpi, allow_dpi_reduction=allow_dpi_reduction,
+        encode_page=encode_output_page
+    )
+
+
+def process_page(img, watermark_text, interference_text,
+                 ripple_amplitude=2, ripple_frequency=0.05,
+                 guilloche_density=20, guilloche_color_depth=0.3,
+                 noise_level=10, num_lines=50, num_interference=100,
+                 watermark_font_size=60,
+                 enable_anti_copy=False, anti_copy_pattern='dot_matrix',
+                 anti_copy_density=50, watermark_density='normal',
+                 watermark_color=(128, 128, 128), watermark_alpha=80,
+                 buyer_id=None, enable_spatial_tracking=False,
+                 enable_visible_code=True, enable_invisible_dots=True,
+                 enable_binding_line=False, code_length=DEFAULT_CODE_LENGTH,
+                 progress_callback=None):
+    """
+    对单页图像应用全部防护层（参数含义同 process_pdf）
+
+    参数:
+        img: PIL Image 对象（栅格化后的页面）
+        ...: 见 process_pdf
+        progress_callback: 进度回调函数（可选）
+
+    返回:
+        处理后的 PIL Image 对象
+    """
+
+    def update_progress(message):
+        """内部辅助函数：更新进度"""
+        if progress_callback:
+            progress_callback(message)
+
+    # 确保是 RGB 模式
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    # 第二步：添加防复印底纹（批量发行模式）
+    if enable_anti_copy:
+        update_progress(f"  添加防复印底纹（{anti_copy_pattern}）...")
+        img = add_anti_copy_pattern(img, anti_copy_pattern, anti_copy_density)
+
+    # 第三步：添加 Guilloche 底纹
+    if guilloche_density > 0 and guilloche_color_depth > 0:
+        update_progress(f"  添加高频干扰底纹（Guilloche Pattern）...")
+        img = apply_guilloche_overlay(img, guilloche_density, guilloche_color_depth)
+
+    # 第四步：应用水波纹扭曲（核心算法 - 干扰行检测）
+    if ripple_amplitude > 0:
+        update_progress(f"  应用水波纹几何扭曲（干扰 OCR 行检测）...")
+        img = apply_water_ripple_distortion(img, ripple_amplitude, ripple_frequency)
+
+    # 第五步：添加可见水印（支持自定义密度和颜色）
+    if watermark_text:
+        update_progress(f"  添加可见水印...")
+        img = add_visible_watermark(img, watermark_text, watermark_font_size,
+                                   watermark_density, watermark_color, watermark_alpha)
+
+    # 第六步：添加噪点
+    if noise_level > 0:
+        update_progress(f"  添加防扫描噪点...")
+        img = add_noise(img, noise_level)
+
+    # 第七步：添加干扰线
+    if num_lines > 0:
+        update_progress(f"  添加干扰线条...")
+        img = add_interference_lines(img, num_lines)
+
+    # 第七步：添加隐形干扰字符
+    if interference_text:
+        update_progress(f"  添加隐形干扰字符...")
+        img = add_invisible_interference_text(img, interference_text, num_interference)
+
+    # 第八步：添加空间溯源标记
+    if enable_spatial_tracking and buyer_id:
+        try:
+            # 检查图像是否有效
+            if img is None:
+                raise ValueError("图像对象为空，可能是前面的处理步骤出错")
+
+            width, height = img.size
+            if width == 0 or height == 0:
+                raise ValueError(f"图像尺寸无效: {width}x{height}")
+
+            update_progress(f"  添加空间溯源标记（图像尺寸: {width}x{height}）...")
+            img = add_spatial_tracking(img, buyer_id, enable_visible_code, enable_invisible_dots,
+                                       code_length)
+        except Exception as e:
+            # 如果空间溯源失败，记录错误但不中断整个流程
+            update_progress(f"  警告：空间溯源标记添加失败")
+            update_progress(f"  错误信息: {str(e)}")
+            # 继续处理，不添加溯源标记
+
+    # 第八步B：添加装订线编码（点线编码）
+    if enable_binding_line and buyer_id:
+        try:
+            update_progress(f"  添加装订线编码（点线二进制）...")
+            img = add_binding_line_encoding(img, buyer_id, code_length)
+        except Exception as e:
+            update_progress(f"  警告：装订线编码添加失败")
+            update_progress(f"  错误信息: {str(e)}")
+
+    return img
+
+
+def structure_marks_ready(enable_structure_marks, trace_key=None, progress_callback=None):
+    """
+    检查能否写入结构标记：未配置密钥时跳过并提示，密钥过短时拒绝发行
+
+    参数:
+        enable_structure_marks: 是否要求写入结构标记
+        trace_key: 令牌密钥（可选，默认读取环境变量）
+        progress_callback: 进度回调函数
+
+    返回:
+        bool，是否写入结构标记
+
+    异常:
+        ValueError: 配置的密钥过短（见 structure_marks.require_trace_key）
+    """
+    if not enable_structure_marks:
+        return False
+    if structure_marks.trace_key(trace_key) is None:
+        if progress_callback:
+            progress_callback(f"未配置结构标记密钥（环境变量 {structure_marks.TRACE_KEY_ENV}），"
+                              f"不写入结构标记")
+        return False
+    structure_marks.require_trace_key(trace_key)
+    return True
 
 
 def process_pdf(pdf_bytes, watermark_text, interference_text,
@@ -867,7 +1750,20 @@ def process_pdf(pdf_bytes, watermark_text, interference_text,
                 # 空间溯源参数
                 buyer_id=None, enable_spatial_tracking=False,
                 enable_visible_code=True, enable_invisible_dots=True,
-                enable_binding_line=False,
+                enable_binding_line=False, code_length=DEFAULT_CODE_LENGTH,
+                enable_structure_marks=True, trace_key=None,
+                # 页面缓存
+                page_cache=None,
+                # 内存预算参数
+                max_rss_mb=None, max_workers=1, pdf_info=None,
+                # 目标体积参数
+                target_size_mb=None, allow_dpi_reduction=False, output_dpi=None,
+                # 分卷输出参数
+                max_part_mb=None, max_pages_per_part=None, part_stem='part',
+                # 黑白二值输出参数
+                threshold_method='otsu',
+                # 发行台账
+                ledger=None, page_fingerprints=None,
                 # 回调函数（用于进度更新）
                 progress_callback=None):
     """
@@ -884,6 +1780,8 @@ def process_pdf(pdf_bytes, watermark_text, interference_text,
     8. 灰度化处理（可选）
     9. JPEG 压缩并重组为 PDF
 
+    每页处理完成后立即压缩编码，原始栅格页随即释放
+
     参数:
         pdf_bytes: PDF 文件的字节内容
         watermark_text: 可见水印文字
@@ -896,14 +1794,40 @@ def process_pdf(pdf_bytes, watermark_text, interference_text,
         num_lines: 干扰线数量
         num_interference: 隐形干扰字符数量
         watermark_font_size: 水印字体大小
-        output_mode: 输出模式 ('grayscale' 或 'color')
+        output_mode: 输出模式 ('grayscale'、'color'、'bilevel' 或 'mrc')。bilevel 将页面
+                     二值化后以 CCITT G4 压缩，溯源标记强制保留为黑色，
+                     可见水印以网点形式保留；mrc 把文字和溯源标记放在全分辨率
+                     1 位蒙版中，底纹和水印放在低分辨率 JPEG 背景中
         dpi: 输出分辨率
         quality: JPEG 压缩质量
+        code_length: 特征码位数（4-8，买家较多时加长以避免撞码，见 recommended_code_length）
+        enable_structure_marks: 设置了 buyer_id 时，是否在 PDF 结构（XMP、图像资源名、对象顺序）中
+                                写入加密的特征码令牌，直接转发的副本无需渲染即可溯源
+                                （未配置密钥时跳过，见 structure_marks_ready）
+        trace_key: 结构标记的令牌密钥（可选，默认读取环境变量 WATERMARK_TRACE_KEY）
+        page_cache: PageCache 对象（可选），缓存栅格化结果供重复处理复用
+        max_rss_mb: 进程内存上限（MB，可选）。设置后先用 pdfinfo 估算每页开销，
+                    自动选择栅格化窗口和并发页数（页面缓存还能增长的部分一并计入）；
+                    预算不足时在栅格化之前抛出 memory_budget.MemoryBudgetExceeded
+        max_workers: 最大并发处理页数（设置 max_rss_mb 时为上限）
+        pdf_info: probe_pdf 的结果（可选，批量发行时只读取一次，避免每份副本重复调用 pdfinfo）
+        target_size_mb: 目标体积（MB，可选）。设置后忽略 quality，先处理少量抽样页
+                        搜索满足目标的最高质量，再对全文只编码一次
+        allow_dpi_reduction: 目标体积模式下是否允许降低输出 DPI
+        output_dpi: 输出分辨率（可选，低于 dpi 时编码前缩小页面）
+        max_part_mb: 每个分卷的体积上限（MB，可选），用于内存有限的打印机
+        max_pages_per_part: 每个分卷的页数上限（可选）
+        part_stem: 分卷文件名前缀
+        threshold_method: bilevel / mrc 模式的阈值方法 ('otsu' 或 'adaptive')
+        ledger: issuance_ledger.IssuanceLedger 对象（可选），记录本次发行
+        page_fingerprints: 列表（可选），传入时在栅格化循环中逐页追加母版页面指纹
+                           （批量发行时由 process_pdf_batch 收集，母版无需再栅格化一次）
         progress_callback: 进度回调函数，接受一个字符串参数
 
     返回:
         (output_pdf, preview_images) 元组
-        - output_pdf: BytesIO 对象（处理后的 PDF）
+        - output_pdf: BytesIO 对象（处理后的 PDF）；设置了分卷上限时为
+          [(文件名, BytesIO), ...] 列表，文件名形如 '{part_stem}_01of03.pdf'
         - preview_images: 字典 {'original': Image, 'processed': Image}（第一页预览）
     """
 
@@ -912,108 +1836,168 @@ def process_pdf(pdf_bytes, watermark_text, interference_text,
         if progress_callback:
             progress_callback(message)
 
-    # 第一步：PDF 转图片
-    update_progress(f"第一步：将 PDF 转换为图片（{dpi} DPI）...")
-    images = pdf_to_images(pdf_bytes, dpi=dpi)
-
-    processed_images = []
-    preview_images = {'original': None, 'processed': None}
+    # 栅格化之前检查结构标记密钥（密钥不合格时直接拒绝发行）
+    enable_structure_marks = bool(buyer_id) and structure_marks_ready(
+        enable_structure_marks, trace_key, progress_callback)
+
+    page_options = dict(
+        ripple_amplitude=ripple_amplitude, ripple_frequency=ripple_frequency,
+        guilloche_density=guilloche_density, guilloche_color_depth=guilloche_color_depth,
+        noise_level=noise_level, num_lines=num_lines, num_interference=num_interference,
+        watermark_font_size=watermark_font_size,
+        enable_anti_copy=enable_anti_copy, anti_copy_pattern=anti_copy_pattern,
+        anti_copy_density=anti_copy_density, watermark_density=watermark_density,
+        watermark_color=watermark_color, watermark_alpha=watermark_alpha,
+        buyer_id=buyer_id, enable_spatial_tracking=enable_spatial_tracking,
+        enable_visible_code=enable_visible_code, enable_invisible_dots=enable_invisible_dots,
+        enable_binding_line=enable_binding_line, code_length=code_length,
+    )
 
-    for i, img in enumerate(images):
-        update_progress(f"处理第 {i+1}/{len(images)} 页...")
-
-        # 保存原始图像（用于预览第一页）
-        if i == 0:
-            preview_images['original'] = img.copy()
-
-        # 确保是 RGB 模式
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-
-        # 第二步：添加防复印底纹（批量发行模式）
-        if enable_anti_copy:
-            update_progress(f"  添加防复印底纹（{anti_copy_pattern}）...")
-            img = add_anti_copy_pattern(img, anti_copy_pattern, anti_copy_density)
-
-        # 第三步：添加 Guilloche 底纹
-        if guilloche_density > 0 and guilloche_color_depth > 0:
-            update_progress(f"  添加高频干扰底纹（Guilloche Pattern）...")
-            img = apply_guilloche_overlay(img, guilloche_density, guilloche_color_depth)
-
-        # 第四步：应用水波纹扭曲（核心算法 - 干扰行检测）
-        if ripple_amplitude > 0:
-            update_progress(f"  应用水波纹几何扭曲（干扰 OCR 行检测）...")
-            img = apply_water_ripple_distortion(img, ripple_amplitude, ripple_frequency)
-
-        # 第五步：添加可见水印（支持自定义密度和颜色）
-        if watermark_text:
-            update_progress(f"  添加可见水印...")
-            img = add_visible_watermark(img, watermark_text, watermark_font_size,
-                                       watermark_density, watermark_color, watermark_alpha)
-
-        # 第六步：添加噪点
-        if noise_level > 0:
-            update_progress(f"  添加防扫描噪点...")
-            img = add_noise(img, noise_level)
-
-        # 第七步：添加干扰线
-        if num_lines > 0:
-            update_progress(f"  添加干扰线条...")
-            img = add_interference_lines(img, num_lines)
-
-        # 第七步：添加隐形干扰字符
-        if interference_text:
-            update_progress(f"  添加隐形干扰字符...")
-            img = add_invisible_interference_text(img, interference_text, num_interference)
-
-        # 第八步：添加空间溯源标记
-        if enable_spatial_tracking and buyer_id:
-            try:
-                # 检查图像是否有效
-                if img is None:
-                    raise ValueError("图像对象为空，可能是前面的处理步骤出错")
-
-                width, height = img.size
-                if width == 0 or height == 0:
-                    raise ValueError(f"图像尺寸无效: {width}x{height}")
-
-                update_progress(f"  添加空间溯源标记（图像尺寸: {width}x{height}）...")
-                img = add_spatial_tracking(img, buyer_id, enable_visible_code, enable_invisible_dots)
-            except Exception as e:
-                # 如果空间溯源失败，记录错误但不中断整个流程
-                import traceback
-                error_details = traceback.format_exc()
-                update_progress(f"  警告：空间溯源标记添加失败")
-                update_progress(f"  错误信息: {str(e)}")
-                # 继续处理，不添加溯源标记
-
-        # 第八步B：添加装订线编码（点线编码）
-        if enable_binding_line and buyer_id:
-            try:
-                update_progress(f"  添加装订线编码（点线二进制）...")
-                img = add_binding_line_encoding(img, buyer_id)
-            except Exception as e:
-                import traceback
-                update_progress(f"  警告：装订线编码添加失败")
-                update_progress(f"  错误信息: {str(e)}")
+    # 内存预算：在栅格化之前规划窗口大小和并发页数
+    window = None
+    workers = max(1, max_workers)
+    page_count = None
+    if max_rss_mb:
+        info = pdf_info or probe_pdf(pdf_bytes)
+        page_count = info['pages']
+        plan = memory_budget.plan_memory(
+            info['page_sizes'], dpi, max_rss_mb,
+            output_mode=output_mode,
+            max_workers=workers,
+            cache_bytes=memory_budget.cache_headroom(page_cache),
+            enable_anti_copy=enable_anti_copy,
+            guilloche=guilloche_density > 0 and guilloche_color_depth > 0,
+            ripple=ripple_amplitude > 0,
+            watermark=bool(watermark_text),
+            noise=noise_level > 0
+        )
+        update_progress(plan.describe())
+        window, workers = plan.window, plan.workers
+
+    # 目标体积：在抽样页上选择质量和输出 DPI，全文只编码一次
+    if target_size_mb:
+        update_progress(f"按目标体积 {target_size_mb} MB 抽样选择压缩参数...")
+        choice = choose_target_encoding(
+            pdf_bytes, watermark_text, interference_text, target_size_mb,
+            output_mode=output_mode, dpi=dpi, allow_dpi_reduction=allow_dpi_reduction,
+            page_cache=page_cache, **page_options
+        )
+        quality, output_dpi = choice['quality'], choice['dpi']
+        fit_note = "" if choice['fits'] else "（已是最小设置，仍可能超出目标）"
+        update_progress(f"  选定质量 {quality}%，输出 {output_dpi} DPI，"
+                        f"预计 {choice['estimated_bytes'] / 1024 / 1024:.1f} MB{fit_note}")
 
-        # 保存处理后的图像（用于预览第一页）
-        if i == 0:
-            preview_images['processed'] = img.copy()
+    output_dpi = output_dpi or dpi
 
-        processed_images.append(img)
+    # 第一步：PDF 转图片
+    update_progress(f"第一步：将 PDF 转换为图片（{dpi} DPI）...")
 
-    # 第八步和第九步：灰度化 + JPEG 压缩并重组为 PDF
+    preview_images = {'original': None, 'processed': None}
+    mark_layers = {}
+
+    # 台账中还没有该母版时，顺带记录每页的感知哈希（供溯源时反查母版）
+    document_sha256 = issuance_ledger.sha256_bytes(pdf_bytes) if ledger is not None else None
+    fingerprints = page_fingerprints
+    if fingerprints is None and ledger is not None and not ledger.has_fingerprints(document_sha256):
+        fingerprints = []
+
+    def layers_for(size):
+        """二值化时需要保留的溯源标记和水印图层（同尺寸页面共用）"""
+        if output_mode not in ('bilevel', 'mrc'):
+            return None, None
+        if size not in mark_layers:
+            layers = render_mark_layers(
+                size,
+                # mrc 模式下水印留在背景中，无需单独绘制
+                watermark_text if output_mode == 'bilevel' else "",
+                buyer_id,
+                watermark_font_size, watermark_density, watermark_color, watermark_alpha,
+                enable_spatial_tracking, enable_visible_code, enable_invisible_dots,
+                enable_binding_line, code_length
+            )
+            mark_layers[size] = tuple(
+                size_target.resize_for_dpi(layer, dpi, output_dpi) if layer else None
+                for layer in layers
+            )
+        return mark_layers[size]
+
+    def finish_page(index, original, processed):
+        """保存预览并立即编码，返回编码后的页面（栅格页随即释放）"""
+        marks, watermark = layers_for(processed.size)
+        processed = size_target.resize_for_dpi(processed, dpi, output_dpi)
+        if index == 0:
+            preview_images['original'] = original
+            # 二值页面转为 L 模式，便于界面显示
+            preview_images['processed'] = (
+                binarize_page(processed, threshold_method, marks, watermark).convert('L')
+                if output_mode == 'bilevel' else processed.copy()
+            )
+        return encode_output_page(processed, output_mode, output_dpi, quality,
+                                  threshold_method, marks, watermark)
+
+    def encoded_pages():
+        """逐页处理并编码（生成器：写出端按需拉取，分卷写满即写出）"""
+        index = 0
+        for images in iter_page_windows(pdf_bytes, dpi, window, page_cache, page_count):
+            total = page_count or len(images)
+
+            if workers == 1:
+                for img in images:
+                    update_progress(f"处理第 {index+1}/{total} 页...")
+                    if fingerprints is not None:
+                        fingerprints.append(page_fingerprint.fingerprint(img))
+                    # 保存原始图像（用于预览第一页）
+                    original = img.copy() if index == 0 else None
+                    processed = process_page(img, watermark_text, interference_text,
+                                             progress_callback=progress_callback, **page_options)
+                    yield finish_page(index, original, processed)
+                    index += 1
+                continue
+
+            # 多页并发处理：numpy / OpenCV / Pillow 的主要运算会释放 GIL
+            # 工作线程中不调用进度回调（Streamlit 只允许在主线程更新界面）
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for start in range(0, len(images), workers):
+                    chunk = [images[i] for i in range(start, min(start + workers, len(images)))]
+                    if fingerprints is not None:
+                        fingerprints.extend(page_fingerprint.fingerprint(img) for img in chunk)
+                    original = chunk[0].copy() if index == 0 else None
+                    update_progress(f"处理第 {index+1}-{index+len(chunk)}/{total} 页...")
+                    results = pool.map(
+                        lambda page: process_page(page, watermark_text, interference_text,
+                                                  **page_options),
+                        chunk
+                    )
+                    for processed in results:
+                        yield finish_page(index, original, processed)
+                        index += 1
+
+    # 第八步和第九步：灰度化 + 压缩逐页进行，编码后的页面直接写入 PDF（分卷写满即写出）
     if output_mode == 'grayscale':
         update_progress("第八步：转换为灰度模式（减少 2/3 体积）...")
-    update_progress(f"第九步：JPEG 压缩并重组为 PDF（质量 {quality}%）...")
-
-    output_pdf = images_to_pdf(
-        processed_images,
-        output_mode=output_mode,
-        dpi=dpi,
-        quality=quality
-    )
+    if output_mode == 'bilevel':
+        update_progress("第九步：二值化 + CCITT G4 压缩并重组为 PDF...")
+    elif output_mode == 'mrc':
+        update_progress(f"第九步：文字蒙版（G4）+ 低分辨率背景（JPEG {quality}%）重组为 PDF...")
+    else:
+        update_progress(f"第九步：JPEG 压缩并重组为 PDF（质量 {quality}%）...")
+
+    feature_code = generate_feature_code(buyer_id, code_length) if buyer_id else None
+    output_pdf = write_output(encoded_pages(), max_part_mb, max_pages_per_part, part_stem,
+                              feature_code if enable_structure_marks else None, trace_key)
+    if isinstance(output_pdf, list):
+        update_progress(f"已拆分为 {len(output_pdf)} 个分卷")
+
+    if ledger is not None:
+        parameters = {key: value for key, value in page_options.items() if key != 'buyer_id'}
+        parameters.update(watermark_text=watermark_text, interference_text=interference_text,
+                          output_mode=output_mode, dpi=dpi, output_dpi=output_dpi,
+                          quality=quality)
+        ledger.record_release(
+            document_sha256,
+            [issuance_ledger.issue_record(output_pdf, buyer_id, feature_code)],
+            mode='single', parameters=parameters, page_fingerprints=fingerprints
+        )
 
     return output_pdf, preview_images
 
@@ -1021,6 +2005,167 @@ def process_pdf(pdf_bytes, watermark_text, interference_text,
 # ============================================================================
 # 批量发行模式
 # ============================================================================
+
+# 隐形干扰字符在叠加层中的近似颜色和透明度（与 add_invisible_interference_text 一致）
+INTERFERENCE_OVERLAY_FILL = (225, 225, 225)
+INTERFERENCE_OVERLAY_ALPHA = 45
+
+
+def _layer_mask(canvas, threshold=250):
+    """白底图层中非白色的像素作为 1 位蒙版（黑色为绘制区域）"""
+    gray = np.asarray(canvas.convert('L'))
+    return Image.fromarray(np.where(gray < threshold, 0, 255).astype(np.uint8)).convert('1')
+
+
+def render_buyer_overlays(size, watermark_text="", buyer_id=None, interference_text="",
+                          num_interference=50, watermark_font_size=40,
+                          watermark_density='very_dense', watermark_color=(200, 200, 200),
+                          watermark_alpha=60, enable_spatial_tracking=False,
+                          enable_visible_code=True, enable_invisible_dots=True,
+                          enable_binding_line=False, code_length=DEFAULT_CODE_LENGTH):
+    """
+    绘制买家专属的叠加层（每种颜色一个 1 位蒙版）
+
+    与 process_page 中对应图层的颜色和透明度一致，以 ImageMask + 填充色
+    叠加在共享页面图像上，不需要重新编码整页
+
+    参数:
+        size: 页面像素尺寸 (width, height)
+        watermark_text: 可见水印文字
+        buyer_id: 买家标识
+        interference_text: 干扰文字内容
+        ...: 其他参数同 process_pdf_batch
+
+    返回:
+        [(mask, fill, alpha), ...] 列表
+        - mask: 1 位 PIL Image（黑色为绘制区域）
+        - fill: RGB 填充色（0-255）
+        - alpha: 透明度（0-255），None 表示不透明
+    """
+    overlays = []
+
+    if watermark_text:
+        canvas = add_visible_watermark(Image.new('RGB', size, 'white'), watermark_text,
+                                       watermark_font_size, watermark_density,
+                                       (0, 0, 0), 255)
+        overlays.append((_layer_mask(canvas, 128), tuple(watermark_color), watermark_alpha))
+
+    if interference_text and num_interference > 0:
+        canvas = Image.new('RGB', size, 'white')
+        draw = ImageDraw.Draw(canvas)
+        font = ImageFont.load_default()
+        words = interference_text.split()
+        for _ in range(num_interference):
+            x = random.randint(0, max(0, size[0] - 50))
+            y = random.randint(0, max(0, size[1] - 20))
+            draw.text((x, y), random.choice(words), font=font, fill=(0, 0, 0))
+        overlays.append((_layer_mask(canvas, 128), INTERFERENCE_OVERLAY_FILL,
+                         INTERFERENCE_OVERLAY_ALPHA))
+
+    if buyer_id and enable_spatial_tracking:
+        # 装订线明码（深灰）和位置黑点颜色不同，分别生成蒙版
+        if enable_visible_code:
+            canvas = add_spatial_tracking(Image.new('RGB', size, 'white'), buyer_id,
+                                          enable_visible=True, enable_invisible=False,
+                                          code_length=code_length)
+            overlays.append((_layer_mask(canvas, 200), (80, 80, 80), None))
+        if enable_invisible_dots:
+            canvas = add_spatial_tracking(Image.new('RGB', size, 'white'), buyer_id,
+                                          enable_visible=False, enable_invisible=True,
+                                          code_length=code_length)
+            overlays.append((_layer_mask(canvas), (0, 0, 0), None))
+
+    if buyer_id and enable_binding_line:
+        canvas = add_binding_line_encoding(Image.new('RGB', size, 'white'), buyer_id, code_length)
+        overlays.append((_layer_mask(canvas, 200), (160, 160, 160), None))
+
+    return overlays
+
+
+def encode_overlays(overlays, output_mode='grayscale'):
+    """
+    把叠加层编码为 CCITT G4 图像蒙版
+
+    参数:
+        overlays: render_buyer_overlays 的返回值
+        output_mode: 输出模式（grayscale 时填充色转为灰度）
+
+    返回:
+        [(EncodedImage, fill, alpha), ...] 列表（fill 和 alpha 已换算为 0-1）
+    """
+    encoded = []
+    for mask, fill, alpha in overlays:
+        if output_mode == 'grayscale':
+            fill = (0.299 * fill[0] + 0.587 * fill[1] + 0.114 * fill[2]) / 255
+        else:
+            fill = tuple(c / 255 for c in fill)
+        encoded.append((pdf_writer.encode_ccitt_g4(mask, image_mask=True), fill,
+                        None if alpha is None else alpha / 255))
+    return encoded
+
+
+def overlay_page(base, overlays):
+    """
+    在共享页面上叠加买家专属图层（不复制页面图像数据）
+
+    参数:
+        base: pdf_writer.PdfPage 对象（所有买家共用）
+        overlays: encode_overlays 的返回值
+
+    返回:
+        新的 PdfPage 对象，引用 base 的图像数据流
+    """
+    page = pdf_writer.PdfPage(base.width_pt, base.height_pt)
+    page.layers = list(base.layers)
+    for image, fill, alpha in overlays:
+        page.add_image(image, fill=fill, alpha=alpha)
+    return page
+
+
+def encode_shared_pages(pdf_bytes, output_mode='grayscale', dpi=200, quality=75,
+                        output_dpi=None, page_cache=None, progress_callback=None,
+                        window=None, pdf_info=None, fingerprints=None, **page_options):
+    """
+    处理并编码与买家无关的页面（每页只编码一次，供所有买家共用）
+
+    参数:
+        pdf_bytes: PDF 文件的字节内容
+        output_mode: 输出模式（'grayscale' 或 'color'）
+        dpi: 栅格化分辨率
+        quality: JPEG 压缩质量
+        output_dpi: 输出分辨率（可选）
+        page_cache: PageCache 对象（可选）
+        progress_callback: 进度回调函数
+        window: 每批栅格化的页数（可选，由内存预算规划），None 表示一次栅格化全部页面
+        pdf_info: probe_pdf 的结果（可选，避免重复读取页数）
+        fingerprints: 列表（可选），传入时逐页追加母版页面指纹（供发行台账反查母版）
+        **page_options: 传给 process_page 的防护层参数（个人图层参数会被忽略）
+
+    返回:
+        [(PdfPage, 像素尺寸), ...] 列表
+    """
+    page_options = dict(page_options, buyer_id=None, enable_spatial_tracking=False,
+                        enable_binding_line=False)
+    output_dpi = output_dpi or dpi
+    page_count = pdf_info['pages'] if pdf_info else None
+
+    pages = []
+    for images in iter_page_windows(pdf_bytes, dpi=dpi, window=window,
+                                    page_cache=page_cache, page_count=page_count):
+        for img in images:
+            if progress_callback:
+                total = f"/{page_count}" if page_count else ""
+                progress_callback(f"编码共享页面 {len(pages) + 1}{total}...")
+            if fingerprints is not None:
+                fingerprints.append(page_fingerprint.fingerprint(img))
+            processed = process_page(img, "", "", **page_options)
+            size = processed.size
+            processed = size_target.resize_for_dpi(processed, dpi, output_dpi)
+            pages.append((pdf_writer.encode_page(processed, output_mode, output_dpi, quality),
+                           size))
+    return pages
+
+
 def process_pdf_batch(pdf_bytes, customer_list,
                      # 批量发行模式特定参数
                      watermark_template="{name} {phone}",
@@ -1036,12 +2181,20 @@ def process_pdf_batch(pdf_bytes, customer_list,
                      enable_visible_code=True,
                      enable_invisible_dots=True,
                      enable_binding_line=False,
+                     code_length=DEFAULT_CODE_LENGTH,
+                     enable_structure_marks=True, trace_key=None,
                      # 其他参数
                      ripple_amplitude=1, ripple_frequency=0.03,
                      guilloche_density=15, guilloche_color_depth=0.2,
                      noise_level=5, num_lines=30, num_interference=50,
                      interference_text="样本 测试 防伪",
                      output_mode='grayscale', dpi=200, quality=75,
+                     page_cache=None,
+                     max_rss_mb=None, max_workers=1,
+                     target_size_mb=None, allow_dpi_reduction=False,
+                     max_part_mb=None, max_pages_per_part=None,
+                     threshold_method='otsu', shared_pages=False,
+                     ledger=None,
                      progress_callback=None):
     """
     批量处理 PDF，为每个买家生成专属溯源水印版本
@@ -1057,10 +2210,32 @@ def process_pdf_batch(pdf_bytes, customer_list,
         enable_anti_copy: 是否启用防复印底纹
         anti_copy_pattern: 防复印底纹类型
         anti_copy_density: 防复印底纹密度
+        code_length: 特征码位数（4-8），传入 'auto' 时按买家数量选择撞码概率不超过 1% 的最短位数
+        enable_structure_marks: 是否在每份副本的 PDF 结构中写入加密的特征码令牌（见 process_pdf）
+        trace_key: 结构标记的令牌密钥（可选，默认读取环境变量 WATERMARK_TRACE_KEY）
+        page_cache: PageCache 对象（可选），未传入时为本批次创建临时缓存，
+                    母版只栅格化一次
+        max_rss_mb: 进程内存上限（MB，可选），每份副本按此预算规划（页面缓存还能增长的
+                    部分一并计入，临时缓存不超过上限的 memory_budget.CACHE_SHARE）；
+                    共享页面模式下共享页面也按此预算分窗栅格化
+        max_workers: 最大并发处理页数
+        target_size_mb: 单份目标体积（MB，可选），按第一位买家抽样选择一次压缩参数，
+                        所有副本共用
+        allow_dpi_reduction: 目标体积模式下是否允许降低输出 DPI
+        max_part_mb: 每个分卷的体积上限（MB，可选）
+        max_pages_per_part: 每个分卷的页数上限（可选）
+        shared_pages: 共享页面模式。与买家无关的防护层只处理并编码一次，
+                      各买家的 PDF 逐字节引用同一组 JPEG 数据流，再以小体积的
+                      1 位图像蒙版叠加水印、干扰字符、溯源标记和装订线
+                      （仅支持 grayscale / color 输出；噪点和干扰线各买家相同）
+        ledger: issuance_ledger.IssuanceLedger 对象（可选）。全部副本生成后在一个事务中
+                写入台账，同批次内撞码的买家会在进度信息中提示
         ... 其他参数同 process_pdf
 
     返回:
         字典 {customer_id: (pdf_bytesio, customer_info), ...}
+        设置了分卷上限时 pdf_bytesio 为 [(文件名, BytesIO), ...] 列表，
+        文件名以 customer_id 为前缀
     """
 
     def update_progress(message):
@@ -1069,9 +2244,94 @@ def process_pdf_batch(pdf_bytes, customer_list,
             progress_callback(message)
 
     results = {}
+    issues = []
     total_customers = len(customer_list)
 
-    update_progress(f"开始批量处理，共 {total_customers} 个买家...")
+    if code_length == 'auto':
+        code_length = recommended_code_length(total_customers)
+    check_code_length(code_length)
+    enable_structure_marks = structure_marks_ready(enable_structure_marks, trace_key,
+                                                   progress_callback)
+
+    # 所有买家共用同一份母版，栅格化结果只需计算一次
+    # （设置了内存上限时临时缓存按上限缩小，其增长计入每次内存规划）
+    if page_cache is None:
+        page_cache = PageCache(memory_budget.cache_budget_bytes(max_rss_mb, DEFAULT_CACHE_BYTES)
+                               if max_rss_mb else DEFAULT_CACHE_BYTES)
+
+    if shared_pages and output_mode not in ('grayscale', 'color'):
+        raise ValueError(f"共享页面模式仅支持 grayscale / color 输出，当前为 {output_mode}")
+
+    update_progress(f"开始批量处理，共 {total_customers} 个买家（{code_length} 位特征码，"
+                    f"撞码概率 {collision_probability(total_customers, code_length):.2%}）...")
+
+    # 目标体积：各副本只有个人信息不同，压缩参数只需选择一次
+    output_dpi = None
+    if target_size_mb and customer_list:
+        first = customer_list[0]
+        first_name = first.get('name', '未知')
+        first_phone = first.get('phone', '未知')
+        choice = choose_target_encoding(
+            pdf_bytes,
+            watermark_template.format(name=first_name, phone=first_phone),
+            interference_text, target_size_mb,
+            output_mode=output_mode, dpi=dpi, allow_dpi_reduction=allow_dpi_reduction,
+            page_cache=page_cache,
+            ripple_amplitude=ripple_amplitude, ripple_frequency=ripple_frequency,
+            guilloche_density=guilloche_density, guilloche_color_depth=guilloche_color_depth,
+            noise_level=noise_level, num_lines=num_lines, num_interference=num_interference,
+            watermark_font_size=watermark_font_size,
+            enable_anti_copy=enable_anti_copy, anti_copy_pattern=anti_copy_pattern,
+            anti_copy_density=anti_copy_density, watermark_density=watermark_density,
+            watermark_color=watermark_color, watermark_alpha=watermark_alpha,
+            buyer_id=f"{first_name}_{first_phone}",
+            enable_spatial_tracking=enable_spatial_tracking,
+            enable_visible_code=enable_visible_code,
+            enable_invisible_dots=enable_invisible_dots,
+            enable_binding_line=enable_binding_line,
+            code_length=code_length
+        )
+        quality, output_dpi = choice['quality'], choice['dpi']
+        update_progress(f"按目标体积 {target_size_mb} MB 选定质量 {quality}%，输出 {output_dpi} DPI")
+
+    # 页数和页面尺寸只读取一次，各副本规划内存时共用
+    pdf_info = probe_pdf(pdf_bytes) if max_rss_mb else None
+
+    # 台账中还没有该母版时，在第一次栅格化母版的循环中顺带逐页计算感知哈希
+    document_sha256 = issuance_ledger.sha256_bytes(pdf_bytes) if ledger is not None else None
+    fingerprints = ([] if ledger is not None and not ledger.has_fingerprints(document_sha256)
+                    else None)
+
+    # 共享页面模式：与买家无关的图层只处理和编码一次
+    shared = None
+    if shared_pages:
+        shared_window = None
+        if max_rss_mb:
+            plan = memory_budget.plan_memory(
+                pdf_info['page_sizes'], dpi, max_rss_mb,
+                output_mode=output_mode,
+                max_workers=1,
+                cache_bytes=memory_budget.cache_headroom(page_cache),
+                enable_anti_copy=enable_anti_copy,
+                guilloche=guilloche_density > 0 and guilloche_color_depth > 0,
+                ripple=ripple_amplitude > 0,
+                watermark=False,
+                noise=noise_level > 0
+            )
+            update_progress(plan.describe())
+            shared_window = plan.window
+
+        update_progress("处理并编码共享页面（所有买家共用）...")
+        shared = encode_shared_pages(
+            pdf_bytes, output_mode=output_mode, dpi=dpi, quality=quality,
+            output_dpi=output_dpi, page_cache=page_cache,
+            window=shared_window, pdf_info=pdf_info, fingerprints=fingerprints,
+            ripple_amplitude=ripple_amplitude, ripple_frequency=ripple_frequency,
+            guilloche_density=guilloche_density, guilloche_color_depth=guilloche_color_depth,
+            noise_level=noise_level, num_lines=num_lines,
+            enable_anti_copy=enable_anti_copy, anti_copy_pattern=anti_copy_pattern,
+            anti_copy_density=anti_copy_density
+        )
 
     for idx, customer in enumerate(customer_list, 1):
         customer_name = customer.get('name', '未知')
@@ -1088,6 +2348,34 @@ def process_pdf_batch(pdf_bytes, customer_list,
         # 生成 buyer_id（使用姓名+手机号组合）
         buyer_id = f"{customer_name}_{customer_phone}"
 
+        # 使用序号作为 key，保存 PDF 和买家信息
+        customer_id = f"{idx:04d}_{customer_name}"
+
+        if shared is not None:
+            # 只绘制并编码买家专属叠加层（同尺寸页面共用）
+            overlays = {}
+            pages = []
+            for base, size in shared:
+                if size not in overlays:
+                    overlays[size] = encode_overlays(render_buyer_overlays(
+                        size, watermark_text, buyer_id, interference_text,
+                        num_interference, watermark_font_size, watermark_density,
+                        watermark_color, watermark_alpha, enable_spatial_tracking,
+                        enable_visible_code, enable_invisible_dots, enable_binding_line,
+                        code_length
+                    ), output_mode)
+                pages.append(overlay_page(base, overlays[size]))
+
+            feature_code = generate_feature_code(buyer_id, code_length)
+            output_pdf = write_output(pages, max_part_mb, max_pages_per_part, customer_id,
+                                      feature_code if enable_structure_marks else None,
+                                      trace_key)
+            results[customer_id] = (output_pdf, customer)
+            if ledger is not None:
+                issues.append(issuance_ledger.issue_record(output_pdf, buyer_id, feature_code, customer))
+            update_progress(f"[{idx}/{total_customers}] 完成：{customer_name}")
+            continue
+
         # 处理单个 PDF
         output_pdf, _ = process_pdf(
             pdf_bytes,
@@ -1116,15 +2404,57 @@ def process_pdf_batch(pdf_bytes, customer_list,
             enable_visible_code=enable_visible_code,
             enable_invisible_dots=enable_invisible_dots,
             enable_binding_line=enable_binding_line,
+            code_length=code_length,
+            enable_structure_marks=enable_structure_marks,
+            trace_key=trace_key,
+            page_cache=page_cache,
+            max_rss_mb=max_rss_mb,
+            max_workers=max_workers,
+            pdf_info=pdf_info,
+            output_dpi=output_dpi,
+            max_part_mb=max_part_mb,
+            max_pages_per_part=max_pages_per_part,
+            part_stem=customer_id,
+            threshold_method=threshold_method,
+            # 第一份副本栅格化母版时收集页面指纹
+            page_fingerprints=fingerprints if idx == 1 else None,
             progress_callback=None  # 不传递进度回调，避免输出过多信息
         )
 
-        # 使用序号作为 key，保存 PDF 和买家信息
-        customer_id = f"{idx:04d}_{customer_name}"
         results[customer_id] = (output_pdf, customer)
+        if ledger is not None:
+            issues.append(issuance_ledger.issue_record(
+                output_pdf, buyer_id, generate_feature_code(buyer_id, code_length), customer))
 
         update_progress(f"[{idx}/{total_customers}] 完成：{customer_name}")
 
-    update_progress(f"批量处理完成！共生成 {total_customers} 份专属 PDF")
+    collision_note = ""
+    if ledger is not None:
+        _, collisions = ledger.record_release(
+            document_sha256, issues, mode='batch',
+            parameters=dict(
+                watermark_template=watermark_template, watermark_font_size=watermark_font_size,
+                watermark_density=watermark_density, watermark_color=watermark_color,
+                watermark_alpha=watermark_alpha, enable_anti_copy=enable_anti_copy,
+                anti_copy_pattern=anti_copy_pattern, anti_copy_density=anti_copy_density,
+                enable_spatial_tracking=enable_spatial_tracking,
+                enable_visible_code=enable_visible_code,
+                enable_invisible_dots=enable_invisible_dots,
+                enable_binding_line=enable_binding_line, code_length=code_length,
+                ripple_amplitude=ripple_amplitude, ripple_frequency=ripple_frequency,
+                guilloche_density=guilloche_density, guilloche_color_depth=guilloche_color_depth,
+                noise_level=noise_level, num_lines=num_lines, num_interference=num_interference,
+                interference_text=interference_text, output_mode=output_mode, dpi=dpi,
+                output_dpi=output_dpi, quality=quality, shared_pages=shared_pages
+            ),
+            page_fingerprints=fingerprints
+        )
+        for code, buyer_ids in collisions.items():
+            update_progress(f"⚠️ 特征码 {code} 同时分配给了 {len(buyer_ids)} 位买家："
+                            f"{'、'.join(buyer_ids)}（溯源时需结合可见水印区分）")
+        if collisions:
+            collision_note = f"，其中 {len(collisions)} 组买家特征码相同"
+
+    update_progress(f"批量处理完成！共生成 {total_customers} 份专属 PDF{collision_note}")
 
     return results
@@ -0,0 +1,290 @@
+"""
+发行台账模块
+
+每次发行（单份或批量）时把 文档哈希、买家、特征码、参数、输出哈希、时间
+写入本地 SQLite 台账，溯源时不必再找回当时的买家名单：
+一次走索引的查询即可列出该特征码在所有历史发行中对应的买家
+同一批次内出现撞码时在发行时即给出提示
+装订线读数有误码时，可在全部已发行的特征码中按汉明距离容错查找
+母版每页的感知哈希也记入台账，泄露的页面可先反查出自哪份母版（见 page_fingerprint）
+不依赖 Streamlit，可独立使用
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+import buyer_index
+import page_fingerprint
+
+
+DEFAULT_LEDGER_PATH = 'issuance_ledger.db'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS releases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    document_sha256 TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    parameters TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS issues (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    release_id INTEGER NOT NULL REFERENCES releases(id),
+    document_sha256 TEXT NOT NULL,
+    buyer_id TEXT,
+    buyer_name TEXT,
+    buyer_phone TEXT,
+    feature_code TEXT,
+    output_sha256 TEXT NOT NULL,
+    issued_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_issues_feature_code ON issues(feature_code);
+CREATE INDEX IF NOT EXISTS idx_issues_document ON issues(document_sha256);
+CREATE INDEX IF NOT EXISTS idx_issues_release ON issues(release_id, feature_code);
+CREATE TABLE IF NOT EXISTS page_fingerprints (
+    document_sha256 TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    phash INTEGER NOT NULL,
+    dhash INTEGER NOT NULL,
+    PRIMARY KEY (document_sha256, page)
+);
+"""
+
+
+def sha256_bytes(data):
+    """字节内容的 SHA-256"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def output_sha256(output_pdf):
+    """
+    输出文件的 SHA-256
+
+    参数:
+        output_pdf: BytesIO 对象，或分卷列表 [(文件名, BytesIO), ...]（按分卷顺序连续计算）
+
+    返回:
+        十六进制摘要字符串
+    """
+    parts = [output_pdf] if not isinstance(output_pdf, list) else [part for _, part in output_pdf]
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.getbuffer())
+    return digest.hexdigest()
+
+
+def issue_record(output_pdf, buyer_id=None, feature_code=None, customer=None):
+    """
+    构造一条发行记录
+
+    参数:
+        output_pdf: 发给该买家的输出（BytesIO 或分卷列表）
+        buyer_id: 买家标识（写入溯源标记的 ID）
+        feature_code: 特征码
+        customer: 买家信息字典（可选，记录姓名和手机号）
+
+    返回:
+        字典，传给 IssuanceLedger.record_release
+    """
+    customer = customer or {}
+    return {
+        'buyer_id': buyer_id,
+        'buyer_name': None if customer.get('name') is None else str(customer['name']),
+        'buyer_phone': None if customer.get('phone') is None else str(customer['phone']),
+        'feature_code': feature_code,
+        'output_sha256': output_sha256(output_pdf),
+    }
+
+
+class IssuanceLedger:
+    """
+    SQLite 发行台账（线程安全，可在 Streamlit 会话之间共享）
+
+    - releases: 每次发行一行（母版哈希、模式、参数）
+    - issues: 每份副本一行，按特征码和母版建立索引
+    - page_fingerprints: 母版每页一行（pHash、dHash），同一母版多次发行只记一次
+    """
+
+    def __init__(self, path=DEFAULT_LEDGER_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        if path != ':memory:':
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._binding_indexes = {}  # 特征码位数 → BindingCodeIndex（有新发行时失效）
+        self._fingerprint_index = None  # FingerprintIndex（有新母版时失效）
+
+    def record_release(self, document_sha256, issues, mode='batch', parameters=None,
+                       page_fingerprints=None):
+        """
+        在一个事务中写入一次发行及其全部副本
+
+        参数:
+            document_sha256: 母版 PDF 的 SHA-256
+            issues: issue_record 返回的字典列表
+            mode: 'single' 或 'batch'
+            parameters: 发行参数字典（以 JSON 保存）
+            page_fingerprints: 母版每页的 page_fingerprint.fingerprint 结果列表（可选，已记录的母版忽略）
+
+        返回:
+            (release_id, 撞码字典 {特征码: [buyer_id, ...]})
+        """
+        now = datetime.now().isoformat(timespec='seconds')
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO releases (document_sha256, mode, parameters, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (document_sha256, mode,
+                 json.dumps(parameters or {}, ensure_ascii=False, default=str), now)
+            )
+            release_id = cursor.lastrowid
+            self._conn.executemany(
+                "INSERT INTO issues (release_id, document_sha256, buyer_id, buyer_name, "
+                "buyer_phone, feature_code, output_sha256, issued_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(release_id, document_sha256, issue['buyer_id'], issue['buyer_name'],
+                  issue['buyer_phone'], issue['feature_code'], issue['output_sha256'], now)
+                 for issue in issues]
+            )
+            if page_fingerprints:
+                inserted = self._conn.executemany(
+                    "INSERT OR IGNORE INTO page_fingerprints (document_sha256, page, phash, dhash) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(document_sha256, page, phash, dhash)
+                     for page, (phash, dhash) in enumerate(page_fingerprints)]
+                ).rowcount
+                if inserted:
+                    self._fingerprint_index = None
+            self._binding_indexes.clear()
+        return release_id, self.release_collisions(release_id)
+
+    def release_collisions(self, release_id):
+        """
+        同一次发行中特征码相同的买家
+
+        返回:
+            字典 {特征码: [buyer_id, ...]}
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT feature_code, buyer_id FROM issues "
+                "WHERE release_id = ? AND feature_code IN ("
+                "  SELECT feature_code FROM issues WHERE release_id = ? AND feature_code IS NOT NULL"
+                "  GROUP BY feature_code HAVING COUNT(*) > 1"
+                ") ORDER BY feature_code, id",
+                (release_id, release_id)
+            ).fetchall()
+
+        collisions = {}
+        for row in rows:
+            collisions.setdefault(row['feature_code'], []).append(row['buyer_id'])
+        return collisions
+
+    def lookup(self, feature_code, document_sha256=None):
+        """
+        查找特征码在所有历史发行中对应的副本（走 feature_code 索引）
+
+        参数:
+            feature_code: 特征码（大小写、首尾空白不敏感）
+            document_sha256: 只查某份母版的发行（可选）
+
+        返回:
+            字典列表（buyer_id、buyer_name、buyer_phone、feature_code、document_sha256、
+            output_sha256、issued_at、release_id、mode、parameters），按发行时间倒序
+        """
+        query = ("SELECT issues.*, releases.mode, releases.parameters FROM issues "
+                 "JOIN releases ON releases.id = issues.release_id "
+                 "WHERE issues.feature_code = ?")
+        args = [str(feature_code).upper().strip()]
+        if document_sha256:
+            query += " AND issues.document_sha256 = ?"
+            args.append(document_sha256)
+        query += " ORDER BY issues.id DESC"
+
+        with self._lock:
+            rows = self._conn.execute(query, args).fetchall()
+        return [dict(row, parameters=json.loads(row['parameters'])) for row in rows]
+
+    def nearest(self, bits, confidence=None, max_distance=buyer_index.DEFAULT_MAX_DISTANCE,
+                top_k=None):
+        """
+        按有误码的装订线读数查找已发行的副本
+
+        容错索引按特征码位数建立在全部已发行的特征码上，发行新副本后重新建立
+
+        参数:
+            bits: 装订线读出的二进制字符串（位数 × 6）
+            confidence: 每一位的置信度数组（可选，0 表示该位缺失）
+            max_distance: 允许的误码位数
+            top_k: 最多返回的特征码数
+
+        返回:
+            lookup 的字典列表，另含 'distance' 和 'cost'，按代价、距离、发行时间倒序排列
+        """
+        code_length = len(bits) // buyer_index.BITS_PER_CHAR
+        with self._lock:
+            index = self._binding_indexes.get(code_length)
+            if index is None:
+                codes = [row[0] for row in self._conn.execute(
+                    "SELECT DISTINCT feature_code FROM issues WHERE length(feature_code) = ?",
+                    (code_length,))]
+                index = self._binding_indexes[code_length] = buyer_index.BindingCodeIndex(codes)
+
+        return [dict(row, distance=match['distance'], cost=match['cost'])
+                for match in index.query(bits, confidence, max_distance, top_k)
+                for row in self.lookup(match['feature_code'])]
+
+    def has_fingerprints(self, document_sha256):
+        """该母版的页面指纹是否已记录（已记录时发行无需再计算）"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT 1 FROM page_fingerprints WHERE document_sha256 = ? LIMIT 1",
+                (document_sha256,)).fetchone() is not None
+
+    def find_documents(self, fingerprints, top_k=page_fingerprint.DEFAULT_TOP_K,
+                       max_distance=page_fingerprint.DEFAULT_MAX_DISTANCE):
+        """
+        按盗版页面的感知哈希查找来源母版
+
+        指纹索引建立在全部已记录的母版页面上，记录新母版后重新建立
+
+        参数:
+            fingerprints: 盗版页面的 page_fingerprint.fingerprint 结果列表
+            top_k: 最多返回的母版数
+            max_distance: 每页允许的最大汉明距离之和（0-128）
+
+        返回:
+            FingerprintIndex.query 的字典列表，另含该母版最近一次发行的
+            'mode'、'parameters'、'created_at' 和发行次数 'releases'
+        """
+        with self._lock:
+            index = self._fingerprint_index
+            if index is None:
+                index = self._fingerprint_index = page_fingerprint.FingerprintIndex(
+                    self._conn.execute("SELECT document_sha256, page, phash, dhash FROM page_fingerprints"))
+
+        results = index.query(fingerprints, top_k, max_distance)
+        with self._lock:
+            for result in results:
+                latest = self._conn.execute(
+                    "SELECT mode, parameters, created_at, "
+                    "(SELECT COUNT(*) FROM releases WHERE document_sha256 = ?) AS releases "
+                    "FROM releases WHERE document_sha256 = ? ORDER BY id DESC LIMIT 1",
+                    (result['document_sha256'], result['document_sha256'])).fetchone()
+                if latest is not None:
+                    result.update(dict(latest, parameters=json.loads(latest['parameters'])))
+        return results
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM issues").fetchone()[0]
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,235 @@
+"""
+内存预算模块
+根据页面尺寸、DPI 和启用的防护层估算每页内存开销，
+在预算内规划栅格化窗口大小和并发页数（页面缓存还能增长的部分一并计入），
+超出预算时在栅格化之前失败
+不依赖 Streamlit，可独立使用
+"""
+
+import os
+import sys
+
+
+# 保守的安全余量（解释器、库和碎片）
+SAFETY_MARGIN_BYTES = 64 * 1024 * 1024
+
+# 经验值：压缩后每像素字节数（JPEG 质量 75 左右；bilevel 为 CCITT G4，mrc 为 G4 蒙版 + 背景）
+ENCODED_BYTES_PER_PIXEL = {
+    'grayscale': 0.12,
+    'color': 0.25,
+    'bilevel': 0.02,
+    'mrc': 0.03,
+}
+
+# 设置了内存上限且调用方未传入页面缓存时，临时缓存最多占上限的比例
+CACHE_SHARE = 0.25
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """即使最小并发也无法在内存预算内完成处理"""
+
+
+class MemoryPlan:
+    """
+    内存规划结果
+
+    属性:
+        window: 一次栅格化的页数
+        workers: 同时处理的页数
+        page_peak_bytes: 单页处理峰值（字节）
+        estimated_peak_bytes: 整个任务的预计峰值（字节，不含进程基线，含页面缓存的增长）
+        budget_bytes: 可用预算（字节，已扣除进程基线和安全余量）
+        cache_bytes: 为页面缓存预留的字节数
+    """
+
+    def __init__(self, window, workers, page_peak_bytes, estimated_peak_bytes, budget_bytes,
+                 cache_bytes=0):
+        self.window = window
+        self.workers = workers
+        self.page_peak_bytes = page_peak_bytes
+        self.estimated_peak_bytes = estimated_peak_bytes
+        self.budget_bytes = budget_bytes
+        self.cache_bytes = cache_bytes
+
+    def describe(self):
+        """生成用于进度提示的中文说明"""
+        mb = 1024 * 1024
+        return (f"内存规划：单页峰值约 {self.page_peak_bytes / mb:.0f} MB，"
+                f"预计总峰值约 {self.estimated_peak_bytes / mb:.0f} MB"
+                f"（可用 {self.budget_bytes / mb:.0f} MB，"
+                f"其中为页面缓存预留 {self.cache_bytes / mb:.0f} MB），"
+                f"每次栅格化 {self.window} 页，并发 {self.workers} 页")
+
+
+def current_rss_bytes():
+    """
+    读取当前进程的常驻内存（RSS）
+
+    返回:
+        字节数，无法读取时返回 0
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 返回字节，Linux 返回 KB
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except (ImportError, OSError):
+        return 0
+
+
+def page_pixels(width_pt, height_pt, dpi):
+    """
+    计算页面栅格化后的像素尺寸
+
+    参数:
+        width_pt: 页面宽度（pt）
+        height_pt: 页面高度（pt）
+        dpi: 栅格化分辨率
+
+    返回:
+        (width_px, height_px) 元组
+    """
+    return int(round(width_pt * dpi / 72.0)), int(round(height_pt * dpi / 72.0))
+
+
+def estimate_page_cost(width_pt, height_pt, dpi, output_mode='grayscale',
+                       enable_anti_copy=False, guilloche=True, ripple=False,
+                       watermark=True, noise=True):
+    """
+    估算单页的内存开销
+
+    各步骤的临时数组（按每像素字节数）：
+    - 栅格化页面：RGB 3 字节
+    - 防复印底纹 / Guilloche：RGBA 图层 + RGBA 副本 + 合成结果，约 12 字节
+    - 水波纹扭曲：两张 float32 映射表 + 输入输出数组，约 14 字节
+    - 可见水印：对角线两倍边长的 RGBA 临时画布（旋转时再复制一份）
+    - 高斯噪点：float64 噪声、求和、裁剪三份三通道数组，约 72 字节
+
+    参数:
+        width_pt: 页面宽度（pt）
+        height_pt: 页面高度（pt）
+        dpi: 栅格化分辨率
+        output_mode: 输出模式
+        enable_anti_copy / guilloche / ripple / watermark / noise: 启用的防护层
+
+    返回:
+        字典 {'raster': 栅格页字节, 'peak': 处理峰值字节, 'encoded': 编码后字节}
+    """
+    width, height = page_pixels(width_pt, height_pt, dpi)
+    pixels = width * height
+
+    raster = pixels * 3
+    stages = [0]
+
+    if enable_anti_copy or guilloche:
+        stages.append(pixels * 12)
+    if ripple:
+        stages.append(pixels * 14)
+    if watermark:
+        temp_side = 2 * int((width ** 2 + height ** 2) ** 0.5)
+        stages.append(temp_side * temp_side * 4 * 2 + pixels * 8)
+    if noise:
+        stages.append(pixels * 72)
+
+    encoded = int(pixels * ENCODED_BYTES_PER_PIXEL.get(output_mode, 0.25))
+
+    return {
+        'raster': raster,
+        'peak': raster + max(stages),
+        'encoded': encoded,
+    }
+
+
+def cache_headroom(page_cache):
+    """
+    页面缓存还能增长的字节数（当前占用已包含在进程 RSS 中）
+
+    参数:
+        page_cache: PageCache 对象或 None
+
+    返回:
+        字节数（未使用缓存时为 0）
+    """
+    if page_cache is None:
+        return 0
+    return max(page_cache.max_bytes - page_cache.current_bytes, 0)
+
+
+def cache_budget_bytes(max_rss_mb, default_bytes):
+    """
+    按内存上限确定临时页面缓存的字节预算
+
+    参数:
+        max_rss_mb: 进程常驻内存上限（MB）
+        default_bytes: 未设置上限时的缓存预算（字节）
+
+    返回:
+        字节数（不超过上限的 CACHE_SHARE）
+    """
+    return min(default_bytes, int(max_rss_mb * 1024 * 1024 * CACHE_SHARE))
+
+
+def plan_memory(page_sizes, dpi, max_rss_mb, output_mode='grayscale', max_workers=4,
+                baseline_bytes=None, cache_bytes=0, **layers):
+    """
+    在内存预算内规划栅格化窗口和并发页数
+
+    预计峰值 = 窗口内的栅格页 + 并发页的处理峰值 + 已编码页面 + 页面缓存的增长
+
+    参数:
+        page_sizes: 每页尺寸列表 [(width_pt, height_pt), ...]
+        dpi: 栅格化分辨率
+        max_rss_mb: 进程常驻内存上限（MB）
+        output_mode: 输出模式
+        max_workers: 最大并发页数
+        baseline_bytes: 进程当前占用（字节），默认读取当前 RSS
+        cache_bytes: 任务期间页面缓存还可能增长的字节数（见 cache_headroom）
+        **layers: 传给 estimate_page_cost 的防护层开关
+
+    返回:
+        MemoryPlan 对象
+
+    异常:
+        MemoryBudgetExceeded: 单页、单并发也放不进预算
+    """
+    if not page_sizes:
+        raise ValueError("PDF 没有页面，无法规划内存")
+
+    if baseline_bytes is None:
+        baseline_bytes = current_rss_bytes()
+
+    budget = int(max_rss_mb * 1024 * 1024) - baseline_bytes - SAFETY_MARGIN_BYTES
+
+    costs = [estimate_page_cost(w, h, dpi, output_mode, **layers) for w, h in page_sizes]
+    raster = max(c['raster'] for c in costs)
+    peak = max(c['peak'] for c in costs)
+    encoded_total = sum(c['encoded'] for c in costs)
+
+    def total(window, workers):
+        return window * raster + workers * (peak - raster) + encoded_total + cache_bytes
+
+    if total(1, 1) > budget:
+        mb = 1024 * 1024
+        raise MemoryBudgetExceeded(
+            f"内存预算不足：{dpi} DPI 下单页处理约需 {total(1, 1) / mb:.0f} MB，"
+            f"可用仅 {max(budget, 0) / mb:.0f} MB（上限 {max_rss_mb} MB，"
+            f"进程已占用 {baseline_bytes / mb:.0f} MB，页面缓存最多还会占用 {cache_bytes / mb:.0f} MB）。"
+            f"请降低 DPI、关闭部分防护层或缩小页面缓存"
+        )
+
+    workers = 1
+    while workers < max_workers and total(workers + 1, workers + 1) <= budget:
+        workers += 1
+
+    window = workers
+    while window < len(page_sizes) and total(window + 1, workers) <= budget:
+        window += 1
+
+    return MemoryPlan(window, workers, peak, total(window, workers), budget, cache_bytes)
@@ -0,0 +1,195 @@
+"""
+页面缓存模块
+将栅格化后的 PDF 页面以无损压缩（PNG）形式保存在内存中，按需解码
+支持字节预算和 LRU 淘汰，同一进程内可同时保留数十份母版
+不依赖 Streamlit，可独立使用
+"""
+
+import io
+import hashlib
+import threading
+from collections import OrderedDict
+from PIL import Image
+
+
+# 默认缓存预算：512 MB（200 DPI 灰度文本页压缩后通常只有几百 KB）
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+
+# PNG 压缩级别：1 为最快，压缩率已足够（白底文本页约 1/20）
+DEFAULT_COMPRESS_LEVEL = 1
+
+
+def document_key(pdf_bytes, dpi):
+    """
+    生成缓存键（文档内容哈希 + DPI）
+
+    参数:
+        pdf_bytes: PDF 文件的字节内容
+        dpi: 栅格化分辨率
+
+    返回:
+        缓存键字符串
+    """
+    digest = hashlib.sha256(pdf_bytes).hexdigest()
+    return f"{digest}@{dpi}"
+
+
+def compress_page(image, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """
+    将页面图像无损压缩为 PNG 字节
+
+    参数:
+        image: PIL Image 对象
+        compress_level: PNG 压缩级别（0-9）
+
+    返回:
+        PNG 字节
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', compress_level=compress_level)
+    return buffer.getvalue()
+
+
+def decompress_page(blob):
+    """
+    将 PNG 字节解码为页面图像
+
+    参数:
+        blob: PNG 字节
+
+    返回:
+        PIL Image 对象（已完整加载）
+    """
+    image = Image.open(io.BytesIO(blob))
+    image.load()
+    return image
+
+
+class CachedPages:
+    """
+    压缩页面序列
+
+    行为与页面图像列表相同（支持 len、下标和迭代），
+    但每次访问时才解码对应页面，内存中始终只保留压缩数据
+    """
+
+    def __init__(self, blobs):
+        self._blobs = list(blobs)
+        self._nbytes = sum(len(blob) for blob in self._blobs)
+
+    def __len__(self):
+        return len(self._blobs)
+
+    def __getitem__(self, index):
+        return decompress_page(self._blobs[index])
+
+    def __iter__(self):
+        for blob in self._blobs:
+            yield decompress_page(blob)
+
+    @property
+    def nbytes(self):
+        """压缩后占用的字节数"""
+        return self._nbytes
+
+
+class PageCache:
+    """
+    内存页面缓存（按文档 LRU 淘汰）
+
+    参数:
+        max_bytes: 缓存字节预算，超出时淘汰最久未使用的文档
+        compress_level: PNG 压缩级别
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.max_bytes = max_bytes
+        self.compress_level = compress_level
+        self._entries = OrderedDict()
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        查询缓存
+
+        参数:
+            key: 缓存键（见 document_key）
+
+        返回:
+            CachedPages 对象，未命中返回 None
+        """
+        with self._lock:
+            pages = self._entries.get(key)
+            if pages is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return pages
+
+    def put(self, key, images):
+        """
+        压缩并缓存一份文档的所有页面
+
+        单份文档超出整个预算时不会入缓存，但仍返回压缩后的页面序列
+
+        参数:
+            key: 缓存键
+            images: PIL Image 对象列表
+
+        返回:
+            CachedPages 对象
+        """
+        pages = CachedPages(compress_page(img, self.compress_level) for img in images)
+        return self.store(key, pages)
+
+    def store(self, key, pages):
+        """
+        缓存已压缩的页面序列（用于分批栅格化后一次性入缓存）
+
+        参数:
+            key: 缓存键
+            pages: CachedPages 对象
+
+        返回:
+            pages
+        """
+        size = pages.nbytes
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._current_bytes -= old.nbytes
+
+            if size <= self.max_bytes:
+                self._entries[key] = pages
+                self._current_bytes += size
+                self._evict()
+
+        return pages
+
+    def _evict(self):
+        """淘汰最久未使用的文档，直到回到预算内（调用方需持有锁）"""
+        while self._current_bytes > self.max_bytes and self._entries:
+            _, pages = self._entries.popitem(last=False)
+            self._current_bytes -= pages.nbytes
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._entries.clear()
+            self._current_bytes = 0
+
+    @property
+    def current_bytes(self):
+        """当前缓存占用的字节数"""
+        return self._current_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
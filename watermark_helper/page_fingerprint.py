@@ -0,0 +1,147 @@
+"""
+页面感知哈希模块
+
+泄露的副本先要确定来自哪一份母版，才能按该母版的发行参数和台账解码。
+发行时为母版的每一页计算两个 64 位感知哈希（pHash：32×32 灰度图 DCT 的低频 8×8 与中位数比较；
+dHash：9×8 灰度图相邻像素比较），存入发行台账；溯源时对盗版页面在低分辨率下计算同样的哈希，
+按汉明距离在全部母版页面中查找（一次异或 + popcount，数万页也只需毫秒）。
+两种哈希都只看整页的低频结构，对水印、底纹、噪点和 JPEG 压缩不敏感
+不依赖 Streamlit，可独立使用
+"""
+
+import cv2
+import numpy as np
+
+import buyer_index
+
+
+# 溯源时渲染页面的分辨率（哈希只用 32×32 的缩略图，无需高分辨率）
+FINGERPRINT_DPI = 50
+
+# pHash 的 DCT 输入边长和保留的低频边长
+PHASH_INPUT = 32
+HASH_SIDE = 8
+
+# 两种哈希的汉明距离之和不超过该值（共 128 位）视为同一页
+DEFAULT_MAX_DISTANCE = 24
+
+# 默认返回的候选母版数
+DEFAULT_TOP_K = 3
+
+
+def _bits_to_int(bits):
+    """布尔数组（按行展开）打包为 64 位有符号整数（SQLite INTEGER 可直接保存）"""
+    value = np.packbits(bits.astype(np.uint8).ravel()).view('>u8')[0]
+    return int(np.int64(np.uint64(value).view(np.int64)))
+
+
+def _gray(image):
+    """PIL Image 或 numpy 数组转为 float32 灰度数组"""
+    gray = np.asarray(image.convert('L') if hasattr(image, 'convert') else image)
+    return gray.astype(np.float32)
+
+
+def phash(image):
+    """
+    感知哈希（DCT 低频系数与中位数比较）
+
+    参数:
+        image: PIL Image 对象或灰度 numpy 数组
+
+    返回:
+        64 位有符号整数
+    """
+    small = cv2.resize(_gray(image), (PHASH_INPUT, PHASH_INPUT), interpolation=cv2.INTER_AREA)
+    low = cv2.dct(small)[:HASH_SIDE, :HASH_SIDE]
+    # 直流分量只反映整体亮度，不参与中位数
+    return _bits_to_int(low > np.median(low.ravel()[1:]))
+
+
+def dhash(image):
+    """
+    差分哈希（每行相邻像素的亮度梯度方向）
+
+    参数:
+        image: PIL Image 对象或灰度 numpy 数组
+
+    返回:
+        64 位有符号整数
+    """
+    small = cv2.resize(_gray(image), (HASH_SIDE + 1, HASH_SIDE), interpolation=cv2.INTER_AREA)
+    return _bits_to_int(small[:, 1:] > small[:, :-1])
+
+
+def fingerprint(image):
+    """
+    页面指纹
+
+    参数:
+        image: PIL Image 对象或灰度 numpy 数组（任意分辨率；翻拍件先用
+               page_registration.registered_thumbnail 去掉背景和倾斜）
+
+    返回:
+        (pHash, dHash) 元组
+    """
+    return phash(image), dhash(image)
+
+
+class FingerprintIndex:
+    """
+    母版页面指纹索引（内存中的 numpy 数组，按汉明距离查找）
+
+    参数:
+        rows: [(document_sha256, 页码, pHash, dHash), ...]（页码从 0 开始）
+    """
+
+    def __init__(self, rows):
+        rows = list(rows)
+        self.documents = [row[0] for row in rows]
+        self.pages = np.array([row[1] for row in rows], dtype=np.int64)
+        self.phashes = np.array([row[2] for row in rows], dtype=np.int64).view(np.uint64)
+        self.dhashes = np.array([row[3] for row in rows], dtype=np.int64).view(np.uint64)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def distances(self, fingerprint):
+        """与全部页面的汉明距离之和（0-128）"""
+        value_p, value_d = (np.array([value], dtype=np.int64).view(np.uint64)[0] for value in fingerprint)
+        return (buyer_index.popcount(self.phashes ^ value_p)
+                + buyer_index.popcount(self.dhashes ^ value_d)).astype(np.int64)
+
+    def query(self, fingerprints, top_k=DEFAULT_TOP_K, max_distance=DEFAULT_MAX_DISTANCE):
+        """
+        查找盗版页面来自哪份母版
+
+        参数:
+            fingerprints: 盗版页面的指纹列表（可以只有一页）
+            top_k: 最多返回的母版数
+            max_distance: 每页允许的最大汉明距离之和
+
+        返回:
+            字典列表，按匹配页数降序、平均距离升序排列
+            - document_sha256: 母版哈希
+            - matches: [(盗版页下标, 母版页码, 距离), ...]（每个盗版页取该母版中最近的一页）
+            - distance: 匹配页的平均距离
+        """
+        if not len(self):
+            return []
+
+        documents = {}
+        for suspect, value in enumerate(fingerprints):
+            distances = self.distances(value)
+            for row in np.flatnonzero(distances <= max_distance):
+                best = documents.setdefault(self.documents[row], {})
+                if suspect not in best or distances[row] < best[suspect][1]:
+                    best[suspect] = (int(self.pages[row]), int(distances[row]))
+
+        ranked = []
+        for document, best in documents.items():
+            matches = [(suspect, page, distance) for suspect, (page, distance) in sorted(best.items())]
+            ranked.append({
+                'document_sha256': document,
+                'matches': matches,
+                'distance': float(np.mean([match[2] for match in matches])),
+            })
+        ranked.sort(key=lambda item: (-len(item['matches']), item['distance']))
+        return ranked[:top_k]
@@ -0,0 +1,216 @@
+"""
+页面配准模块
+
+翻拍、重新扫描的盗版页面与发行时的页面网格不再逐像素对齐（有背景、倾斜、透视），
+位置点和装订线的检测都会失败。这里在缩小的金字塔层上找到纸张四边或内容框，
+估计透视 / 旋转变换，只把溯源用的四条页边区域变换回标准网格，
+输出与 render_trace_pages 相同形式的页边画布，检测函数无需改动即可使用
+不依赖 Streamlit，可独立使用
+"""
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import image_processor
+
+
+# 在长边不超过该值的金字塔层上定位纸张和内容框
+REGISTRATION_SIZE = 512
+
+# 纸张至少占画面的比例（更小的亮区域视为画面中的其他物体）
+MIN_PAGE_AREA = 0.2
+
+# 画面四周的边框平均亮度高于该值时认为纸张铺满画面（没有背景，只可能倾斜）
+BACKGROUND_BRIGHTNESS = 200
+
+# 倾斜角小于该值（度）时不做旋转
+MIN_SKEW_DEGREES = 0.2
+
+# 判定为内容（文字、标记）的最低深度（255 - 灰度）
+CONTENT_DARKNESS = 64
+
+
+def _pyramid(gray):
+    """把灰度图逐级 pyrDown 到长边不超过 REGISTRATION_SIZE，返回 (小图, 缩小倍数)"""
+    factor = 1
+    while max(gray.shape) > REGISTRATION_SIZE:
+        gray = cv2.pyrDown(gray)
+        factor *= 2
+    return gray, factor
+
+
+def _order_corners(points):
+    """四个角点按 左上、右上、右下、左下 排列"""
+    points = np.asarray(points, dtype=np.float32).reshape(4, 2)
+    sums = points.sum(axis=1)
+    diffs = points[:, 1] - points[:, 0]
+    return np.array([points[np.argmin(sums)], points[np.argmin(diffs)],
+                     points[np.argmax(sums)], points[np.argmax(diffs)]], dtype=np.float32)
+
+
+def find_page_quad(gray):
+    """
+    在画面中找到纸张的四个角点
+
+    参数:
+        gray: 灰度 numpy 数组（全分辨率）
+
+    返回:
+        4 × 2 数组（左上、右上、右下、左下，全分辨率坐标），纸张铺满画面或找不到时返回 None
+    """
+    small, factor = _pyramid(gray)
+
+    # 纸张铺满画面时四周没有背景
+    border = np.concatenate([small[0], small[-1], small[:, 0], small[:, -1]])
+    if border.mean() > BACKGROUND_BRIGHTNESS:
+        return None
+
+    _, paper = cv2.threshold(cv2.GaussianBlur(small, (5, 5), 0), 0, 255,
+                             cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    paper = cv2.morphologyEx(paper, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+    contours, _ = cv2.findContours(paper, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+
+    contour = max(contours, key=cv2.contourArea)
+    if cv2.contourArea(contour) < MIN_PAGE_AREA * small.size:
+        return None
+
+    approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+    corners = approx if len(approx) == 4 else cv2.boxPoints(cv2.minAreaRect(contour))
+    corners = _order_corners(corners) * factor + (factor - 1) / 2
+
+    # 在全分辨率上把角点精确到亚像素（金字塔层上的误差可达数个像素）
+    window = max(factor * 2, 5)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    refined = cv2.cornerSubPix(gray, corners.reshape(-1, 1, 2).copy(), (window, window), (-1, -1),
+                               criteria).reshape(4, 2)
+
+    # 精修跑偏（如角点附近有其他强角点）时保留粗定位结果
+    moved = np.linalg.norm(refined - corners, axis=1) > window
+    refined[moved] = corners[moved]
+    return refined
+
+
+def find_skew(gray):
+    """
+    由内容框（文字和标记的最小外接矩形）估计纸张铺满画面时的倾斜角
+
+    参数:
+        gray: 灰度 numpy 数组（全分辨率）
+
+    返回:
+        倾斜角（度，逆时针为正），没有内容时返回 0
+    """
+    small, _ = _pyramid(gray)
+    points = cv2.findNonZero((255 - small > CONTENT_DARKNESS).astype(np.uint8))
+    if points is None or len(points) < 10:
+        return 0.0
+
+    _, _, angle = cv2.minAreaRect(points)
+    # OpenCV 的角度范围随版本不同，统一到 [-45, 45)
+    angle = (angle + 45) % 90 - 45
+    return -float(angle)
+
+
+def register_page(image):
+    """
+    估计盗版页面到标准页面网格的变换
+
+    参数:
+        image: PIL Image 对象（扫描件或照片）
+
+    返回:
+        字典
+        - method: 'page'（找到纸张四边，透视变换）、'skew'（纸张铺满画面，旋转）或 None（无需配准）
+        - matrix: 3 × 3 矩阵，把标准页面坐标映射到输入图像坐标
+        - size: 标准页面尺寸 (宽, 高)
+    """
+    gray = np.asarray(image.convert('L'))
+    height, width = gray.shape
+
+    corners = find_page_quad(gray)
+    if corners is not None:
+        top_left, top_right, bottom_right, bottom_left = corners
+        page_width = (np.linalg.norm(top_right - top_left) + np.linalg.norm(bottom_right - bottom_left)) / 2
+        page_height = (np.linalg.norm(bottom_left - top_left) + np.linalg.norm(bottom_right - top_right)) / 2
+        size = (int(round(page_width)), int(round(page_height)))
+        target = np.array([[0, 0], [size[0] - 1, 0], [size[0] - 1, size[1] - 1], [0, size[1] - 1]],
+                          dtype=np.float32)
+        matrix = cv2.getPerspectiveTransform(target, corners)
+        return {'method': 'page', 'matrix': matrix, 'size': size}
+
+    angle = find_skew(gray)
+    if abs(angle) >= MIN_SKEW_DEGREES:
+        # 绕画面中心旋转回正（标准坐标 → 输入坐标）
+        rotation = cv2.getRotationMatrix2D(((width - 1) / 2, (height - 1) / 2), angle, 1.0)
+        return {'method': 'skew', 'matrix': np.vstack([rotation, [0, 0, 1]]), 'size': (width, height)}
+
+    return {'method': None, 'matrix': np.eye(3), 'size': (width, height)}
+
+
+def warp_margins(image, registration):
+    """
+    只把溯源标记所在的四条页边区域变换到标准页面网格
+
+    参数:
+        image: PIL Image 对象
+        registration: register_page 的结果
+
+    返回:
+        PIL Image 对象（RGB，标准页面尺寸，页边以外为白色）
+    """
+    source = np.asarray(image.convert('RGB'))
+    size = registration['size']
+    canvas = Image.new('RGB', size, 'white')
+
+    for left, top, right, bottom in image_processor.trace_margin_boxes(*size):
+        if right <= left or bottom <= top:
+            continue
+        # 页边区域内的坐标先平移到整页坐标，再映射到输入图像
+        offset = np.array([[1, 0, left], [0, 1, top], [0, 0, 1]], dtype=np.float64)
+        strip = cv2.warpPerspective(source, registration['matrix'] @ offset, (right - left, bottom - top),
+                                    flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                                    borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
+        canvas.paste(Image.fromarray(strip), (left, top))
+
+    return canvas
+
+
+def register_margins(image):
+    """
+    配准页面并只变换页边区域（无需配准时原样返回）
+
+    参数:
+        image: PIL Image 对象
+
+    返回:
+        (PIL Image 对象, register_page 的结果)
+    """
+    registration = register_page(image)
+    if registration['method'] is None:
+        return image, registration
+    return warp_margins(image, registration), registration
+
+
+def registered_thumbnail(image, size=256):
+    """
+    把整页配准到标准页面网格并缩小（用于计算页面指纹，见 page_fingerprint）
+
+    参数:
+        image: PIL Image 对象
+        size: 缩略图长边（像素）
+
+    返回:
+        灰度 numpy 数组（无需配准时为整页缩略图）
+    """
+    registration = register_page(image)
+    width, height = registration['size']
+    scale = size / max(width, height)
+    target = (max(1, round(width * scale)), max(1, round(height * scale)))
+    # 缩略图坐标 → 标准页面坐标 → 输入图像坐标
+    to_page = np.diag([width / target[0], height / target[1], 1.0])
+    return cv2.warpPerspective(np.asarray(image.convert('L')), registration['matrix'] @ to_page, target,
+                               flags=cv2.INTER_AREA | cv2.WARP_INVERSE_MAP,
+                               borderMode=cv2.BORDER_REPLICATE)
@@ -0,0 +1,501 @@
+"""
+PDF 组装模块
+直接把已编码的图像数据流（JPEG 等）写入 PDF，不经过二次编码
+处理完一页即可编码一页，整份文档只在内存中保留压缩后的数据
+不依赖 Streamlit，可独立使用
+"""
+
+import io
+import weakref
+from PIL import Image
+
+
+# 每页的 PDF 结构开销（页面对象、内容流、交叉引用表项），分卷、目标体积和成本预估共用
+PAGE_OVERHEAD_BYTES = 400
+
+
+class PdfName(str):
+    """PDF 名称对象（序列化为 /Name）"""
+
+
+class EncodedImage:
+    """
+    已编码的图像 XObject
+
+    参数:
+        data: 编码后的数据流字节
+        width: 图像宽度（像素）
+        height: 图像高度（像素）
+        filter: PDF 解码过滤器名称（如 'DCTDecode'）
+        color_space: 颜色空间（'DeviceGray' / 'DeviceRGB'），图像蒙版为 None
+        bits: 每个颜色分量的位数
+        decode_parms: 解码参数字典（可选）
+        image_mask: 是否为 1 位图像蒙版（按填充色绘制）
+    """
+
+    def __init__(self, data, width, height, filter, color_space='DeviceGray',
+                 bits=8, decode_parms=None, image_mask=False):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.filter = filter
+        self.color_space = color_space
+        self.bits = bits
+        self.decode_parms = decode_parms
+        self.image_mask = image_mask
+
+    def __len__(self):
+        return len(self.data)
+
+
+class PdfPage:
+    """
+    一页 PDF（由若干图像图层按顺序叠加而成）
+
+    参数:
+        width_pt: 页面宽度（pt，1/72 英寸）
+        height_pt: 页面高度（pt）
+    """
+
+    def __init__(self, width_pt, height_pt):
+        self.width_pt = width_pt
+        self.height_pt = height_pt
+        self.layers = []
+
+    def add_image(self, image, rect=None, fill=None, alpha=None):
+        """
+        添加一个图像图层
+
+        参数:
+            image: EncodedImage 对象
+            rect: 放置区域 (x, y, width, height)，单位 pt，默认铺满整页
+            fill: 图像蒙版的填充色（0-1 灰度值或 RGB 元组）
+            alpha: 图层透明度（0-1），None 表示不透明
+
+        返回:
+            self（便于链式调用）
+        """
+        if rect is None:
+            rect = (0, 0, self.width_pt, self.height_pt)
+        self.layers.append((image, rect, fill, alpha))
+        return self
+
+    @property
+    def nbytes(self):
+        """本页引用的图像数据总字节数"""
+        return sum(len(layer[0]) for layer in self.layers)
+
+
+def page_size_pt(image, dpi):
+    """
+    根据像素尺寸和分辨率计算页面尺寸
+
+    参数:
+        image: PIL Image 对象
+        dpi: 分辨率
+
+    返回:
+        (width_pt, height_pt) 元组
+    """
+    width, height = image.size
+    return width * 72.0 / dpi, height * 72.0 / dpi
+
+
+def encode_jpeg(image, quality=75):
+    """
+    将图像编码为 JPEG 数据流
+
+    参数:
+        image: PIL Image 对象（L 或 RGB 模式，其他模式自动转换为 RGB）
+        quality: JPEG 压缩质量 (10-100)
+
+    返回:
+        EncodedImage 对象
+    """
+    if image.mode not in ('L', 'RGB'):
+        image = image.convert('RGB')
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality, optimize=True)
+
+    return EncodedImage(
+        buffer.getvalue(),
+        image.width,
+        image.height,
+        'DCTDecode',
+        color_space='DeviceGray' if image.mode == 'L' else 'DeviceRGB'
+    )
+
+
+def encode_ccitt_g4(image, image_mask=False):
+    """
+    将 1 位图像编码为 CCITT Group 4 数据流（黑白文本页通常只有 JPEG 的 1/10）
+
+    借助 Pillow（libtiff）写出单条带 TIFF，再取出条带数据直接嵌入 PDF
+
+    参数:
+        image: PIL Image 对象（非 1 位图像按 128 阈值二值化）
+        image_mask: 是否编码为图像蒙版（黑色像素按填充色绘制，白色像素透明）
+
+    返回:
+        EncodedImage 对象
+    """
+    if image.mode != '1':
+        image = image.convert('L').point(lambda v: 255 if v >= 128 else 0).convert('1')
+
+    buffer = io.BytesIO()
+    # 整页一个条带（ROWSPERSTRIP = 高度），数据流即为完整的 G4 编码
+    image.save(buffer, format='TIFF', compression='group4', tiffinfo={278: image.height})
+
+    tiff = Image.open(io.BytesIO(buffer.getvalue()))
+    offset = tiff.tag_v2[273][0]
+    length = tiff.tag_v2[279][0]
+
+    return EncodedImage(
+        buffer.getvalue()[offset:offset + length],
+        image.width,
+        image.height,
+        'CCITTFaxDecode',
+        color_space=None if image_mask else 'DeviceGray',
+        bits=1,
+        # Pillow 以 BlackIsZero 写出 1 位 TIFF，配合 BlackIs1 解码后黑色像素为 0
+        # （图像蒙版中值为 0 的像素按填充色绘制，其余透明）
+        decode_parms={'K': -1, 'Columns': image.width, 'Rows': image.height,
+                      'BlackIs1': True},
+        image_mask=image_mask
+    )
+
+
+def encode_page(image, output_mode='grayscale', dpi=200, quality=75):
+    """
+    按输出模式编码单页
+
+    参数:
+        image: PIL Image 对象
+        output_mode: 输出模式 ('grayscale'、'color' 或 'bilevel')
+        dpi: 输出分辨率
+        quality: JPEG 压缩质量（bilevel 模式无损，忽略此参数）
+
+    返回:
+        PdfPage 对象
+    """
+    if output_mode == 'bilevel':
+        width_pt, height_pt = page_size_pt(image, dpi)
+        return PdfPage(width_pt, height_pt).add_image(encode_ccitt_g4(image))
+
+    if output_mode == 'grayscale':
+        image = image.convert('L')
+
+    width_pt, height_pt = page_size_pt(image, dpi)
+    return PdfPage(width_pt, height_pt).add_image(encode_jpeg(image, quality))
+
+
+def encode_mrc_page(mask, background, dpi=200, quality=75, fill=0):
+    """
+    编码混合光栅内容（MRC）页面：低分辨率 JPEG 背景 + 全分辨率 1 位前景蒙版
+
+    背景铺满整页，前景蒙版（CCITT G4）叠加在上方，按填充色绘制文字和标记
+
+    参数:
+        mask: 前景蒙版（1 位 PIL Image，黑色为前景，决定页面尺寸）
+        background: 背景图像（PIL Image，任意分辨率，拉伸铺满整页）
+        dpi: 前景蒙版的分辨率
+        quality: 背景 JPEG 压缩质量
+        fill: 前景填充色（0-1 灰度值或 RGB 元组，默认黑色）
+
+    返回:
+        PdfPage 对象
+    """
+    width_pt, height_pt = page_size_pt(mask, dpi)
+    page = PdfPage(width_pt, height_pt)
+    page.add_image(encode_jpeg(background, quality))
+    page.add_image(encode_ccitt_g4(mask, image_mask=True), fill=fill)
+    return page
+
+
+# ============================================================================
+# 分卷输出
+# ============================================================================
+
+# 每个文件的固定开销（文件头、目录、交叉引用表头和 trailer）
+FILE_OVERHEAD_BYTES = 1024
+
+
+def split_pages(pages, max_part_bytes=None, max_pages_per_part=None):
+    """
+    按体积和页数上限把页面顺序划分为若干分卷
+
+    单页本身超过体积上限时独占一个分卷（无法再拆分）
+
+    参数:
+        pages: PdfPage 对象的可迭代序列（可以是生成器，按需逐页拉取）
+        max_part_bytes: 每个分卷的体积上限（字节，可选）
+        max_pages_per_part: 每个分卷的页数上限（可选）
+
+    返回:
+        生成器，每个分卷写满（下一页放不下）时立即产出该分卷的 PdfPage 列表
+    """
+    current = []
+    current_bytes = FILE_OVERHEAD_BYTES
+
+    for page in pages:
+        page_bytes = page.nbytes + PAGE_OVERHEAD_BYTES
+        over_size = max_part_bytes and current_bytes + page_bytes > max_part_bytes
+        over_count = max_pages_per_part and len(current) >= max_pages_per_part
+
+        if current and (over_size or over_count):
+            yield current
+            current = []
+            current_bytes = FILE_OVERHEAD_BYTES
+
+        current.append(page)
+        current_bytes += page_bytes
+
+    if current:
+        yield current
+
+
+def part_file_name(stem, index, count):
+    """
+    生成分卷文件名（按序号排序即为阅读顺序）
+
+    参数:
+        stem: 文件名前缀
+        index: 分卷序号（从 1 开始）
+        count: 分卷总数
+
+    返回:
+        如 'exam_01of03.pdf'
+    """
+    width = max(2, len(str(count)))
+    return f"{stem}_{index:0{width}d}of{count:0{width}d}.pdf"
+
+
+def write_parts(pages, stem='part', max_part_bytes=None, max_pages_per_part=None, **structure):
+    """
+    把页面序列写成若干个分卷 PDF
+
+    每个分卷写满即写出，已编码的页面随即释放，内存中只保留当前分卷的页面和已写出的文件；
+    分卷总数在最后才能确定，文件名在全部写完后统一生成
+
+    参数:
+        pages: PdfPage 对象的可迭代序列（可以是生成器）
+        stem: 分卷文件名前缀
+        max_part_bytes: 每个分卷的体积上限（字节，可选）
+        max_pages_per_part: 每个分卷的页数上限（可选）
+        **structure: 结构标记参数（xmp / image_prefix / order_bits，见 write_pdf），每个分卷都写入
+
+    返回:
+        [(文件名, BytesIO), ...] 列表
+    """
+    outputs = [write_pdf(part_pages, **structure)
+               for part_pages in split_pages(pages, max_part_bytes, max_pages_per_part)]
+    return [(part_file_name(stem, index, len(outputs)), output)
+            for index, output in enumerate(outputs, 1)]
+
+
+# ============================================================================
+# PDF 序列化
+# ============================================================================
+class _Ref:
+    """间接对象引用"""
+
+    def __init__(self, number):
+        self.number = number
+
+
+def _format_number(value):
+    """格式化数值（去掉多余的小数位）"""
+    if isinstance(value, int):
+        return str(value)
+    text = f"{value:.4f}".rstrip('0').rstrip('.')
+    return text if text not in ('', '-0') else '0'
+
+
+def _serialize(value):
+    """把 Python 值序列化为 PDF 语法"""
+    if isinstance(value, _Ref):
+        return f"{value.number} 0 R"
+    if isinstance(value, PdfName):
+        return '/' + value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return _format_number(value)
+    if isinstance(value, dict):
+        items = ' '.join(f"/{k} {_serialize(v)}" for k, v in value.items() if v is not None)
+        return f"<< {items} >>"
+    if isinstance(value, (list, tuple)):
+        return '[' + ' '.join(_serialize(v) for v in value) + ']'
+    if isinstance(value, str):
+        escaped = value.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        return f"({escaped})"
+    raise TypeError(f"无法序列化为 PDF 对象: {type(value)}")
+
+
+def _image_dict(image):
+    """生成图像 XObject 的字典"""
+    d = {
+        'Type': PdfName('XObject'),
+        'Subtype': PdfName('Image'),
+        'Width': image.width,
+        'Height': image.height,
+        'BitsPerComponent': image.bits,
+        'Filter': PdfName(image.filter),
+        'DecodeParms': image.decode_parms,
+    }
+    if image.image_mask:
+        d['ImageMask'] = True
+    else:
+        d['ColorSpace'] = PdfName(image.color_space)
+    return d
+
+
+def _fill_operator(fill):
+    """生成填充色操作符（用于图像蒙版）"""
+    if fill is None:
+        return '0 g'
+    if isinstance(fill, (int, float)):
+        return f"{_format_number(float(fill))} g"
+    return ' '.join(_format_number(float(c)) for c in fill) + ' rg'
+
+
+class _PdfBuilder:
+    """按对象编号顺序写出 PDF 的内部辅助类"""
+
+    def __init__(self, output):
+        self.output = output
+        self.offsets = {}
+        self.next_number = 1
+        self.output.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def reserve(self):
+        ref = _Ref(self.next_number)
+        self.next_number += 1
+        return ref
+
+    def write(self, ref, obj, stream=None):
+        self.offsets[ref.number] = self.output.tell()
+        if stream is not None:
+            obj = dict(obj)
+            obj['Length'] = len(stream)
+        body = f"{ref.number} 0 obj\n{_serialize(obj)}\n".encode('latin-1')
+        self.output.write(body)
+        if stream is not None:
+            self.output.write(b"stream\n")
+            self.output.write(stream)
+            self.output.write(b"\nendstream\n")
+        self.output.write(b"endobj\n")
+
+    def finish(self, root, info=None):
+        xref_offset = self.output.tell()
+        count = self.next_number
+        lines = [f"xref\n0 {count}\n", "0000000000 65535 f \n"]
+        for number in range(1, count):
+            lines.append(f"{self.offsets.get(number, 0):010d} 00000 n \n")
+        self.output.write(''.join(lines).encode('latin-1'))
+        trailer = {'Size': count, 'Root': root}
+        if info is not None:
+            trailer['Info'] = info
+        self.output.write(f"trailer\n{_serialize(trailer)}\nstartxref\n{xref_offset}\n%%EOF\n".encode('latin-1'))
+
+
+def write_pdf(pages, output=None, metadata=None, xmp=None, image_prefix='Im', order_bits=None):
+    """
+    把页面序列写成 PDF
+
+    同一个 EncodedImage 被多个页面引用时，只在文件中写入一次
+
+    参数:
+        pages: PdfPage 对象的可迭代序列
+        output: 可写的二进制文件对象（可选，默认新建 BytesIO）
+        metadata: 文档信息字典（可选，如 {'Producer': '...'}）
+        xmp: XMP 元数据流字节（可选，挂在文档目录的 /Metadata 上）
+        image_prefix: 图像资源名前缀（资源名为前缀 + 图层序号）
+        order_bits: 对象顺序标记（'0' / '1' 字符串，按页循环使用，可选）。
+                    '1' 表示该页的页面对象编号排在内容流之前（见 structure_marks）
+
+    返回:
+        output 对象（BytesIO 时已回到开头）
+    """
+    if output is None:
+        output = io.BytesIO()
+
+    builder = _PdfBuilder(output)
+    catalog_ref = builder.reserve()
+    pages_ref = builder.reserve()
+
+    # id(图像) → (弱引用, 对象引用)。pages 为生成器时已写出的图像可能被释放、id 被复用，
+    # 用弱引用确认仍是同一个对象；不持有强引用，流式写出时内存不随页数增长
+    image_refs = {}
+    page_refs = []
+
+    for page_index, page in enumerate(pages):
+        xobjects = {}
+        ext_states = {}
+        ops = []
+
+        for image, rect, fill, alpha in page.layers:
+            entry = image_refs.get(id(image))
+            if entry is not None and entry[0]() is image:
+                ref = entry[1]
+            else:
+                ref = builder.reserve()
+                builder.write(ref, _image_dict(image), stream=image.data)
+                image_refs[id(image)] = (weakref.ref(image), ref)
+
+            name = f"{image_prefix}{len(xobjects)}"
+            xobjects[name] = ref
+
+            x, y, w, h = (_format_number(float(v)) for v in rect)
+            op = ['q']
+            if alpha is not None:
+                gs_name = f"GS{len(ext_states)}"
+                ext_states[gs_name] = {'Type': PdfName('ExtGState'), 'ca': alpha, 'CA': alpha}
+                op.append(f"/{gs_name} gs")
+            if image.image_mask:
+                op.append(_fill_operator(fill))
+            op.append(f"{w} 0 0 {h} {x} {y} cm /{name} Do Q")
+            ops.append(' '.join(op))
+
+        if order_bits and order_bits[page_index % len(order_bits)] == '1':
+            page_ref = builder.reserve()
+            content_ref = builder.reserve()
+        else:
+            content_ref = builder.reserve()
+            page_ref = builder.reserve()
+        builder.write(content_ref, {}, stream='\n'.join(ops).encode('latin-1'))
+
+        resources = {'ProcSet': [PdfName('PDF'), PdfName('ImageB'), PdfName('ImageC')],
+                     'XObject': xobjects}
+        if ext_states:
+            resources['ExtGState'] = ext_states
+
+        builder.write(page_ref, {
+            'Type': PdfName('Page'),
+            'Parent': pages_ref,
+            'MediaBox': [0, 0, page.width_pt, page.height_pt],
+            'Resources': resources,
+            'Contents': content_ref,
+        })
+        page_refs.append(page_ref)
+
+    builder.write(pages_ref, {'Type': PdfName('Pages'), 'Kids': page_refs, 'Count': len(page_refs)})
+    catalog = {'Type': PdfName('Catalog'), 'Pages': pages_ref}
+    if xmp:
+        metadata_ref = builder.reserve()
+        builder.write(metadata_ref, {'Type': PdfName('Metadata'), 'Subtype': PdfName('XML')},
+                      stream=xmp)
+        catalog['Metadata'] = metadata_ref
+    builder.write(catalog_ref, catalog)
+
+    info_ref = None
+    if metadata:
+        info_ref = builder.reserve()
+        builder.write(info_ref, dict(metadata))
+
+    builder.finish(catalog_ref, info_ref)
+
+    if isinstance(output, io.BytesIO):
+        output.seek(0)
+    return output
@@ -0,0 +1,140 @@
+"""
+目标体积模块
+在抽样页面上二分搜索 JPEG 质量（可选降低 DPI），
+使整份 PDF 的预计体积不超过目标值，最终只对全文编码一次
+不依赖 Streamlit，可独立使用
+"""
+
+from PIL import Image
+
+import pdf_writer
+
+
+# 抽样页数
+DEFAULT_SAMPLES = 5
+
+# 质量搜索范围
+MIN_QUALITY = 20
+MAX_QUALITY = 95
+
+# 允许降低 DPI 时依次尝试的分辨率
+DPI_STEPS = (300, 250, 200, 150, 120, 100)
+
+# 外推误差余量
+SAFETY_FACTOR = 1.03
+
+
+def sample_indices(page_count, max_samples=DEFAULT_SAMPLES):
+    """
+    在文档中均匀选取抽样页
+
+    参数:
+        page_count: 总页数
+        max_samples: 最多抽样页数
+
+    返回:
+        页面下标列表（从 0 开始，升序且不重复）
+    """
+    if page_count <= max_samples:
+        return list(range(page_count))
+    step = page_count / max_samples
+    return sorted({int(step * i + step / 2) for i in range(max_samples)})
+
+
+def resize_for_dpi(image, dpi, output_dpi):
+    """
+    按输出分辨率缩小页面图像（页面物理尺寸不变）
+
+    参数:
+        image: PIL Image 对象（按 dpi 栅格化）
+        dpi: 当前分辨率
+        output_dpi: 输出分辨率
+
+    返回:
+        缩小后的 PIL Image 对象（output_dpi 不低于 dpi 时原样返回）
+    """
+    if not output_dpi or output_dpi >= dpi:
+        return image
+    scale = output_dpi / dpi
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.LANCZOS)
+
+
+def estimate_document_bytes(samples, page_count, quality, output_mode='grayscale',
+                            encode_page=pdf_writer.encode_page):
+    """
+    用抽样页的编码体积外推整份 PDF 的体积
+
+    参数:
+        samples: 抽样页 PIL Image 列表（已按输出分辨率缩放）
+        page_count: 总页数
+        quality: JPEG 压缩质量
+        output_mode: 输出模式
+        encode_page: 单页编码函数 (image, output_mode, dpi, quality) -> PdfPage
+
+    返回:
+        预计字节数
+    """
+    total = 0
+    for image in samples:
+        total += encode_page(image, output_mode, quality=quality).nbytes
+    mean_bytes = total / len(samples)
+    return int((mean_bytes + pdf_writer.PAGE_OVERHEAD_BYTES) * page_count * SAFETY_FACTOR)
+
+
+def choose_encoding(samples, page_count, target_bytes, output_mode='grayscale', dpi=200,
+                    allow_dpi_reduction=False, min_quality=MIN_QUALITY, max_quality=MAX_QUALITY,
+                    encode_page=pdf_writer.encode_page):
+    """
+    选择满足目标体积的最高 JPEG 质量（必要时降低 DPI）
+
+    先在原 DPI 下二分搜索质量；最低质量仍超出目标且允许降 DPI 时，
+    依次尝试更低的分辨率。全部失败时返回能达到的最小体积设置
+
+    参数:
+        samples: 抽样页 PIL Image 列表（按 dpi 栅格化并已处理）
+        page_count: 总页数
+        target_bytes: 目标体积（字节）
+        output_mode: 输出模式
+        dpi: 栅格化分辨率
+        allow_dpi_reduction: 是否允许降低输出 DPI
+        min_quality: 最低质量
+        max_quality: 最高质量
+        encode_page: 单页编码函数（见 estimate_document_bytes）
+
+    返回:
+        字典 {'quality': 质量, 'dpi': 输出分辨率, 'estimated_bytes': 预计体积,
+              'fits': 是否满足目标}
+    """
+    if not samples:
+        raise ValueError("没有抽样页面，无法选择压缩参数")
+
+    candidates = [dpi]
+    if allow_dpi_reduction:
+        candidates += [step for step in DPI_STEPS if step < dpi]
+
+    best = None
+    for output_dpi in candidates:
+        scaled = [resize_for_dpi(image, dpi, output_dpi) for image in samples]
+
+        low_bytes = estimate_document_bytes(scaled, page_count, min_quality, output_mode,
+                                            encode_page)
+        best = {'quality': min_quality, 'dpi': output_dpi,
+                'estimated_bytes': low_bytes, 'fits': low_bytes <= target_bytes}
+        if not best['fits']:
+            continue
+
+        # 二分搜索：满足目标的最高质量
+        low, high = min_quality, max_quality
+        while low < high:
+            mid = (low + high + 1) // 2
+            size = estimate_document_bytes(scaled, page_count, mid, output_mode, encode_page)
+            if size <= target_bytes:
+                low = mid
+                best = {'quality': mid, 'dpi': output_dpi,
+                        'estimated_bytes': size, 'fits': True}
+            else:
+                high = mid - 1
+        return best
+
+    return best
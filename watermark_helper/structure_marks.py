@@ -0,0 +1,302 @@
+"""
+PDF 结构溯源标记模块
+
+泄露者直接转发发行的 PDF 时，文件结构原样保留，无需栅格化即可溯源。
+发行时把特征码加密成带校验的令牌，写入三处结构：
+- XMP 元数据的 DocumentID（伪装成 UUID）
+- 每页图像 XObject 的资源名
+- 对象编号顺序（每页一位：页面对象编号先于 / 后于其内容流）
+溯源时只做字节级解析（必要时解压 Flate 流），毫秒级完成；
+文件被其他工具重写、结构标记丢失或校验失败时再回退到图像解码。
+令牌密钥由部署环境配置（环境变量 WATERMARK_TRACE_KEY），没有内置的默认密钥，
+未配置密钥时不能写入结构标记，也读不出任何令牌
+不依赖 Streamlit，可独立使用
+"""
+
+import hashlib
+import hmac
+import os
+import re
+import zlib
+from collections import Counter
+
+import buyer_index
+
+
+# 令牌密钥所在的环境变量（公开的默认密钥谁都能伪造令牌，因此不提供默认值）
+TRACE_KEY_ENV = 'WATERMARK_TRACE_KEY'
+MIN_KEY_BYTES = 16
+
+# 令牌组成：位数 1 字节 + 特征码 8 字节（不足补空格，与掩码异或）+ 校验 7 字节，共 128 位
+PAYLOAD_BYTES = 1 + buyer_index.SUPPORTED_CODE_LENGTHS[-1]
+MAC_BYTES = 7
+TOKEN_HEX = (PAYLOAD_BYTES + MAC_BYTES) * 2
+TOKEN_BITS = TOKEN_HEX * 4
+
+# 图像资源名前缀（后接令牌和图层序号）
+IMAGE_NAME_PREFIX = 'Im'
+
+_UUID_PATTERN = re.compile(rb'uuid:([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})')
+_NAME_PATTERN = re.compile(rb'/' + IMAGE_NAME_PREFIX.encode() + rb'([0-9a-f]{%d})\d+' % TOKEN_HEX)
+_OBJECT_PATTERN = re.compile(rb'(\d+)\s+0\s+obj\b')
+_STREAM_PATTERN = re.compile(rb'stream\r?\n')
+
+
+def trace_key(key=None):
+    """
+    解析令牌密钥：显式传入的密钥优先，否则读取环境变量 WATERMARK_TRACE_KEY
+
+    参数:
+        key: 密钥（bytes 或 str，可选）
+
+    返回:
+        bytes 密钥，未配置时返回 None
+    """
+    key = key or os.environ.get(TRACE_KEY_ENV)
+    if not key:
+        return None
+    return key.encode('utf-8') if isinstance(key, str) else key
+
+
+def require_trace_key(key=None):
+    """
+    解析发行用的令牌密钥（未配置或过短时拒绝发行）
+
+    参数:
+        key: 密钥（可选，见 trace_key）
+
+    返回:
+        bytes 密钥
+
+    异常:
+        ValueError: 未配置密钥，或密钥短于 MIN_KEY_BYTES 字节
+    """
+    key = trace_key(key)
+    if key is None:
+        raise ValueError(f"未配置结构标记密钥：请设置环境变量 {TRACE_KEY_ENV} 或传入 trace_key")
+    if len(key) < MIN_KEY_BYTES:
+        raise ValueError(f"结构标记密钥至少 {MIN_KEY_BYTES} 字节，当前为 {len(key)} 字节")
+    return key
+
+
+def _mask(key):
+    """特征码部分的异或掩码"""
+    return hmac.new(key, b'mask', hashlib.sha256).digest()[:PAYLOAD_BYTES]
+
+
+def _mac(key, payload):
+    """令牌校验码"""
+    return hmac.new(key, payload, hashlib.sha256).digest()[:MAC_BYTES]
+
+
+def make_token(feature_code, key=None):
+    """
+    把特征码加密为带校验的令牌
+
+    参数:
+        feature_code: 特征码（4-8 位）
+        key: 令牌密钥（默认读取环境变量，见 require_trace_key）
+
+    返回:
+        32 位十六进制字符串（同一密钥、同一特征码的结果相同）
+    """
+    key = require_trace_key(key)
+    if len(feature_code) not in buyer_index.SUPPORTED_CODE_LENGTHS:
+        raise ValueError(f"特征码位数必须在 {buyer_index.SUPPORTED_CODE_LENGTHS[0]}-"
+                         f"{buyer_index.SUPPORTED_CODE_LENGTHS[-1]} 之间，当前为 {len(feature_code)}")
+    payload = bytes([len(feature_code)]) + feature_code.encode('ascii').ljust(PAYLOAD_BYTES - 1)
+    masked = bytes(a ^ b for a, b in zip(payload, _mask(key)))
+    return (masked + _mac(key, payload)).hex()
+
+
+def read_token(token, key=None):
+    """
+    解密令牌
+
+    参数:
+        token: make_token 生成的十六进制字符串
+        key: 令牌密钥（默认读取环境变量，见 trace_key）
+
+    返回:
+        特征码，格式不符、校验失败或未配置密钥时返回 None
+    """
+    key = trace_key(key)
+    if key is None:
+        return None
+    try:
+        raw = bytes.fromhex(token)
+    except ValueError:
+        return None
+    if len(raw) != PAYLOAD_BYTES + MAC_BYTES:
+        return None
+
+    payload = bytes(a ^ b for a, b in zip(raw[:PAYLOAD_BYTES], _mask(key)))
+    if not hmac.compare_digest(_mac(key, payload), raw[PAYLOAD_BYTES:]):
+        return None
+    code = payload[1:1 + payload[0]].decode('ascii', errors='replace')
+    if len(code) != payload[0] or any(char not in buyer_index.CODE_CHARS for char in code):
+        return None
+    return code
+
+
+def token_bits(token):
+    """令牌的二进制字符串（对象顺序标记按页循环使用）"""
+    return bin(int(token, 16))[2:].zfill(TOKEN_BITS)
+
+
+def _uuid(token):
+    """令牌格式化为 UUID 形式"""
+    return f"{token[:8]}-{token[8:12]}-{token[12:16]}-{token[16:20]}-{token[20:]}"
+
+
+def xmp_packet(token):
+    """
+    生成携带令牌的 XMP 元数据包（令牌作为 DocumentID）
+
+    参数:
+        token: make_token 生成的令牌
+
+    返回:
+        XMP 数据流字节
+    """
+    return (
+        '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>\n'
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/">\n'
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">\n'
+        '<rdf:Description rdf:about="" xmlns:xmpMM="http://ns.adobe.com/xap/1.0/mm/">\n'
+        f'<xmpMM:DocumentID>uuid:{_uuid(token)}</xmpMM:DocumentID>\n'
+        '</rdf:Description>\n'
+        '</rdf:RDF>\n'
+        '</x:xmpmeta>\n'
+        '<?xpacket end="r"?>'
+    ).encode('utf-8')
+
+
+def writer_options(feature_code, key=None):
+    """
+    生成 pdf_writer.write_pdf 的结构标记参数
+
+    参数:
+        feature_code: 特征码
+        key: 令牌密钥（未配置时抛出 ValueError，见 require_trace_key）
+
+    返回:
+        字典 {'xmp', 'image_prefix', 'order_bits'}，可直接作为关键字参数传入
+    """
+    token = make_token(feature_code, key)
+    return {
+        'xmp': xmp_packet(token),
+        'image_prefix': IMAGE_NAME_PREFIX + token,
+        'order_bits': token_bits(token),
+    }
+
+
+def _objects(pdf_bytes):
+    """按编号切分顶层间接对象 {编号: 对象字节}（同号对象取最后一次出现，即增量更新后的版本）"""
+    matches = list(_OBJECT_PATTERN.finditer(pdf_bytes))
+    objects = {}
+    for match, following in zip(matches, matches[1:] + [None]):
+        end = following.start() if following else len(pdf_bytes)
+        objects[int(match.group(1))] = pdf_bytes[match.end():end]
+    return objects
+
+
+def _inflated_streams(objects):
+    """解压非图像的 Flate 数据流（被重写工具压缩的 XMP 和对象流）"""
+    for body in objects.values():
+        stream = _STREAM_PATTERN.search(body)
+        if stream is None:
+            continue
+        header = body[:stream.start()]
+        if b'/FlateDecode' not in header or b'/Image' in header:
+            continue
+        try:
+            yield zlib.decompressobj().decompress(body[stream.end():])
+        except zlib.error:
+            continue
+
+
+def _page_order_bits(objects):
+    """
+    按页面树顺序读出对象顺序标记（页面对象编号小于内容流编号记为 1）
+
+    返回:
+        (二进制字符串或 None, 页数或 None)
+    """
+    pages = None
+    for body in objects.values():
+        if re.search(rb'/Type\s*/Pages\b', body) and not re.search(rb'/Parent\s', body):
+            pages = body
+            break
+    if pages is None:
+        return None, None
+
+    count = re.search(rb'/Count\s+(\d+)', pages)
+    kids = re.search(rb'/Kids\s*\[([^\]]*)\]', pages)
+    page_count = int(count.group(1)) if count else None
+    if kids is None:
+        return None, page_count
+
+    bits = []
+    for number in (int(n) for n in re.findall(rb'(\d+)\s+0\s+R', kids.group(1))):
+        contents = re.search(rb'/Contents\s+(\d+)\s+0\s+R', objects.get(number, b''))
+        if contents is None:
+            # 不是本模块写出的扁平页面树，无法读取
+            return None, page_count
+        bits.append('1' if number < int(contents.group(1)) else '0')
+    return ''.join(bits), page_count
+
+
+def read_structure_marks(pdf_bytes, key=None):
+    """
+    不渲染页面，直接从 PDF 结构中读取特征码
+
+    知道密钥的人都能写出令牌；怀疑密钥泄露时可要求页面上的图像标记证实
+    （见 trace_engine.trace_pdf 的 confirm 参数）
+
+    参数:
+        pdf_bytes: PDF 文件的字节内容
+        key: 令牌密钥（默认读取环境变量；未配置时读不出任何令牌）
+
+    返回:
+        字典
+        - code: 特征码（各通道多数一致者），读不到有效令牌时为 None
+        - channels: {'xmp', 'names', 'order'} 各通道读出的特征码（读不到为 None）
+          页数不足 TOKEN_BITS 时对象顺序只能部分读出，与其他通道的令牌一致时记为该特征码
+        - consistent: 读出的通道是否全部一致，对象顺序与读出的令牌对不上时也为 False
+          （不一致说明文件被篡改或拼接）
+        - page_count: 页面树给出的页数（无法解析时为 None）
+    """
+    key = trace_key(key)
+    objects = _objects(pdf_bytes)
+    texts = [pdf_bytes, *_inflated_streams(objects)]
+
+    def first_code(pattern):
+        for text in texts:
+            for match in pattern.finditer(text):
+                code = read_token(match.group(1).decode('ascii').replace('-', ''), key)
+                if code:
+                    return code
+        return None
+
+    channels = {'xmp': first_code(_UUID_PATTERN), 'names': first_code(_NAME_PATTERN), 'order': None}
+
+    order_bits, page_count = _page_order_bits(objects)
+    if order_bits and len(order_bits) >= TOKEN_BITS:
+        channels['order'] = read_token(f"{int(order_bits[:TOKEN_BITS], 2):0{TOKEN_HEX}x}", key)
+    elif order_bits:
+        # 页数不足一个完整令牌：与其他通道读出的令牌逐位比对
+        for code in {channels['xmp'], channels['names']} - {None}:
+            expected = token_bits(make_token(code, key))
+            if order_bits == expected[:len(order_bits)]:
+                channels['order'] = code
+
+    found = Counter(code for code in channels.values() if code)
+    # 其他通道读出了令牌，对象顺序却对不上任何令牌：结构被拼接或改写过
+    order_mismatch = bool(order_bits) and bool(found) and channels['order'] is None
+    return {
+        'code': found.most_common(1)[0][0] if found else None,
+        'channels': channels,
+        'consistent': len(found) <= 1 and not order_mismatch,
+        'page_count': page_count,
+    }
@@ -0,0 +1,795 @@
+#!/usr/bin/env python3
+"""
+PDF 输出流程 - 功能测试脚本
+
+测试内容：
+1. 页面缓存的压缩、命中与 LRU 淘汰
+2. 内存预算规划
+3. 逐页编码的处理流程
+4. 处理成本预估
+5. 目标体积模式
+6. 分卷输出
+7. 黑白二值（CCITT G4）输出
+8. 混合光栅内容（MRC）输出
+9. 共享页面批量发行
+10. 混合模式（保留文字层）
+11. 发行台账
+12. PDF 结构溯源标记（密钥配置、不渲染溯源、页面标记证实、伪造和篡改检测）
+13. 母版页面感知哈希（反查来源母版）
+"""
+
+import os
+import re
+import time
+import zipfile
+import numpy as np
+from PIL import Image, ImageDraw, PdfParser
+
+import buyer_index
+import cost_estimator
+import hybrid_pdf
+import image_processor
+import issuance_ledger
+import memory_budget
+import page_fingerprint
+import page_registration
+import pdf_writer
+import size_target
+import structure_marks
+import trace_engine
+from page_cache import PageCache, DEFAULT_CACHE_BYTES, document_key
+
+
+A4_PT = (595.276, 841.89)
+
+
+def make_test_page(width=827, height=1169, label="TEST"):
+    """生成一张带文字的白底测试页（约 100 DPI 的 A4）"""
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    for row in range(40, height - 40, 30):
+        draw.text((60, row), f"{label} line {row}", fill=(0, 0, 0))
+    return image
+
+
+def read_pdf_pages(pdf_bytes):
+    """用 Pillow 的 PDF 解析器读取每页的页面字典"""
+    parser = PdfParser.PdfParser(buf=pdf_bytes)
+    return [parser.read_indirect(ref) for ref in parser.pages]
+
+
+def test_page_cache():
+    """测试页面缓存"""
+    print("测试 1: 页面缓存")
+    print("-" * 60)
+
+    pages = [make_test_page(label=f"P{i}") for i in range(3)]
+    raw_bytes = sum(len(p.tobytes()) for p in pages)
+
+    cache = PageCache(max_bytes=10 * 1024 * 1024)
+    key = document_key(b"%PDF-test-document", 100)
+    cached = cache.put(key, pages)
+
+    print(f"原始大小: {raw_bytes / 1024:.0f} KB，压缩后: {cached.nbytes / 1024:.0f} KB")
+    assert cached.nbytes < raw_bytes / 5
+
+    # 解码结果应与原图逐像素一致（无损）
+    assert len(cached) == 3
+    assert cached[1].tobytes() == pages[1].tobytes()
+    print("✅ 压缩无损，按需解码正确")
+
+    # pdf_to_images 命中缓存时不再调用 poppler
+    hit = image_processor.pdf_to_images(b"%PDF-test-document", dpi=100, page_cache=cache)
+    assert hit is cached
+    assert cache.hits == 1
+    print("✅ pdf_to_images 命中缓存")
+
+    # 超出预算时淘汰最久未使用的文档
+    small_cache = PageCache(max_bytes=cached.nbytes + 1)
+    small_cache.put('a', pages)
+    small_cache.put('b', pages)
+    assert 'a' not in small_cache and 'b' in small_cache
+    assert small_cache.current_bytes <= small_cache.max_bytes
+    print("✅ LRU 淘汰生效")
+
+    print()
+
+
+def test_memory_plan():
+    """测试内存预算规划"""
+    print("测试 2: 内存预算规划")
+    print("-" * 60)
+
+    sizes = [A4_PT] * 50
+    cost = memory_budget.estimate_page_cost(*A4_PT, dpi=200)
+    print(f"200 DPI A4 单页峰值: {cost['peak'] / 1024 / 1024:.0f} MB")
+
+    plan = memory_budget.plan_memory(sizes, 200, max_rss_mb=4096, max_workers=4,
+                                     baseline_bytes=0)
+    print(plan.describe())
+    assert 1 <= plan.workers <= 4
+    assert plan.workers <= plan.window <= 50
+    assert plan.estimated_peak_bytes <= plan.budget_bytes
+
+    # 预算越小，窗口和并发越小
+    small = memory_budget.plan_memory(sizes, 200, max_rss_mb=1024, max_workers=4,
+                                      baseline_bytes=0)
+    assert small.window <= plan.window and small.workers <= plan.workers
+    print(f"✅ 预算收紧后：窗口 {small.window} 页，并发 {small.workers} 页")
+
+    # 页面缓存还能增长的部分计入预计峰值：满额的大缓存会挤占窗口，甚至放不下
+    mb = 1024 * 1024
+    cache = PageCache(max_bytes=256 * mb)
+    cache.put("used", [Image.new('L', (400, 400), 255)])
+    headroom = memory_budget.cache_headroom(cache)
+    assert headroom == 256 * mb - cache.current_bytes and memory_budget.cache_headroom(None) == 0
+    cached = memory_budget.plan_memory(sizes, 200, max_rss_mb=1024, max_workers=4,
+                                       baseline_bytes=0, cache_bytes=headroom)
+    assert cached.cache_bytes == headroom
+    assert cached.estimated_peak_bytes - headroom < small.estimated_peak_bytes
+    assert cached.estimated_peak_bytes <= cached.budget_bytes
+    try:
+        memory_budget.plan_memory(sizes, 200, max_rss_mb=1024, baseline_bytes=0,
+                                  cache_bytes=PageCache(max_bytes=1024 * mb).max_bytes)
+    except memory_budget.MemoryBudgetExceeded:
+        pass
+    else:
+        raise AssertionError("缓存占满预算时应抛出 MemoryBudgetExceeded")
+    assert memory_budget.cache_budget_bytes(1024, DEFAULT_CACHE_BYTES) == 256 * mb
+    assert memory_budget.cache_budget_bytes(4096, DEFAULT_CACHE_BYTES) == DEFAULT_CACHE_BYTES
+    print(f"✅ 为页面缓存预留 {headroom / mb:.0f} MB 后：窗口 {cached.window} 页，并发 {cached.workers} 页")
+
+    # 放不下时在栅格化之前失败
+    try:
+        memory_budget.plan_memory(sizes, 300, max_rss_mb=128, baseline_bytes=0)
+    except memory_budget.MemoryBudgetExceeded as e:
+        print(f"✅ 预算不足时提前失败: {e}")
+    else:
+        raise AssertionError("预算不足时应抛出 MemoryBudgetExceeded")
+
+    print()
+
+
+def test_streaming_process_pdf():
+    """测试逐页编码的处理流程（通过缓存命中跳过 poppler）"""
+    print("测试 3: 逐页编码处理流程")
+    print("-" * 60)
+
+    pdf_key = b"%PDF-streaming-test"
+    cache = PageCache()
+    cache.put(document_key(pdf_key, 100), [make_test_page(label=f"P{i}") for i in range(3)])
+
+    for workers in (1, 2):
+        output_pdf, preview = image_processor.process_pdf(
+            pdf_key, "机密 TEST", "",
+            ripple_amplitude=0, noise_level=0, num_lines=0,
+            dpi=100, page_cache=cache, max_workers=workers
+        )
+        pages = read_pdf_pages(output_pdf.getvalue())
+        assert len(pages) == 3
+        assert abs(pages[0][b'MediaBox'][2] - 827 * 72 / 100) < 0.5
+        assert preview['original'] is not None and preview['processed'] is not None
+        print(f"✅ 并发 {workers}：{len(pages)} 页，{len(output_pdf.getvalue()) / 1024:.0f} KB")
+
+    print()
+
+
+def test_cost_estimate():
+    """测试处理成本预估（样本页外推）"""
+    print("测试 4: 处理成本预估")
+    print("-" * 60)
+
+    page = make_test_page()
+    sizes = [A4_PT] * 10 + [(A4_PT[0] * 2, A4_PT[1])]
+
+    estimate = cost_estimator.estimate_from_sample(
+        page, sizes, 0, dpi=100, quality=75, copies=1,
+        watermark_text="张三 13800138000", interference_text="",
+        ripple_amplitude=0, noise_level=0, num_lines=0
+    )
+    print(estimate.describe())
+
+    # 11 页中有一页是双倍面积，外推系数为 12
+    single_page = pdf_writer_page_bytes(page)
+    assert 6 * single_page < estimate.copy_bytes < 24 * single_page
+    assert estimate.peak_memory_bytes > 0
+
+    batch = estimate.with_copies(2000)
+    assert batch.total_bytes == estimate.copy_bytes * 2000
+    assert batch.total_seconds > estimate.total_seconds
+    print(f"✅ 2000 份预计耗时 {cost_estimator.format_duration(batch.total_seconds)}")
+
+    print()
+
+
+def pdf_writer_page_bytes(page):
+    """按默认参数处理并编码一页，返回编码后的字节数"""
+    processed = image_processor.process_page(page.copy(), "张三 13800138000", "",
+                                             ripple_amplitude=0, noise_level=0, num_lines=0)
+    return pdf_writer.encode_page(processed, 'grayscale', 100, 75).nbytes
+
+
+def test_target_size():
+    """测试目标体积模式"""
+    print("测试 5: 目标体积模式")
+    print("-" * 60)
+
+    pages = [image_processor.add_noise(make_test_page(label=f"P{i}"), 20) for i in range(8)]
+
+    free = len(image_processor.images_to_pdf(pages, dpi=100, quality=95).getvalue())
+    target_mb = free * 0.5 / 1024 / 1024
+    output = image_processor.images_to_pdf(pages, dpi=100, target_size_mb=target_mb)
+    size = len(output.getvalue())
+    print(f"质量 95: {free / 1024:.0f} KB，目标 {target_mb * 1024:.0f} KB，实际 {size / 1024:.0f} KB")
+    assert size <= target_mb * 1024 * 1024
+    assert size > target_mb * 1024 * 1024 * 0.5
+    print("✅ 输出体积满足目标，且没有过度压缩")
+
+    # 质量降到最低仍放不下时，允许降低 DPI
+    tiny_mb = free * 0.01 / 1024 / 1024
+    choice = size_target.choose_encoding(pages[:2], len(pages), int(tiny_mb * 1024 * 1024),
+                                         dpi=200, allow_dpi_reduction=True)
+    print(f"目标 {tiny_mb * 1024:.0f} KB → 质量 {choice['quality']}，{choice['dpi']} DPI")
+    assert choice['dpi'] < 200
+    print("✅ 允许降低 DPI")
+
+    print()
+
+
+def test_split_parts():
+    """测试按体积和页数拆分分卷"""
+    print("测试 6: 分卷输出")
+    print("-" * 60)
+
+    pages = [image_processor.add_noise(make_test_page(label=f"P{i}"), 20) for i in range(7)]
+
+    # 按页数拆分：7 页每卷 3 页 → 3 卷
+    parts = image_processor.images_to_pdf(pages, dpi=100, max_pages_per_part=3,
+                                          part_stem="exam")
+    names = [name for name, _ in parts]
+    assert names == ["exam_01of03.pdf", "exam_02of03.pdf", "exam_03of03.pdf"]
+    assert [len(read_pdf_pages(p.getvalue())) for _, p in parts] == [3, 3, 1]
+    print(f"✅ 按页数拆分: {names}")
+
+    # 按体积拆分：每卷不超过约 2.5 页的体积
+    single = len(image_processor.images_to_pdf(pages[:1], dpi=100).getvalue())
+    limit_mb = single * 2.5 / 1024 / 1024
+    parts = image_processor.images_to_pdf(pages, dpi=100, max_part_mb=limit_mb)
+    sizes = [len(p.getvalue()) for _, p in parts]
+    assert sum(len(read_pdf_pages(p.getvalue())) for _, p in parts) == 7
+    assert all(size <= limit_mb * 1024 * 1024 for size in sizes)
+    print(f"✅ 按体积拆分为 {len(parts)} 卷，最大 {max(sizes) / 1024:.0f} KB")
+
+    # 分卷写满即产出：拉取第 4 页时第一卷（3 页）已可写出，后续页面尚未编码
+    pulled = []
+
+    def encoded_pages():
+        for i, page in enumerate(pages):
+            pulled.append(i)
+            yield pdf_writer.encode_page(page, dpi=100)
+
+    first_part = next(pdf_writer.split_pages(encoded_pages(), max_pages_per_part=3))
+    assert len(first_part) == 3 and len(pulled) == 4
+    print("✅ 分卷写满即写出，不需要先编码全部页面")
+
+    # 打包后文件名顺序与阅读顺序一致
+    archive = zipfile.ZipFile(image_processor.package_parts(parts, folder="0001_张三"))
+    assert archive.namelist() == sorted(archive.namelist())
+    assert archive.namelist()[0].startswith("0001_张三/part_01of")
+    print("✅ ZIP 打包顺序正确")
+
+    print()
+
+
+def test_bilevel_output():
+    """测试黑白二值输出（溯源标记在阈值化后保留）"""
+    print("测试 7: 黑白二值输出")
+    print("-" * 60)
+
+    buyer_id = "张三_13800138000"
+    page = image_processor.process_page(
+        make_test_page(), "", "",
+        ripple_amplitude=0, noise_level=10, num_lines=0,
+        buyer_id=buyer_id, enable_spatial_tracking=True, enable_binding_line=True
+    )
+
+    # 装订线编码是浅灰色，直接阈值化会被丢弃
+    marks, _ = image_processor.render_mark_layers(page.size, buyer_id=buyer_id,
+                                                  enable_spatial_tracking=True,
+                                                  enable_binding_line=True)
+    mark_pixels = np.asarray(marks) < 250
+    plain = np.asarray(image_processor.binarize_page(page))
+    assert plain[mark_pixels].any()
+
+    for method in ('otsu', 'adaptive'):
+        binary = np.asarray(image_processor.binarize_page(page, method, marks))
+        assert not binary[mark_pixels].any()
+    print("✅ 溯源标记在二值化后保持为黑色")
+
+    bilevel = pdf_writer.encode_page(image_processor.binarize_page(page, 'otsu', marks),
+                                     'bilevel', 100)
+    jpeg = pdf_writer.encode_page(page, 'grayscale', 100, 75)
+    print(f"G4: {bilevel.nbytes / 1024:.1f} KB，JPEG: {jpeg.nbytes / 1024:.1f} KB")
+    assert bilevel.nbytes * 5 < jpeg.nbytes
+
+    # 完整流程：通过缓存命中跳过 poppler
+    pdf_key = b"%PDF-bilevel-test"
+    cache = PageCache()
+    cache.put(document_key(pdf_key, 100), [make_test_page(label=f"P{i}") for i in range(2)])
+    output_pdf, preview = image_processor.process_pdf(
+        pdf_key, "机密", "", ripple_amplitude=0, noise_level=0, num_lines=0,
+        dpi=100, output_mode='bilevel', page_cache=cache,
+        buyer_id=buyer_id, enable_binding_line=True
+    )
+    data = output_pdf.getvalue()
+    assert len(read_pdf_pages(data)) == 2
+    assert data.count(b"/CCITTFaxDecode") == 2
+    assert preview['processed'].mode == 'L'
+    print(f"✅ bilevel 输出 {len(data) / 1024:.1f} KB")
+
+    print()
+
+
+def test_mrc_output():
+    """测试 MRC 输出（全分辨率文字蒙版 + 低分辨率背景）"""
+    print("测试 8: MRC 输出")
+    print("-" * 60)
+
+    page = image_processor.process_page(make_test_page(), "张三 13800138000", "",
+                                        ripple_amplitude=0, num_lines=0)
+    mask, background = image_processor.split_mrc_layers(page)
+
+    assert mask.mode == '1' and mask.size == page.size
+    assert background.width == page.width // image_processor.MRC_BACKGROUND_SCALE
+
+    # 背景中不应残留文字（文字像素由蒙版负责）
+    text = np.asarray(mask) == 0
+    small_text = np.asarray(mask.convert('L').resize(background.size, Image.BOX)) < 128
+    assert text.any()
+    assert np.asarray(background)[small_text].mean() > 180
+    print("✅ 文字进入前景蒙版，背景无文字残影")
+
+    # 彩色页面（底色、粉色防伪底纹）的背景保留颜色，灰度页面的背景仍为 L 模式
+    source = make_test_page()
+    tinted = Image.new('RGB', source.size, (230, 200, 200))
+    tinted.paste(source, mask=Image.eval(source.convert('L'), lambda v: 255 - v))
+    _, gray_background = image_processor.split_mrc_layers(source)
+    _, color_background = image_processor.split_mrc_layers(tinted)
+    assert gray_background.mode == 'L' and background.mode == 'RGB'
+    assert color_background.mode == 'RGB'
+    red, green, blue = np.asarray(color_background, dtype=np.float32).reshape(-1, 3).mean(axis=0)
+    assert red > green + 20 and abs(green - blue) < 5
+    assert b"/DeviceRGB" in pdf_writer.write_pdf(
+        [image_processor.encode_output_page(tinted, 'mrc', 100, 75)]).getvalue()
+    print("✅ 彩色页面的 MRC 背景保留颜色")
+
+    mrc = image_processor.encode_output_page(page, 'mrc', 100, 75)
+    jpeg = image_processor.encode_output_page(page, 'grayscale', 100, 75)
+    print(f"MRC: {mrc.nbytes / 1024:.1f} KB，JPEG: {jpeg.nbytes / 1024:.1f} KB")
+    assert mrc.nbytes * 2 < jpeg.nbytes
+
+    data = pdf_writer.write_pdf([mrc]).getvalue()
+    assert b"/ImageMask true" in data and b"/DCTDecode" in data
+    print("✅ 背景 JPEG + 图像蒙版组合写入 PDF")
+
+    print()
+
+
+def dct_streams(pdf_bytes):
+    """取出 PDF 中所有 JPEG 图像数据流"""
+    streams = []
+    for match in re.finditer(rb"/DCTDecode[^>]*/Length (\d+) >>\nstream\n", pdf_bytes):
+        streams.append(pdf_bytes[match.end():match.end() + int(match.group(1))])
+    return streams
+
+
+def test_shared_batch():
+    """测试共享页面批量发行（各买家逐字节共用页面图像）"""
+    print("测试 9: 共享页面批量发行")
+    print("-" * 60)
+
+    pdf_key = b"%PDF-shared-test"
+    cache = PageCache()
+    cache.put(document_key(pdf_key, 100), [make_test_page(label=f"P{i}") for i in range(2)])
+    customers = [{'name': '张三', 'phone': '13800138000'},
+                 {'name': '李四', 'phone': '13900139000'}]
+
+    results = image_processor.process_pdf_batch(
+        pdf_key, customers, watermark_density='sparse', ripple_amplitude=0,
+        dpi=100, page_cache=cache, shared_pages=True,
+        enable_spatial_tracking=True, enable_binding_line=True
+    )
+    first, second = [results[key][0].getvalue() for key in sorted(results)]
+
+    assert len(read_pdf_pages(first)) == 2
+    assert dct_streams(first) == dct_streams(second) and len(dct_streams(first)) == 2
+    assert first != second
+    print("✅ 页面 JPEG 数据流在各买家之间逐字节相同")
+
+    overlay_bytes = len(first) - sum(len(stream) for stream in dct_streams(first))
+    print(f"单份 {len(first) / 1024:.0f} KB，其中买家叠加层约 {overlay_bytes / 1024:.1f} KB")
+    assert b"/ImageMask true" in first and b"/ExtGState" in first
+
+    # 内存预算规划出的窗口逐批栅格化共享页面，结果与一次栅格化相同
+    options = dict(ripple_amplitude=0, noise_level=0, num_lines=0)
+    whole = image_processor.encode_shared_pages(pdf_key, dpi=100, page_cache=cache, **options)
+    windowed = image_processor.encode_shared_pages(pdf_key, dpi=100, page_cache=cache, window=1,
+                                                   pdf_info={'pages': 2}, **options)
+    assert [size for _, size in windowed] == [size for _, size in whole]
+    assert [page.nbytes for page, _ in windowed] == [page.nbytes for page, _ in whole]
+    print("✅ 共享页面按内存窗口分批栅格化")
+
+    # 生成器逐页产出新图像（写出后即释放）：每页都引用自己的数据流
+    def fresh_pages():
+        for i in range(4):
+            image = pdf_writer.encode_jpeg(make_test_page(label=f"G{i}"))
+            yield pdf_writer.PdfPage(*A4_PT).add_image(image)
+
+    streamed = pdf_writer.write_pdf(fresh_pages()).getvalue()
+    assert len(set(dct_streams(streamed))) == 4
+    print("✅ 流式写出时每页引用自己的图像")
+
+    try:
+        image_processor.process_pdf_batch(pdf_key, customers, page_cache=cache, dpi=100,
+                                          output_mode='bilevel', shared_pages=True)
+    except ValueError as e:
+        print(f"✅ 不支持的输出模式: {e}")
+    else:
+        raise AssertionError("bilevel 输出不支持共享页面模式")
+
+    print()
+
+
+def make_text_pdf(pages):
+    """用 PyMuPDF 生成带文字层的测试 PDF"""
+    doc = hybrid_pdf.fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Exam page {i}\n" + "Line of text.\n" * 20, fontsize=11)
+    return doc.tobytes()
+
+
+def test_hybrid_pdf():
+    """测试混合模式（防护图层渲染一次，各页共用）"""
+    print("测试 10: 混合模式")
+    print("-" * 60)
+
+    if hybrid_pdf.fitz is None:
+        print("未安装 PyMuPDF，跳过")
+        print()
+        return
+
+    added = {}
+    for pages in (2, 20):
+        source = make_text_pdf(pages)
+        output = hybrid_pdf.apply_hybrid_protection(
+            source, dpi=72, guilloche_density=10, watermark_text="机密"
+        ).getvalue()
+        added[pages] = len(output) - len(source)
+
+        doc = hybrid_pdf.fitz.open(stream=output, filetype='pdf')
+        xrefs = {image[0] for page in doc for image in page.get_images()}
+        assert len(xrefs) == 1
+        assert "Exam page 1" in doc[1].get_text()
+        print(f"{pages} 页：增加 {added[pages] / 1024:.1f} KB，共享图层 {len(xrefs)} 个")
+
+    # 页数增加 10 倍，增加的体积几乎不变
+    assert added[20] < added[2] * 1.5
+    print("✅ 文字层保留，输出体积与页数基本无关")
+
+    print()
+
+
+def test_issuance_ledger():
+    """测试发行台账：批量和单份发行写入台账，按特征码查询，同批次撞码提示"""
+    print("测试 11: 发行台账")
+    print("-" * 60)
+
+    # 找到两位特征码相同的买家
+    seen = {}
+    customers = []
+    for i in range(10000):
+        customer = {'name': f'买家{i}', 'phone': f'139{i:08d}'}
+        code = buyer_index.feature_codes([buyer_index.buyer_id(customer)])[0]
+        if code in seen:
+            customers = [seen[code], customer]
+            break
+        seen[code] = customer
+    collided_code = code
+    customers.append({'name': '张三', 'phone': '13800138000'})
+
+    pdf_key = b"%PDF-ledger-test"
+    cache = PageCache()
+    cache.put(document_key(pdf_key, 100), [make_test_page(label="L")])
+    ledger = issuance_ledger.IssuanceLedger(':memory:')
+
+    messages = []
+    results = image_processor.process_pdf_batch(
+        pdf_key, customers, watermark_density='sparse', ripple_amplitude=0,
+        dpi=100, page_cache=cache, shared_pages=True, enable_spatial_tracking=True,
+        ledger=ledger, progress_callback=messages.append
+    )
+    assert len(ledger) == 3
+    assert any(collided_code in message and '⚠️' in message for message in messages)
+    print(messages[-1])
+
+    # 撞码的两位买家都能查到，且输出哈希与实际文件一致
+    issued = ledger.lookup(collided_code.lower())
+    assert sorted(row['buyer_name'] for row in issued) == sorted(c['name'] for c in customers[:2])
+    outputs = {issuance_ledger.sha256_bytes(pdf.getvalue()) for pdf, _ in results.values()}
+    assert {row['output_sha256'] for row in issued} <= outputs
+    assert issued[0]['parameters']['shared_pages'] is True
+    assert issued[0]['document_sha256'] == issuance_ledger.sha256_bytes(pdf_key)
+
+    # 单份发行也记入台账，查询覆盖所有历史发行
+    image_processor.process_pdf(
+        pdf_key, "张三 13800138000", "", ripple_amplitude=0, noise_level=0, num_lines=0,
+        dpi=100, page_cache=cache, buyer_id="张三_13800138000", enable_spatial_tracking=True,
+        ledger=ledger
+    )
+    code = image_processor.generate_feature_code("张三_13800138000")
+    assert [row['mode'] for row in ledger.lookup(code)] == ['single', 'batch']
+    assert ledger.lookup(code, document_sha256='0' * 64) == []
+    print(f"✅ 台账共 {len(ledger)} 份副本，特征码 {collided_code} 查到 {len(issued)} 位买家")
+
+    print()
+
+
+# 结构标记的测试密钥（部署时由环境变量 WATERMARK_TRACE_KEY 提供）
+TEST_TRACE_KEY = b"test-structure-marks-key-0123"
+
+
+def rendered_cache(pdf_bytes, dpi):
+    """用 PyMuPDF 渲染 PDF 并放入页面缓存（本环境没有 Poppler 时供图像溯源使用）"""
+    doc = hybrid_pdf.fitz.open(stream=pdf_bytes, filetype='pdf')
+    pages = []
+    for page in doc:
+        pixmap = page.get_pixmap(dpi=dpi)
+        pages.append(Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples))
+    cache = PageCache()
+    cache.put(document_key(pdf_bytes, dpi), pages)
+    return cache
+
+
+def test_structure_marks():
+    """测试 PDF 结构溯源标记：不渲染页面直接读出，可要求页面标记证实；伪造、篡改、剥离和未配置密钥时不采信"""
+    print("测试 12: PDF 结构溯源标记")
+    print("-" * 60)
+
+    pdf_key = b"%PDF-structure-test"
+    cache = PageCache()
+    cache.put(document_key(pdf_key, 100), [make_test_page(label=f"S{i}") for i in range(3)])
+    customers = [{'name': '张三', 'phone': '13800138000'},
+                 {'name': '李四', 'phone': '13900139000'}]
+
+    # 未配置密钥时拒绝生成令牌，发行时跳过结构标记
+    saved_key = os.environ.pop(structure_marks.TRACE_KEY_ENV, None)
+    try:
+        for bad_key in (None, b"short"):
+            try:
+                structure_marks.make_token("ABCD", bad_key)
+            except ValueError as e:
+                print(f"✅ 拒绝发行: {e}")
+            else:
+                raise AssertionError("未配置或过短的密钥不能生成令牌")
+        messages = []
+        plain, _ = image_processor.process_pdf(
+            pdf_key, "", "", ripple_amplitude=0, noise_level=0, num_lines=0, dpi=100,
+            page_cache=cache, buyer_id="张三_13800138000", progress_callback=messages.append
+        )
+        assert any(structure_marks.TRACE_KEY_ENV in message for message in messages)
+        assert structure_marks.read_structure_marks(plain.getvalue(), TEST_TRACE_KEY)['code'] is None
+    finally:
+        if saved_key is not None:
+            os.environ[structure_marks.TRACE_KEY_ENV] = saved_key
+
+    if hybrid_pdf.fitz is None:
+        print("未安装 PyMuPDF，跳过结构标记溯源测试")
+        print()
+        return
+
+    results = image_processor.process_pdf_batch(
+        pdf_key, customers, watermark_density='sparse', ripple_amplitude=0,
+        dpi=100, page_cache=cache, shared_pages=True, code_length=6,
+        enable_spatial_tracking=True, enable_binding_line=True, trace_key=TEST_TRACE_KEY
+    )
+    outputs = {}
+    for key in sorted(results):
+        pdf_bytes = results[key][0].getvalue()
+        expected = image_processor.generate_feature_code(buyer_index.buyer_id(results[key][1]), 6)
+        outputs[expected] = pdf_bytes
+        assert len(read_pdf_pages(pdf_bytes)) == 3
+
+        # 令牌校验通过且三个通道一致：直接返回，不渲染任何页面（未传入页面缓存）
+        start = time.perf_counter()
+        trace = trace_engine.trace_pdf(pdf_bytes, dpi=100, trace_key=TEST_TRACE_KEY)
+        elapsed = (time.perf_counter() - start) * 1000
+        assert trace['code'] == expected and trace['source'] == 'structure'
+        assert trace['pages_scanned'] == 0 and trace['page_count'] == 3
+        assert trace['structure']['confirmed'] is None
+        assert all(code == expected for code in trace['structure']['channels'].values())
+
+        # 要求证实时第一页的装订线和位置点与之一致才采信
+        confirmed = trace_engine.trace_pdf(pdf_bytes, dpi=100, page_cache=rendered_cache(pdf_bytes, 100),
+                                           trace_key=TEST_TRACE_KEY, confirm=True)
+        assert confirmed['code'] == expected and confirmed['source'] == 'structure'
+        assert confirmed['structure']['confirmed'] and confirmed['pages_scanned'] == 1
+        print(f"{results[key][1]['name']}：结构标记 {trace['code']}（三个通道一致，未渲染页面，"
+              f"{elapsed:.1f} ms；页面标记证实）")
+
+    (first_code, first), (second_code, second) = outputs.items()
+    first_token = structure_marks.make_token(first_code, TEST_TRACE_KEY)
+    second_token = structure_marks.make_token(second_code, TEST_TRACE_KEY)
+
+    # 伪造：张三副本的页面换上李四的令牌，要求证实时页面标记不能证实，按页面标记溯源
+    forged = pdf_writer.write_pdf(
+        (pdf_writer.encode_page(page, 'grayscale', 100, 90)
+         for page in rendered_cache(first, 100).get(document_key(first, 100))),
+        **structure_marks.writer_options(second_code, TEST_TRACE_KEY)
+    ).getvalue()
+    trace = trace_engine.trace_pdf(forged, dpi=100, page_cache=rendered_cache(forged, 100),
+                                   trace_key=TEST_TRACE_KEY, confirm=True)
+    assert trace['structure']['code'] == second_code and trace['structure']['confirmed'] is False
+    assert trace['code'] == first_code and trace['source'] == 'vote'
+    print("✅ 伪造的令牌未被页面标记证实，不采信")
+
+    # 其他工具重写（压缩对象流）后 XMP 和资源名仍可读出
+    doc = hybrid_pdf.fitz.open(stream=first, filetype='pdf')
+    rewritten = doc.tobytes(garbage=4, deflate=True, use_objstms=1)
+    assert structure_marks.read_structure_marks(rewritten, TEST_TRACE_KEY)['code'] == first_code
+    print("✅ 重写并压缩对象流后仍能读出")
+
+    # 两份副本的结构拼接（篡改）：各通道不一致，不采信
+    uuid = structure_marks._UUID_PATTERN
+    tampered = uuid.sub(uuid.search(second).group(0), first)
+    marks = structure_marks.read_structure_marks(tampered, TEST_TRACE_KEY)
+    assert marks['channels']['xmp'] == second_code and marks['channels']['names'] == first_code
+    assert not marks['consistent']
+    # 不一致时回退到图像溯源
+    trace = trace_engine.trace_pdf(tampered, dpi=100, page_cache=rendered_cache(tampered, 100),
+                                   trace_key=TEST_TRACE_KEY)
+    assert trace['code'] == first_code and trace['source'] == 'vote' and trace['pages_scanned'] >= 1
+
+    # XMP 和资源名都换成另一份的令牌，对象顺序对不上任何令牌：同样视为篡改
+    # （令牌首字节是位数，16 页的对象顺序才覆盖到第一位字符）
+    blank = pdf_writer.encode_page(Image.new('L', (40, 40), 255), 'grayscale', 100, 90)
+    long_copy = image_processor.write_output([blank] * 16, feature_code=first_code,
+                                             trace_key=TEST_TRACE_KEY).getvalue()
+    assert structure_marks.read_structure_marks(long_copy, TEST_TRACE_KEY)['consistent']
+    swapped = long_copy.replace(first_token.encode(), second_token.encode())
+    swapped = swapped.replace(structure_marks._uuid(first_token).encode(),
+                              structure_marks._uuid(second_token).encode())
+    marks = structure_marks.read_structure_marks(swapped, TEST_TRACE_KEY)
+    assert marks['channels']['xmp'] == marks['channels']['names'] == second_code
+    assert marks['channels']['order'] is None and not marks['consistent']
+
+    # 密钥不同或未写入结构标记时读不出
+    assert structure_marks.read_token(first_token, TEST_TRACE_KEY) == first_code
+    assert structure_marks.read_token(first_token, b"other-structure-marks-key") is None
+    plain, _ = image_processor.process_pdf(
+        pdf_key, "", "", ripple_amplitude=0, noise_level=0, num_lines=0, dpi=100,
+        page_cache=cache, buyer_id="张三_13800138000", enable_structure_marks=False,
+        trace_key=TEST_TRACE_KEY
+    )
+    assert structure_marks.read_structure_marks(plain.getvalue(), TEST_TRACE_KEY)['code'] is None
+    print("✅ 篡改、换密钥和未写入时不采信结构标记，回退到图像溯源")
+
+    print()
+
+
+def make_layout_page(seed, width=827, height=1169):
+    """生成版式随机的测试页（段落长短、插图框位置各不相同）"""
+    rng = np.random.default_rng(seed)
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    y = 60
+    while y < height - 80:
+        if rng.random() < 0.1:
+            box_height = int(rng.integers(80, 250))
+            draw.rectangle([80, y, int(rng.integers(300, width - 80)), y + box_height],
+                           outline='black', width=3)
+            y += box_height + 20
+        else:
+            draw.rectangle([70, y, 70 + int(rng.integers(200, width - 150)), y + 10], fill=(40, 40, 40))
+            y += int(rng.integers(18, 30))
+    return image
+
+
+def test_page_fingerprints():
+    """测试母版页面感知哈希：发行时记入台账，带水印的低分辨率盗版页反查出母版和页码"""
+    print("测试 13: 母版页面感知哈希")
+    print("-" * 60)
+
+    cache = PageCache()
+    documents = {}
+    for doc in range(20):
+        pdf_key = f"%PDF-fingerprint-{doc}".encode()
+        pages = [make_layout_page(doc * 10 + page) for page in range(5)]
+        cache.put(document_key(pdf_key, 100), pages)
+        documents[issuance_ledger.sha256_bytes(pdf_key)] = (pdf_key, pages)
+
+    # 其余母版的历史发行直接写入台账，被泄露的母版走完整的批量发行和单份发行
+    ledger = issuance_ledger.IssuanceLedger(':memory:')
+    document, page = list(documents)[7], 3
+    for sha256, (_, pages) in documents.items():
+        if sha256 != document:
+            ledger.record_release(sha256, [], page_fingerprints=[page_fingerprint.fingerprint(image)
+                                                                  for image in pages])
+    pdf_key = documents[document][0]
+    light = dict(ripple_amplitude=0, guilloche_density=0, noise_level=0, num_lines=0,
+                 num_interference=0, dpi=100, page_cache=cache, ledger=ledger)
+    image_processor.process_pdf_batch(pdf_key, [{'name': '张三', 'phone': '13800138000'}],
+                                      enable_anti_copy=False, shared_pages=True, **light)
+    # 同一母版再次发行不重复记录
+    image_processor.process_pdf(pdf_key, "", "", buyer_id="李四_13900139000", **light)
+    count = ledger._conn.execute("SELECT COUNT(*) FROM page_fingerprints").fetchone()[0]
+    assert count == 20 * 5
+
+    # 批量发行在栅格化母版的循环中逐页计算指纹（共享页面和逐份处理两种模式）
+    expected = [page_fingerprint.fingerprint(image) for image in documents[document][1]]
+    fresh = issuance_ledger.IssuanceLedger(':memory:')
+    image_processor.process_pdf_batch(
+        pdf_key, [{'name': '王五', 'phone': '13700137000'}, {'name': '赵六', 'phone': '13600136000'}],
+        enable_anti_copy=False, **dict(light, ledger=fresh))
+    for recorded in (ledger, fresh):
+        rows = recorded._conn.execute(
+            "SELECT phash, dhash FROM page_fingerprints WHERE document_sha256 = ? ORDER BY page",
+            (document,)).fetchall()
+        assert [tuple(row) for row in rows] == expected
+    fresh.close()
+
+    # 盗版页面：带买家水印和溯源标记，低分辨率、翻拍（深色背景）
+    leaked = image_processor.process_page(
+        documents[document][1][page].copy(), "张三 13800138000", "样本", buyer_id="张三_13800138000",
+        enable_spatial_tracking=True, enable_binding_line=True, watermark_density='very_dense',
+        watermark_color=(200, 200, 200), watermark_alpha=60)
+    small = leaked.resize((leaked.width // 4, leaked.height // 4), Image.LANCZOS)
+    photo = Image.new('RGB', (small.width + 60, small.height + 60), (50, 50, 50))
+    photo.paste(small, (30, 30))
+
+    for name, suspect in [('低分辨率', small), ('翻拍', photo)]:
+        start = time.perf_counter()
+        fingerprint = page_fingerprint.fingerprint(page_registration.registered_thumbnail(suspect))
+        found = ledger.find_documents([fingerprint])
+        elapsed = (time.perf_counter() - start) * 1000
+        best = found[0]
+        print(f"{name}：母版 {best['document_sha256'][:12]} 第 {best['matches'][0][1] + 1} 页，"
+              f"距离 {best['matches'][0][2]}/128（{elapsed:.1f} ms）")
+        assert best['document_sha256'] == document and best['matches'][0][1] == page
+        assert best['mode'] == 'single' and best['releases'] == 2
+
+    # 无关页面不匹配任何母版
+    assert ledger.find_documents([page_fingerprint.fingerprint(make_layout_page(999))]) == []
+    print(f"✅ {len(documents)} 份母版、{count} 页中反查出来源母版和页码")
+
+    print()
+
+
+def main():
+    """运行所有测试"""
+    print("=" * 60)
+    print("PDF 输出流程 - 功能测试")
+    print("=" * 60)
+    print()
+
+    test_page_cache()
+    test_memory_plan()
+    test_streaming_process_pdf()
+    test_cost_estimate()
+    test_target_size()
+    test_split_parts()
+    test_bilevel_output()
+    test_mrc_output()
+    test_shared_batch()
+    test_hybrid_pdf()
+    test_issuance_ledger()
+    test_structure_marks()
+    test_page_fingerprints()
+
+    print("=" * 60)
+    print("所有测试完成")
+    print("=" * 60)
+
+
+if __name__ == '__main__':
+    main()
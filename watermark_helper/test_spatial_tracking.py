@@ -6,9 +6,45 @@
 1. 特征码生成的一致性
 2. 特征码生成的唯一性
 3. 解密卡生成
+4. 位置点检测
+5. 快速溯源的页边区域
+6. 装订线编码解码（缩放、偏移）
+7. 多页投票溯源
+8. 批量溯源（进程池、哈希缓存、报告）
+9. 特征码索引（批量计算、持久化、撞码）
+10. 可配置特征码位数（长码装订线、自动识别位数）
+11. 位置点字符集合索引（漏点、污点、跨位数去重）
+12. 装订线误码容错查找（汉明距离、逐位置信度）
+13. 装订线明码模板匹配识别
+14. 页面配准（翻拍件透视、扫描件倾斜）
+15. 本地溯源服务（HTTP 接口、结果缓存、只接受本机请求、重新加载台账）
 """
 
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw
+
 import image_processor
+import pdf_writer
+import decode_binding_line
+import trace_engine
+import bulk_trace
+import buyer_index
+import glyph_classifier
+import page_registration
+import trace_server
+from issuance_ledger import IssuanceLedger
+from page_cache import PageCache, document_key
 
 
 def test_feature_code_consistency():
@@ -189,6 +225,664 @@ def test_feature_code_format():
     print()
 
 
+def test_dot_scores():
+    """测试位置点检测（得分向量）"""
+    print("测试 6: 位置点检测")
+    print("-" * 60)
+
+    buyer_id = "张三_13800138000"
+    code = image_processor.generate_feature_code(buyer_id)
+
+    for mode in ('RGB', 'L'):
+        page = Image.new('RGB', (1654, 2339), 'white')
+        image_processor.add_spatial_tracking(page, buyer_id, enable_visible=False)
+        page = page.convert(mode)
+
+        start = time.perf_counter()
+        scores = image_processor.dot_scores(page)
+        elapsed = (time.perf_counter() - start) * 1000
+
+        detected, chars = image_processor.position_code_from_scores(scores)
+        print(f"{mode}: 得分 {len(scores)} 个，检测到 {chars}（{elapsed:.2f} ms）")
+
+        assert len(scores) == len(image_processor.CHAR_POSITION_MAP)
+        assert sorted(set(code)) == chars
+        assert detected == ''.join(chars)
+        for char in code:
+            assert scores[image_processor.POSITION_CHARS.index(char)] == 1.0
+
+    # 空白页没有黑点
+    blank_scores = image_processor.dot_scores(Image.new('L', (1654, 2339), 255))
+    assert blank_scores.max() == 0
+    assert image_processor.position_code_from_scores(blank_scores) == (None, [])
+
+    print("✅ 测试通过：位置点得分与特征码一致")
+    print()
+
+
+def test_trace_margin_boxes():
+    """测试快速溯源的页边区域覆盖全部溯源标记"""
+    print("测试 7: 快速溯源页边区域")
+    print("-" * 60)
+
+    buyer_id = "李四_13900139000"
+    expected_code = image_processor.generate_feature_code(buyer_id)
+
+    for size in ((1654, 2339), (2339, 1654), (1240, 1754)):
+        page = Image.new('RGB', size, 'white')
+        image_processor.add_binding_line_encoding(page, buyer_id)
+        image_processor.add_spatial_tracking(page, buyer_id)
+
+        # 只保留页边区域，其余涂白（模拟 render_trace_pages 的输出）
+        boxes = image_processor.trace_margin_boxes(*size)
+        margins = Image.new('RGB', size, 'white')
+        for box in boxes:
+            margins.paste(page.crop(box), box[:2])
+
+        area = sum((right - left) * (bottom - top) for left, top, right, bottom in boxes)
+        print(f"{size[0]}x{size[1]}: 渲染面积 {area / (size[0] * size[1]):.1%}")
+
+        assert (image_processor.dot_scores(margins) == image_processor.dot_scores(page)).all()
+        assert (decode_binding_line.detect_binding_line_code(margins)
+                == decode_binding_line.detect_binding_line_code(page))
+
+    print("✅ 测试通过：页边区域包含全部溯源标记")
+
+    # 实际用 pdftoppm 渲染页边（按 POPPLER_PATH 解析命令，与 pdf2image 一致）
+    if shutil.which(image_processor.poppler_command('pdftoppm')) is None:
+        print("未安装 poppler，跳过页边渲染测试")
+        print()
+        return
+
+    page = Image.new('RGB', (1654, 2339), 'white')
+    image_processor.add_binding_line_encoding(page, buyer_id)
+    image_processor.add_spatial_tracking(page, buyer_id)
+    pdf_bytes = pdf_writer.write_pdf([pdf_writer.encode_page(page, 'grayscale', 200, 95)]).getvalue()
+
+    full = image_processor.pdf_to_images(pdf_bytes, dpi=200)[0]
+    margins, = image_processor.render_trace_pages(pdf_bytes, [0], dpi=200)
+    assert margins.size == full.size
+    assert (image_processor.dot_scores(margins) == image_processor.dot_scores(full)).all()
+    assert (decode_binding_line.detect_binding_line_code(margins)
+            == image_processor.encode_to_binary(expected_code))
+    print("✅ 测试通过：pdftoppm 页边渲染与整页渲染的溯源结果一致")
+    print()
+
+
+def test_binding_line_scales():
+    """测试装订线解码对缩放和偏移的容忍度"""
+    print("测试 8: 装订线编码解码（缩放、偏移）")
+    print("-" * 60)
+
+    buyer_id = "王五_13700137000"
+    expected = image_processor.encode_to_binary(image_processor.generate_feature_code(buyer_id))
+    trace_size = (1654, 2339)
+
+    def issued_page(size):
+        page = Image.new('RGB', size, 'white')
+        image_processor.add_binding_line_encoding(page, buyer_id)
+        image_processor.add_spatial_tracking(page, buyer_id)
+        return page
+
+    # 按 300 / 200 / 150 DPI 发行，200 DPI 溯源
+    cases = {
+        '300 DPI 发行': issued_page((2480, 3508)).resize(trace_size, Image.LANCZOS),
+        '200 DPI 发行': issued_page(trace_size),
+        '150 DPI 发行': issued_page((1240, 1754)).resize(trace_size, Image.LANCZOS),
+    }
+
+    # 扫描偏移：上边裁掉 37 像素，整体右移 9 像素
+    shifted = Image.new('RGB', trace_size, 'white')
+    shifted.paste(issued_page(trace_size).crop((0, 37, 1640, 2339)), (9, 0))
+    cases['偏移'] = shifted
+
+    # 黑白二值输出（灰色标记阈值化为黑色）
+    cases['黑白二值'] = issued_page(trace_size).convert('L').point(lambda v: 0 if v < 200 else 255)
+
+    for label, page in cases.items():
+        start = time.perf_counter()
+        result = decode_binding_line.read_binding_line(page)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"{label}: 尺度 {result['scale']:.2f}，间距 {result['pitch']:.1f}，"
+              f"检测到 {result['present'].sum()} 个符号（{elapsed:.1f} ms）")
+        assert decode_binding_line.detect_binding_line_code(page) == expected
+
+    assert decode_binding_line.detect_binding_line_code(Image.new('RGB', trace_size, 'white')) is None
+
+    # 黑色正文（旁注、行号）压在装订线区域：只有标记灰度范围内的像素参与匹配
+    crowded = Image.new('RGB', trace_size, 'white')
+    draw = ImageDraw.Draw(crowded)
+    for y in range(180, 2200, 20):
+        draw.text((8, y), "- 1 . o -", fill=(0, 0, 0))
+    image_processor.add_binding_line_encoding(crowded, buyer_id)
+    assert decode_binding_line.detect_binding_line_code(crowded) == expected
+    assert decode_binding_line.detect_binding_line_code(cases['黑白二值'], output_mode='bilevel') == expected
+
+    print("✅ 测试通过：各种缩放和偏移下均解码正确，黑色正文不被当作装订线标记")
+    print()
+
+
+def test_multi_page_trace():
+    """测试多页投票溯源：跳过封面和残缺页面，确定后提前结束"""
+    print("测试 9: 多页投票溯源")
+    print("-" * 60)
+
+    buyer_id = "赵六_13600136000"
+    feature_code = image_processor.generate_feature_code(buyer_id)
+    size = (1654, 2339)
+
+    def issued_page():
+        page = Image.new('RGB', size, 'white')
+        image_processor.add_binding_line_encoding(page, buyer_id)
+        image_processor.add_spatial_tracking(page, buyer_id, enable_visible=False)
+        return page
+
+    # 封面没有溯源标记，第 2 页装订线被裁掉，第 3 页起完整
+    cover = Image.new('RGB', size, 'white')
+    cropped = issued_page()
+    cropped.paste('white', (0, 0, 60, size[1]))
+    pages = [cover, cropped, issued_page(), issued_page(), issued_page()]
+
+    cache = PageCache()
+    pdf_bytes = b'%PDF-1.4 multi-page trace'
+    cache.put(document_key(pdf_bytes, 200), pages)
+
+    messages = []
+    result = trace_engine.trace_pdf(pdf_bytes, page_cache=cache, progress_callback=messages.append)
+    for message in messages:
+        print(message)
+
+    assert result['code'] == feature_code
+    assert result['source'] == 'vote'
+    assert result['early_exit'] and result['pages_scanned'] == 3
+    assert result['page_count'] == len(pages)
+
+    # 每页只有装订线时需要两页才能确定
+    result = trace_engine.trace_images([cropped, issued_page().crop((0, 0, 200, size[1]))] * 2)
+    assert result['code'] == feature_code and result['pages_scanned'] == 4
+
+    # 没有任何标记
+    result = trace_engine.trace_images([cover, cover])
+    assert result['code'] is None and not result['early_exit']
+
+    print(f"✅ 测试通过：第 3 页确定特征码 {feature_code}，跳过其余 2 页")
+    print()
+
+
+def test_bulk_trace():
+    """测试批量溯源：并行处理、按哈希去重和缓存、匹配买家、输出报告"""
+    print("测试 10: 批量溯源")
+    print("-" * 60)
+
+    customers = [
+        {'name': '张三', 'phone': '13800138000'},
+        {'name': '李四', 'phone': '13900139000'},
+    ]
+    size = (1654, 2339)
+
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for customer in customers:
+            page = Image.new('RGB', size, 'white')
+            buyer_id = f"{customer['name']}_{customer['phone']}"
+            image_processor.add_binding_line_encoding(page, buyer_id)
+            image_processor.add_spatial_tracking(page, buyer_id, enable_visible=False)
+            path = os.path.join(folder, f"{customer['phone']}.png")
+            page.save(path)
+            paths.append(path)
+
+        # 重复上传的文件（内容相同）和没有标记的文件
+        shutil.copy(paths[0], os.path.join(folder, 'copy.png'))
+        Image.new('RGB', size, 'white').save(os.path.join(folder, 'blank.png'))
+
+        files = bulk_trace.collect_files([folder])
+        assert len(files) == 4
+
+        cache = bulk_trace.TraceResultCache(os.path.join(folder, 'cache.json'))
+        rows = {os.path.basename(row['file']): row
+                for row in bulk_trace.trace_files(files, customers, workers=2, cache=cache)}
+        cache.save()
+
+        assert rows['13800138000.png']['buyer_name'] == '张三'
+        assert rows['13900139000.png']['buyer_name'] == '李四'
+        assert rows['copy.png']['code'] == rows['13800138000.png']['code']
+        assert rows['blank.png']['code'] is None and not rows['blank.png']['buyer_name']
+        assert rows['13800138000.png']['confidence'] > 0.2
+        assert not any(row['cached'] for row in rows.values())
+        # 内容相同的文件只溯源一次，未识别的空白页不缓存
+        assert len(cache) == 2
+
+        # 第二次运行：识别出的文件全部命中缓存（耗时不沿用首次溯源），空白页重新溯源
+        cache = bulk_trace.TraceResultCache(os.path.join(folder, 'cache.json'))
+        start = time.perf_counter()
+        again = bulk_trace.trace_files(files, customers, cache=cache)
+        elapsed = (time.perf_counter() - start) * 1000
+        assert [row['cached'] for row in again] == [row['code'] is not None for row in again]
+        assert all(row['seconds'] == 0 for row in again if row['cached'])
+        assert [row['buyer_name'] for row in again] == [rows[os.path.basename(f)]['buyer_name'] for f in files]
+        print(f"缓存命中耗时: {elapsed:.1f} ms")
+
+        # 检查页数上限不同的结果不共用缓存
+        limited = bulk_trace.trace_files(files[:1], customers, cache=cache, max_pages=1)
+        assert not limited[0]['cached']
+
+        report_path = os.path.join(folder, 'report.json')
+        bulk_trace.write_report(again, report_path)
+        with open(report_path, 'r', encoding='utf-8') as f:
+            assert len(json.load(f)) == 4
+        bulk_trace.write_report(again, os.path.join(folder, 'report.csv'))
+
+    print("✅ 测试通过：批量溯源结果正确，重复文件命中缓存")
+    print()
+
+
+def test_buyer_index():
+    """测试特征码索引：批量计算与逐个计算一致、持久化、撞码时返回全部买家"""
+    print("测试 11: 特征码索引")
+    print("-" * 60)
+
+    customers = [{'name': f'买家{i}', 'phone': 13800000000 + i} for i in range(5000)]
+    codes = [image_processor.generate_feature_code(f"{c['name']}_{c['phone']}") for c in customers]
+    assert buyer_index.feature_codes([buyer_index.buyer_id(c) for c in customers]) == codes
+
+    with tempfile.TemporaryDirectory() as folder:
+        start = time.perf_counter()
+        index = buyer_index.load_index(customers, folder)
+        elapsed = (time.perf_counter() - start) * 1000
+
+        path = os.path.join(folder, f"{buyer_index.list_hash(customers)}.json")
+        assert os.path.exists(path)
+        loaded = buyer_index.FeatureCodeIndex.load(path, customers)
+        assert loaded.codes == codes == index.codes
+
+        # 名单变化后索引不再适用
+        assert buyer_index.list_hash(customers[:-1]) != buyer_index.list_hash(customers)
+        assert buyer_index.FeatureCodeIndex.load(path, customers[:-1]) is None
+
+    # 5000 位买家在 36^4 个特征码中必然有撞码，撞码时返回全部买家
+    collisions = index.collisions()
+    assert collisions
+    code, buyers = next(iter(collisions.items()))
+    assert index.lookup(code.lower()) == buyers
+    assert [codes[customers.index(buyer)] for buyer in buyers] == [code] * len(buyers)
+    assert index.lookup('????') == []
+
+    print(f"5000 位买家建立索引耗时 {elapsed:.1f} ms，撞码 {len(collisions)} 组")
+    print("✅ 测试通过：索引结果与逐个计算一致，撞码时返回全部买家")
+    print()
+
+
+def test_code_length():
+    """测试可配置特征码位数：推荐位数、长码装订线往返、解码时自动识别位数"""
+    print("测试 12: 可配置特征码位数")
+    print("-" * 60)
+
+    assert image_processor.recommended_code_length(1000) == 5
+    assert image_processor.recommended_code_length(100000) == 8
+    assert image_processor.collision_probability(100000, 8) < 0.01
+    assert image_processor.collision_probability(5000, 4) > 0.5
+
+    buyer_id = "赵六_13600136000"
+    short_code = image_processor.generate_feature_code(buyer_id)
+    trace_size = (1654, 2339)
+
+    for code_length in (6, 8):
+        code = image_processor.generate_feature_code(buyer_id, code_length)
+        assert len(code) == code_length and code.startswith(short_code)
+
+        # 页面较矮时（150 DPI 的 A4）压缩符号间距
+        for size in (trace_size, (1240, 1754)):
+            page = Image.new('RGB', size, 'white')
+            image_processor.add_binding_line_encoding(page, buyer_id, code_length)
+            image_processor.add_spatial_tracking(page, buyer_id, code_length=code_length)
+            result = decode_binding_line.read_binding_line(page)
+            print(f"{code_length} 位 {size[0]}x{size[1]}：识别为 {result['code_length']} 位，"
+                  f"间距 {result['pitch']:.1f}")
+            assert result['code_length'] == code_length
+            assert (image_processor.decode_from_binary(decode_binding_line.detect_binding_line_code(page))
+                    == code)
+
+        page = Image.new('RGB', trace_size, 'white')
+        image_processor.add_binding_line_encoding(page, buyer_id, code_length)
+        image_processor.add_spatial_tracking(page, buyer_id, code_length=code_length)
+        assert trace_engine.trace_images([page])['code'] == code
+
+    # 索引按特征码长度选择对应位数
+    customers = [{'name': '赵六', 'phone': '13600136000'}, {'name': '钱七', 'phone': '13500135000'}]
+    long_code = image_processor.generate_feature_code(buyer_id, 8)
+    assert buyer_index.find_buyers_by_code(long_code, customers, None) == customers[:1]
+    assert buyer_index.find_buyers_by_code(short_code, customers, None) == customers[:1]
+
+    print("✅ 测试通过：长码可往返解码，位数自动识别")
+    print()
+
+
+def test_char_set_index():
+    """测试位置点字符集合索引：完全一致时返回全部买家，漏点或多出污点时按差异排序"""
+    print("测试 13: 位置点字符集合索引")
+    print("-" * 60)
+
+    customers = [{'name': f'买家{i}', 'phone': 13900000000 + i} for i in range(20000)]
+    index = buyer_index.load_index(customers, None)
+    codes = index.codes
+    assert [int(mask) for mask in index.masks[:100]] == [buyer_index.char_mask(c) for c in codes[:100]]
+
+    target = customers[1234]
+    code = codes[1234]
+    chars = sorted(set(code))
+
+    # 完全一致：全部同字符集合的买家（含字母异序的撞码）距离为 0
+    start = time.perf_counter()
+    exact = index.rank_by_chars(chars, top_k=1)
+    elapsed = (time.perf_counter() - start) * 1000
+    assert target in [candidate['customer'] for candidate in exact]
+    assert all(sorted(set(candidate['feature_code'])) == chars
+               for candidate in exact if candidate['missing'] + candidate['extra'] == 0)
+
+    # 漏检一个点 / 多出一个污点：目标买家距离为 1，排在所有更远的买家之前
+    speck = next(c for c in buyer_index.CODE_CHARS if c not in chars)
+    for label, detected in (('漏点', chars[1:]), ('污点', chars + [speck])):
+        ranked = index.rank_by_chars(detected, top_k=200)
+        distances = [candidate['missing'] + candidate['extra'] for candidate in ranked]
+        assert distances == sorted(distances)
+        position = [candidate['customer'] for candidate in ranked].index(target)
+        assert distances[position] == 1
+        print(f"{label}：目标买家排第 {position + 1} 位")
+
+    top = buyer_index.find_buyers_by_chars(code, customers, index_dir=None)[0]
+    assert top['missing'] == top['extra'] == 0
+
+    # 多出一个污点时字符数变为 5，仍在 4 位特征码中找到目标买家（不按字符数猜位数）
+    ranked = buyer_index.find_buyers_by_chars(chars + [speck], customers, index_dir=None)
+    match = next(candidate for candidate in ranked if candidate['customer'] == target
+                 and candidate['feature_code'] == code)
+    assert match['missing'] + match['extra'] == 1
+    assert all(candidate['missing'] + candidate['extra'] <= 1
+               for candidate in ranked[:ranked.index(match)])
+    ids = [buyer_index.buyer_id(candidate['customer']) for candidate in ranked]
+    assert len(ids) == len(set(ids))
+
+    # 同一买家在多个位数下都匹配时只出现一次，保留距离最小的位数
+    few = customers[:3]
+    six = image_processor.generate_feature_code(buyer_index.buyer_id(few[0]), 6)
+    ranked = buyer_index.rank_buyers_by_chars(
+        lambda length: buyer_index.FeatureCodeIndex(few, code_length=length), sorted(set(six)), top_k=5)
+    assert sorted(buyer_index.buyer_id(candidate['customer']) for candidate in ranked) == \
+        sorted(buyer_index.buyer_id(customer) for customer in few)
+    assert ranked[0]['customer'] == few[0] and ranked[0]['missing'] + ranked[0]['extra'] == 0
+    assert set(ranked[0]['feature_code']) == set(six)
+    assert ranked[0]['code_length'] == len(ranked[0]['feature_code'])
+    print(f"20000 位买家按字符集合查找耗时 {elapsed:.2f} ms")
+    print("✅ 测试通过：字符集合索引返回全部匹配买家，残缺检测按差异排序")
+    print()
+
+
+def test_binding_nearest():
+    """测试装订线误码容错查找：污损符号读错后仍能按汉明距离和置信度找到买家"""
+    print("测试 14: 装订线误码容错查找")
+    print("-" * 60)
+
+    customers = [{'name': f'买家{i}', 'phone': 13300000000 + i} for i in range(20000)]
+    target = customers[4321]
+    code = image_processor.generate_feature_code(buyer_index.buyer_id(target))
+    truth = image_processor.encode_to_binary(code)
+    assert [format(int(v), '024b') for v in buyer_index.code_values([code])] == [truth]
+
+    # 两条短线上被点上墨点：小墨点读错为圆点（低置信度），大墨点可能读不出符号
+    for radius in (3, 6):
+        page = Image.new('RGB', (1654, 2339), 'white')
+        image_processor.add_binding_line_encoding(page, buyer_index.buyer_id(target))
+        draw = ImageDraw.Draw(page)
+        for i in [i for i, bit in enumerate(truth) if bit == '1'][:2]:
+            y = image_processor.BINDING_LINE_START_Y + i * image_processor.BINDING_LINE_SPACING
+            x = image_processor.BINDING_LINE_X
+            draw.ellipse([x - radius, y - radius, x + radius, y + radius], fill=(160, 160, 160))
+
+        trace = trace_engine.trace_images([page])
+        assert trace['bits'] != truth
+
+        start = time.perf_counter()
+        nearest = buyer_index.find_buyers_by_bits(trace['bits'], customers, trace['bit_confidence'],
+                                                  index_dir=None)
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"墨点半径 {radius}：读出 {image_processor.decode_from_binary(trace['bits'])}，"
+              f"容错匹配 {nearest[0]['feature_code']}（{nearest[0]['distance']} 位误码）")
+        assert nearest[0]['customer'] == target
+        assert buyer_index.unambiguous_code(nearest) == code
+
+    # 多索引哈希的候选与全表扫描一致
+    index = buyer_index.BindingCodeIndex(buyer_index.load_index(customers, None).codes)
+    start = time.perf_counter()
+    matches = index.query(trace['bits'], trace['bit_confidence'])
+    query_ms = (time.perf_counter() - start) * 1000
+    scanned = index.query(trace['bits'], trace['bit_confidence'], max_distance=3)
+    assert matches == [match for match in scanned if match['distance'] <= 2]
+    assert index.query('0' * 30) == []
+
+    # 发行台账：在所有已发行的特征码上查找，有新发行后重建
+    ledger = IssuanceLedger(':memory:')
+    ledger.record_release('0' * 64, [{'buyer_id': buyer_index.buyer_id(target), 'buyer_name': target['name'],
+                                      'buyer_phone': str(target['phone']), 'feature_code': code,
+                                      'output_sha256': '1' * 64}])
+    assert ledger.nearest(trace['bits'], trace['bit_confidence'])[0]['buyer_name'] == target['name']
+    misread = image_processor.decode_from_binary(trace['bits'])
+    assert '?' not in misread
+    ledger.record_release('0' * 64, [{'buyer_id': 'x', 'buyer_name': None, 'buyer_phone': None,
+                                      'feature_code': misread, 'output_sha256': '2' * 64}])
+    assert {row['feature_code'] for row in ledger.nearest(trace['bits'], trace['bit_confidence'])} \
+        == {code, misread}
+    ledger.close()
+
+    print(f"20000 位买家容错查找耗时 {elapsed:.2f} ms（索引已建立时 {query_ms:.2f} ms）")
+    print("✅ 测试通过：误码读数按汉明距离和置信度找回买家")
+    print()
+
+
+def test_visible_code_classifier():
+    """测试装订线明码模板匹配：不同发行分辨率、不同位数下均能识别"""
+    print("测试 15: 装订线明码模板匹配识别")
+    print("-" * 60)
+
+    trace_size = (1654, 2339)
+    cases = [('周九_13200132000', 4, trace_size),
+             ('吴十_13100131000', 6, (2480, 3508)),
+             ('郑一_13000130000', 8, trace_size),
+             ('王二_18900189000', 4, (2480, 3508))]
+
+    for buyer_id, code_length, size in cases:
+        page = Image.new('RGB', size, 'white')
+        image_processor.add_binding_line_encoding(page, buyer_id, code_length)
+        image_processor.add_spatial_tracking(page, buyer_id, code_length=code_length)
+        page = page.resize(trace_size, Image.LANCZOS) if size != trace_size else page
+
+        start = time.perf_counter()
+        result = glyph_classifier.read_visible_code(page)
+        elapsed = (time.perf_counter() - start) * 1000
+        expected = image_processor.generate_feature_code(buyer_id, code_length)
+        print(f"{size[0]}x{size[1]} 发行 {code_length} 位：识别为 {result['code']}（{elapsed:.1f} ms）")
+        assert result['code'] == expected
+        assert result['scores'].min() > 0.8
+
+    # 没有明码时不返回结果
+    page = Image.new('RGB', trace_size, 'white')
+    image_processor.add_binding_line_encoding(page, cases[0][0])
+    assert glyph_classifier.read_visible_code(page) is None
+
+    # 明码字体随 Pillow 分发，不依赖系统字体（各操作系统发行和识别的字形一致）
+    font = image_processor.visible_code_font()
+    assert font.getname() == ('Aileron', 'Regular')
+    assert font.size == image_processor.VISIBLE_CODE_FONT_SIZE
+
+    print("✅ 测试通过：明码模板匹配识别正确")
+    print()
+
+
+def test_page_registration():
+    """测试页面配准：翻拍件（深色背景、旋转、透视）和扫描件（倾斜）配准后能溯源"""
+    print("测试 16: 页面配准")
+    print("-" * 60)
+
+    buyer_id = '陈三_13900139001'
+    expected = image_processor.generate_feature_code(buyer_id)
+    page = Image.new('RGB', (1654, 2339), 'white')
+    image_processor.add_binding_line_encoding(page, buyer_id)
+    image_processor.add_spatial_tracking(page, buyer_id)
+    draw = ImageDraw.Draw(page)
+    for y in range(400, 2000, 40):
+        draw.line([(250, y), (1400, y)], fill=(30, 30, 30), width=6)
+    source = np.asarray(page)
+    height, width = source.shape[:2]
+    corners = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+
+    # 翻拍：缩小、旋转 3°、轻微透视，放在深色桌面上
+    rotation = cv2.getRotationMatrix2D((width / 2, height / 2), 3, 0.92)
+    target = cv2.transform(corners[None], rotation)[0] + np.float32([170, 180])
+    target[0] += [25, 25]
+    photo = Image.fromarray(cv2.warpPerspective(
+        source, cv2.getPerspectiveTransform(corners, target), (2000, 2700),
+        borderValue=(60, 60, 60)))
+
+    # 扫描：纸张铺满画面，倾斜 1.5°
+    scan = Image.fromarray(cv2.warpAffine(
+        source, cv2.getRotationMatrix2D((width / 2, height / 2), 1.5, 1.0), (width, height),
+        borderValue=(255, 255, 255)))
+
+    for name, image, method in [('翻拍', photo, 'page'), ('扫描', scan, 'skew')]:
+        start = time.perf_counter()
+        registered, registration = page_registration.register_margins(image)
+        elapsed = (time.perf_counter() - start) * 1000
+        raw = trace_engine.trace_images([image])
+        result = trace_engine.trace_images([registered])
+        print(f"{name}：配准方式 {registration['method']}，未配准 {raw['code']}，"
+              f"配准后 {result['code']}（{elapsed:.0f} ms）")
+        assert registration['method'] == method
+        assert raw['source'] not in ('vote', 'binding')
+        assert result['code'] == expected and result['source'] == 'vote'
+        assert trace_engine.trace_images([image], register=True)['code'] == expected
+
+    # 已对齐的页面不做变换
+    registered, registration = page_registration.register_margins(page)
+    assert registration['method'] is None and registered is page
+
+    print("✅ 测试通过：翻拍件和扫描件配准后溯源正确")
+    print()
+
+
+def test_trace_server():
+    """测试本地溯源服务：上传图片返回特征码和买家，重复上传命中缓存，拒绝非本机请求"""
+    print("测试 17: 本地溯源服务")
+    print("-" * 60)
+
+    customers = [
+        {'name': '张三', 'phone': '13800138000'},
+        {'name': '李四', 'phone': '13900139000'},
+    ]
+    buyer_id = f"{customers[1]['name']}_{customers[1]['phone']}"
+    expected = image_processor.generate_feature_code(buyer_id)
+    page = Image.new('RGB', (1654, 2339), 'white')
+    image_processor.add_binding_line_encoding(page, buyer_id)
+    image_processor.add_spatial_tracking(page, buyer_id, enable_visible=False)
+    marked = io.BytesIO()
+    page.save(marked, format='PNG')
+    blank = io.BytesIO()
+    Image.new('RGB', (1654, 2339), 'white').save(blank, format='PNG')
+
+    # 非回环地址不能监听
+    try:
+        trace_server.create_server(None, '0.0.0.0', 0)
+        assert False, "应拒绝监听非回环地址"
+    except ValueError:
+        pass
+
+    service = trace_server.TraceService(customers, workers=1)
+    start = time.perf_counter()
+    service.warm()
+    print(f"启动预热耗时: {(time.perf_counter() - start) * 1000:.0f} ms")
+    server = trace_server.create_server(service, '127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def request(path, data=None, headers=None):
+        """发送请求，返回 (状态码, JSON)"""
+        req = urllib.request.Request(base + path, data=data, headers=headers or {})
+        try:
+            with urllib.request.urlopen(req, timeout=60) as response:
+                return response.status, json.load(response)
+        except urllib.error.HTTPError as e:
+            return e.code, json.load(e)
+
+    try:
+        status, health = request('/health')
+        assert status == 200 and health['customers'] == 2 and health['workers'] == 1
+
+        status, result = request('/trace', marked.getvalue())
+        print(f"首次溯源: {result['code']}（{result['source']}），"
+              f"解码 {result['trace_seconds'] * 1000:.0f} ms，请求 {result['seconds'] * 1000:.0f} ms")
+        assert status == 200
+        assert result['code'] == expected and result['source'] == 'vote'
+        assert [buyer['name'] for buyer in result['buyers']] == ['李四']
+        assert not result['cached']
+
+        status, again = request('/trace', marked.getvalue())
+        print(f"重复上传: 命中缓存，请求 {again['seconds'] * 1000:.1f} ms")
+        assert again['cached'] and again['code'] == expected and again['buyers'] == result['buyers']
+
+        status, result = request('/trace', blank.getvalue())
+        assert status == 200 and result['code'] is None and result['buyers'] == []
+
+        status, result = request('/trace', b'not a pdf or image')
+        assert status == 400 and 'error' in result
+
+        # 目标主机名不是本机（DNS 重绑定）或由其他网站的页面发起时拒绝
+        for headers in ({'Host': 'attacker.example:80'},
+                        {'Origin': 'https://attacker.example'},
+                        {'Origin': 'null'},
+                        {'Sec-Fetch-Site': 'cross-site'}):
+            status, _ = request('/health', headers=headers)
+            assert status == 403, headers
+        status, _ = request('/trace', marked.getvalue(), headers={'Origin': 'https://attacker.example'})
+        assert status == 403
+        status, _ = request('/health', headers={'Origin': f"http://localhost:{server.server_address[1]}",
+                                                'Sec-Fetch-Site': 'same-origin'})
+        assert status == 200
+
+        status, health = request('/reload', b'')
+        assert status == 200 and health['cached_results'] == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.close()
+
+    # reload 换下的旧台账等正在进行的请求结束后才关闭
+    folder = tempfile.mkdtemp()
+    try:
+        ledger = IssuanceLedger(os.path.join(folder, 'issuance_ledger.db'))
+        service = trace_server.TraceService(customers, ledger, workers=1)
+        with service._ledger_in_use() as in_flight:
+            service.reload()
+            assert service.ledger is not in_flight
+            assert len(in_flight) == 0 and in_flight.lookup(expected) == []
+        try:
+            len(in_flight)
+            assert False, "最后一个请求结束后应关闭旧台账"
+        except sqlite3.ProgrammingError:
+            pass
+        # 没有请求在使用时立即关闭
+        current = service.ledger
+        service.reload()
+        try:
+            len(current)
+            assert False, "空闲的旧台账应立即关闭"
+        except sqlite3.ProgrammingError:
+            pass
+        service.close()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    print("✅ 测试通过：本地溯源服务返回正确的特征码和买家")
+    print()
+
+
 def main():
     """运行所有测试"""
     print("=" * 60)
@@ -201,6 +895,18 @@ def main():
     test_char_position_map()
     test_map_reference_generation()
     test_feature_code_format()
+    test_dot_scores()
+    test_trace_margin_boxes()
+    test_binding_line_scales()
+    test_multi_page_trace()
+    test_bulk_trace()
+    test_buyer_index()
+    test_code_length()
+    test_char_set_index()
+    test_binding_nearest()
+    test_visible_code_classifier()
+    test_page_registration()
+    test_trace_server()
 
     print("=" * 60)
     print("所有测试完成")
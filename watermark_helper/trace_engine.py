@@ -0,0 +1,390 @@
+"""
+多页投票溯源引擎
+
+逐页（只渲染页边区域）检测隐形位置点和装订线编码，累积每个字符的证据，
+某个特征码明显领先时立即停止：干净的副本通常第一页就能确定，
+封面、裁剪或遮挡的页面则由后续页面补足；
+扫描件、翻拍件先配准到标准页面网格（见 page_registration）；
+直接转发的副本不渲染页面，从 PDF 结构中读出特征码（见 structure_marks，可要求页面标记证实）；
+解码之前可按页面感知哈希在发行台账中反查来源母版（见 page_fingerprint）
+不依赖 Streamlit，可独立使用
+"""
+
+from collections import Counter, defaultdict
+
+import numpy as np
+
+import image_processor
+import decode_binding_line
+import page_fingerprint
+import page_registration
+import structure_marks
+from page_cache import document_key
+
+
+# 领先票数达到该值即提前结束
+# 单页装订线解码记 1 票，位置点与之一致再加 1 票，干净的副本一页即可确定
+DEFAULT_VOTE_MARGIN = 2
+
+# 给出有序特征码（可直接查找买家）的结果来源
+ORDERED_SOURCES = ('structure', 'vote', 'binding')
+
+# 反查来源母版时使用的页数（封面可能多份母版相同，多看几页）
+SOURCE_PAGES = 3
+
+
+class TraceEvidence:
+    """
+    逐页累积的溯源证据
+
+    - votes: 每个完整特征码获得的票数
+    - bit_evidence: 特征码位数 → 装订线每一位的累积证据
+      （正为短线 1，负为圆点 0，绝对值为置信度之和）
+    - dot_hits: 每个位置点字符被检测为黑点的页数（按 POSITION_CHARS 排列）
+    - binding_pages: 特征码位数 → 读出该位数装订线编码的页数
+    """
+
+    def __init__(self):
+        self.votes = Counter()
+        self.bit_evidence = {}
+        self.dot_hits = np.zeros(len(image_processor.POSITION_CHARS), dtype=np.int64)
+        self.pages = 0
+        self.binding_pages = defaultdict(int)
+
+    def add_page(self, image):
+        """
+        检测一页并累积证据
+
+        参数:
+            image: PIL Image 对象（整页或 render_trace_pages 的页边画布）
+
+        返回:
+            字典 {'binding_code': 装订线解码结果或 None, 'dot_chars': 检测到的位置点字符}
+        """
+        self.pages += 1
+
+        scores = image_processor.dot_scores(image)
+        self.dot_hits += scores > image_processor.DOT_SCORE_THRESHOLD
+        _, dot_chars = image_processor.position_code_from_scores(scores)
+
+        binding_code = None
+        binding = decode_binding_line.read_binding_line(image)
+        if (binding is not None and
+                binding['present'].sum() >= decode_binding_line.min_symbols(len(binding['bits']))):
+            code_length = binding['code_length']
+            signs = np.array([1.0 if bit == '1' else -1.0 for bit in binding['bits']])
+            if code_length not in self.bit_evidence:
+                self.bit_evidence[code_length] = np.zeros(len(signs))
+            self.bit_evidence[code_length] += signs * binding['confidence']
+            self.binding_pages[code_length] += 1
+
+            candidate = image_processor.decode_from_binary(binding['bits'])
+            if '?' not in candidate:
+                binding_code = candidate
+
+        if binding_code:
+            self.votes[binding_code] += 1
+            # 两种标记互相印证
+            if dot_chars == sorted(set(binding_code)):
+                self.votes[binding_code] += 1
+        elif dot_chars:
+            # 位置点没有顺序，只支持字符集合一致的已有候选
+            for code in list(self.votes):
+                if sorted(set(code)) == dot_chars:
+                    self.votes[code] += 1
+
+        return {'binding_code': binding_code, 'dot_chars': dot_chars}
+
+    def leader(self):
+        """
+        当前领先的特征码
+
+        返回:
+            (特征码或 None, 领先第二名的票数)
+        """
+        ranked = self.votes.most_common(2)
+        if not ranked:
+            return None, 0
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0
+        return ranked[0][0], ranked[0][1] - runner_up
+
+    def code_length(self):
+        """装订线给出的特征码位数（读出页数最多者），没有装订线证据时返回 None"""
+        if not self.binding_pages:
+            return None
+        return max(self.binding_pages,
+                   key=lambda length: (self.binding_pages[length],
+                                       np.abs(self.bit_evidence[length]).sum()))
+
+    def binding_bits(self):
+        """
+        累积的装订线读数（用于误码时的容错查找）
+
+        返回:
+            (二进制字符串或 None, 每一位的平均置信度数组，0 表示所有页面都未检测到该符号)
+        """
+        code_length = self.code_length()
+        if code_length is None:
+            return None, np.zeros(0)
+        evidence = self.bit_evidence[code_length]
+        bits = ''.join('1' if value > 0 else '0' for value in evidence)
+        return bits, np.abs(evidence) / self.binding_pages[code_length]
+
+    def binding_code(self):
+        """由累积的装订线证据逐位取符号解码（可拼合多张各自残缺的页面）"""
+        bits, confidence = self.binding_bits()
+        if bits is None or not confidence.any():
+            return None
+        code = image_processor.decode_from_binary(bits)
+        return code if '?' not in code else None
+
+    def dot_chars(self):
+        """检测次数不少于最多者一半的位置点字符（无顺序）"""
+        if not self.dot_hits.any():
+            return []
+        threshold = self.dot_hits.max() / 2
+        return sorted(image_processor.POSITION_CHARS[i]
+                      for i in np.flatnonzero(self.dot_hits >= threshold))
+
+    def char_confidence(self):
+        """特征码每个字符的置信度（对应 6 位装订线证据绝对值的最小值）"""
+        code_length = self.code_length()
+        if code_length is None:
+            return np.zeros(0)
+        return np.abs(self.bit_evidence[code_length]).reshape(code_length, 6).min(axis=1)
+
+    def confidence(self):
+        """整体置信度（0~1）：最弱字符在各页装订线上的平均判别裕度，只有位置点时为 0"""
+        code_length = self.code_length()
+        if code_length is None:
+            return 0.0
+        return float(self.char_confidence().min() / self.binding_pages[code_length])
+
+    def result(self):
+        """
+        汇总证据得出特征码
+
+        优先级：票数领先的特征码 > 累积装订线证据解码 > 位置点字符（无顺序）
+
+        返回:
+            字典 {'code', 'source' ('vote' / 'binding' / 'dots' / None), 'confidence',
+                  'votes', 'char_confidence', 'bits', 'bit_confidence', 'dot_hits', 'pages_scanned'}
+            bits / bit_confidence 为累积的装订线读数，code 无法确定时可用于容错查找
+        """
+        code, lead = self.leader()
+        source = 'vote' if code and lead > 0 else None
+
+        if source is None:
+            code = self.binding_code()
+            source = 'binding' if code else None
+
+        if source is None:
+            chars = self.dot_chars()
+            code = ''.join(chars) if chars else None
+            source = 'dots' if code else None
+
+        bits, bit_confidence = self.binding_bits()
+        return {
+            'code': code,
+            'source': source,
+            'confidence': self.confidence() if source in ('vote', 'binding') else 0.0,
+            'votes': dict(self.votes),
+            'char_confidence': self.char_confidence(),
+            'bits': bits,
+            'bit_confidence': bit_confidence,
+            'dot_hits': self.dot_hits.copy(),
+            'pages_scanned': self.pages,
+        }
+
+
+def trace_images(images, vote_margin=DEFAULT_VOTE_MARGIN, progress_callback=None,
+                 page_count=None, register=False):
+    """
+    逐页投票溯源
+
+    参数:
+        images: PIL Image 对象的可迭代对象（可以是生成器，按需逐页产出）
+        vote_margin: 领先票数达到该值即停止读取后续页面
+        progress_callback: 进度回调函数，接受一个字符串参数
+        page_count: 总页数（仅用于进度显示）
+        register: 是否先把每页配准到标准页面网格（扫描件、翻拍件）
+
+    返回:
+        TraceEvidence.result() 的字典，另含 'early_exit'
+    """
+    evidence = TraceEvidence()
+    early_exit = False
+    total = f"/{page_count}" if page_count else ""
+
+    for index, image in enumerate(images):
+        if register:
+            image, _ = page_registration.register_margins(image)
+        page = evidence.add_page(image)
+        code, lead = evidence.leader()
+
+        if progress_callback:
+            found = page['binding_code'] or ''.join(page['dot_chars']) or '未检测到标记'
+            progress_callback(f"第 {index + 1}{total} 页：{found}，领先：{code or '无'}（{lead} 票）")
+
+        if code and lead >= vote_margin:
+            early_exit = True
+            break
+
+    result = evidence.result()
+    result['early_exit'] = early_exit
+    return result
+
+
+def structure_confirmed(result, code):
+    """
+    页面上的图像标记是否证实结构标记给出的特征码
+
+    结构令牌只能说明文件由持有密钥者写出，无法防止伪造或拼接，
+    须至少有一页解码出相同的有序特征码，或位置点字符集合与之一致
+
+    参数:
+        result: 图像溯源结果（trace_images 的字典）
+        code: 结构标记读出的特征码
+
+    返回:
+        bool
+    """
+    if result['source'] in ('vote', 'binding'):
+        return result['code'] == code
+    if result['source'] == 'dots':
+        return result['code'] == ''.join(sorted(set(code)))
+    return False
+
+
+def _structure_result(pdf_bytes, marks):
+    """把结构标记的读取结果整理成与 trace_pdf 同格式的字典（不渲染页面）"""
+    result = TraceEvidence().result()
+    result.update(code=marks['code'], source='structure', confidence=1.0, early_exit=True,
+                  page_count=marks['page_count'] or image_processor.count_pdf_pages(pdf_bytes),
+                  registered=False, structure=marks)
+    return result
+
+
+def trace_pdf(pdf_bytes, dpi=200, page_cache=None, max_pages=None,
+              vote_margin=DEFAULT_VOTE_MARGIN, progress_callback=None, register=False,
+              structure=True, trace_key=None, confirm=False):
+    """
+    对 PDF 逐页投票溯源（每页只渲染页边区域，领先后立即停止）
+
+    参数:
+        pdf_bytes: PDF 文件的字节内容
+        dpi: 渲染分辨率
+        page_cache: PageCache 对象（可选），命中时直接使用缓存的整页
+        max_pages: 最多检查的页数（None 表示不限）
+        vote_margin: 领先票数达到该值即停止
+        progress_callback: 进度回调函数，接受一个字符串参数
+        register: 是否先配准页面（扫描件、翻拍件转成的 PDF；此时需渲染整页才能找到纸张边缘）
+                  'auto' 表示先按原始网格快速溯源，读不出有序特征码时再配准重试
+        structure: 是否先读取 PDF 结构标记（直接转发的副本毫秒级完成；结构标记缺失、
+                   校验失败或各通道不一致时回退到图像解码）
+        trace_key: 结构标记的令牌密钥（可选，默认读取环境变量 WATERMARK_TRACE_KEY）
+        confirm: 是否要求页面标记证实结构标记（见 structure_confirmed；需渲染页边，
+                 用于怀疑密钥泄露、令牌可能被伪造时）
+
+    返回:
+        trace_images 的结果字典，另含 'page_count'、'registered'（是否经过配准）
+        和 'structure'（结构标记的读取结果，见 structure_marks.read_structure_marks，
+        另含 'confirmed'：页面标记是否证实，未核对时为 None）
+        采信结构标记时 source 为 'structure'、confidence 为 1.0；
+        未要求证实时不渲染任何页面（pages_scanned 为 0）
+    """
+    marks = structure_marks.read_structure_marks(pdf_bytes, trace_key) if structure else None
+    # 通道之间不一致说明文件被篡改，不采信结构标记
+    hint = marks['code'] if marks and marks['code'] and marks['consistent'] else None
+    if marks is not None:
+        marks['confirmed'] = None
+    if hint and not confirm:
+        if progress_callback:
+            progress_callback(f"PDF 结构标记：{hint}（未渲染页面）")
+        return _structure_result(pdf_bytes, marks)
+    if hint and progress_callback:
+        progress_callback(f"PDF 结构标记：{hint}，用页面标记核对")
+
+    result = _trace_rendered(pdf_bytes, dpi, page_cache, max_pages, vote_margin,
+                             progress_callback, register)
+    result['structure'] = marks
+    if hint:
+        marks['confirmed'] = structure_confirmed(result, hint)
+        if marks['confirmed']:
+            result.update(code=hint, source='structure', confidence=1.0)
+        elif progress_callback:
+            progress_callback("页面标记未能证实结构标记，不采信结构标记")
+    return result
+
+
+def _trace_rendered(pdf_bytes, dpi, page_cache, max_pages, vote_margin, progress_callback,
+                    register):
+    """按页面上的图像标记溯源（trace_pdf 去掉结构标记部分）"""
+    if register == 'auto':
+        result = _trace_rendered(pdf_bytes, dpi, page_cache, max_pages, vote_margin,
+                                 progress_callback, False)
+        if result['source'] in ORDERED_SOURCES or not result['page_count']:
+            return result
+        if progress_callback:
+            progress_callback("未读出有序特征码，可能是扫描件或翻拍件，尝试页面配准")
+        registered = _trace_rendered(pdf_bytes, dpi, page_cache, max_pages, vote_margin,
+                                     progress_callback, True)
+        # 配准后仍读不出时保留原始结果（如只有位置点）
+        return registered if registered['source'] is not None or result['source'] is None else result
+
+    cached = page_cache.get(document_key(pdf_bytes, dpi)) if page_cache is not None else None
+    if cached is not None:
+        page_count = len(cached)
+    else:
+        page_count = image_processor.count_pdf_pages(pdf_bytes)
+    limit = page_count if max_pages is None else min(page_count, max_pages)
+
+    if register:
+        # 纸张边缘和内容框不在页边区域内，按需逐页渲染整页
+        pages = (image_processor.render_pages(pdf_bytes, [index], dpi, page_cache)[0]
+                 for index in range(limit))
+    else:
+        pages = image_processor.iter_trace_pages(pdf_bytes, range(limit), dpi, page_cache)
+    try:
+        result = trace_images(pages, vote_margin, progress_callback, page_count, register)
+    finally:
+        pages.close()
+
+    result['page_count'] = page_count
+    result['registered'] = bool(register)
+    return result
+
+
+def page_fingerprints(pdf_bytes, max_pages=SOURCE_PAGES):
+    """
+    低分辨率渲染前几页并计算页面指纹（翻拍件、扫描件先配准，去掉背景和倾斜）
+
+    参数:
+        pdf_bytes: PDF 文件的字节内容
+        max_pages: 最多使用的页数
+
+    返回:
+        page_fingerprint.fingerprint 的结果列表
+    """
+    page_count = image_processor.count_pdf_pages(pdf_bytes)
+    pages = image_processor.render_pages(pdf_bytes, range(min(page_count, max_pages)),
+                                         dpi=page_fingerprint.FINGERPRINT_DPI)
+    return [page_fingerprint.fingerprint(page_registration.registered_thumbnail(page))
+            for page in pages]
+
+
+def find_source_document(pdf_bytes, ledger, max_pages=SOURCE_PAGES,
+                         top_k=page_fingerprint.DEFAULT_TOP_K):
+    """
+    按页面感知哈希在发行台账中反查盗版来自哪份母版
+
+    参数:
+        pdf_bytes: 盗版 PDF 的字节内容
+        ledger: issuance_ledger.IssuanceLedger 对象
+        max_pages: 最多使用的页数
+        top_k: 最多返回的母版数
+
+    返回:
+        IssuanceLedger.find_documents 的字典列表（最可能的母版在前）
+    """
+    return ledger.find_documents(page_fingerprints(pdf_bytes, max_pages), top_k)
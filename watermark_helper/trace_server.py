@@ -0,0 +1,596 @@
+#!/usr/bin/env python3
+"""
+本地溯源服务
+
+auto_trace.py、decode_binding_line.py 每次运行都要重新导入 OpenCV、pandas、pdf2image
+并重新读取买家名单，交互溯源的大部分时间花在启动上。本服务常驻运行：
+买家名单和特征码索引、发行台账的容错索引常驻内存，进程池在启动时预热
+（导入模块、生成装订线和明码模板），每次请求只做实际的解码和查找。
+相同内容的文件按哈希缓存溯源结果，买家匹配每次重新进行。
+服务只监听本机回环地址，并拒绝来自其他地址、其他主机名或其他网站页面（Origin、Sec-Fetch-Site）的请求
+
+接口（返回 JSON）:
+    GET  /health   服务状态
+    POST /trace    请求体为 PDF 或图片的原始字节（按文件头识别），
+                   可选查询参数 dpi、max_pages；返回特征码、候选特征码和匹配的买家
+    POST /reload   重新读取买家名单、重新打开发行台账（名单或台账在其他进程中更新后调用）
+
+用法:
+    python3 trace_server.py -c customers.csv
+    python3 trace_server.py -l issuance_ledger.db -p 8765 -w 4
+    curl --data-binary @suspect.pdf http://127.0.0.1:8765/trace
+    curl --data-binary @photo.jpg "http://127.0.0.1:8765/trace?max_pages=1"
+"""
+
+import argparse
+import hashlib
+import io
+import ipaddress
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+import buyer_index
+import bulk_trace
+import glyph_classifier
+import image_processor
+import page_fingerprint
+import page_registration
+import trace_engine
+from auto_trace import load_customer_list
+from issuance_ledger import IssuanceLedger
+
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# 请求体大小上限（MB）
+MAX_UPLOAD_MB = 200
+
+# 内存中缓存的溯源结果数
+RESULT_CACHE_SIZE = 256
+
+# 预热进程池时检测的空白页面尺寸（A4，200 DPI）
+WARMUP_PAGE_SIZE = (1654, 2339)
+
+
+def is_loopback(host):
+    """主机名或地址是否为本机回环地址"""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host.strip('[]')).is_loopback
+    except ValueError:
+        return False
+
+
+def _warm_worker():
+    """
+    进程池初始化函数：在空白页面上走一遍检测流程
+
+    生成各尺度的装订线模板、明码字符模板，初始化 OpenCV，使第一个请求不再承担这些开销
+    """
+    page = Image.new('RGB', WARMUP_PAGE_SIZE, 'white')
+    trace_engine.trace_images([page])
+    glyph_classifier.read_visible_code(page)
+    page_fingerprint.fingerprint(page_registration.registered_thumbnail(page))
+
+
+def _ping():
+    """空任务（用于确认工作进程已启动并完成预热）"""
+    return os.getpid()
+
+
+def _first_page(data, is_pdf, registered, dpi):
+    """第一页图像（识别装订线明码用，已配准时变换到标准页面网格）"""
+    if is_pdf:
+        if registered:
+            page = image_processor.render_pages(data, [0], dpi=dpi)[0]
+        else:
+            return image_processor.render_trace_pages(data, [0], dpi=dpi)[0]
+    else:
+        with Image.open(io.BytesIO(data)) as image:
+            page = image.convert('RGB')
+    page, _ = page_registration.register_margins(page)
+    return page
+
+
+def _image_fingerprints(data, max_pages=trace_engine.SOURCE_PAGES):
+    """图片前几帧的页面指纹"""
+    with Image.open(io.BytesIO(data)) as image:
+        return [page_fingerprint.fingerprint(page_registration.registered_thumbnail(frame.convert('RGB')))
+                for frame in itertools.islice(ImageSequence.Iterator(image), max_pages)]
+
+
+def trace_payload(data, is_pdf, dpi=200, max_pages=None, fingerprints=False):
+    """
+    溯源一个上传的文件（进程池工作函数，不做买家匹配）
+
+    参数:
+        data: PDF 或图片的字节内容
+        is_pdf: 是否为 PDF
+        dpi: PDF 渲染分辨率
+        max_pages: 最多检查的页数
+        fingerprints: 是否计算页面指纹（有发行台账时用于反查母版）
+
+    返回:
+        可序列化为 JSON 的字典
+        - code, source, confidence, pages_scanned, page_count, registered, structure: 同 trace_pdf
+        - bits, bit_confidence: 装订线读数（容错查找用）
+        - visible_code: 没有有序特征码时识别的装订线明码（识别失败为 None）
+        - fingerprints: 页面指纹列表
+        - seconds: 耗时
+    """
+    start = time.perf_counter()
+    result = bulk_trace.trace_bytes(data, is_pdf, dpi, max_pages)
+
+    visible_code = None
+    if result['source'] not in trace_engine.ORDERED_SOURCES and result['page_count']:
+        visible = glyph_classifier.read_visible_code(
+            _first_page(data, is_pdf, result.get('registered'), dpi))
+        visible_code = visible['code'] if visible else None
+
+    page_prints = []
+    if fingerprints:
+        page_prints = trace_engine.page_fingerprints(data) if is_pdf else _image_fingerprints(data)
+
+    return {
+        'code': result['code'],
+        'source': result['source'],
+        'confidence': round(float(result['confidence']), 4),
+        'pages_scanned': result['pages_scanned'],
+        'page_count': result['page_count'],
+        'registered': bool(result.get('registered')),
+        'structure': result.get('structure'),
+        'bits': result['bits'],
+        'bit_confidence': np.round(np.asarray(result['bit_confidence'], dtype=float), 4).tolist(),
+        'visible_code': visible_code,
+        'fingerprints': [[int(value) for value in fingerprint] for fingerprint in page_prints],
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+
+
+def _buyer(customer, feature_code, origin, issued_at=None):
+    """买家信息转为响应中的字典"""
+    buyer = {'name': str(customer.get('name', '')), 'phone': str(customer.get('phone', '')),
+             'feature_code': feature_code, 'origin': origin}
+    if issued_at:
+        buyer['issued_at'] = issued_at
+    return buyer
+
+
+class TraceService:
+    """
+    常驻的溯源服务（与 HTTP 无关，可直接在 Python 中调用）
+
+    参数:
+        customer_list: 买家字典列表（可选）
+        ledger: issuance_ledger.IssuanceLedger 对象（可选）
+        workers: 工作进程数（None 为 CPU 核数）
+        dpi: 默认 PDF 渲染分辨率
+        max_pages: 默认每个文件最多检查的页数
+        customers_path: 买家名单文件路径（reload 时重新读取）
+    """
+
+    def __init__(self, customer_list=None, ledger=None, workers=None, dpi=200, max_pages=None,
+                 customers_path=None):
+        self.customer_list = customer_list or []
+        self.ledger = ledger
+        self.workers = workers or os.cpu_count() or 1
+        self.dpi = dpi
+        self.max_pages = max_pages
+        self.customers_path = customers_path
+        self.started = time.time()
+        self.requests = 0
+
+        self._lock = threading.Lock()
+        self._indexes = {}  # 特征码位数 → FeatureCodeIndex
+        self._results = OrderedDict()  # 缓存键 → trace_payload 的结果
+        self._ledger_users = {}  # 发行台账 → 正在使用它的请求数
+        self._retired = set()  # reload 换下、等待最后一个请求结束后关闭的台账
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_warm_worker)
+
+    def warm(self):
+        """启动全部工作进程并等待预热完成，同时建立默认位数的特征码索引"""
+        futures = [self._executor.submit(_ping) for _ in range(self.workers)]
+        if self.customer_list:
+            self._index(buyer_index.DEFAULT_CODE_LENGTH)
+        wait(futures)
+
+    def _index(self, code_length):
+        """获取买家名单的特征码索引（首次使用时建立，之后常驻内存）"""
+        with self._lock:
+            index = self._indexes.get(code_length)
+            if index is None:
+                index = self._indexes[code_length] = buyer_index.load_index(
+                    self.customer_list, code_length=code_length)
+            return index
+
+    @contextmanager
+    def _ledger_in_use(self):
+        """
+        当前发行台账（上下文管理器）
+
+        使用期间持有台账的引用计数：reload 换下的旧台账在最后一个使用它的请求结束后才关闭
+        """
+        with self._lock:
+            ledger = self.ledger
+            if ledger is not None:
+                self._ledger_users[ledger] = self._ledger_users.get(ledger, 0) + 1
+        try:
+            yield ledger
+        finally:
+            if ledger is not None:
+                with self._lock:
+                    self._ledger_users[ledger] -= 1
+                    idle = not self._ledger_users[ledger]
+                    if idle:
+                        del self._ledger_users[ledger]
+                    retire = idle and ledger in self._retired
+                    if retire:
+                        self._retired.remove(ledger)
+                if retire:
+                    ledger.close()
+
+    def reload(self):
+        """
+        重新读取买家名单、重新打开发行台账（清空特征码索引，溯源结果缓存仍然有效；内存台账保持不变）
+
+        旧台账没有请求在使用时立即关闭，否则等正在进行的请求结束后再关闭
+        """
+        customer_list = load_customer_list(self.customers_path) if self.customers_path else self.customer_list
+        reopen = self.ledger is not None and self.ledger.path != ':memory:'
+        ledger = IssuanceLedger(self.ledger.path) if reopen else self.ledger
+        with self._lock:
+            old_ledger, self.ledger = self.ledger, ledger
+            self.customer_list = customer_list
+            self._indexes = {}
+            retire = reopen and old_ledger not in self._ledger_users
+            if reopen and not retire:
+                self._retired.add(old_ledger)
+        if retire:
+            old_ledger.close()
+
+    def status(self):
+        """服务状态"""
+        return {
+            'status': 'ok',
+            'customers': len(self.customer_list),
+            'ledger': self.ledger.path if self.ledger is not None else None,
+            'workers': self.workers,
+            'cached_results': len(self._results),
+            'requests': self.requests,
+            'uptime': round(time.time() - self.started, 1),
+        }
+
+    def buyers(self, feature_code, document_sha256=None):
+        """
+        特征码对应的买家（名单和台账中的同一买家只列一次）
+
+        参数:
+            feature_code: 特征码
+            document_sha256: 只匹配该母版的发行记录（该母版下没有记录时匹配全部）
+
+        返回:
+            字典列表 {'name', 'phone', 'feature_code', 'origin' ('customers' / 'ledger'), 'issued_at'}
+        """
+        with self._ledger_in_use() as ledger:
+            return self._buyers(ledger, feature_code, document_sha256)
+
+    def _buyers(self, ledger, feature_code, document_sha256=None):
+        """buyers 的实现（ledger 为本次请求持有的发行台账）"""
+        buyers = []
+        if self.customer_list and len(feature_code) in buyer_index.SUPPORTED_CODE_LENGTHS:
+            buyers += [_buyer(customer, feature_code, 'customers')
+                       for customer in self._index(len(feature_code)).lookup(feature_code)]
+        if ledger is not None:
+            issues = ledger.lookup(feature_code, document_sha256) if document_sha256 else []
+            issues = issues or ledger.lookup(feature_code)
+            buyers += [_buyer({'name': issue['buyer_name'] or issue['buyer_id'],
+                               'phone': issue['buyer_phone'] or ''},
+                              feature_code, 'ledger', issue['issued_at'])
+                       for issue in issues]
+        return list({(buyer['name'], buyer['phone']): buyer for buyer in buyers}.values())
+
+    def candidates(self, traced):
+        """
+        没有有序特征码时的候选特征码
+
+        位置点字符按字符集合在名单中查找；装订线读数有误码时按汉明距离在台账（或名单）中查找
+
+        返回:
+            (候选字典列表, 代价唯一最小的特征码或 None)
+        """
+        with self._ledger_in_use() as ledger:
+            return self._candidates(ledger, traced)
+
+    def _candidates(self, ledger, traced):
+        """candidates 的实现（ledger 为本次请求持有的发行台账）"""
+        candidates = []
+        if traced['source'] == 'dots' and self.customer_list:
+            for match in buyer_index.rank_buyers_by_chars(self._index, traced['code']):
+                candidate = _buyer(match['customer'], match['feature_code'], 'customers')
+                candidates.append(dict(candidate, missing=match['missing'], extra=match['extra']))
+
+        bits = traced['bits']
+        code_length = len(bits) // buyer_index.BITS_PER_CHAR if bits else None
+        if code_length not in buyer_index.SUPPORTED_CODE_LENGTHS:
+            return candidates, None
+
+        confidence = np.asarray(traced['bit_confidence'])
+        nearest = []
+        if ledger is not None:
+            nearest = ledger.nearest(bits, confidence)
+            for match in nearest:
+                candidate = _buyer({'name': match['buyer_name'] or match['buyer_id'],
+                                    'phone': match['buyer_phone'] or ''},
+                                   match['feature_code'], 'ledger', match['issued_at'])
+                candidates.append(dict(candidate, distance=match['distance'], cost=round(match['cost'], 4)))
+        elif self.customer_list:
+            nearest = self._index(code_length).nearest(bits, confidence)
+            for match in nearest:
+                candidate = _buyer(match['customer'], match['feature_code'], 'customers')
+                candidates.append(dict(candidate, distance=match['distance'], cost=round(match['cost'], 4)))
+        return candidates, buyer_index.unambiguous_code(nearest)
+
+    def trace(self, data, dpi=None, max_pages=None):
+        """
+        溯源一个 PDF 或图片并匹配买家
+
+        参数:
+            data: 文件的字节内容（以 %PDF- 开头的视为 PDF，其余按图片读取）
+            dpi: PDF 渲染分辨率（None 使用服务默认值）
+            max_pages: 最多检查的页数（None 使用服务默认值）
+
+        返回:
+            字典
+            - sha256, code, confidence, pages_scanned, page_count, registered, structure, visible_code
+            - source: 'structure' / 'vote' / 'binding' / 'dots' 同 trace_pdf；
+              'nearest' 为装订线误码容错匹配，'visible' 为装订线明码，None 为未识别
+            - candidates: 候选特征码（位置点字符集合或容错查找的结果）
+            - buyers: 特征码对应的买家
+            - source_document: 有发行台账时最可能的母版（find_documents 的第一项，没找到为 None）
+            - cached: 是否命中溯源结果缓存
+            - trace_seconds: 解码耗时（命中缓存时为首次解码的耗时），seconds: 本次请求的总耗时
+        """
+        with self._ledger_in_use() as ledger:
+            return self._trace(ledger, data, dpi, max_pages)
+
+    def _trace(self, ledger, data, dpi=None, max_pages=None):
+        """trace 的实现（整个请求使用同一个发行台账，reload 不会在请求中途关闭它）"""
+        start = time.perf_counter()
+        dpi = dpi or self.dpi
+        max_pages = max_pages or self.max_pages
+        is_pdf = data[:5] == b'%PDF-'
+        sha256 = hashlib.sha256(data).hexdigest()
+        key = bulk_trace.TraceResultCache.key(sha256, dpi, max_pages)
+
+        with self._lock:
+            self.requests += 1
+            traced = self._results.get(key)
+            if traced is not None:
+                self._results.move_to_end(key)
+        cached = traced is not None
+
+        if traced is None:
+            traced = self._executor.submit(trace_payload, data, is_pdf, dpi, max_pages,
+                                           ledger is not None).result()
+            with self._lock:
+                self._results[key] = traced
+                while len(self._results) > RESULT_CACHE_SIZE:
+                    self._results.popitem(last=False)
+
+        source_document = None
+        if ledger is not None and traced['fingerprints']:
+            documents = ledger.find_documents(traced['fingerprints'])
+            source_document = documents[0] if documents else None
+
+        code, source = traced['code'], traced['source']
+        candidates = []
+        if source not in trace_engine.ORDERED_SOURCES:
+            candidates, nearest_code = self._candidates(ledger, traced)
+            if nearest_code:
+                code, source = nearest_code, 'nearest'
+            elif traced['visible_code']:
+                code, source = traced['visible_code'], 'visible'
+
+        buyers = []
+        if source in trace_engine.ORDERED_SOURCES + ('nearest', 'visible'):
+            buyers = self._buyers(ledger, code, source_document['document_sha256'] if source_document else None)
+
+        return {
+            'sha256': sha256,
+            'code': code,
+            'source': source,
+            'confidence': traced['confidence'],
+            'pages_scanned': traced['pages_scanned'],
+            'page_count': traced['page_count'],
+            'registered': traced['registered'],
+            'structure': traced['structure'],
+            'visible_code': traced['visible_code'],
+            'candidates': candidates,
+            'buyers': buyers,
+            'source_document': source_document,
+            'cached': cached,
+            'trace_seconds': traced['seconds'],
+            'seconds': round(time.perf_counter() - start, 3),
+        }
+
+    def close(self):
+        """关闭进程池和发行台账（包括 reload 换下、尚未关闭的旧台账）"""
+        self._executor.shutdown(cancel_futures=True)
+        with self._lock:
+            ledgers, self._retired = [self.ledger, *self._retired], set()
+        for ledger in ledgers:
+            if ledger is not None:
+                ledger.close()
+
+
+class TraceRequestHandler(BaseHTTPRequestHandler):
+    """HTTP 请求处理（服务对象为 self.server.service）"""
+
+    server_version = 'WatermarkTrace/1.0'
+
+    def log_message(self, format, *args):
+        """按服务器设置决定是否输出访问日志"""
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload):
+        """发送 JSON 响应"""
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _allowed(self):
+        """
+        只接受本机发起、且目标主机名为本机的请求（防止 DNS 重绑定）
+
+        浏览器中其他网站的页面也能向本机地址发请求：带有非本机 Origin 或
+        Sec-Fetch-Site: cross-site 的请求同样拒绝（curl 和脚本不发送这两个请求头）
+        """
+        host = urlsplit(f"//{self.headers.get('Host', '')}").hostname or ''
+        origin = self.headers.get('Origin')
+        same_origin = origin is None or is_loopback(urlsplit(origin).hostname or '')
+        cross_site = self.headers.get('Sec-Fetch-Site', '').lower() == 'cross-site'
+        if (is_loopback(self.client_address[0]) and is_loopback(host)
+                and same_origin and not cross_site):
+            return True
+        self._send_json(403, {'error': '只接受本机请求'})
+        return False
+
+    def do_GET(self):
+        """GET /health"""
+        if not self._allowed():
+            return
+        if urlsplit(self.path).path == '/health':
+            self._send_json(200, self.server.service.status())
+        else:
+            self._send_json(404, {'error': f'未知接口: {self.path}'})
+
+    def do_POST(self):
+        """POST /trace、/reload"""
+        if not self._allowed():
+            return
+        url = urlsplit(self.path)
+
+        if url.path == '/reload':
+            try:
+                self.server.service.reload()
+            except Exception as e:
+                self._send_json(500, {'error': str(e)})
+                return
+            self._send_json(200, self.server.service.status())
+            return
+
+        if url.path != '/trace':
+            self._send_json(404, {'error': f'未知接口: {self.path}'})
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0:
+            self._send_json(411, {'error': '请求体为空（请以 PDF 或图片的原始字节作为请求体）'})
+            return
+        if length > MAX_UPLOAD_MB * 1024 * 1024:
+            self._send_json(413, {'error': f'文件超过 {MAX_UPLOAD_MB} MB'})
+            return
+
+        try:
+            query = {name: int(values[-1]) for name, values in parse_qs(url.query).items()
+                     if name in ('dpi', 'max_pages')}
+        except ValueError:
+            self._send_json(400, {'error': 'dpi 和 max_pages 必须为整数'})
+            return
+
+        data = self.rfile.read(length)
+        try:
+            result = self.server.service.trace(data, query.get('dpi'), query.get('max_pages'))
+        except Exception as e:
+            self._send_json(400, {'error': f'溯源失败: {e}'})
+            return
+        self._send_json(200, result)
+
+
+def create_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT, verbose=False):
+    """
+    创建 HTTP 服务器（不启动）
+
+    参数:
+        service: TraceService 对象
+        host: 监听地址（必须是本机回环地址）
+        port: 端口（0 表示由系统分配，实际端口见 server.server_address）
+        verbose: 是否输出访问日志
+
+    返回:
+        ThreadingHTTPServer 对象
+    """
+    if not is_loopback(host):
+        raise ValueError(f"溯源服务只能监听本机回环地址，不能监听 {host}")
+
+    server = ThreadingHTTPServer((host, port), TraceRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def main():
+    """主函数"""
+    parser = argparse.ArgumentParser(description='本地溯源服务（HTTP 接口，只监听本机）')
+    parser.add_argument('-c', '--customers', help='买家名单文件（CSV/Excel，包含 name 和 phone 两列）')
+    parser.add_argument('-l', '--ledger', help='发行台账文件（issuance_ledger.db），按历史发行记录匹配买家')
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f'监听地址（默认 {DEFAULT_HOST}，只能是回环地址）')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, help=f'端口（默认 {DEFAULT_PORT}）')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='工作进程数（默认 CPU 核数）')
+    parser.add_argument('--dpi', type=int, default=200, help='PDF 渲染分辨率（默认 200）')
+    parser.add_argument('--max_pages', type=int, default=None, help='每个文件最多检查的页数')
+    parser.add_argument('-q', '--quiet', action='store_true', help='不输出访问日志')
+    args = parser.parse_args()
+
+    if not is_loopback(args.host):
+        print(f"❌ 溯源服务只能监听本机回环地址，不能监听 {args.host}")
+        sys.exit(1)
+    if args.ledger and not os.path.exists(args.ledger):
+        print(f"❌ 发行台账不存在: {args.ledger}")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    customer_list = load_customer_list(args.customers) if args.customers else None
+    ledger = IssuanceLedger(args.ledger) if args.ledger else None
+    service = TraceService(customer_list, ledger, args.workers, args.dpi, args.max_pages,
+                           customers_path=args.customers)
+    service.warm()
+    server = create_server(service, args.host, args.port, verbose=not args.quiet)
+
+    host, port = server.server_address[:2]
+    print(f"✅ 溯源服务已启动（{time.perf_counter() - start:.1f} 秒）：http://{host}:{port}")
+    print(f"   买家 {len(service.customer_list)} 位，工作进程 {service.workers} 个"
+          f"{'，发行台账 ' + args.ledger if args.ledger else ''}")
+    print(f"   curl --data-binary @suspect.pdf http://{host}:{port}/trace")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+        print("溯源服务已停止")
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()